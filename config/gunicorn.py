@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration: gunicorn -c config/gunicorn.py config.wsgi:application
+
+For the async read endpoints (investec/async_views.py) run the ASGI application
+under uvicorn workers instead:
+
+    GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker DB_CONN_MAX_AGE=0 \
+        gunicorn -c config/gunicorn.py config.asgi:application
+
+Production runs config/gunicorn_production.py, which adds a preloaded application.
+
+Sets up the Prometheus multiprocess directory so /metrics aggregates all workers
+(see investec/metrics.py). The directory is emptied when the master starts, and the
+samples of a worker that exits are marked dead so its live gauges are dropped.
+"""
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8001')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+
+# Must be set before the workers import prometheus_client
+os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'klikk_bi_etl_prometheus')
+)
+
+
+def on_starting(server):
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,38 @@
+"""
+Production Gunicorn configuration:
+
+    gunicorn -c config/gunicorn_production.py config.asgi:application
+
+The settings of config/gunicorn.py, plus the application preloaded in the master:
+Django, the URLconf and the parsing stack (pandas, numpy, openpyxl, warmed with
+investec.importers.warm_up) are imported once before the workers fork, so a worker
+that is started or restarted (timeout, crash, max_requests) serves its first request
+without paying the import cost, and the imported modules' memory is shared
+copy-on-write between the workers.
+
+With the application preloaded, SIGHUP restarts the workers but does not reload the
+code: restart the service after a deploy.
+"""
+import gc
+import os
+
+from config.gunicorn import *  # noqa: F401,F403
+
+preload_app = True
+
+# The preloaded application creates its Prometheus samples in the master, before
+# on_starting resets the directory (see config/gunicorn.py)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def when_ready(server):
+    # Runs in the master after the application is loaded, before the first fork
+    from django.db import connections
+    from investec.importers import warm_up
+
+    warm_up()
+    # A connection opened in the master would be shared by every forked worker
+    connections.close_all()
+    # Keep the preloaded objects out of the workers' garbage collections, which would
+    # otherwise write to (and un-share) the pages holding them
+    gc.freeze()
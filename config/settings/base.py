@@ -38,8 +38,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'investec.middleware.MetricsMiddleware',
+    'investec.middleware.QueryAttributionMiddleware',
+    'investec.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'investec.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -121,6 +124,116 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Investec ETL settings
+# Lot matching methods ('fifo', 'average') whose cost basis is refreshed on every transaction import
+INVESTEC_COST_BASIS_METHODS = config(
+    'INVESTEC_COST_BASIS_METHODS',
+    default='fifo',
+    cast=lambda v: [s.strip() for s in v.split(',') if s.strip()]
+)
+
+# Dividend TTM on transactions: 'stored' reads the dividend_ttm column written at import,
+# 'live' computes it at read time from the transactions (?ttm= overrides per request)
+INVESTEC_TTM_READ_MODE = config('INVESTEC_TTM_READ_MODE', default='stored')
+# Write dividend_ttm onto transactions at import (not needed when reads use 'live')
+INVESTEC_STORE_DIVIDEND_TTM = config('INVESTEC_STORE_DIVIDEND_TTM', default=True, cast=bool)
+
+# Import pipelines (investec/pipeline.py): rows per batch passed between stages and the load
+# stage: 'bulk_create', or 'copy' (PostgreSQL COPY FROM STDIN, bulk_create elsewhere)
+INVESTEC_PIPELINE_BATCH_ROWS = config('INVESTEC_PIPELINE_BATCH_ROWS', default=5000, cast=int)
+INVESTEC_PIPELINE_LOAD = config('INVESTEC_PIPELINE_LOAD', default='bulk_create')
+
+# Watch folder (manage.py watch_folder): statements dropped into INVESTEC_WATCH_DIR are
+# imported and moved to the archive or error folder (defaults: <watch dir>/archive, /error)
+INVESTEC_WATCH_DIR = config('INVESTEC_WATCH_DIR', default=str(BASE_DIR / 'incoming'))
+INVESTEC_WATCH_ARCHIVE_DIR = config('INVESTEC_WATCH_ARCHIVE_DIR', default='')
+INVESTEC_WATCH_ERROR_DIR = config('INVESTEC_WATCH_ERROR_DIR', default='')
+# Seconds between scans when inotify (watchdog) is not available
+INVESTEC_WATCH_POLL_SECONDS = config('INVESTEC_WATCH_POLL_SECONDS', default=2.0, cast=float)
+# A file is picked up once its size and mtime have not changed for this many seconds
+INVESTEC_WATCH_SETTLE_SECONDS = config('INVESTEC_WATCH_SETTLE_SECONDS', default=5.0, cast=float)
+
+# Upload admission control (investec/memory.py): uploads whose estimated import memory
+# exceeds the budget (MB, 0 disables) are rejected (413) or, with 'queue', copied to
+# INVESTEC_WATCH_DIR for the watch_folder process (202) instead of parsed in the web worker
+INVESTEC_UPLOAD_MEMORY_BUDGET_MB = config('INVESTEC_UPLOAD_MEMORY_BUDGET_MB', default=512, cast=float)
+INVESTEC_UPLOAD_OVER_BUDGET = config('INVESTEC_UPLOAD_OVER_BUDGET', default='reject')
+# watch_folder imports one file at a time; files whose estimated import memory exceeds this
+# budget (MB, 0 disables) are moved to the error folder. Keep it above the upload budget, or
+# queued uploads can never be imported
+INVESTEC_WATCH_MEMORY_BUDGET_MB = config('INVESTEC_WATCH_MEMORY_BUDGET_MB', default=2048, cast=float)
+# Upload responses report the peak resident memory, sampled at this interval (seconds);
+# INVESTEC_UPLOAD_TRACEMALLOC also reports traced Python allocations (slows imports down)
+INVESTEC_UPLOAD_MEMORY_SAMPLE_INTERVAL = config('INVESTEC_UPLOAD_MEMORY_SAMPLE_INTERVAL', default=0.01, cast=float)
+INVESTEC_UPLOAD_TRACEMALLOC = config('INVESTEC_UPLOAD_TRACEMALLOC', default=False, cast=bool)
+
+# Rows rejected by upload validation are kept as CSV reports (paged or downloaded through
+# /api/investec/upload-errors/<id>/); only the newest INVESTEC_UPLOAD_ERROR_KEEP are kept
+INVESTEC_UPLOAD_ERROR_DIR = config('INVESTEC_UPLOAD_ERROR_DIR', default=str(BASE_DIR / 'upload_errors'))
+INVESTEC_UPLOAD_ERROR_KEEP = config('INVESTEC_UPLOAD_ERROR_KEEP', default=200, cast=int)
+
+# Transaction export artifacts (investec/exports.py): /export/transactions/ serves files written
+# to INVESTEC_EXPORT_DIR once per data version, refreshed when imports commit ('background'
+# thread, 'sync', or 'off': only on request); the newest INVESTEC_EXPORT_KEEP artifacts of each
+# format and TTM mode are kept
+INVESTEC_EXPORT_DIR = config('INVESTEC_EXPORT_DIR', default=str(BASE_DIR / 'exports'))
+INVESTEC_EXPORT_KEEP = config('INVESTEC_EXPORT_KEEP', default=3, cast=int)
+INVESTEC_EXPORT_REFRESH = config('INVESTEC_EXPORT_REFRESH', default='background')
+
+# Slow-query log: queries slower than this (milliseconds, 0 disables) are logged and aggregated
+# per fingerprint in the InvestecSlowQuery table; this fraction of slow SELECTs is planned again
+# with EXPLAIN (estimated plan only, the query is not run twice)
+INVESTEC_SLOW_QUERY_MS = config('INVESTEC_SLOW_QUERY_MS', default=500, cast=float)
+INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE = config('INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE', default=0.1, cast=float)
+INVESTEC_SLOW_QUERY_LOG = config('INVESTEC_SLOW_QUERY_LOG', default=str(BASE_DIR / 'logs' / 'slow_queries.log'))
+
+# On-demand profiling: requests sent with the header X-Profile: <token> (or ?profile=<token>)
+# are profiled into INVESTEC_PROFILE_DIR; empty token disables. Only the slowest
+# INVESTEC_PROFILE_KEEP profiles are kept.
+INVESTEC_PROFILE_TOKEN = config('INVESTEC_PROFILE_TOKEN', default='')
+INVESTEC_PROFILE_DIR = config('INVESTEC_PROFILE_DIR', default=str(BASE_DIR / 'profiles'))
+INVESTEC_PROFILE_KEEP = config('INVESTEC_PROFILE_KEEP', default=20, cast=int)
+# Seconds between stack samples for the collapsed-stack (flamegraph) output
+INVESTEC_PROFILE_INTERVAL = config('INVESTEC_PROFILE_INTERVAL', default=0.005, cast=float)
+
+# /metrics: served to these client addresses or networks (REMOTE_ADDR, so the proxy's address
+# behind a reverse proxy) and to requests sending Authorization: Bearer <token>; empty token
+# disables the token
+INVESTEC_METRICS_ALLOWED_IPS = config(
+    'INVESTEC_METRICS_ALLOWED_IPS',
+    default='127.0.0.1,::1',
+    cast=lambda v: [s.strip() for s in v.split(',') if s.strip()]
+)
+INVESTEC_METRICS_TOKEN = config('INVESTEC_METRICS_TOKEN', default='')
+
+# Logging: investec.timings writes one JSON line per import stage (time, queries, rows/s),
+# investec.slow_queries one JSON line per slow query to a rotating file
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': INVESTEC_SLOW_QUERY_LOG,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,  # Opened on the first slow query (querylog.install creates the folder)
+        },
+    },
+    'loggers': {
+        'investec': {
+            'handlers': ['console'],
+            'level': config('INVESTEC_LOG_LEVEL', default='INFO'),
+        },
+        'investec.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 # CSRF settings - trusted origins for cross-origin requests
 # This is required when accessing the app from a different host/IP
 # If using a specific port, add it (e.g., http://192.168.1.236:8000)
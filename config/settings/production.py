@@ -19,7 +19,10 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default='StrongPasswordHere'),
         'HOST': config('DB_HOST', default='127.0.0.1'),
         'PORT': config('DB_PORT', default='5432'),
-        'CONN_MAX_AGE': 600,  # Reuse connections for 10 minutes (connection pooling)
+        # Reuse connections for 10 minutes (connection pooling). Set DB_CONN_MAX_AGE=0 under
+        # ASGI (uvicorn workers): each request runs its queries in its own thread there, so a
+        # persistent connection would be left open by every request
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=600, cast=int),
         'OPTIONS': {
             'connect_timeout': 10,
         }
@@ -19,7 +19,10 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default='StrongPasswordHere'),
         'HOST': config('DB_HOST', default='127.0.0.1'),
         'PORT': config('DB_PORT', default='5432'),
-        'CONN_MAX_AGE': 600,  # Reuse connections for 10 minutes (connection pooling)
+        # Reuse connections for 10 minutes (connection pooling). Set DB_CONN_MAX_AGE=0 under
+        # ASGI (uvicorn workers): each request runs its queries in its own thread there, so a
+        # persistent connection would be left open by every request
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=600, cast=int),
         'OPTIONS': {
             'connect_timeout': 10,
         }
@@ -40,7 +43,7 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 # Use WhiteNoise to serve static files when DEBUG=False
 # Install with: pip install whitenoise
-# Add 'whitenoise.middleware.WhiteNoiseMiddleware' to MIDDLEWARE (already in base.py)
+# Served by investec.middleware.StaticFilesMiddleware (WhiteNoise, also under ASGI; already in base.py)
 # WhiteNoise should be added after SecurityMiddleware and before other middleware
 # For now, we'll serve static files via URL patterns (see urls.py)
 
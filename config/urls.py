@@ -4,9 +4,12 @@ URL configuration for config project.
 from django.contrib import admin
 from django.urls import path, include
 
+from investec.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('rest_framework.urls')),
     path('api/investec/', include('investec.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
@@ -1,12 +1,14 @@
 from django.contrib import admin
-from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareNameMapping, InvestecJseShareMonthlyPerformance
+from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareNameMapping, InvestecJseShareMonthlyPerformance, InvestecJsePositionCheckpoint, InvestecJseRealizedGain, InvestecJseOpenLot, InvestecSlowQuery
+from .share_codes import clear_share_codes, resolve_share_codes
 
 
 @admin.register(InvestecJseTransaction)
 class InvestecJseTransactionAdmin(admin.ModelAdmin):
-    list_display = ['date', 'year', 'month', 'day', 'account_number', 'share_name', 'type', 'quantity', 'value', 'value_per_share', 'value_calculated', 'created_at']
+    list_display = ['date', 'year', 'month', 'day', 'account_number', 'share_name', 'share_code', 'type', 'quantity', 'value', 'value_per_share', 'value_calculated', 'created_at']
     list_filter = ['date', 'year', 'month', 'type', 'account_number']
-    search_fields = ['account_number', 'share_name', 'description']
+    search_fields = ['account_number', 'share_name', 'share_code', 'description']
+    readonly_fields = ['share_code']
     date_hierarchy = 'date'
 
 
@@ -26,6 +28,22 @@ class InvestecJseShareNameMappingAdmin(admin.ModelAdmin):
     search_fields = ['share_name', 'company', 'share_code']
     readonly_fields = ['created_at', 'updated_at']
 
+    # Keep the share_code denormalized onto transactions in step with the mapping
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'share_name' in form.changed_data:
+            clear_share_codes([form.initial['share_name']])
+        resolve_share_codes([obj.share_name])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        clear_share_codes([obj.share_name])
+
+    def delete_queryset(self, request, queryset):
+        share_names = list(queryset.values_list('share_name', flat=True))
+        super().delete_queryset(request, queryset)
+        clear_share_codes(share_names)
+
 
 @admin.register(InvestecJseShareMonthlyPerformance)
 class InvestecJseShareMonthlyPerformanceAdmin(admin.ModelAdmin):
@@ -34,3 +52,49 @@ class InvestecJseShareMonthlyPerformanceAdmin(admin.ModelAdmin):
     search_fields = ['share_name']
     date_hierarchy = 'date'
     readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(InvestecJsePositionCheckpoint)
+class InvestecJsePositionCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['date', 'year', 'month', 'account_number', 'share_name', 'quantity', 'updated_at']
+    list_filter = ['year', 'month', 'account_number']
+    search_fields = ['account_number', 'share_name']
+    date_hierarchy = 'date'
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(InvestecJseRealizedGain)
+class InvestecJseRealizedGainAdmin(admin.ModelAdmin):
+    list_display = ['date', 'account_number', 'share_name', 'method', 'quantity', 'sell_price', 'proceeds', 'cost_basis', 'realized_gain', 'unmatched_quantity']
+    list_filter = ['method', 'year', 'month', 'account_number']
+    search_fields = ['account_number', 'share_name']
+    date_hierarchy = 'date'
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(InvestecJseOpenLot)
+class InvestecJseOpenLotAdmin(admin.ModelAdmin):
+    list_display = ['date', 'account_number', 'share_name', 'method', 'quantity', 'unit_cost', 'cost_basis']
+    list_filter = ['method', 'account_number']
+    search_fields = ['account_number', 'share_name']
+    date_hierarchy = 'date'
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(InvestecSlowQuery)
+class InvestecSlowQueryAdmin(admin.ModelAdmin):
+    list_display = ['short_sql', 'source', 'stage', 'calls', 'total_seconds', 'mean_seconds', 'max_seconds', 'has_plan', 'last_seen']
+    list_filter = ['source', 'stage']
+    search_fields = ['sql', 'source', 'stage', 'fingerprint']
+    readonly_fields = [field.name for field in InvestecSlowQuery._meta.fields]
+    
+    @admin.display(description='SQL')
+    def short_sql(self, obj):
+        return obj.sql[:120]
+    
+    @admin.display(boolean=True, description='Plan')
+    def has_plan(self, obj):
+        return bool(obj.explain_plan)
+    
+    def has_add_permission(self, request):
+        return False
@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class InvestecConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'investec'
+
+    def ready(self):
+        from django.conf import settings
+
+        from .instrumentation import install_request_query_counter
+        install_request_query_counter()
+
+        if settings.INVESTEC_SLOW_QUERY_MS > 0:
+            from .querylog import install
+            install()
@@ -0,0 +1,322 @@
+"""
+Async versions of the read endpoints, under /api/investec/async/.
+
+They take the same query parameters and return the same payloads as the DRF views
+in views.py (the querysets are built by the same helpers), but are plain async
+Django views using the async ORM. Served under uvicorn workers (config/asgi.py,
+GUNICORN_WORKER_CLASS in config/gunicorn.py) a worker keeps answering while these
+wait on the database, instead of one request per sync worker.
+
+The transaction and performance lists are streamed: rows are read in chunks of
+STREAM_CHUNK_SIZE (a server-side cursor on PostgreSQL) and written as they are
+serialized, so memory does not grow with the page size. The performance list's
+latest mode (one row per series) is not: its count comes before the results.
+"""
+import json
+from datetime import datetime
+from functools import wraps
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db.models import Max
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+
+from .ledger import holdings_as_of
+from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareMonthlyPerformance
+from .serializers import HOLDINGS_SNAPSHOT_FIELDS, HOLDINGS_SERIES_FIELDS, PERFORMANCE_FIELDS, TRANSACTION_FIELDS, serialize_columns, serialize_values
+from .ttm import live_dividend_ttm
+from .views import (
+    HOLDINGS_TOTALS_FIELDS, _after_cursor, _encode_cursor, _holdings_series_rows, _holdings_totals_rows,
+    _latest_performance, _parse_date_range, _performance_queryset, _series_by_share, _transaction_page,
+    _transaction_queryset, _ttm_read_mode,
+)
+
+
+STREAM_CHUNK_SIZE = 500
+
+
+def _get_only(view):
+    """require_GET for async views (Django 4.2's method decorators only wrap sync views)."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET'])
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+# Same compact, non-ASCII-escaped output as DRF's JSONRenderer
+JSON_DUMPS_PARAMS = {'separators': (',', ':'), 'ensure_ascii': False}
+
+
+def _json_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params=JSON_DUMPS_PARAMS)
+
+
+def _error(message, status_code=400):
+    return _json_response({'error': message}, status=status_code)
+
+
+def _dumps(value):
+    return json.dumps(value, **JSON_DUMPS_PARAMS)
+
+
+class RowStream:
+    """
+    Serialized rows of a values_list() queryset, read STREAM_CHUNK_SIZE at a time.
+    
+    Stops after `limit` rows (has_more is set if another row exists) and keeps the
+    row count and the last raw row for the part of the payload written after them.
+    """
+
+    def __init__(self, queryset, model, fields, limit=None):
+        self.queryset = queryset
+        self.model = model
+        self.fields = fields
+        self.limit = limit
+        self.count = 0
+        self.last = None
+        self.has_more = False
+
+    async def chunks(self):
+        # Django 4.2's QuerySet.aiterator() runs values_list() queries on the event loop
+        # thread (SynchronousOnlyOperation), so step the sync iterator in the request's
+        # sync thread instead, one chunk per call
+        rows = self.queryset.iterator(chunk_size=STREAM_CHUNK_SIZE)
+        next_chunk = sync_to_async(lambda: list(islice(rows, STREAM_CHUNK_SIZE)))
+        try:
+            while True:
+                chunk = await next_chunk()
+                if self.limit is not None and self.count + len(chunk) > self.limit:
+                    chunk = chunk[:self.limit - self.count]
+                    self.has_more = True
+                if chunk:
+                    self.count += len(chunk)
+                    self.last = chunk[-1]
+                    yield serialize_values(self.model, chunk, self.fields)
+                if self.has_more or len(chunk) < STREAM_CHUNK_SIZE:
+                    return
+        finally:
+            await sync_to_async(rows.close)()
+
+
+async def _stream_object(head, key, stream, tail=None):
+    """
+    Yield a JSON object: the entries of head, then `key` with the rows of stream as
+    they are read, then the entries returned by tail() once all rows are written.
+    """
+    opening = _dumps(head)[:-1]
+    yield f'{opening}{"," if head else ""}"{key}":['
+    first = True
+    async for rows in stream.chunks():
+        body = ','.join(_dumps(row) for row in rows)
+        yield body if first else f',{body}'
+        first = False
+    closing = _dumps(tail()) if tail else '{}'
+    yield f']{"," if closing != "{}" else ""}{closing[1:]}'
+
+
+def _streaming_json(content):
+    return StreamingHttpResponse(content, content_type='application/json')
+
+
+# ------------------------------------------------
+# Transactions
+# ------------------------------------------------
+
+@_get_only
+async def transaction_list_view(request):
+    """Async transaction_list_view: same parameters and payload, results streamed."""
+    try:
+        ttm_mode = _ttm_read_mode(request.GET)
+        limit, offset = _transaction_page(request.GET)
+    except ValueError as e:
+        return _error(str(e))
+    
+    queryset = _transaction_queryset(request.GET)
+    total_count = await queryset.acount()
+    
+    columns = list(TRANSACTION_FIELDS)
+    if ttm_mode == 'live':
+        queryset = queryset.annotate(live_dividend_ttm=live_dividend_ttm())
+        columns[columns.index('dividend_ttm')] = 'live_dividend_ttm'
+    rows = queryset.values_list(*columns)[offset:offset + limit]
+    
+    head = {'count': total_count, 'limit': limit, 'offset': offset, 'ttm': ttm_mode}
+    return _streaming_json(_stream_object(head, 'results', RowStream(rows, InvestecJseTransaction, TRANSACTION_FIELDS)))
+
+
+@_get_only
+async def export_companies_view(request):
+    """Async export_companies_view."""
+    companies = InvestecJsePortfolio.objects.values('company', 'share_code').distinct().order_by('company')
+    companies_list = [
+        {
+            'company': item['company'],
+            'share_code': item['share_code']
+        }
+        async for item in companies
+    ]
+    
+    return _json_response({
+        'count': len(companies_list),
+        'companies': companies_list
+    })
+
+
+@_get_only
+async def export_share_names_view(request):
+    """Async export_share_names_view."""
+    share_names = InvestecJseTransaction.objects.exclude(
+        share_name=''
+    ).exclude(
+        share_name__isnull=True
+    ).values_list('share_name', flat=True).distinct().order_by('share_name')
+    
+    share_names_list = [share_name async for share_name in share_names]
+    
+    return _json_response({
+        'count': len(share_names_list),
+        'share_names': share_names_list
+    })
+
+
+# ------------------------------------------------
+# Share Performance
+# ------------------------------------------------
+
+@_get_only
+async def share_performance_list_view(request):
+    """Async share_performance_list_view: same parameters, cursor and payload, results streamed."""
+    try:
+        queryset, limit = _performance_queryset(request.GET)
+        cursor = request.GET.get('cursor', None)
+        if cursor:
+            queryset = _after_cursor(queryset, cursor)
+    except ValueError as e:
+        return _error(str(e))
+    
+    if request.GET.get('latest', 'false').lower() == 'true':
+        # One row per series, not streamed: the count leads the payload, as in the sync view
+        rows = [row async for row in _latest_performance(queryset).values_list(*PERFORMANCE_FIELDS)]
+        return _json_response({
+            'count': len(rows),
+            'latest': True,
+            'results': serialize_values(InvestecJseShareMonthlyPerformance, rows, PERFORMANCE_FIELDS),
+        })
+    
+    stream = RowStream(
+        queryset.order_by('-date', '-id').values_list(*PERFORMANCE_FIELDS),
+        InvestecJseShareMonthlyPerformance,
+        PERFORMANCE_FIELDS,
+        limit=limit,
+    )
+    
+    def next_cursor():
+        if not (stream.has_more and stream.last):
+            return {'next_cursor': None}
+        last = stream.last
+        return {'next_cursor': _encode_cursor(last[PERFORMANCE_FIELDS.index('date')], last[PERFORMANCE_FIELDS.index('id')])}
+    
+    return _streaming_json(_stream_object({'limit': limit}, 'results', stream, next_cursor))
+
+
+# ------------------------------------------------
+# Portfolio Holdings
+# ------------------------------------------------
+
+@_get_only
+async def holdings_snapshot_view(request):
+    """Async holdings_snapshot_view."""
+    requested = request.GET.get('date', None)
+    dates = InvestecJsePortfolio.objects.all()
+    if requested:
+        requested_date = parse_date(requested)
+        if requested_date is None:
+            return _error(f'Invalid date: {requested}. Expected YYYY-MM-DD.')
+        dates = dates.filter(date__lte=requested_date)
+    snapshot_date = (await dates.aaggregate(latest=Max('date')))['latest']
+    
+    if snapshot_date is None:
+        return _error('No portfolio snapshot found.', status_code=404)
+    
+    rows = InvestecJsePortfolio.objects.filter(date=snapshot_date).order_by('share_code').values_list(*HOLDINGS_SNAPSHOT_FIELDS)
+    data = serialize_columns(InvestecJsePortfolio, [row async for row in rows], HOLDINGS_SNAPSHOT_FIELDS)
+    
+    return _json_response({
+        'date': str(snapshot_date),
+        'count': len(data['share_code']),
+        'fields': HOLDINGS_SNAPSHOT_FIELDS,
+        'data': data,
+    })
+
+
+@_get_only
+async def holdings_series_view(request):
+    """Async holdings_series_view."""
+    try:
+        from_date, to_date = _parse_date_range(request.GET)
+    except ValueError as e:
+        return _error(str(e))
+    
+    rows = _holdings_series_rows(request.GET, from_date, to_date)
+    series = _series_by_share([row async for row in rows])
+    
+    return _json_response({
+        'from_date': str(from_date) if from_date else None,
+        'to_date': str(to_date) if to_date else None,
+        'count': len(series),
+        'fields': HOLDINGS_SERIES_FIELDS,
+        'series': series,
+    })
+
+
+@_get_only
+async def holdings_totals_view(request):
+    """Async holdings_totals_view."""
+    try:
+        from_date, to_date = _parse_date_range(request.GET)
+    except ValueError as e:
+        return _error(str(e))
+    
+    rows = [row async for row in _holdings_totals_rows(from_date, to_date)]
+    data = serialize_columns(InvestecJsePortfolio, rows, HOLDINGS_TOTALS_FIELDS)
+    
+    return _json_response({
+        'count': len(data['date']),
+        'fields': HOLDINGS_TOTALS_FIELDS,
+        'data': data,
+    })
+
+
+# ------------------------------------------------
+# Position Ledger
+# ------------------------------------------------
+
+@_get_only
+async def positions_view(request):
+    """Async positions_view (the ledger walk itself runs in the request's sync thread)."""
+    requested = request.GET.get('date', None)
+    if requested:
+        as_of_date = parse_date(requested)
+        if as_of_date is None:
+            return _error(f'Invalid date: {requested}. Expected YYYY-MM-DD.')
+    else:
+        as_of_date = datetime.now().date()
+    
+    account_number = request.GET.get('account_number', None)
+    positions = await sync_to_async(holdings_as_of)(as_of_date, account_number=account_number)
+    
+    return _json_response({
+        'date': str(as_of_date),
+        'count': len(positions),
+        'results': [
+            {
+                'account_number': position['account_number'],
+                'share_name': position['share_name'],
+                'quantity': format(position['quantity'], 'f'),
+            }
+            for position in positions
+        ],
+    })
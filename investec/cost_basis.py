@@ -0,0 +1,321 @@
+"""
+Lot matching engine: cost basis and realized P&L from Buy/Sell transactions.
+
+Each (account_number, share_name) trade stream is matched independently, either
+FIFO or average cost, using value_per_share (parsed from "at 1,192 Cents") as the
+trade price. Results replace the stream's rows in InvestecJseRealizedGain (one per
+Sell) and InvestecJseOpenLot (remaining lots).
+
+FIFO is vectorized: with no short positions, FIFO pairs the k-th share bought with
+the k-th share sold, so matching is an intersection of the cumulative Buy and Sell
+quantity intervals (np.searchsorted over the merged breakpoints). Streams where a
+Sell exceeds the position held (incomplete history) use the sequential matcher.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+
+from .models import InvestecJseOpenLot, InvestecJseRealizedGain, InvestecJseTransaction
+
+
+METHODS = ('fifo', 'average')
+
+# Streams smaller than this are matched in-process even when workers are requested;
+# pickling them to a worker costs more than matching them.
+PARALLEL_MIN_TRADES = 50000
+
+# Tolerance for float quantity comparisons (quantities have 4 decimal places)
+EPSILON = 1e-9
+
+
+def _trade_order(dates, is_buy, ids):
+    """Chronological order; within a day Buys are applied before Sells, then by id."""
+    return np.lexsort((ids, ~is_buy, dates))
+
+
+def _fifo_vectorized(buy_qty, buy_price, sell_qty):
+    """
+    Match Sells against Buys FIFO without a Python loop.
+
+    Returns (cost per sell, matched quantity per sell, remaining quantity per buy).
+    Assumes cumulative Sells never exceed cumulative earlier Buys.
+    """
+    buy_end = np.cumsum(buy_qty)
+    sell_end = np.cumsum(sell_qty)
+    matched_total = min(buy_end[-1] if len(buy_end) else 0.0, sell_end[-1] if len(sell_end) else 0.0)
+
+    cost = np.zeros(len(sell_qty))
+    matched = np.zeros(len(sell_qty))
+    if matched_total > EPSILON:
+        # Every breakpoint of either cumulative series starts a segment owned by exactly one buy and one sell
+        points = np.union1d(np.concatenate(([0.0], buy_end)), sell_end)
+        points = np.append(points[points < matched_total], matched_total)
+        starts, ends = points[:-1], points[1:]
+        segment_qty = ends - starts
+        buy_idx = np.searchsorted(buy_end, starts, side='right')
+        sell_idx = np.searchsorted(sell_end, starts, side='right')
+        cost = np.bincount(sell_idx, weights=segment_qty * buy_price[buy_idx], minlength=len(sell_qty))
+        matched = np.bincount(sell_idx, weights=segment_qty, minlength=len(sell_qty))
+
+    remaining = np.clip(buy_end - matched_total, 0.0, buy_qty)
+    return cost, matched, remaining
+
+
+def _fifo_sequential(is_buy, qty, price):
+    """Reference FIFO matcher that tolerates Sells exceeding the position (unmatched quantity)."""
+    lots = []  # [trade_index, remaining_qty, price]
+    head = 0
+    cost = {}
+    matched = {}
+    for i in range(len(qty)):
+        if is_buy[i]:
+            lots.append([i, qty[i], price[i]])
+            continue
+        to_match = qty[i]
+        sell_cost = 0.0
+        while to_match > EPSILON and head < len(lots):
+            take = min(to_match, lots[head][1])
+            sell_cost += take * lots[head][2]
+            lots[head][1] -= take
+            to_match -= take
+            if lots[head][1] <= EPSILON:
+                head += 1
+        cost[i] = sell_cost
+        matched[i] = qty[i] - max(to_match, 0.0)
+    remaining = {lot[0]: lot[1] for lot in lots[head:] if lot[1] > EPSILON}
+    return cost, matched, remaining
+
+
+def match_fifo(is_buy, qty, price):
+    """
+    FIFO-match one chronologically ordered trade stream.
+
+    Returns (cost, matched, remaining) as dicts keyed by trade position:
+    cost/matched per Sell, remaining quantity per open Buy.
+    """
+    position = np.cumsum(np.where(is_buy, qty, -qty))
+    if len(position) and position.min() < -EPSILON:
+        return _fifo_sequential(is_buy, qty, price)
+
+    buy_pos = np.flatnonzero(is_buy)
+    sell_pos = np.flatnonzero(~is_buy)
+    cost, matched, remaining = _fifo_vectorized(qty[buy_pos], price[buy_pos], qty[sell_pos])
+    open_mask = remaining > EPSILON
+    return (
+        dict(zip(sell_pos.tolist(), cost.tolist())),
+        dict(zip(sell_pos.tolist(), matched.tolist())),
+        dict(zip(buy_pos[open_mask].tolist(), remaining[open_mask].tolist())),
+    )
+
+
+def match_average(is_buy, qty, price):
+    """
+    Average-cost-match one chronologically ordered trade stream.
+
+    Returns (cost, matched, remaining) like match_fifo; remaining holds a single
+    entry for the last Buy with the pooled quantity, and the pooled unit cost is
+    returned as a fourth element.
+    """
+    position = 0.0
+    pool_cost = 0.0
+    last_buy = None
+    cost = {}
+    matched = {}
+    for i in range(len(qty)):
+        if is_buy[i]:
+            position += qty[i]
+            pool_cost += qty[i] * price[i]
+            last_buy = i
+            continue
+        take = min(qty[i], position)
+        average = pool_cost / position if position > EPSILON else 0.0
+        cost[i] = take * average
+        matched[i] = take
+        pool_cost -= take * average
+        position -= take
+    remaining = {last_buy: position} if last_buy is not None and position > EPSILON else {}
+    unit_cost = pool_cost / position if position > EPSILON else 0.0
+    return cost, matched, remaining, unit_cost
+
+
+def match_stream(stream, method='fifo'):
+    """
+    Match one trade stream. stream is a dict of equal-length numpy arrays:
+    ids, dates (datetime64[D]), is_buy (bool), qty (absolute), price.
+
+    Returns a dict of numpy arrays describing sells (sell_*) and open lots (lot_*);
+    arrays keep the result cheap to send back from a worker process.
+    """
+    order = _trade_order(stream['dates'], stream['is_buy'], stream['ids'])
+    ids = stream['ids'][order]
+    dates = stream['dates'][order]
+    is_buy = stream['is_buy'][order]
+    qty = stream['qty'][order]
+    price = stream['price'][order]
+
+    if method == 'average':
+        cost, matched, remaining, unit_cost = match_average(is_buy, qty, price)
+        lot_unit_cost = {i: unit_cost for i in remaining}
+    else:
+        cost, matched, remaining = match_fifo(is_buy, qty, price)
+        lot_unit_cost = {i: price[i] for i in remaining}
+
+    sell_pos = np.array(sorted(cost), dtype=np.int64)
+    lot_pos = np.array(sorted(remaining), dtype=np.int64)
+    return {
+        'sell_ids': ids[sell_pos],
+        'sell_dates': dates[sell_pos],
+        'sell_qty': qty[sell_pos],
+        'sell_price': price[sell_pos],
+        'sell_cost': np.array([cost[i] for i in sell_pos.tolist()], dtype=float),
+        'sell_matched': np.array([matched[i] for i in sell_pos.tolist()], dtype=float),
+        'lot_ids': ids[lot_pos],
+        'lot_dates': dates[lot_pos],
+        'lot_qty': np.array([remaining[i] for i in lot_pos.tolist()], dtype=float),
+        'lot_unit_cost': np.array([lot_unit_cost[i] for i in lot_pos.tolist()], dtype=float),
+    }
+
+
+def _match_stream_job(args):
+    key, stream, method = args
+    return key, match_stream(stream, method)
+
+
+def _keys_filter(keys):
+    """Q matching exactly the given (account_number, share_name) keys, one IN list per account."""
+    shares_by_account = {}
+    for account_number, share_name in keys:
+        shares_by_account.setdefault(account_number, set()).add(share_name)
+    condition = Q(pk__in=[])
+    for account_number, share_names in shares_by_account.items():
+        condition |= Q(account_number=account_number, share_name__in=share_names)
+    return condition
+
+
+def load_streams(keys=None):
+    """
+    Load Buy/Sell transactions with a trade price into per (account_number, share_name) streams.
+
+    keys: optional set of (account_number, share_name) to restrict the load.
+    Returns ({key: stream}, skipped) where skipped counts trades without value_per_share.
+    """
+    queryset = InvestecJseTransaction.objects.filter(type__in=['Buy', 'Sell'])
+    if keys is not None:
+        queryset = queryset.filter(_keys_filter(keys))
+    rows = queryset.order_by('account_number', 'share_name').values_list(
+        'id', 'account_number', 'share_name', 'date', 'type', 'quantity', 'value_per_share'
+    )
+
+    skipped = 0
+    grouped = {}
+    for row in rows:
+        if row[6] is None:
+            skipped += 1
+            continue
+        grouped.setdefault((row[1], row[2]), []).append(row)
+
+    streams = {}
+    for key, key_rows in grouped.items():
+        ids, _, _, dates, types, quantities, prices = zip(*key_rows)
+        streams[key] = {
+            'ids': np.array(ids, dtype=np.int64),
+            'dates': np.array(dates, dtype='datetime64[D]'),
+            'is_buy': np.array(types) == 'Buy',
+            'qty': np.abs(np.array(quantities, dtype=float)),
+            'price': np.array(prices, dtype=float),
+        }
+    return streams, skipped
+
+
+def match_streams(streams, method='fifo', workers=None):
+    """
+    Match every stream, in parallel worker processes when workers > 1.
+    Returns {key: match_stream result}.
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown cost basis method: {method}. Expected one of {", ".join(METHODS)}.')
+
+    total_trades = sum(len(stream['ids']) for stream in streams.values())
+    jobs = [(key, stream, method) for key, stream in streams.items()]
+    if not workers or workers <= 1 or total_trades < PARALLEL_MIN_TRADES or len(jobs) < 2:
+        return dict(map(_match_stream_job, jobs))
+
+    # Largest streams first so one long stream does not end up last on a busy worker
+    jobs.sort(key=lambda job: len(job[1]['ids']), reverse=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(_match_stream_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+
+def _money(value, places='0.01'):
+    return Decimal(str(value)).quantize(Decimal(places))
+
+
+def rebuild_cost_basis(keys=None, method='fifo', workers=None):
+    """
+    Recompute realized gains and open lots.
+
+    keys: optional iterable of (account_number, share_name); only those streams are
+    recomputed (a stream is always recomputed from its first trade). None rebuilds all.
+    Returns a dict with counts of streams, sells and open lots written.
+    """
+    if keys is not None:
+        keys = set(keys)
+    streams, skipped = load_streams(keys)
+    results = match_streams(streams, method=method, workers=workers)
+
+    gains = []
+    lots = []
+    for (account_number, share_name), result in results.items():
+        for sell_id, sell_date, quantity, sell_price, cost, matched in zip(
+            result['sell_ids'].tolist(), result['sell_dates'].tolist(), result['sell_qty'].tolist(),
+            result['sell_price'].tolist(), result['sell_cost'].tolist(), result['sell_matched'].tolist(),
+        ):
+            gains.append(InvestecJseRealizedGain(
+                account_number=account_number,
+                share_name=share_name,
+                method=method,
+                date=sell_date,
+                year=sell_date.year,
+                month=sell_date.month,
+                sell_transaction_id=sell_id,
+                quantity=_money(quantity, '0.0001'),
+                sell_price=_money(sell_price),
+                proceeds=_money(quantity * sell_price),
+                cost_basis=_money(cost),
+                realized_gain=_money(matched * sell_price - cost),
+                unmatched_quantity=_money(quantity - matched, '0.0001'),
+            ))
+        for buy_id, buy_date, quantity, unit_cost in zip(
+            result['lot_ids'].tolist(), result['lot_dates'].tolist(),
+            result['lot_qty'].tolist(), result['lot_unit_cost'].tolist(),
+        ):
+            lots.append(InvestecJseOpenLot(
+                account_number=account_number,
+                share_name=share_name,
+                method=method,
+                date=buy_date,
+                buy_transaction_id=buy_id,
+                quantity=_money(quantity, '0.0001'),
+                unit_cost=_money(unit_cost, '0.0001'),
+                cost_basis=_money(quantity * unit_cost),
+            ))
+
+    with transaction.atomic():
+        for model in (InvestecJseRealizedGain, InvestecJseOpenLot):
+            stale = model.objects.filter(method=method)
+            if keys is not None:
+                stale = stale.filter(_keys_filter(keys))
+            stale.delete()
+        InvestecJseRealizedGain.objects.bulk_create(gains, batch_size=5000)
+        InvestecJseOpenLot.objects.bulk_create(lots, batch_size=5000)
+
+    return {
+        'method': method,
+        'streams': len(results),
+        'realized_gains': len(gains),
+        'open_lots': len(lots),
+        'skipped_without_price': skipped,
+    }
@@ -0,0 +1,401 @@
+"""
+Transaction export artifacts: the /export/transactions/ file written once per data
+version instead of on every request.
+
+An artifact is a file in INVESTEC_EXPORT_DIR (transactions-<ttm>-<time>-<id>.xlsx or
+.csv) with a JSON sidecar describing it: format, TTM mode of the Dividend TTM column,
+row count, date of the last row and the data version it was written from. The data
+version is the import generation - a counter in INVESTEC_EXPORT_DIR that the importers
+and rebuild_derived bump, since their bulk updates (dividend_ttm, resolved share codes)
+do not touch updated_at - plus the transactions' count, max id and max updated_at
+(admin edits and deletes), read with one aggregate query.
+
+- export_artifact() returns the newest artifact of a format and TTM mode. A current
+  artifact is served as is (a cache hit); a stale one is served too, with a refresh
+  started in the background, unless the caller asks for a fresh one; without an
+  artifact one is written right away.
+- refresh_exports() is called when an import commits: it bumps the generation and
+  brings every variant that has an artifact (and the default one) up to date, in a
+  background thread (INVESTEC_EXPORT_REFRESH). A 'stored' CSV artifact whose only
+  change since is this import adding rows dated after its last row is copied and
+  appended to instead of written again; workbooks are always written whole, xlsx
+  cannot be appended to without rewriting it.
+- Only the newest INVESTEC_EXPORT_KEEP artifacts of each variant are kept.
+
+CSV artifacts list the transactions oldest first, so new statements append at the
+end; workbooks keep the newest-first order of the transaction list.
+"""
+import csv
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .metrics import record_cache_lookup
+from .models import InvestecJseTransaction
+
+
+logger = logging.getLogger('investec.exports')
+
+FORMATS = ['xlsx', 'csv']
+DEFAULT_FORMAT = 'xlsx'
+TTM_MODES = ['stored', 'live']
+
+# Column header and the transaction value it is read from
+EXPORT_COLUMNS = [
+    ('Date', 'date'),
+    ('Year', 'year'),
+    ('Month', 'month'),
+    ('Day', 'day'),
+    ('Account Number', 'account_number'),
+    ('Description', 'description'),
+    ('Share Name', 'share_name'),
+    ('Share Code', 'share_code'),
+    ('Type', 'type'),
+    ('Quantity', 'quantity'),
+    ('Value', 'value'),
+    ('Value Per Share', 'value_per_share'),
+    ('Value Calculated', 'value_calculated'),
+    ('Dividend TTM', 'dividend_ttm'),
+    ('Created At', 'created_at'),
+    ('Updated At', 'updated_at'),
+]
+_NUMBER_FIELDS = {'quantity', 'value', 'value_per_share', 'value_calculated', 'dividend_ttm'}
+_TIME_FIELDS = {'created_at', 'updated_at'}
+
+_GENERATION_FILE = '.generation'
+
+# One background refresh at a time per process; refreshes requested while one is
+# queued are folded into it (the queued refresh reads the data when it starts)
+_executor = None
+_lock = threading.Lock()
+_queued = None  # (generation, append) of the queued refresh
+
+
+def _directory():
+    directory = settings.INVESTEC_EXPORT_DIR
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+# ------------------------------------------------
+# Data version
+# ------------------------------------------------
+
+def _generation_path():
+    return os.path.join(_directory(), _GENERATION_FILE)
+
+
+def current_generation():
+    try:
+        with open(_generation_path()) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_generation():
+    """Increment the import generation (under a file lock, workers share it) and return it."""
+    with open(_generation_path(), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            generation = int(f.read().strip() or 0) + 1
+        except ValueError:
+            generation = 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(generation))
+    return generation
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def data_version():
+    stats = InvestecJseTransaction.objects.aggregate(count=Count('id'), max_id=Max('id'), max_updated=Max('updated_at'))
+    return {
+        'generation': current_generation(),
+        'count': stats['count'],
+        'max_id': stats['max_id'],
+        'max_updated_at': _isoformat(stats['max_updated']),
+    }
+
+
+# ------------------------------------------------
+# Artifacts
+# ------------------------------------------------
+
+def _prefix(ttm_mode):
+    return f'transactions-{ttm_mode}-'
+
+
+def list_artifacts(file_format, ttm_mode):
+    """Metadata of the stored artifacts of a variant, oldest first."""
+    directory = _directory()
+    prefix = _prefix(ttm_mode)
+    artifacts = []
+    # Artifact ids start with their creation time, so they sort oldest first
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(prefix) and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get('format') == file_format and os.path.exists(meta_path(meta)):
+            artifacts.append(meta)
+    return artifacts
+
+
+def latest_artifact(file_format, ttm_mode):
+    artifacts = list_artifacts(file_format, ttm_mode)
+    return artifacts[-1] if artifacts else None
+
+
+def meta_path(meta):
+    return os.path.join(_directory(), meta['filename'])
+
+
+def _rows(ttm_mode, order):
+    queryset = InvestecJseTransaction.objects.order_by(*order)
+    fields = [field for _, field in EXPORT_COLUMNS]
+    if ttm_mode == 'live':
+        from .ttm import live_dividend_ttm
+        queryset = queryset.annotate(live_dividend_ttm=live_dividend_ttm())
+        fields[fields.index('dividend_ttm')] = 'live_dividend_ttm'
+    return queryset.values_list(*fields)
+
+
+def _export_row(values):
+    """A transaction's export values: numbers as floats (None when zero or empty), times without time zone."""
+    row = []
+    for (_, field), value in zip(EXPORT_COLUMNS, values):
+        if field in _NUMBER_FIELDS:
+            value = float(value) if value else None
+        elif field in _TIME_FIELDS:
+            # Excel does not take time zone aware datetimes
+            value = value.replace(tzinfo=None) if value else None
+        row.append(value)
+    return row
+
+
+def _write_csv_rows(f, rows):
+    writer = csv.writer(f)
+    last = None
+    count = 0
+    for values in rows.iterator(chunk_size=2000):
+        writer.writerow(['' if value is None else value for value in _export_row(values)])
+        last = values
+        count += 1
+    return count, last
+
+
+def _new_meta(file_format, ttm_mode, version):
+    artifact_id = f'{timezone.now():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+    return {
+        'id': artifact_id,
+        'filename': f'{_prefix(ttm_mode)}{artifact_id}.{file_format}',
+        'format': file_format,
+        'ttm': ttm_mode,
+        'version': version,
+        'generated_at': timezone.now().isoformat(),
+    }
+
+
+def _tmp_path(meta):
+    # Keeps the extension (pandas picks the Excel writer by it)
+    return os.path.join(_directory(), f'.tmp-{meta["filename"]}')
+
+
+def _save(meta, tmp_path):
+    """Move a written artifact into place, then its sidecar (readers only see complete artifacts)."""
+    path = meta_path(meta)
+    os.replace(tmp_path, path)
+    sidecar = f'{os.path.splitext(path)[0]}.json'
+    with open(f'{sidecar}.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{sidecar}.tmp', sidecar)
+    evict_artifacts(meta['format'], meta['ttm'], settings.INVESTEC_EXPORT_KEEP)
+    return meta
+
+
+def write_artifact(file_format, ttm_mode):
+    """Write a whole artifact from the current transactions. Returns its metadata."""
+    version = data_version()
+    meta = _new_meta(file_format, ttm_mode, version)
+    tmp_path = _tmp_path(meta)
+    if file_format == 'csv':
+        with open(tmp_path, 'w', newline='') as f:
+            csv.writer(f).writerow([header for header, _ in EXPORT_COLUMNS])
+            rows = _rows(ttm_mode, ['date', 'created_at', 'id'])
+            count, last = _write_csv_rows(f, rows.filter(id__lte=version['max_id']) if version['max_id'] is not None else rows)
+        meta['last_date'] = _isoformat(last[0]) if last else None
+    else:
+        import pandas as pd
+        data = [_export_row(values) for values in _rows(ttm_mode, ['-date', '-created_at']).iterator(chunk_size=2000)]
+        df = pd.DataFrame(data, columns=[header for header, _ in EXPORT_COLUMNS])
+        df.to_excel(tmp_path, index=False, engine='openpyxl')
+        count = len(data)
+    meta['count'] = count
+    logger.info(json.dumps({'export': meta['filename'], 'rows': count, 'appended': False}))
+    return _save(meta, tmp_path)
+
+
+def appendable(meta):
+    """Whether the only change since meta's CSV artifact is rows dated after its last row (nothing deleted or edited)."""
+    max_id = meta['version']['max_id']
+    if max_id is None:
+        return False
+    old = InvestecJseTransaction.objects.filter(id__lte=max_id).aggregate(count=Count('id'), max_updated=Max('updated_at'))
+    if old['count'] != meta['count'] or _isoformat(old['max_updated']) != meta['version']['max_updated_at']:
+        return False
+    first_date = InvestecJseTransaction.objects.filter(id__gt=max_id).aggregate(first_date=Min('date'))['first_date']
+    return first_date is None or first_date.isoformat() > meta['last_date']
+
+
+def append_artifact(meta):
+    """Copy a CSV artifact and append the rows added since. Returns the new artifact's metadata."""
+    version = data_version()
+    appended = _new_meta(meta['format'], meta['ttm'], version)
+    tmp_path = _tmp_path(appended)
+    shutil.copyfile(meta_path(meta), tmp_path)
+    # Rows past version's max id were added after it was read; the next refresh appends them
+    new_rows = _rows(meta['ttm'], ['date', 'created_at', 'id']).filter(id__gt=meta['version']['max_id'], id__lte=version['max_id'])
+    with open(tmp_path, 'a', newline='') as f:
+        count, last = _write_csv_rows(f, new_rows)
+    appended.update(
+        count=meta['count'] + count,
+        last_date=_isoformat(last[0]) if last else meta['last_date'],
+        appended_to=meta['id'],
+    )
+    logger.info(json.dumps({'export': appended['filename'], 'rows': count, 'appended': True}))
+    return _save(appended, tmp_path)
+
+
+def evict_artifacts(file_format, ttm_mode, keep):
+    artifacts = list_artifacts(file_format, ttm_mode)
+    for meta in artifacts[:max(len(artifacts) - keep, 0)]:
+        path = meta_path(meta)
+        for stale in (path, f'{os.path.splitext(path)[0]}.json'):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def is_current(meta, version=None):
+    return meta['version'] == (version or data_version())
+
+
+def export_artifact(file_format, ttm_mode, fresh=False):
+    """
+    The artifact to serve for a format and TTM mode: (metadata, current). A stale
+    artifact is returned with current=False and a background refresh started, unless
+    fresh=True, which writes a current one first.
+    """
+    meta = latest_artifact(file_format, ttm_mode)
+    current = meta is not None and is_current(meta)
+    record_cache_lookup('export_artifact', current)
+    if current:
+        return meta, True
+    if meta is not None and not fresh:
+        _schedule(None, False)
+        return meta, False
+    return write_artifact(file_format, ttm_mode), True
+
+
+# ------------------------------------------------
+# Refresh after imports
+# ------------------------------------------------
+
+def _variants():
+    """(format, TTM mode) of the default export and of every variant with an artifact."""
+    variants = {(DEFAULT_FORMAT, settings.INVESTEC_TTM_READ_MODE)}
+    for name in os.listdir(_directory()):
+        parts = name.split('-')
+        extension = os.path.splitext(name)[1].lstrip('.')
+        if len(parts) == 4 and parts[0] == 'transactions' and parts[1] in TTM_MODES and extension in FORMATS:
+            variants.add((extension, parts[1]))
+    return sorted(variants)
+
+
+def refresh(generation=None, append=False):
+    """
+    Bring every variant up to the current data version. With append=True, a 'stored'
+    CSV artifact one generation behind generation (this import is the only change
+    since) is appended to when its rows are unchanged.
+    """
+    version = data_version()
+    written = []
+    for file_format, ttm_mode in _variants():
+        meta = latest_artifact(file_format, ttm_mode)
+        if meta is not None and is_current(meta, version):
+            continue
+        if (append and meta is not None and file_format == 'csv' and ttm_mode == 'stored'
+                and generation is not None and meta['version']['generation'] == generation - 1
+                and appendable(meta)):
+            written.append(append_artifact(meta))
+        else:
+            written.append(write_artifact(file_format, ttm_mode))
+    return written
+
+
+def _run_queued():
+    global _queued
+    with _lock:
+        (generation, append), _queued = _queued, None
+    try:
+        refresh(generation, append)
+    except Exception:
+        logger.exception('Export refresh failed')
+    finally:
+        # This thread's database connections
+        connections.close_all()
+
+
+def _schedule(generation, append):
+    global _executor, _queued
+    with _lock:
+        if _queued is not None:
+            # The queued refresh has not started yet and will see these changes too; it
+            # only appends when this is the single change since the artifact
+            _queued = (generation, False)
+            return
+        _queued = (generation, append)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='investec-exports')
+        _executor.submit(_run_queued)
+
+
+def refresh_exports(append=False):
+    """
+    Record that the transactions changed and refresh the export artifacts once the
+    current database transaction commits: in a background thread, in this thread
+    ('sync') or not at all ('off': the artifacts are only written when requested),
+    per INVESTEC_EXPORT_REFRESH. append=True when the change only added rows (no
+    deletes, no updates of stored rows).
+    """
+    mode = settings.INVESTEC_EXPORT_REFRESH
+
+    def on_commit():
+        generation = bump_generation()
+        if mode == 'off':
+            return
+        if mode == 'sync':
+            refresh(generation, append)
+        else:
+            _schedule(generation, append)
+
+    transaction.on_commit(on_commit)
@@ -0,0 +1,1400 @@
+"""
+Statement file importers shared by the upload endpoints and the ingest command.
+
+Each file type is a pipeline (see pipeline.py): an Excel extract stage, normalize
+and validate stages mapping the rows onto the model's fields, load stages writing
+them and derive stages bringing derived data up to date. Each file type is used in
+two ways:
+- process_*_file runs an upload through the whole pipeline (parse, then load);
+- parse_*_file runs the extract, normalize and validate stages without touching
+  the database, so files can be parsed in worker processes, and import_* writes a
+  parse result later, replacing the date range (transactions) or month (portfolio)
+  it covers.
+
+Parse results are dicts with 'success' and 'filename'; failures carry an 'error'
+message and the HTTP 'status_code' the upload endpoint answers with. Successful
+parses carry the rows to load as a DataFrame of model fields in 'frame' and the
+rejected rows as an error frame in 'errors' (see validation.py); import results
+report its size, the first errors and the id of the stored error report. Pass a
+StageTimer as timer= to record per-stage timings.
+"""
+import os
+import re
+import traceback
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+
+import pandas as pd
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+from .cost_basis import rebuild_cost_basis
+from .exports import refresh_exports
+from .instrumentation import StageTimer
+from .ledger import refresh_positions
+from .metrics import TTM_RECOMPUTE_SECONDS, record_rows_ingested
+from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareNameMapping
+from .pipeline import DERIVE, LOAD, NORMALIZE, VALIDATE, Context, ExcelExtract, Pipeline, PipelineError, Stage, load_stage
+from .serializers import InvestecJsePortfolioSerializer
+from .share_codes import resolve_share_codes, share_codes_for
+from .ttm import DIVIDEND_TYPES, calculate_dividend_ttm
+from .validation import decimal_limit, empty_errors, is_blank, parse_numbers, summarize_errors, validate_columns
+
+
+FILE_TRANSACTIONS = 'transactions'
+FILE_PORTFOLIO = 'portfolio'
+FILE_MAPPING = 'mapping'
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+
+
+def _file_error(filename, error, status_code=400, **extra):
+    return {'success': False, 'filename': filename, 'error': error, 'status_code': status_code, **extra}
+
+
+def _exception_error(filename, e, **extra):
+    """500 payload for an unexpected exception; call from inside the except block."""
+    payload = _file_error(
+        filename,
+        f'Error processing file: {str(e)}',
+        status_code=500,
+        exception_type=type(e).__name__,
+        **extra,
+        pandas_version=getattr(pd, '__version__', None),
+    )
+    if getattr(settings, 'DEBUG', False):
+        payload['traceback'] = traceback.format_exc()
+    return payload
+
+
+def _parse(pipeline, uploaded_file, timer):
+    """Run pipeline.parse, answering failures with an error payload."""
+    try:
+        return pipeline.parse(uploaded_file, timer)
+    except PipelineError as e:
+        return _file_error(uploaded_file.name, e.message, e.status_code, **e.extra)
+    except Exception as e:
+        return _exception_error(uploaded_file.name, e)
+
+
+def _run(pipeline, uploaded_file, timer):
+    """Run pipeline.run. Returns (context, None), or (None, error payload) when the file fails."""
+    try:
+        return pipeline.run(uploaded_file, timer), None
+    except PipelineError as e:
+        return None, _file_error(uploaded_file.name, e.message, e.status_code, **e.extra)
+    except Exception as e:
+        return None, _exception_error(uploaded_file.name, e)
+
+
+def _normalize_columns(columns):
+    return columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_')
+
+
+def classify_workbook(df_raw):
+    """
+    Detect the file type of a workbook read with header=None, using the same header
+    detection as the parsers: a "Portfolio Holdings Report" title (portfolio), a row
+    naming both 'date' and 'account' (transactions) or a Share_Name column in the
+    first row (mapping). Returns FILE_PORTFOLIO, FILE_TRANSACTIONS, FILE_MAPPING or None.
+    """
+    rows = [
+        ' '.join([str(val).lower() for val in row.values if pd.notna(val)])
+        for _, row in df_raw.iterrows()
+    ]
+    if any('portfolio holdings report' in row_str for row_str in rows):
+        return FILE_PORTFOLIO
+    if any('date' in row_str and 'account' in row_str for row_str in rows):
+        return FILE_TRANSACTIONS
+    if rows:
+        first_row = _normalize_columns(pd.Index([str(val) for val in df_raw.iloc[0].values if pd.notna(val)]))
+        if any('share_name' in col or 'sharename' in col for col in first_row):
+            return FILE_MAPPING
+    return None
+
+
+# ------------------------------------------------
+# Transactions
+# ------------------------------------------------
+
+# Map common column name variations to model fields
+TRANSACTION_COLUMNS = {
+    'date': ['date', 'transaction_date', 'trade_date'],
+    'account_number': ['account_number', 'account', 'account_no', 'accountnum'],
+    'description': ['description', 'desc', 'details'],
+    'share_name': ['share_name', 'sharename', 'stock_name', 'stock', 'instrument', 'security', 'share_name'],
+    'type': ['type', 'action', 'transaction_type', 'transaction', 'side'],
+    'quantity': ['quantity', 'qty', 'shares', 'units'],
+    'value': ['value', 'amount', 'price', 'total', 'transaction_value'],
+}
+
+# Type can be extracted from the description
+TRANSACTION_REQUIRED = ['date', 'account_number', 'description', 'share_name', 'quantity', 'value']
+
+
+def _statement_dates(df_raw, filename):
+    """
+    The statement date range: from the filename (...-YYYYMMDD-YYYYMMDD...) or from the
+    "From date" / "To date" rows of the workbook. Returns (from_date, to_date), either
+    of which may be None.
+    """
+    # Extract date range from filename (format: TransactionHistory-All-YYYYMMDD-YYYYMMDD.xlsx)
+    from_date = None
+    to_date = None
+    
+    # Try to extract dates from filename pattern: ...-YYYYMMDD-YYYYMMDD...
+    date_pattern = re.search(r'(\d{8})-(\d{8})', filename)
+    if date_pattern:
+        try:
+            from_date_str = date_pattern.group(1)
+            to_date_str = date_pattern.group(2)
+            from_date = pd.to_datetime(from_date_str, format='%Y%m%d').date()
+            to_date = pd.to_datetime(to_date_str, format='%Y%m%d').date()
+        except:
+            pass
+    
+    # If not found in filename, try to find dates in the Excel file itself
+    if from_date is None or to_date is None:
+        # Look for "From" and "To" date patterns in the raw data
+        for idx, row in df_raw.iterrows():
+            row_str = ' '.join([str(val) for val in row.values if pd.notna(val)])
+            row_lower = row_str.lower()
+            
+            # Look for "from date" or "to date" patterns
+            if 'from' in row_lower and 'date' in row_lower:
+                # Try to extract date from this row
+                for cell_val in row.values:
+                    if pd.notna(cell_val):
+                        cell_str = str(cell_val).strip()
+                        # Try various date formats
+                        for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
+                            try:
+                                parsed_date = pd.to_datetime(cell_str, format=date_format).date()
+                                if from_date is None:
+                                    from_date = parsed_date
+                                elif to_date is None and parsed_date > from_date:
+                                    to_date = parsed_date
+                                break
+                            except:
+                                try:
+                                    parsed_date = pd.to_datetime(cell_str).date()
+                                    if from_date is None:
+                                        from_date = parsed_date
+                                    elif to_date is None and parsed_date > from_date:
+                                        to_date = parsed_date
+                                    break
+                                except:
+                                    continue
+            
+            if 'to' in row_lower and 'date' in row_lower:
+                # Try to extract date from this row
+                for cell_val in row.values:
+                    if pd.notna(cell_val):
+                        cell_str = str(cell_val).strip()
+                        # Try various date formats
+                        for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
+                            try:
+                                parsed_date = pd.to_datetime(cell_str, format=date_format).date()
+                                if to_date is None or parsed_date > to_date:
+                                    to_date = parsed_date
+                                break
+                            except:
+                                try:
+                                    parsed_date = pd.to_datetime(cell_str).date()
+                                    if to_date is None or parsed_date > to_date:
+                                        to_date = parsed_date
+                                    break
+                                except:
+                                    continue
+            
+            # Stop searching after finding both dates or after checking first 20 rows
+            if from_date and to_date or idx > 20:
+                break
+    
+    return from_date, to_date
+
+
+def _locate_transactions(df_raw, filename, context):
+    """ExcelExtract locate: the header row (containing 'Date' and 'Account Number') and the statement dates."""
+    header_row = None
+    for idx, row in df_raw.iterrows():
+        row_str = ' '.join([str(val).lower() for val in row.values if pd.notna(val)])
+        if 'date' in row_str and 'account' in row_str:
+            header_row = idx
+            break
+    
+    context.values['from_date'], context.values['to_date'] = _statement_dates(df_raw, filename)
+    return header_row
+
+
+def _transaction_fields(description_val, account_number_val, share_name_val, type_val, has_type, quantity):
+    """
+    The text fields of one statement row, worked out from its description where the
+    statement leaves them out: returns (account_number, description, share_name, type,
+    quantity, value_per_share, value_calculated). A zero quantity is taken from the
+    description of dividend rows.
+    """
+    # Get description early to check for dividend patterns
+    description = str(description_val)[:255] if not pd.isna(description_val) else ''
+    
+    # For dividends, quantity might be in description
+    # Patterns: "DIV. 327 NINETY 1L" -> quantity is 327
+    #          "FOREIGN DIV. 3061 BATS" -> quantity is 3061
+    #          "DIV. TAX ON 74 NINETY 1L" -> quantity is 74
+    #          "SPEC.DIV. 1229 OUTSURE" -> quantity is 1229
+    if quantity == 0 and description:
+        description_upper = description.upper()
+        if 'FOREIGN DIV' in description_upper:
+            # Extract quantity from pattern like "FOREIGN DIV. 3061 BATS"
+            foreign_div_match = re.search(r'FOREIGN\s+DIV\.?\s*(\d+)', description, re.IGNORECASE)
+            if foreign_div_match:
+                try:
+                    quantity = Decimal(foreign_div_match.group(1))
+                except (InvalidOperation, ValueError):
+                    pass  # Keep original quantity if extraction fails
+        elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
+            # Extract quantity from pattern like "SPEC.DIV. 1229 OUTSURE"
+            spec_div_match = re.search(r'SPEC(?:IAL)?\.?\s*DIV(?:IDEND)?\.?\s*(\d+)', description, re.IGNORECASE)
+            if spec_div_match:
+                try:
+                    quantity = Decimal(spec_div_match.group(1))
+                except (InvalidOperation, ValueError):
+                    pass  # Keep original quantity if extraction fails
+        elif 'DIV. TAX' in description_upper or 'DIVIDEND TAX' in description_upper:
+            # Extract quantity from pattern like "DIV. TAX ON 74 NINETY 1L"
+            div_tax_match = re.search(r'DIV\.?\s*TAX\s+ON\s+(\d+)', description, re.IGNORECASE)
+            if div_tax_match:
+                try:
+                    quantity = Decimal(div_tax_match.group(1))
+                except (InvalidOperation, ValueError):
+                    pass  # Keep original quantity if extraction fails
+        elif description_upper.startswith('DIV'):
+            # Extract quantity from pattern like "DIV. 327 NINETY 1L"
+            div_match = re.search(r'DIV\.?\s*(\d+)', description, re.IGNORECASE)
+            if div_match:
+                try:
+                    quantity = Decimal(div_match.group(1))
+                except (InvalidOperation, ValueError):
+                    pass  # Keep original quantity if extraction fails
+    
+    # Get other fields
+    # Account number - handle both string and numeric values
+    if pd.isna(account_number_val):
+        account_number = ''
+    else:
+        # Convert to string, handling numeric values
+        account_number = str(int(account_number_val)) if isinstance(account_number_val, (int, float)) else str(account_number_val)
+        account_number = account_number[:50]
+    
+    # Share name - try to extract from description if missing
+    if pd.isna(share_name_val) or str(share_name_val).strip() == '':
+        # Try to extract share name from description
+        if description:
+            description_upper = description.upper()
+            # For foreign dividends: "FOREIGN DIV. 3061 BATS" -> extract "BATS"
+            #                      "FOREIGN DIV. 123 A V I" -> extract "A V I" and convert to "AVI"
+            if 'FOREIGN DIV' in description_upper:
+                # Try to match spaced letters first (e.g., "A V I" -> "AVI")
+                foreign_spaced_match = re.search(r'FOREIGN\s+DIV\.?\s*\d+\s+((?:[A-Z]\s+)+[A-Z])', description, re.IGNORECASE)
+                if foreign_spaced_match:
+                    # Remove spaces from spaced letters (e.g., "A V I" -> "AVI")
+                    spaced_name = foreign_spaced_match.group(1)
+                    share_name = spaced_name.replace(' ', '').upper()[:100]
+                else:
+                    # Try regular word pattern
+                    foreign_div_share_match = re.search(r'FOREIGN\s+DIV\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
+                    if foreign_div_share_match:
+                        share_name = foreign_div_share_match.group(1).upper()[:100]
+                    else:
+                        # Fallback: look for uppercase words after the number
+                        words = description.split()
+                        found_number = False
+                        for word in words:
+                            if word.isdigit():
+                                found_number = True
+                            elif found_number and word.isupper() and len(word) > 2:
+                                share_name = word[:100]
+                                break
+                        else:
+                            share_name = ''
+            # For special dividends: "SPEC.DIV. 1229 OUTSURE" -> extract "OUTSURE"
+            elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
+                # Extract share name from pattern like "SPEC.DIV. 1229 OUTSURE"
+                spec_div_share_match = re.search(r'SPEC(?:IAL)?\.?\s*DIV(?:IDEND)?\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
+                if spec_div_share_match:
+                    share_name = spec_div_share_match.group(1).upper()[:100]
+                else:
+                    # Fallback: look for uppercase words after the number
+                    words = description.split()
+                    found_number = False
+                    for word in words:
+                        if word.isdigit():
+                            found_number = True
+                        elif found_number and word.isupper() and len(word) > 2:
+                            share_name = word[:100]
+                            break
+                    else:
+                        share_name = ''
+            # For regular dividends: "DIV. 327 NINETY 1L" -> extract "NINETY"
+            #                    "DIV. 446 A V I" -> extract "A V I" and convert to "AVI"
+            #                    "DIV. TAX ON 74 NINETY 1L" -> extract "NINETY"
+            elif description_upper.startswith('DIV'):
+                # Handle "DIV. TAX ON" pattern: "DIV. TAX ON 74 NINETY 1L" -> "NINETY"
+                div_tax_match = re.search(r'DIV\.?\s*TAX\s+ON\s+\d+\s+(\w+)', description, re.IGNORECASE)
+                if div_tax_match:
+                    share_name = div_tax_match.group(1).upper()[:100]
+                else:
+                    # Try to match spaced letters first (e.g., "A V I" -> "AVI")
+                    spaced_letters_match = re.search(r'DIV\.?\s*\d+\s+((?:[A-Z]\s+)+[A-Z])', description, re.IGNORECASE)
+                    if spaced_letters_match:
+                        # Remove spaces from spaced letters (e.g., "A V I" -> "AVI")
+                        spaced_name = spaced_letters_match.group(1)
+                        share_name = spaced_name.replace(' ', '').upper()[:100]
+                    else:
+                        # Try regular word pattern (e.g., "DIV. 327 NINETY 1L" -> "NINETY")
+                        div_share_match = re.search(r'DIV\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
+                        if div_share_match:
+                            share_name = div_share_match.group(1).upper()[:100]
+                        else:
+                            # Fallback: look for uppercase words
+                            words = description.split()
+                            for word in words:
+                                if word.isupper() and len(word) > 2 and word not in ['DIV', 'DIVIDEND', 'FOREIGN', 'TAX', 'ON']:
+                                    share_name = word[:100]
+                                    break
+                            else:
+                                share_name = ''
+            else:
+                # For other transactions: "Buy 179 NEDBANK" -> "NEDBANK"
+                words = description.split()
+                for word in reversed(words):  # Check from end, as share name is usually at the end
+                    if word.isupper() and len(word) > 2:
+                        share_name = word[:100]
+                        break
+                else:
+                    share_name = ''  # Couldn't extract, use empty
+        else:
+            share_name = ''
+    else:
+        share_name = str(share_name_val)[:100]
+    
+    # Extract type from description if not a separate column
+    if has_type:
+        transaction_type = str(type_val)[:50] if not pd.isna(type_val) else ''
+    else:
+        # Try to extract type from description (e.g., "Buy 179 NEDBANK" -> "Buy")
+        transaction_type = ''
+        if description:
+            description_upper = description.upper()
+            # Account-related transactions (no share code)
+            if 'FEE' in description_upper or 'QUARTERLY ADMIN FEE' in description_upper:
+                transaction_type = 'Fee'
+            elif 'BROKER' in description_upper:
+                transaction_type = 'Broker Fee'
+            elif 'VAT' in description_upper:
+                transaction_type = 'VAT'
+            elif 'CAP.REDUC' in description_upper or 'CAPITAL REDUCTION' in description_upper:
+                transaction_type = 'Capital Reduction'
+            elif 'INTER A/C TRF' in description_upper or 'INTER ACCOUNT TRANSFER' in description_upper:
+                transaction_type = 'Inter Account Transfer'
+            elif 'TRF' in description_upper and ('TO' in description_upper or 'FROM' in description_upper):
+                # Handle "TRF FROM TRADING TO INCOME", "TRF INCOME TO TRADING", and similar transfer patterns
+                transaction_type = 'Transfer'
+            elif 'TRANSFER FROM' in description_upper or 'TRANSFER TO' in description_upper:
+                # Handle "TRANSFER FROM" and "TRANSFER TO" patterns
+                transaction_type = 'Transfer'
+            elif 'INVESTEC BANK' in description_upper or 'BANK TRANSFER' in description_upper:
+                transaction_type = 'Bank Transfer'
+            elif 'INTEREST' in description_upper:
+                transaction_type = 'Interest'
+            # Check for account number pattern: "10011910139 - MC DIPPENAAR" -> Transfer
+            elif re.match(r'^\d+\s*-\s*[A-Z\s]+$', description, re.IGNORECASE):
+                transaction_type = 'Transfer'
+            # Share-related transactions
+            elif 'FOREIGN DIV' in description_upper:
+                transaction_type = 'Foreign Dividend'
+            elif 'DIV. TAX' in description_upper or 'DIVIDEND TAX' in description_upper:
+                transaction_type = 'Dividend Tax'
+            elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
+                transaction_type = 'Special Dividend'
+            elif description_upper.startswith('BUY'):
+                transaction_type = 'Buy'
+            elif description_upper.startswith('SELL'):
+                transaction_type = 'Sell'
+            elif 'DIV' in description_upper or 'DIVIDEND' in description_upper:
+                transaction_type = 'Dividend'
+            else:
+                # Default: take first word as type
+                transaction_type = description.split()[0][:50] if description.split() else ''
+    
+    # Check if this is an account-related transaction (no share code)
+    # These include: FEE, BROKER, VAT, CAP.REDUC, INTEREST, Bank Transfer, QUARTERLY ADMIN FEE, Transfers
+    is_account_transaction = False
+    if description:
+        desc_upper = description.upper()
+        account_keywords = ['FEE', 'BROKER', 'VAT', 'CAP.REDUC', 'CAPITAL REDUCTION', 
+                           'BANK TRANSFER', 'TRANSFER', 'QUARTERLY ADMIN FEE', 
+                           'INTER A/C TRF', 'INTER ACCOUNT TRANSFER', 'INVESTEC BANK',
+                           'TRF FROM', 'TRF TO', 'TRANSFER FROM', 'TRANSFER TO']
+        is_account_transaction = any(keyword in desc_upper for keyword in account_keywords)
+        
+        # Check for "TRF [something] TO [something]" pattern (e.g., "TRF INCOME TO TRADING")
+        if 'TRF' in desc_upper and 'TO' in desc_upper:
+            is_account_transaction = True
+        # Check for "TRF [something] FROM [something]" pattern
+        if 'TRF' in desc_upper and 'FROM' in desc_upper:
+            is_account_transaction = True
+        
+        # Check for account number pattern: "10011910139 - MC DIPPENAAR"
+        if re.match(r'^\d+\s*-\s*[A-Z\s]+$', description, re.IGNORECASE):
+            is_account_transaction = True
+    
+    # Ensure account-related types always have blank share_name
+    account_types = ['VAT', 'Fee', 'Interest', 'Broker Fee', 'Capital Reduction', 
+                       'Bank Transfer', 'Inter Account Transfer', 'Transfer']
+    if transaction_type in account_types:
+        share_name = ''  # Force blank share_name for account-related types
+        is_account_transaction = True
+    
+    # Special case: Transfer patterns should have no share name
+    # Patterns: "TRF FROM TRADING TO INCOME", "TRF INCOME TO TRADING", "TRF TRADING TO INCOME", etc.
+    if description:
+        desc_upper_transfer = description.upper()
+        if ('TRF' in desc_upper_transfer and ('TO' in desc_upper_transfer or 'FROM' in desc_upper_transfer)):
+            share_name = ''
+            is_account_transaction = True
+    
+    # For account-related transactions, allow empty share_name
+    # For share transactions, use empty string if share_name is missing (model allows blank)
+    if not share_name and not is_account_transaction:
+        share_name = ''  # Empty string for share transactions without share name (model allows blank)
+    # If it's an account transaction, share_name remains empty
+    
+    # Extract value per share from description for Buy/Sell transactions
+    value_per_share = None
+    value_calculated = None
+    if transaction_type in ['Buy', 'Sell'] and description:
+        # Pattern: "at 1,192 Cents" or "at 5000 Cents"
+        price_match = re.search(r'at\s+([\d,]+)\s+Cents', description, re.IGNORECASE)
+        if price_match:
+            price_str = price_match.group(1).replace(',', '')
+            try:
+                # Convert from cents to rands (divide by 100)
+                price_cents = Decimal(price_str)
+                value_per_share = price_cents / Decimal('100')
+                
+                # Calculate value_calculated = value_per_share * quantity
+                value_calculated = value_per_share * quantity
+                
+                # Make negative for Buy transactions
+                if transaction_type == 'Buy':
+                    value_calculated = value_calculated * Decimal('-1')
+            except (InvalidOperation, ValueError):
+                pass
+    return account_number, description, share_name, transaction_type, quantity, value_per_share, value_calculated
+
+
+class TransactionColumns(Stage):
+    """Map the statement's columns onto the transaction fields (the file's column names are kept in 'source_columns')."""
+    kind = NORMALIZE
+    name = 'normalize'
+    
+    def process(self, batch, context):
+        # Normalize column names (remove spaces, convert to lowercase)
+        batch.columns = _normalize_columns(batch.columns)
+        
+        # Find actual column names in the dataframe
+        actual_columns = {}
+        for model_field, possible_names in TRANSACTION_COLUMNS.items():
+            for possible_name in possible_names:
+                if possible_name in batch.columns:
+                    actual_columns[model_field] = possible_name
+                    break
+        
+        missing_fields = [field for field in TRANSACTION_REQUIRED if field not in actual_columns]
+        if missing_fields:
+            raise PipelineError(
+                f'Missing required columns: {", ".join(missing_fields)}',
+                available_columns=list(batch.columns),
+                suggestion='Please ensure your Excel file contains columns matching: date, account_number, description, share_name, quantity, value',
+            )
+        
+        context.values['source_columns'] = actual_columns
+        return pd.DataFrame({field: batch[column] for field, column in actual_columns.items()}, index=batch.index)
+
+
+class TransactionValidate(Stage):
+    """
+    Check date, quantity, value and account number for all rows at once and keep the
+    valid rows, with date as dates and quantity and value as Decimals. Rows without a
+    date are not data (repeated headers, totals) and are skipped, not reported.
+    """
+    kind = VALIDATE
+    name = 'validate'
+    
+    def process(self, batch, context):
+        labels = context.values['source_columns']
+        parsed_columns, valid, errors = validate_columns(batch, [
+            {'column': 'date', 'label': labels['date'], 'kind': 'date'},
+            {'column': 'quantity', 'label': labels['quantity'], 'kind': 'number', 'limit': decimal_limit(InvestecJseTransaction, 'quantity')},
+            {'column': 'value', 'label': labels['value'], 'kind': 'number', 'limit': decimal_limit(InvestecJseTransaction, 'value')},
+            {'column': 'account_number', 'label': labels['account_number'], 'kind': 'text'},
+        ], skip=is_blank(batch['date']), first_row=context.values['first_row'])
+        context.errors.append(errors)
+        
+        batch = batch[valid].copy()
+        batch['date'] = [timestamp.date() for timestamp in parsed_columns['date'][valid]]
+        batch['quantity'] = [Decimal(str(number)) for number in parsed_columns['quantity'][valid]]
+        batch['value'] = [Decimal(str(number)) for number in parsed_columns['value'][valid]]
+        return batch
+
+
+class TransactionFields(Stage):
+    """Work out share name, type, dividend quantity and Buy/Sell price from each row's description."""
+    kind = NORMALIZE
+    name = 'classify'
+    
+    def process(self, batch, context):
+        has_type = 'type' in batch.columns
+        rows = zip(
+            batch['description'].tolist(),
+            batch['account_number'].tolist(),
+            batch['share_name'].tolist(),
+            batch['type'].tolist() if has_type else [None] * len(batch),
+            batch['quantity'].tolist(),
+        )
+        fields = [
+            _transaction_fields(description, account_number, share_name, type_val, has_type, quantity)
+            for description, account_number, share_name, type_val, quantity in rows
+        ]
+        dates = batch['date'].tolist()
+        columns = ['account_number', 'description', 'share_name', 'type', 'quantity', 'value_per_share', 'value_calculated']
+        frame = pd.DataFrame(fields or None, columns=columns, index=batch.index, dtype=object)
+        frame.insert(0, 'date', dates)
+        frame.insert(1, 'year', [parsed_date.year for parsed_date in dates])
+        frame.insert(2, 'month', [parsed_date.month for parsed_date in dates])
+        frame.insert(3, 'day', [parsed_date.day for parsed_date in dates])
+        frame.insert(9, 'value', batch['value'])
+        return frame
+
+
+class DeleteRange(Stage):
+    """
+    Before the first batch is written, clear the stored transactions in the statement's
+    date range, remembering which Buy/Sell streams lose rows (their cost basis is
+    recomputed) and which accounts lose dividends (their TTM series is recomputed).
+    """
+    kind = LOAD
+    name = 'delete_range'
+    
+    def start(self, context):
+        from_date = context.values['from_date']
+        to_date = context.values['to_date']
+        cost_basis_keys = set()
+        ttm_accounts = set()
+        if from_date and to_date:
+            cost_basis_keys.update(InvestecJseTransaction.objects.filter(
+                date__gte=from_date,
+                date__lte=to_date,
+                type__in=['Buy', 'Sell'],
+            ).values_list('account_number', 'share_name').distinct())
+            ttm_accounts.update(InvestecJseTransaction.objects.filter(
+                date__gte=from_date,
+                date__lte=to_date,
+                type__in=DIVIDEND_TYPES,
+            ).values_list('account_number', flat=True).distinct())
+            deleted_count = InvestecJseTransaction.objects.filter(
+                date__gte=from_date,
+                date__lte=to_date
+            ).delete()[0]
+        else:
+            # If we can't determine the date range, don't delete anything
+            # This is safer than deleting all transactions
+            deleted_count = 0
+        context.values.update(deleted_count=deleted_count, cost_basis_keys=cost_basis_keys, ttm_accounts=ttm_accounts)
+
+
+class ShareCodes(Stage):
+    """Resolve share_code from the share name mappings, one lookup per batch."""
+    kind = LOAD
+    name = 'share_codes'
+    
+    def process(self, batch, context):
+        share_codes = share_codes_for(share_name for share_name in batch['share_name'] if share_name)
+        return batch.assign(share_code=[share_codes.get(share_name) for share_name in batch['share_name']])
+
+
+class DividendTtm(Stage):
+    """
+    Recompute the dividend TTM series of the accounts the import touched once all
+    batches are written, and stamp dividend_ttm onto their dividend transactions in the
+    loaded date range (unless reads compute TTM live).
+    """
+    kind = DERIVE
+    name = 'dividend_ttm'
+    
+    def start(self, context):
+        self.accounts = set(context.values.get('ttm_accounts', ()))
+        self.dates = []
+    
+    def process(self, batch, context):
+        dividends = batch[batch['type'].isin(DIVIDEND_TYPES)]
+        self.accounts.update(dividends['account_number'])
+        if len(dividends):
+            self.dates += [dividends['date'].min(), dividends['date'].max()]
+        return batch
+    
+    def finish(self, context):
+        if not self.accounts:
+            return
+        with TTM_RECOMPUTE_SECONDS.labels(scope='upload').time():
+            ttm_lookup = calculate_dividend_ttm([], account_numbers=self.accounts)
+        if not settings.INVESTEC_STORE_DIVIDEND_TTM or not self.dates:
+            return
+        
+        transactions = InvestecJseTransaction.objects.filter(
+            date__gte=min(self.dates),
+            date__lte=max(self.dates),
+            type__in=DIVIDEND_TYPES,
+            account_number__in=self.accounts,
+        ).exclude(share_name='').only('id', 'account_number', 'share_name', 'type', 'year', 'month', 'dividend_ttm')
+        changed = []
+        for txn in transactions:
+            # Lookup key: (account_number, share_name, dividend_type, year, month)
+            dividend_ttm = ttm_lookup.get((txn.account_number, txn.share_name, txn.type, txn.year, txn.month))
+            if txn.dividend_ttm != dividend_ttm:
+                txn.dividend_ttm = dividend_ttm
+                changed.append(txn)
+        InvestecJseTransaction.objects.bulk_update(changed, ['dividend_ttm'], batch_size=1000)
+
+
+class Positions(Stage):
+    """Refresh position checkpoints from the earliest month the import can have changed."""
+    kind = DERIVE
+    name = 'positions'
+    
+    def start(self, context):
+        self.refresh_dates = []
+    
+    def process(self, batch, context):
+        if len(batch):
+            self.refresh_dates.append(batch['date'].min())
+        return batch
+    
+    def finish(self, context):
+        if context.values.get('deleted_count') and context.values['from_date']:
+            self.refresh_dates.append(context.values['from_date'])
+        context.values['position_checkpoints'] = refresh_positions(from_date=min(self.refresh_dates)) if self.refresh_dates else 0
+
+
+class CostBasis(Stage):
+    """Recompute lot matching (realized gains, open lots) for the Buy/Sell streams the import touched."""
+    kind = DERIVE
+    name = 'cost_basis'
+    
+    def start(self, context):
+        self.keys = set(context.values.get('cost_basis_keys', ()))
+    
+    def process(self, batch, context):
+        trades = batch[batch['type'].isin(['Buy', 'Sell'])]
+        self.keys.update(zip(trades['account_number'], trades['share_name']))
+        return batch
+    
+    def finish(self, context):
+        if self.keys:
+            for method in settings.INVESTEC_COST_BASIS_METHODS:
+                rebuild_cost_basis(keys=self.keys, method=method)
+
+
+class RefreshExports(Stage):
+    """
+    Refresh the export artifacts once the import commits (see exports.py). With
+    append=True they may be appended to when the import deleted no stored rows.
+    """
+    kind = DERIVE
+    name = 'exports'
+    
+    def __init__(self, append=True):
+        self.append = append
+    
+    def finish(self, context):
+        refresh_exports(append=self.append and not context.values.get('deleted_count'))
+
+
+def transaction_pipeline():
+    return Pipeline(FILE_TRANSACTIONS, [
+        ExcelExtract(_locate_transactions),
+        TransactionColumns(),
+        TransactionValidate(),
+        TransactionFields(),
+        DeleteRange(),
+        ShareCodes(),
+        load_stage(InvestecJseTransaction),
+        DividendTtm(),
+        Positions(),
+        CostBasis(),
+        RefreshExports(),
+    ])
+
+
+def parse_transaction_file(uploaded_file, timer=None):
+    """
+    Parse an Investec transaction statement into the transaction rows to load.
+    
+    The statement date range is taken from the filename (...-YYYYMMDD-YYYYMMDD...)
+    or from the "From date" / "To date" rows of the workbook.
+    Returns a dict with 'frame', 'errors', 'from_date', 'to_date' and 'total_rows'.
+    Stage timings are recorded on timer (a StageTimer) when given.
+    """
+    return _parse(transaction_pipeline(), uploaded_file, timer or StageTimer(FILE_TRANSACTIONS))
+
+
+def _transaction_result(filename, context):
+    values = context.values
+    from_date = values['from_date']
+    to_date = values['to_date']
+    created_count = values.get('created', 0)
+    
+    # Prepare response
+    response_data = {
+        'success': True,
+        'message': f'Successfully imported {created_count} transactions',
+        'deleted_previous': values.get('deleted_count', 0),
+        'total_rows': values['total_rows'],
+        'created': created_count,
+        'position_checkpoints': values.get('position_checkpoints', 0),
+        **summarize_errors(context.error_frame(), filename),
+    }
+    
+    # Add date range information if available
+    if from_date and to_date:
+        response_data['date_range'] = {
+            'from_date': str(from_date),
+            'to_date': str(to_date),
+        }
+        response_data['message'] += f' for date range {from_date} to {to_date}'
+    elif from_date:
+        response_data['date_range'] = {
+            'from_date': str(from_date),
+            'to_date': None,
+        }
+    elif to_date:
+        response_data['date_range'] = {
+            'from_date': None,
+            'to_date': str(to_date),
+        }
+    
+    return response_data
+
+
+def import_transactions(parsed, derive=True, timer=None):
+    """
+    Write a parsed statement, replacing the transactions in its date range.
+    
+    With derive=True (the upload endpoint) the dividend TTM, position checkpoints and
+    cost basis are brought up to date for the import. Bulk loads pass derive=False and
+    recompute derived data once after the last file (see the ingest command).
+    """
+    context = transaction_pipeline().load(parsed, timer or StageTimer(FILE_TRANSACTIONS), derive=derive)
+    return _transaction_result(parsed['filename'], context)
+
+
+def process_transaction_file(uploaded_file, timer=None):
+    """Run a single transaction statement through its pipeline. Returns the result dict."""
+    context, error = _run(transaction_pipeline(), uploaded_file, timer or StageTimer(FILE_TRANSACTIONS))
+    if error:
+        return error
+    return _transaction_result(uploaded_file.name, context)
+
+
+# ------------------------------------------------
+# Portfolio
+# ------------------------------------------------
+
+# Model fields and the export's column names; the first seven columns are required
+PORTFOLIO_COLUMNS = {
+    'instrument': 'Instrument Description',
+    'quantity': 'Total Quantity',
+    'currency': 'Currency',
+    'unit_cost': 'Unit',  # Unit Cost (net)
+    'total_cost': 'Total Cost',
+    'price': 'Price',
+    'total_value': 'Total Value',
+    'exchange_rate': 'Exchange',  # Exchange Rate
+    'move_percent': 'Move (%)',
+    'portfolio_percent': 'Portfolio',  # Portfolio (%)
+    'profit_loss': 'Profit/Loss',
+    'annual_income_zar': 'Annual',  # Annual Income (R)
+}
+PORTFOLIO_REQUIRED = ['instrument', 'quantity', 'currency', 'unit_cost', 'total_cost', 'price', 'total_value']
+PORTFOLIO_OPTIONAL = ['exchange_rate', 'move_percent', 'portfolio_percent', 'profit_loss', 'annual_income_zar']
+
+
+def _locate_portfolio(df_raw, filename, context):
+    """ExcelExtract locate: the holdings date and the header row below the "Portfolio Holdings Report" title."""
+    # First, find the row containing "Portfolio Holdings Report"
+    report_row = None
+    for idx, row in df_raw.iterrows():
+        row_str = ' '.join([str(val) for val in row.values if pd.notna(val)])
+        if 'portfolio holdings report' in row_str.lower():
+            report_row = idx
+            break
+    
+    if report_row is None:
+        raise PipelineError('Could not find "Portfolio Holdings Report" header in Excel file.')
+    
+    # Extract date from Excel file - look for date patterns in rows around the report header
+    portfolio_date = None
+    
+    # Try to extract date from filename first (format: Holdings-YYYYMMDD...)
+    date_match = re.search(r'(\d{8})', filename)
+    if date_match:
+        try:
+            date_str = date_match.group(1)
+            portfolio_date = pd.to_datetime(date_str, format='%Y%m%d').date()
+        except:
+            pass
+    
+    # If not found in filename, look for date in Excel rows around the report header
+    if portfolio_date is None:
+        # Check rows before and after the report header for date patterns
+        search_rows = list(range(max(0, report_row - 5), min(len(df_raw), report_row + 5)))
+        for idx in search_rows:
+            row = df_raw.iloc[idx]
+            for cell_val in row.values:
+                if pd.notna(cell_val):
+                    cell_str = str(cell_val).strip()
+                    # Try various date formats
+                    for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
+                        try:
+                            portfolio_date = pd.to_datetime(cell_str, format=date_format).date()
+                            break
+                        except:
+                            try:
+                                # Try pandas flexible parsing
+                                portfolio_date = pd.to_datetime(cell_str).date()
+                                break
+                            except:
+                                continue
+                if portfolio_date:
+                    break
+            if portfolio_date:
+                break
+    
+    if portfolio_date is None:
+        raise PipelineError('Could not extract date from Excel file. Please ensure the file contains a date near the "Portfolio Holdings Report" header or in the filename (format: YYYYMMDD).')
+    
+    # Find header row starting from the row after "Portfolio Holdings Report"
+    header_row = None
+    for idx in range(report_row + 1, len(df_raw)):
+        row = df_raw.iloc[idx]
+        row_str = ' '.join([str(val).lower() for val in row.values if pd.notna(val)])
+        if 'instrument description' in row_str and 'total quantity' in row_str:
+            header_row = idx
+            break
+    
+    if header_row is None:
+        raise PipelineError('Could not find header row (with "Instrument Description" and "Total Quantity") after "Portfolio Holdings Report".')
+    
+    context.values['date'] = portfolio_date
+    return header_row
+
+
+class PortfolioColumns(Stage):
+    """Map the export's columns onto the holding fields, splitting "ABSA GROUP LIMITED (ABG)" into company and share code."""
+    kind = NORMALIZE
+    name = 'normalize'
+    
+    def process(self, batch, context):
+        col_names = list(batch.columns)
+        missing_cols = [PORTFOLIO_COLUMNS[field] for field in PORTFOLIO_REQUIRED if PORTFOLIO_COLUMNS[field] not in col_names]
+        if missing_cols:
+            raise PipelineError(f'Missing required columns: {", ".join(missing_cols)}', available_columns=col_names[:30])
+        
+        frame = pd.DataFrame(
+            {field: batch[column] for field, column in PORTFOLIO_COLUMNS.items() if column in col_names},
+            index=batch.index,
+        )
+        # Pattern: "COMPANY NAME (CODE)"; without parentheses the full string is the company
+        instrument = frame['instrument'].astype(str).str.strip()
+        parts = instrument.str.extract(r'^(.+?)\s*\(([^)]+)\)\s*$')
+        frame['company'] = parts[0].str.strip().where(parts[0].notna(), instrument).str[:100]
+        frame['share_code'] = parts[1].str.strip().fillna('').str[:20]
+        frame['currency'] = frame['currency'].astype(str).str[:10].where(frame['currency'].notna(), 'ZAR')
+        return frame
+
+
+class PortfolioValidate(Stage):
+    """
+    Keep the holding rows with valid cost and value columns, as Decimals. Rows without
+    an instrument or a (non-zero) quantity are totals and headers: skipped, not reported.
+    Optional columns that are not numbers (or do not fit the field) are left empty.
+    """
+    kind = VALIDATE
+    name = 'validate'
+    
+    def process(self, batch, context):
+        quantities = parse_numbers(batch['quantity'], clean=True)
+        skip = is_blank(batch['instrument']) | quantities.isna() | (quantities == 0)
+        numbers = ['quantity', 'unit_cost', 'total_cost', 'price', 'total_value']
+        parsed_columns, valid, errors = validate_columns(batch, [
+            {
+                'column': field,
+                'label': PORTFOLIO_COLUMNS[field],
+                'kind': 'number',
+                'clean': field == 'quantity',
+                'limit': decimal_limit(InvestecJsePortfolio, field),
+            }
+            for field in numbers
+        ], skip=skip, first_row=context.values['first_row'])
+        context.errors.append(errors)
+        
+        for field in PORTFOLIO_OPTIONAL:
+            if field in batch.columns:
+                values = parse_numbers(batch[field])
+                parsed_columns[field] = values.where(values.abs() < decimal_limit(InvestecJsePortfolio, field))
+        
+        portfolio_date = context.values['date']
+        frame = batch.loc[valid, ['company', 'share_code', 'currency']]
+        frame.insert(0, 'date', portfolio_date)
+        frame.insert(1, 'year', portfolio_date.year)
+        frame.insert(2, 'month', portfolio_date.month)
+        frame.insert(3, 'day', portfolio_date.day)
+        for field, values in parsed_columns.items():
+            frame[field] = pd.Series(
+                [Decimal(str(number)) if pd.notna(number) else None for number in values[valid]],
+                index=frame.index,
+                dtype=object,
+            )
+        return frame
+
+
+class DeleteMonth(Stage):
+    """Before the first batch is written, clear the stored holdings for the portfolio's month/year."""
+    kind = LOAD
+    name = 'delete_month'
+    
+    def start(self, context):
+        portfolio_date = context.values['date']
+        # The date bounds let PostgreSQL prune the delete to the year's partition
+        month_start = portfolio_date.replace(day=1)
+        next_month_start = (month_start + timedelta(days=32)).replace(day=1)
+        context.values['deleted_count'] = InvestecJsePortfolio.objects.filter(
+            date__gte=month_start,
+            date__lt=next_month_start,
+            year=portfolio_date.year,
+            month=portfolio_date.month
+        ).delete()[0]
+
+
+def portfolio_pipeline():
+    return Pipeline(FILE_PORTFOLIO, [
+        ExcelExtract(_locate_portfolio),
+        PortfolioColumns(),
+        PortfolioValidate(),
+        DeleteMonth(),
+        load_stage(InvestecJsePortfolio),
+    ])
+
+
+def parse_portfolio_file(uploaded_file, timer=None):
+    """
+    Parse a "Portfolio Holdings Report" export into the holding rows to load.
+    
+    Returns a dict with 'frame', 'errors', 'date' and 'total_rows'.
+    """
+    return _parse(portfolio_pipeline(), uploaded_file, timer or StageTimer(FILE_PORTFOLIO))
+
+
+def _portfolio_result(filename, context, include_data, timer):
+    portfolio_date = context.values['date']
+    created_count = context.values.get('created', 0)
+    
+    with timer.stage('serialize'):
+        # Retrieve and serialize the created data
+        portfolio_data = []
+        if created_count > 0 and include_data:
+            # Query the created portfolios by date and company/share_code to get full data with IDs
+            portfolios = InvestecJsePortfolio.objects.filter(date=portfolio_date).order_by('company', 'share_code')
+            portfolio_data = InvestecJsePortfolioSerializer(portfolios, many=True).data
+    
+    # Prepare response
+    return {
+        'success': True,
+        'filename': filename,
+        'message': f'Successfully imported {created_count} portfolio holdings',
+        'date': str(portfolio_date),
+        'year': portfolio_date.year,
+        'month': portfolio_date.month,
+        'deleted_previous': context.values.get('deleted_count', 0),
+        'total_rows': context.values['total_rows'],
+        'created': created_count,
+        'data': portfolio_data,
+        **summarize_errors(context.error_frame(), filename),
+    }
+
+
+def import_portfolio(parsed, include_data=True, timer=None):
+    """
+    Write a parsed portfolio, replacing all holdings for its month/year.
+    
+    include_data adds the stored holdings (serialized) to the result, as returned by
+    the upload endpoint.
+    """
+    timer = timer or StageTimer(FILE_PORTFOLIO)
+    context = portfolio_pipeline().load(parsed, timer)
+    return _portfolio_result(parsed['filename'], context, include_data, timer)
+
+
+def process_portfolio_file(uploaded_file, timer=None):
+    """
+    Helper function to process a single portfolio Excel file.
+    Returns a dict with results or error information.
+    """
+    timer = timer or StageTimer(FILE_PORTFOLIO)
+    context, error = _run(portfolio_pipeline(), uploaded_file, timer)
+    if error:
+        return error
+    return _portfolio_result(uploaded_file.name, context, True, timer)
+
+
+# ------------------------------------------------
+# Share Name Mapping
+# ------------------------------------------------
+
+class MappingColumns(Stage):
+    """
+    Map the Share_Name, Company and Share_Code columns. Every column is text and rows
+    without a share name are skipped: nothing to reject.
+    """
+    kind = NORMALIZE
+    name = 'normalize'
+    
+    def process(self, batch, context):
+        # Normalize column names
+        batch.columns = _normalize_columns(batch.columns)
+        
+        # Map column names
+        share_name_col = None
+        company_col = None
+        share_code_col = None
+        
+        for col in batch.columns:
+            col_lower = col.lower()
+            if 'share_name' in col_lower or 'sharename' in col_lower:
+                share_name_col = col
+            elif 'company' in col_lower:
+                company_col = col
+            elif 'share_code' in col_lower or 'sharecode' in col_lower or 'code' in col_lower:
+                share_code_col = col
+        
+        if not share_name_col:
+            raise PipelineError('Missing required column: Share_Name', available_columns=list(batch.columns))
+        
+        def text(col, length=None):
+            if not col:
+                return pd.Series('', index=batch.index)
+            return batch[col].map(lambda val: str(val).strip()[:length] if not pd.isna(val) else '')
+        
+        frame = pd.DataFrame({
+            'share_name': text(share_name_col),
+            'company': text(company_col, 100),
+            'share_code': text(share_code_col, 20),
+        }, index=batch.index)
+        return frame[frame['share_name'] != '']
+
+
+class MappingUpsert(Stage):
+    """
+    Create new share name mappings and update existing ones, one lookup per batch.
+    Company and share code only overwrite stored values when the file provides them;
+    for a share name repeated in the file, later rows win.
+    """
+    kind = LOAD
+    name = 'upsert'
+    
+    def start(self, context):
+        self.created_names = set()
+        context.values.update(created=0, updated=0)
+    
+    def process(self, batch, context):
+        # One query for the mappings that already exist
+        existing = InvestecJseShareNameMapping.objects.in_bulk(set(batch['share_name']), field_name='share_name')
+        
+        # Prepare data for bulk create/update
+        mappings_to_create = {}
+        mappings_to_update = {}
+        
+        for share_name, company, share_code in batch[['share_name', 'company', 'share_code']].itertuples(index=False, name=None):
+            if share_name in existing:
+                # Update existing
+                mapping = existing[share_name]
+                mappings_to_update[share_name] = mapping
+            elif share_name in mappings_to_create:
+                # Repeated in this file: later rows win
+                mapping = mappings_to_create[share_name]
+            else:
+                # Create new
+                mappings_to_create[share_name] = InvestecJseShareNameMapping(
+                    share_name=share_name,
+                    company=company if company else None,
+                    share_code=share_code if share_code else None,
+                )
+                continue
+            if company:
+                mapping.company = company
+            if share_code:
+                mapping.share_code = share_code
+        
+        with transaction.atomic():
+            if mappings_to_create:
+                created_count = len(InvestecJseShareNameMapping.objects.bulk_create(list(mappings_to_create.values())))
+                context.values['created'] += created_count
+                self.created_names.update(mappings_to_create)
+                record_rows_ingested(InvestecJseShareNameMapping._meta.db_table, created_count)
+            if mappings_to_update:
+                InvestecJseShareNameMapping.objects.bulk_update(list(mappings_to_update.values()), ['company', 'share_code'])
+                # Names created by an earlier batch of this file are not counted as updates
+                updated_count = len(mappings_to_update.keys() - self.created_names)
+                context.values['updated'] += updated_count
+                record_rows_ingested(InvestecJseShareNameMapping._meta.db_table, updated_count)
+        return batch
+
+
+class ResolveShareCodes(Stage):
+    """Re-resolve the share_code of the stored transactions with the file's share names, in one UPDATE ... FROM."""
+    kind = DERIVE
+    name = 'resolve_share_codes'
+    
+    def start(self, context):
+        self.share_names = set()
+    
+    def process(self, batch, context):
+        self.share_names.update(batch['share_name'])
+        return batch
+    
+    def finish(self, context):
+        context.values['transactions_resolved'] = resolve_share_codes(self.share_names)
+
+
+def mapping_pipeline():
+    return Pipeline(FILE_MAPPING, [
+        ExcelExtract(),
+        MappingColumns(),
+        MappingUpsert(),
+        ResolveShareCodes(),
+        RefreshExports(append=False),  # Share codes of stored rows change
+    ])
+
+
+def parse_mapping_file(uploaded_file, timer=None):
+    """
+    Parse a share name mapping workbook (Share_Name, Company, Share_Code).
+    
+    Returns a dict with 'frame' (share_name, company and share_code columns, in file
+    order) and 'errors'.
+    """
+    return _parse(mapping_pipeline(), uploaded_file, timer or StageTimer(FILE_MAPPING))
+
+
+def _mapping_result(filename, context):
+    values = context.values
+    return {
+        'success': True,
+        'message': f'Successfully imported {values["created"]} new mappings and updated {values["updated"]} existing mappings',
+        'created': values['created'],
+        'updated': values['updated'],
+        'transactions_resolved': values['transactions_resolved'],
+        **summarize_errors(context.error_frame(), filename),
+    }
+
+
+def import_mappings(parsed, timer=None):
+    """
+    Create new share name mappings and update existing ones. Company and share code
+    only overwrite stored values when the file provides them. The share_code of stored
+    transactions with these share names is then re-resolved.
+    """
+    context = mapping_pipeline().load(parsed, timer or StageTimer(FILE_MAPPING))
+    return _mapping_result(parsed['filename'], context)
+
+
+def import_mapping_rows(rows, filename, timer=None):
+    """
+    Import share name mappings given as (share_name, company, share_code) tuples (accepted
+    suggestions, see share_matching.py) through the load and derive stages of the mapping
+    pipeline, as if they were the rows of a mapping file.
+    """
+    frame = pd.DataFrame(list(rows), columns=['share_name', 'company', 'share_code'])
+    return import_mappings({'success': True, 'filename': filename, 'frame': frame, 'errors': empty_errors()}, timer=timer)
+
+
+def process_mapping_file(uploaded_file, timer=None):
+    """Run a single share name mapping file through its pipeline. Returns the result dict."""
+    context, error = _run(mapping_pipeline(), uploaded_file, timer or StageTimer(FILE_MAPPING))
+    if error:
+        return error
+    return _mapping_result(uploaded_file.name, context)
+
+
+PARSERS = {
+    FILE_TRANSACTIONS: parse_transaction_file,
+    FILE_PORTFOLIO: parse_portfolio_file,
+    FILE_MAPPING: parse_mapping_file,
+}
+
+PIPELINES = {
+    FILE_TRANSACTIONS: transaction_pipeline,
+    FILE_PORTFOLIO: portfolio_pipeline,
+    FILE_MAPPING: mapping_pipeline,
+}
+
+
+def warm_up():
+    """
+    Load the parts of the parsing stack that pandas imports on first use (its Excel
+    reader and writer, openpyxl) by writing and reading back a one-row workbook.
+    config/gunicorn_production.py calls this in the master before the workers fork.
+    """
+    from io import BytesIO
+    
+    buffer = BytesIO()
+    pd.DataFrame({'Date': [date.today()], 'Value': [1.0]}).to_excel(buffer, index=False, engine='openpyxl')
+    buffer.seek(0)
+    pd.read_excel(buffer, header=None)
+
+
+# ------------------------------------------------
+# Bulk loading (ingest / watch_folder commands)
+# ------------------------------------------------
+
+# Rows read to classify a workbook: the titles and header rows all sit near the top
+HEADER_ROWS = 40
+
+# Import order of a batch: mappings first (performance records look up share codes),
+# then portfolios and statements
+KIND_ORDER = [FILE_MAPPING, FILE_PORTFOLIO, FILE_TRANSACTIONS]
+
+
+def _unrecognised(filename):
+    return {
+        'success': False,
+        'filename': filename,
+        'error': 'Unrecognised file (no transaction, portfolio or mapping header)',
+    }
+
+
+def peek_path(path):
+    """
+    Classify the workbook at path from its first HEADER_ROWS rows, without parsing it.
+    
+    Returns (kind, order_key, error): order_key sorts files of one kind into import
+    order - the holdings date of a portfolio report, the from date of a statement
+    (filename or "From date" row; date.min when neither has one). error is a result
+    dict (kind None) for unreadable or unrecognised files.
+    """
+    filename = os.path.basename(path)
+    with open(path, 'rb') as f:
+        try:
+            head = pd.read_excel(f, header=None, nrows=HEADER_ROWS)
+        except Exception as e:
+            return None, None, {'success': False, 'filename': filename, 'error': f'Error reading file: {str(e)}'}
+    kind = classify_workbook(head)
+    if kind is None:
+        return None, None, _unrecognised(filename)
+    order_key = date.min
+    if kind == FILE_PORTFOLIO:
+        try:
+            context = Context(filename, None)
+            _locate_portfolio(head, filename, context)
+            order_key = context.values['date']
+        except PipelineError:
+            pass  # The parser reports it
+    elif kind == FILE_TRANSACTIONS:
+        order_key = _statement_dates(head, filename)[0] or date.min
+    return kind, order_key, None
+
+
+def parse_path(path, kind=None):
+    """
+    Classify (unless kind is given) and parse the workbook at path. No database
+    access, so this can run in a worker process. Returns (kind, parsed); kind is None
+    for unrecognised files.
+    """
+    if kind is None:
+        kind, _, error = peek_path(path)
+        if error:
+            return None, error
+    with open(path, 'rb') as f:
+        return kind, PARSERS[kind](File(f, name=os.path.basename(path)))
+
+
+def parsed_row_count(parsed):
+    return len(parsed['frame']) if 'frame' in parsed else 0
+
+
+def statement_start(parsed):
+    """Sort key for parsed statements: the statement's from date, else its earliest transaction."""
+    dates = parsed['frame']['date'].tolist() if len(parsed['frame']) else []
+    if parsed['from_date']:
+        dates.append(parsed['from_date'])
+    return min(dates) if dates else date.min
+
+
+def import_parsed_file(kind, parsed):
+    """
+    Import one successful parse result without per-file derived data. Returns
+    (result, change): change is what the derived-data rebuild has to cover - True for
+    mappings (every month), the first changed date otherwise, None when nothing
+    dated changed. A file that fails to import gets a result with 'success': False.
+    """
+    try:
+        if kind == FILE_MAPPING:
+            return import_mappings(parsed), True
+        if kind == FILE_PORTFOLIO:
+            return import_portfolio(parsed, include_data=False), parsed['date']
+        result = import_transactions(parsed, derive=False)
+        start_date = statement_start(parsed)
+        return result, start_date if start_date != date.min else None
+    except Exception as e:
+        return {'success': False, 'filename': parsed['filename'], 'error': f'Error importing file: {str(e)}'}, None
+
+
+def batch_rebuild(changes):
+    """
+    The single derived-data recompute covering the changes of import_parsed_file:
+    {'rebuild': bool, 'rebuild_from': date or None} (rebuild_from=None means all months).
+    """
+    if any(change is True for change in changes):
+        # New mappings change share codes on every performance record: rebuild all months
+        return {'rebuild': True, 'rebuild_from': None}
+    changed_dates = [change for change in changes if change]
+    if changed_dates:
+        return {'rebuild': True, 'rebuild_from': min(changed_dates).replace(day=1)}
+    return {'rebuild': False, 'rebuild_from': None}
+
+
+def apply_parsed_files(parsed_files, on_applied=None):
+    """
+    Import parsed files without per-file derived data, in dependency order (KIND_ORDER):
+    mappings, then portfolios and statements in date order so overlapping statements
+    resolve to the latest file.
+    
+    parsed_files maps FILE_* kinds to lists of successful parse results. on_applied is
+    called with (kind, parsed, result) after each file; a file that fails to import
+    does not stop the others.
+    
+    Returns batch_rebuild() of the imported files.
+    """
+    ordered = [(FILE_MAPPING, parsed) for parsed in parsed_files.get(FILE_MAPPING, [])]
+    ordered += [(FILE_PORTFOLIO, parsed) for parsed in sorted(parsed_files.get(FILE_PORTFOLIO, []), key=lambda p: p['date'])]
+    ordered += [(FILE_TRANSACTIONS, parsed) for parsed in sorted(parsed_files.get(FILE_TRANSACTIONS, []), key=statement_start)]
+    
+    changes = []
+    for kind, parsed in ordered:
+        result, change = import_parsed_file(kind, parsed)
+        changes.append(change)
+        if on_applied:
+            on_applied(kind, parsed, result)
+    return batch_rebuild(changes)
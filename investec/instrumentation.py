@@ -0,0 +1,132 @@
+"""
+Stage timing for the import pipelines.
+
+A StageTimer records wall time, SQL query count and query time, and rows processed
+for each named stage of an import. Entering a stage name again adds to the same
+record (e.g. every batch a pipeline stage processes counts towards that stage).
+
+Reports are returned in the optional `timings` block of upload responses and logged
+as one JSON line per stage on the 'investec.timings' logger.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger('investec.timings')
+
+# The view (URL name) and pipeline stage currently issuing SQL, for the slow-query log
+query_source = ContextVar('investec_query_source', default=None)
+query_stage = ContextVar('investec_query_stage', default='')
+# The QueryCounter of the request being handled (MetricsMiddleware). Counted by a wrapper
+# on every connection, so queries the async ORM runs in another thread count too
+request_queries = ContextVar('investec_request_queries', default=None)
+
+
+class QueryCounter:
+    """
+    connection.execute_wrapper callable counting queries and their total time.
+    
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            ...
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def _count_request_query(execute, sql, params, many, context):
+    counter = request_queries.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def _add_request_counter(sender, connection, **kwargs):
+    if _count_request_query not in connection.execute_wrappers:
+        # Insert first: the connection may open inside a `with connection.execute_wrapper(...)` block
+        connection.execute_wrappers.insert(0, _count_request_query)
+
+
+def install_request_query_counter():
+    """Count the queries of every connection, in any thread, into request_queries."""
+    connection_created.connect(_add_request_counter, dispatch_uid='investec_request_queries')
+    for db_connection in connections.all():
+        if db_connection.connection is not None:
+            _add_request_counter(None, db_connection)
+
+
+class StageTimer:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Time the enclosed block as stage `name`, counting the SQL queries it runs."""
+        record = self.stages.setdefault(name, {'seconds': 0.0, 'queries': 0, 'query_seconds': 0.0, 'rows': None})
+        if rows is not None:
+            record['rows'] = (record['rows'] or 0) + rows
+
+        queries = QueryCounter()
+        stage_token = query_stage.set(f'{self.pipeline}.{name}')
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                yield
+        finally:
+            query_stage.reset(stage_token)
+            record['seconds'] += time.perf_counter() - start
+            record['queries'] += queries.count
+            record['query_seconds'] += queries.seconds
+
+    def report(self):
+        """Per-stage breakdown in the order the stages first ran."""
+        stages = []
+        for name, record in self.stages.items():
+            rows = record['rows']
+            seconds = record['seconds']
+            stages.append({
+                'stage': name,
+                'seconds': round(seconds, 4),
+                'queries': record['queries'],
+                'query_seconds': round(record['query_seconds'], 4),
+                'rows': rows,
+                'rows_per_second': round(rows / seconds) if rows and seconds > 0 else None,
+            })
+        return {
+            'pipeline': self.pipeline,
+            'total_seconds': round(time.perf_counter() - self.started, 4),
+            'queries': sum(record['queries'] for record in self.stages.values()),
+            'stages': stages,
+        }
+
+    def log(self, **context):
+        """Write one structured (JSON) log line per stage plus a total line."""
+        report = self.report()
+        for stage in report['stages']:
+            logger.info(json.dumps({'pipeline': self.pipeline, **context, **stage}, default=str))
+        logger.info(json.dumps({
+            'pipeline': self.pipeline,
+            **context,
+            'stage': 'total',
+            'seconds': report['total_seconds'],
+            'queries': report['queries'],
+        }, default=str))
+        return report
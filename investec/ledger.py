@@ -0,0 +1,164 @@
+"""
+Position ledger: running share quantities per (account_number, share_name)
+reconstructed from Buy/Sell transactions.
+
+Month-end checkpoints are stored in InvestecJsePositionCheckpoint (one row per
+account/share for every month with Buy/Sell activity). Holdings on any date D are
+the latest checkpoint before D's month plus the Buy/Sell transactions from the
+start of D's month up to D.
+
+pandas is imported by refresh_positions only: holdings_as_of serves the read
+endpoints without it.
+"""
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Abs
+from decimal import Decimal
+
+from .models import InvestecJsePositionCheckpoint, InvestecJseTransaction
+
+
+# Transaction types that change a position, with the direction they move it.
+# Investec statements carry Sell quantities as negative numbers, but the sign is
+# applied from the type so that positive Sell quantities are handled the same way.
+POSITION_TYPES = {'Buy': 1, 'Sell': -1}
+
+QUANTITY_PLACES = 4
+
+
+def _month_start(value):
+    return value.replace(day=1)
+
+
+def _signed_quantity():
+    """SQL expression: +|quantity| for Buy, -|quantity| for Sell."""
+    return Case(
+        When(type='Buy', then=Abs('quantity')),
+        When(type='Sell', then=Abs('quantity') * Value(-1)),
+        default=Value(0),
+        output_field=DecimalField(max_digits=15, decimal_places=4),
+    )
+
+
+def _latest_checkpoints(before_date, account_number=None):
+    """
+    Return {(account_number, share_name): quantity} from the latest checkpoint dated
+    strictly before before_date for each account/share.
+    """
+    queryset = InvestecJsePositionCheckpoint.objects.filter(date__lt=before_date)
+    if account_number:
+        queryset = queryset.filter(account_number=account_number)
+
+    if connection.features.can_distinct_on_fields:
+        # PostgreSQL: DISTINCT ON (account_number, share_name) ... ORDER BY date DESC
+        queryset = queryset.order_by('account_number', 'share_name', '-date').distinct('account_number', 'share_name')
+    else:
+        latest_date = queryset.filter(
+            account_number=OuterRef('account_number'),
+            share_name=OuterRef('share_name'),
+        ).values('account_number', 'share_name').annotate(latest=Max('date')).values('latest')
+        queryset = queryset.filter(date=Subquery(latest_date))
+
+    return {
+        (row['account_number'], row['share_name']): row['quantity']
+        for row in queryset.values('account_number', 'share_name', 'quantity')
+    }
+
+
+def holdings_as_of(as_of_date, account_number=None):
+    """
+    Reconstruct holdings on as_of_date (inclusive) from checkpoints and transactions.
+
+    Runs two indexed queries: the nearest checkpoint per account/share before the
+    month of as_of_date, and the Buy/Sell delta from the month start to as_of_date.
+    Returns a list of dicts (account_number, share_name, quantity) with non-zero
+    quantities, ordered by account_number and share_name.
+    """
+    month_start = _month_start(as_of_date)
+    positions = _latest_checkpoints(month_start, account_number)
+
+    deltas = InvestecJseTransaction.objects.filter(
+        type__in=POSITION_TYPES.keys(),
+        date__gte=month_start,
+        date__lte=as_of_date,
+    )
+    if account_number:
+        deltas = deltas.filter(account_number=account_number)
+    deltas = deltas.values('account_number', 'share_name').annotate(delta=Sum(_signed_quantity())).order_by()
+
+    for row in deltas:
+        key = (row['account_number'], row['share_name'])
+        positions[key] = positions.get(key, Decimal('0')) + (row['delta'] or Decimal('0'))
+
+    return [
+        {'account_number': key[0], 'share_name': key[1], 'quantity': quantity}
+        for key, quantity in sorted(positions.items())
+        if quantity != 0
+    ]
+
+
+def refresh_positions(from_date=None):
+    """
+    Rebuild position checkpoints from the month of from_date onwards.
+
+    Checkpoints before that month are kept and used as the opening positions, so an
+    import only recomputes the months it can have changed. With from_date=None the
+    whole ledger is rebuilt from the first transaction.
+
+    Running quantities are computed with a grouped cumulative sum over monthly
+    Buy/Sell totals. Returns the number of checkpoints written.
+    """
+    import pandas as pd
+
+    start = _month_start(from_date) if from_date else None
+
+    # Opening positions: latest checkpoint before the rebuild window
+    opening = _latest_checkpoints(start) if start else {}
+
+    trades = InvestecJseTransaction.objects.filter(type__in=POSITION_TYPES.keys())
+    if start:
+        trades = trades.filter(date__gte=start)
+    trades = list(trades.values_list('account_number', 'share_name', 'date', 'type', 'quantity'))
+
+    with transaction.atomic():
+        stale = InvestecJsePositionCheckpoint.objects.all()
+        if start:
+            stale = stale.filter(date__gte=start)
+        stale.delete()
+
+        if not trades:
+            return 0
+
+        df = pd.DataFrame(trades, columns=['account_number', 'share_name', 'date', 'type', 'quantity'])
+        df['signed_quantity'] = df['quantity'].astype(float).abs() * df['type'].map(POSITION_TYPES)
+        df['month_end'] = pd.to_datetime(df['date']).dt.to_period('M').dt.to_timestamp('M')
+
+        monthly = df.groupby(['account_number', 'share_name', 'month_end'], sort=True)['signed_quantity'].sum().reset_index()
+        monthly['quantity'] = monthly.groupby(['account_number', 'share_name'])['signed_quantity'].cumsum()
+
+        if opening:
+            keys = pd.MultiIndex.from_frame(monthly[['account_number', 'share_name']])
+            opening_series = pd.Series(
+                [float(quantity) for quantity in opening.values()],
+                index=pd.MultiIndex.from_tuples(opening.keys()),
+            )
+            monthly['quantity'] += opening_series.reindex(keys, fill_value=0.0).to_numpy()
+
+        monthly['quantity'] = monthly['quantity'].round(QUANTITY_PLACES)
+
+        checkpoints = [
+            InvestecJsePositionCheckpoint(
+                account_number=account,
+                share_name=share_name,
+                date=month_end.date(),
+                year=month_end.year,
+                month=month_end.month,
+                quantity=Decimal(str(quantity)),
+            )
+            for account, share_name, month_end, quantity in zip(
+                monthly['account_number'], monthly['share_name'], monthly['month_end'], monthly['quantity']
+            )
+        ]
+        InvestecJsePositionCheckpoint.objects.bulk_create(checkpoints, batch_size=5000)
+
+    return len(checkpoints)
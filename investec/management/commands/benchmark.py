@@ -0,0 +1,181 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import django
+import pandas as pd
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from investec.instrumentation import QueryCounter
+from investec.synthetic import generate_dataset
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the upload paths, the dividend TTM engine, the list endpoints and the exports '
+        'against synthetic statements of the given sizes. Runs in a freshly migrated test database '
+        '(test_<NAME>) on the configured backend and writes the results to JSON; --compare prints '
+        'the change against an earlier result file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', default='1000,10000', help='Comma-separated statement sizes (default: 1000,10000)')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each read case; uploads run once (default: 3)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data (default: 0)')
+        parser.add_argument('--output', help='Result file (default: benchmark-<commit>-<timestamp>.json)')
+        parser.add_argument('--compare', help='Earlier result file to compare against')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+        parser.add_argument('--keep-files', action='store_true', help='Keep the generated workbooks')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['rows'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError(f'Invalid --rows: {options["rows"]}')
+        if not sizes or min(sizes) < 1:
+            raise CommandError('--rows needs at least one positive size')
+        baseline = self._load(options['compare']) if options['compare'] else None
+
+        commit = _git_commit()
+        output = options['output'] or f'benchmark-{commit or "nogit"}-{datetime.now():%Y%m%d-%H%M%S}.json'
+        report = {
+            'meta': {
+                'commit': commit,
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'pandas': pd.__version__,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'seed': options['seed'],
+                'repeat': options['repeat'],
+            },
+            'results': [],
+        }
+
+        workdir = tempfile.mkdtemp(prefix='investec-benchmark-')
+        # Export artifacts of the test database go to the work directory, not INVESTEC_EXPORT_DIR
+        export_dir = override_settings(INVESTEC_EXPORT_DIR=os.path.join(workdir, 'exports'))
+        export_dir.enable()
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'], serialize=False)
+        try:
+            for rows in sizes:
+                self.stdout.write(f'--- {rows} rows')
+                start = time.perf_counter()
+                paths = generate_dataset(os.path.join(workdir, str(rows)), rows, seed=options['seed'])
+                self.stdout.write(f'generated in {time.perf_counter() - start:.2f}s')
+                for result in self._run_size(rows, paths, max(1, options['repeat'])):
+                    report['results'].append(result)
+                    self._print_result(result, baseline)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            export_dir.disable()
+            if options['keep_files']:
+                self.stdout.write(f'Workbooks kept in {workdir}')
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
+
+    def _run_size(self, rows, paths, repeat):
+        from rest_framework.test import APIClient
+
+        from investec.ttm import calculate_dividend_ttm
+
+        # Every size starts from an empty (test) database
+        call_command('flush', interactive=False, verbosity=0)
+        client = APIClient()
+
+        def upload(url, path, field='file'):
+            with open(path, 'rb') as f:
+                return client.post(url, {field: f}, format='multipart')
+
+        cases = [
+            ('upload_mapping', 1, None, lambda: upload('/api/investec/mapping/upload/', paths['mapping'])),
+            ('upload_portfolio', 1, None, lambda: upload('/api/investec/portfolio/upload/', paths['portfolio'], 'files')),
+            ('upload_transactions', 1, rows, lambda: upload('/api/investec/upload/', paths['transactions'])),
+            ('ttm_engine', repeat, None, lambda: calculate_dividend_ttm([])),
+            ('list_transactions', repeat, None, lambda: client.get('/api/investec/transactions/?limit=100')),
+            ('list_transactions_deep', repeat, None, lambda: client.get(f'/api/investec/transactions/?limit=100&offset={rows // 2}')),
+            ('list_transactions_live_ttm', repeat, None, lambda: client.get('/api/investec/transactions/?limit=100&ttm=live')),
+            ('list_performance', repeat, None, lambda: client.get('/api/investec/performance/')),
+            ('export_companies', repeat, None, lambda: client.get('/api/investec/export/companies/')),
+            ('export_share_names', repeat, None, lambda: client.get('/api/investec/export/share-names/')),
+            ('export_transactions', repeat, None, lambda: client.get('/api/investec/export/transactions/')),
+        ]
+        for name, runs, case_rows, run in cases:
+            seconds = []
+            queries = QueryCounter()
+            error = None
+            for _ in range(runs):
+                queries = QueryCounter()
+                start = time.perf_counter()
+                with connection.execute_wrapper(queries):
+                    response = run()
+                seconds.append(time.perf_counter() - start)
+                status_code = getattr(response, 'status_code', None)
+                if status_code is not None and status_code >= 300:
+                    error = f'HTTP {status_code}'
+                    break
+            median = statistics.median(seconds)
+            yield {
+                'rows': rows,
+                'case': name,
+                'runs': len(seconds),
+                'seconds': [round(value, 4) for value in seconds],
+                'min': round(min(seconds), 4),
+                'median': round(median, 4),
+                'max': round(max(seconds), 4),
+                'queries': queries.count,
+                'query_seconds': round(queries.seconds, 4),
+                'rows_per_second': round(case_rows / median) if case_rows and median > 0 else None,
+                'error': error,
+            }
+
+    def _print_result(self, result, baseline):
+        line = f'{result["case"]:<28} median {result["median"]:>9.4f}s  queries {result["queries"]:>6}'
+        if result['rows_per_second']:
+            line += f'  {result["rows_per_second"]:>8} rows/s'
+        previous = baseline.get((result['rows'], result['case'])) if baseline else None
+        if previous:
+            change = (result['median'] - previous['median']) / previous['median'] * 100 if previous['median'] else 0
+            line += f'  was {previous["median"]:.4f}s ({change:+.1f}%)'
+        if result['error']:
+            self.stdout.write(self.style.ERROR(f'{line}  {result["error"]}'))
+        else:
+            self.stdout.write(line)
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        self.stdout.write(f'Comparing against {path} (commit {previous["meta"].get("commit")})')
+        return {(result['rows'], result['case']): result for result in previous['results']}
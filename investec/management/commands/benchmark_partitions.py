@@ -0,0 +1,192 @@
+import json
+import statistics
+import time
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+
+PLAIN = 'bench_txn_plain'
+PARTITIONED = 'bench_txn_partitioned'
+
+# The transaction table's columns that the range deletes and scans touch
+COLUMNS = (
+    '"id" bigint NOT NULL, "date" date NOT NULL, "year" integer, "month" integer, '
+    '"account_number" varchar(50) NOT NULL, "share_name" varchar(100) NOT NULL, "type" varchar(50) NOT NULL, '
+    '"quantity" numeric(15,4) NOT NULL, "value" numeric(15,2) NOT NULL, "description" varchar(255) NOT NULL'
+)
+# Rows arrive in date order, like statements uploaded month after month (%% is a
+# literal % next to the query parameters)
+FILL = (
+    'INSERT INTO {table} SELECT g, d, EXTRACT(YEAR FROM d), EXTRACT(MONTH FROM d), '
+    "'ACC' || (g %% 3), 'Share ' || (g %% 200), (ARRAY['Buy', 'Sell', 'Dividend', 'Fee'])[1 + g %% 4], "
+    "g %% 1000, (g %% 100000) / 100.0, 'Synthetic transaction' "
+    'FROM (SELECT g, %s::date + (g::bigint * %s / %s)::integer AS d FROM generate_series(1, %s) g) s'
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the transaction table before and after migration 0024 (PostgreSQL): fills a plain '
+        'table and a table partitioned by year with a BRIN index on date with the same synthetic '
+        'transactions, then times month and year range deletes (rolled back) and range scans, and '
+        'reports the sizes of the B-tree and BRIN date indexes. '
+        'The scratch tables are dropped afterwards unless --keep is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000_000, help='Rows per table (default: 10,000,000)')
+        parser.add_argument('--years', type=int, default=10, help='Years the rows span (default: 10)')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each case (default: 3)')
+        parser.add_argument('--output', help='Also write the results to this JSON file')
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch tables')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(f'This benchmark needs PostgreSQL (the configured database is {connection.vendor}).')
+        rows = options['rows']
+        years = options['years']
+        first_year = date.today().year - years + 1
+        start = date(first_year, 1, 1)
+        days = (date(first_year + years, 1, 1) - start).days - 1
+        # A month and a quarter in the middle of the data, and its middle year
+        middle = first_year + years // 2
+        cases = [
+            ('delete_month', 'DELETE FROM {table} WHERE "date" >= %s AND "date" <= %s', (date(middle, 6, 1), date(middle, 6, 30)), True),
+            ('delete_year', None, (date(middle, 1, 1), date(middle, 12, 31)), True),
+            ('scan_month', 'SELECT COUNT(*), SUM("value") FROM {table} WHERE "date" >= %s AND "date" <= %s', (date(middle, 6, 1), date(middle, 6, 30)), False),
+            ('scan_quarter', 'SELECT COUNT(*), SUM("value") FROM {table} WHERE "date" >= %s AND "date" <= %s', (date(middle, 4, 1), date(middle, 6, 30)), False),
+            ('scan_share_year', 'SELECT COUNT(*), SUM("value") FROM {table} WHERE "share_name" = %s AND "date" >= %s AND "date" <= %s', ('Share 7', date(middle, 1, 1), date(middle, 12, 31)), False),
+        ]
+
+        report = {
+            'meta': {
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'database': connection.settings_dict['NAME'],
+                'server_version': connection.pg_version,
+                'rows': rows,
+                'years': years,
+                'repeat': options['repeat'],
+            },
+            'tables': {},
+        }
+        try:
+            self._drop()
+            for table, setup in ((PLAIN, self._create_plain), (PARTITIONED, self._create_partitioned)):
+                begin = time.perf_counter()
+                setup(first_year, years)
+                with connection.cursor() as cursor:
+                    cursor.execute(FILL.format(table=table), [start, days, rows, rows])
+                    self._index(table)
+                    cursor.execute(f'VACUUM ANALYZE {table}')
+                load_seconds = time.perf_counter() - begin
+                self.stdout.write(f'Loaded {rows} rows into {table} in {load_seconds:.1f}s')
+                report['tables'][table] = {
+                    'load_seconds': round(load_seconds, 2),
+                    'index_bytes': {
+                        index: self._index_bytes(f'{table}_{index}') for index in self._indexes(table)
+                    },
+                    'cases': {name: self._time(table, name, sql, params, options['repeat'], rolled_back)
+                              for name, sql, params, rolled_back in cases},
+                }
+        finally:
+            if not options['keep']:
+                self._drop()
+
+        self._print(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def _drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {PLAIN}, {PARTITIONED}')
+
+    def _create_plain(self, first_year, years):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {PLAIN} ({COLUMNS}, PRIMARY KEY ("id"))')
+
+    def _create_partitioned(self, first_year, years):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {PARTITIONED} ({COLUMNS}, PRIMARY KEY ("id", "date")) PARTITION BY RANGE ("date")')
+            for year in range(first_year, first_year + years):
+                cursor.execute(
+                    f'CREATE TABLE {PARTITIONED}_y{year} PARTITION OF {PARTITIONED} '
+                    f"FOR VALUES FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')"
+                )
+            cursor.execute(f'CREATE TABLE {PARTITIONED}_default PARTITION OF {PARTITIONED} DEFAULT')
+
+    def _indexes(self, table):
+        # The transaction table's indexes; migration 0024 adds the BRIN index on date
+        indexes = {
+            'date': '("date")',
+            'year_month': '("year", "month")',
+            'share_type_date': '("share_name", "type", "date")',
+        }
+        if table == PARTITIONED:
+            indexes['date_brin'] = 'USING brin ("date")'
+        return indexes
+
+    def _index(self, table):
+        with connection.cursor() as cursor:
+            for index, definition in self._indexes(table).items():
+                cursor.execute(f'CREATE INDEX {table}_{index} ON {table} {definition}')
+
+    def _index_bytes(self, index):
+        with connection.cursor() as cursor:
+            # pg_partition_tree (PostgreSQL 12+): a partitioned index and its per-partition indexes
+            cursor.execute(
+                'SELECT COALESCE(SUM(pg_relation_size(relid)), 0) FROM pg_partition_tree(%s::regclass)', [index]
+            )
+            size = cursor.fetchone()[0]
+            if not size:
+                cursor.execute('SELECT pg_relation_size(%s::regclass)', [index])
+                size = cursor.fetchone()[0]
+            # SUM over bigint is numeric (a Decimal)
+            return int(size)
+
+    def _time(self, table, name, sql, params, repeat, rolled_back):
+        seconds = []
+        for _ in range(repeat + 1):
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    begin = time.perf_counter()
+                    if name == 'delete_year' and table == PARTITIONED:
+                        # A whole year is a partition: detach and drop it instead of deleting its rows
+                        year = params[0].year
+                        cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {table}_y{year}')
+                        cursor.execute(f'DROP TABLE {table}_y{year}')
+                    elif name == 'delete_year':
+                        cursor.execute(f'DELETE FROM {table} WHERE "date" >= %s AND "date" <= %s', params)
+                    else:
+                        cursor.execute(sql.format(table=table), params)
+                        if cursor.description:
+                            cursor.fetchall()
+                    seconds.append(time.perf_counter() - begin)
+                if rolled_back:
+                    transaction.set_rollback(True)
+        # The first run warms the cache
+        seconds = seconds[1:]
+        return {'median_ms': round(statistics.median(seconds) * 1000, 2), 'runs_ms': [round(s * 1000, 2) for s in seconds]}
+
+    def _print(self, report):
+        plain = report['tables'].get(PLAIN)
+        partitioned = report['tables'].get(PARTITIONED)
+        if not (plain and partitioned):
+            return
+        self.stdout.write(f'\n{"case":<18}{"plain":>12}{"partitioned":>14}{"speedup":>10}')
+        for name, before in plain['cases'].items():
+            after = partitioned['cases'][name]
+            speedup = before['median_ms'] / after['median_ms'] if after['median_ms'] else None
+            self.stdout.write(
+                f'{name:<18}{before["median_ms"]:>10.1f}ms{after["median_ms"]:>12.1f}ms'
+                f'{f"{speedup:.1f}x" if speedup else "-":>10}'
+            )
+        for index, size in partitioned['index_bytes'].items():
+            before = plain['index_bytes'].get(index)
+            self.stdout.write(
+                f'{f"index {index}":<18}{f"{before / 1024 / 1024:.1f}MB" if before is not None else "-":>12}'
+                f'{size / 1024 / 1024:>12.2f}MB'
+            )
@@ -0,0 +1,202 @@
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from investec.management.commands.loadtest import _free_port, _request
+
+
+# Modules that should only be imported by the upload/import paths
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl')
+GUNICORN_CONFIGS = {
+    'default': os.path.join('config', 'gunicorn.py'),
+    'production': os.path.join('config', 'gunicorn_production.py'),
+}
+# Loads the settings, the apps and the URLconf, like every manage.py command that runs checks
+IMPORT_SNIPPET = 'import django; django.setup(); from django.urls import get_resolver; get_resolver().url_patterns'
+
+
+def _parse_importtime(stderr):
+    """Return (total self time, {top-level module: cumulative}, {module: cumulative}) in microseconds."""
+    total = 0
+    top_level = {}
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|', 2)
+        total += int(own)
+        modules[name.strip()] = int(cumulative)
+        if not name.startswith('  '):
+            top_level[name.strip()] = int(cumulative)
+    return total, top_level, modules
+
+
+def _worker_pids(master_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # "pid (comm) state ppid ...": comm may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(entry))
+    return pids
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark process startup: python -X importtime of the settings, apps and URLconf (and '
+        'whether pandas/numpy/openpyxl get imported), the wall time of a manage.py command, and '
+        'for config/gunicorn.py and config/gunicorn_production.py the time from launch to the first '
+        'answered request and from a killed worker to the first request its replacement answers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each measurement (default: 3)')
+        parser.add_argument('--path', default='/api/investec/export/companies/', help='Request to time (GET)')
+        parser.add_argument('--configs', default='default,production', help='Gunicorn configs to compare')
+        parser.add_argument('--top', type=int, default=10, help='Slowest top-level imports to list (default: 10)')
+        parser.add_argument('--output', help='Also write the report to this JSON file')
+
+    def handle(self, *args, **options):
+        configs = [name.strip() for name in options['configs'].split(',') if name.strip()]
+        unknown = set(configs) - set(GUNICORN_CONFIGS)
+        if unknown:
+            raise CommandError(f'Unknown --configs {", ".join(sorted(unknown))}: use {", ".join(GUNICORN_CONFIGS)}')
+        repeat = max(options['repeat'], 1)
+
+        report = {
+            'meta': {
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'settings': os.environ.get('DJANGO_SETTINGS_MODULE'),
+                'worker_class': os.environ.get('GUNICORN_WORKER_CLASS', 'sync'),
+                'repeat': repeat,
+                'path': options['path'],
+            },
+            'imports': self._importtime(repeat, options['top']),
+            'manage_py_check': self._manage_py(repeat),
+            'gunicorn': {name: self._gunicorn(name, repeat, options['path']) for name in configs},
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Report written to {options["output"]}'))
+
+    def _importtime(self, repeat, top):
+        runs = []
+        for _ in range(repeat):
+            process = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', IMPORT_SNIPPET],
+                cwd=settings.BASE_DIR, capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                raise CommandError(f'Import run failed:\n{process.stderr[-2000:]}')
+            runs.append(_parse_importtime(process.stderr))
+        # Report the fastest run: the others include disk cache effects
+        total, top_level, modules = min(runs, key=lambda run: run[0])
+        slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:top]
+        heavy = {name: round(modules[name] / 1000, 1) for name in HEAVY_MODULES if name in modules}
+
+        self.stdout.write(f'\nImports (settings, apps, URLconf): {total / 1000:.0f}ms')
+        for name, cumulative in slowest:
+            self.stdout.write(f'  {cumulative / 1000:>8.1f}ms  {name}')
+        if heavy:
+            self.stdout.write(self.style.WARNING(
+                '  Heavy modules imported at startup: ' + ', '.join(f'{name} ({ms}ms)' for name, ms in heavy.items())
+            ))
+        else:
+            self.stdout.write(f'  None of {", ".join(HEAVY_MODULES)} imported')
+        return {
+            'total_ms': round(total / 1000, 1),
+            'top_level_ms': {name: round(cumulative / 1000, 1) for name, cumulative in slowest},
+            'heavy_modules_ms': heavy,
+        }
+
+    def _manage_py(self, repeat):
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, 'manage.py', 'check'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+            )
+            seconds.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                raise CommandError(f'manage.py check failed:\n{process.stderr[-2000:]}')
+        median = statistics.median(seconds)
+        self.stdout.write(f'\nmanage.py check: {median * 1000:.0f}ms (median of {repeat})')
+        return {'median_ms': round(median * 1000, 1), 'runs_ms': [round(s * 1000, 1) for s in seconds]}
+
+    def _gunicorn(self, name, repeat, path):
+        first_request = []
+        restart = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(prefix='investec-startup-') as workdir:
+                port = _free_port()
+                url = f'http://127.0.0.1:{port}{path}'
+                env = dict(
+                    os.environ,
+                    GUNICORN_BIND=f'127.0.0.1:{port}',
+                    GUNICORN_WORKERS='1',
+                    PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+                )
+                application = 'config.asgi:application' if 'uvicorn' in env.get('GUNICORN_WORKER_CLASS', '') else 'config.wsgi:application'
+                log_path = os.path.join(workdir, 'gunicorn.log')
+                with open(log_path, 'w') as log:
+                    start = time.perf_counter()
+                    server = subprocess.Popen(
+                        [sys.executable, '-m', 'gunicorn', '-c', GUNICORN_CONFIGS[name], application],
+                        cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+                    )
+                try:
+                    first_request.append(self._first_answer(url, server, start, log_path))
+                    # The master answers a killed worker by forking a replacement; the
+                    # request waits in the listen backlog until that worker accepts it
+                    workers = _worker_pids(server.pid)
+                    if workers:
+                        start = time.perf_counter()
+                        os.kill(workers[0], signal.SIGKILL)
+                        restart.append(self._first_answer(url, server, start, log_path))
+                finally:
+                    server.terminate()
+                    try:
+                        server.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        server.kill()
+
+        result = {
+            'config': GUNICORN_CONFIGS[name],
+            'first_request_ms': round(statistics.median(first_request) * 1000, 1),
+            'worker_restart_ms': round(statistics.median(restart) * 1000, 1) if restart else None,
+        }
+        restart_text = f'{result["worker_restart_ms"]:.0f}ms' if restart else '-'
+        self.stdout.write(
+            f'\ngunicorn ({result["config"]}): first request {result["first_request_ms"]:.0f}ms after launch, '
+            f'{restart_text} after a worker is killed (median of {repeat})'
+        )
+        return result
+
+    def _first_answer(self, url, server, start, log_path, timeout=60):
+        """Seconds from start until url answers with a status below 500."""
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                with open(log_path) as f:
+                    raise CommandError(f'gunicorn exited with code {server.returncode}:\n{f.read()[-2000:]}')
+            status, seconds = _request(url, timeout=timeout)
+            if status is not None and status < 500:
+                return time.perf_counter() - start
+            time.sleep(0.01)
+        raise CommandError(f'{url} did not answer within {timeout}s')
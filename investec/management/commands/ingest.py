@@ -0,0 +1,125 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from investec.importers import (
+    EXCEL_EXTENSIONS, FILE_MAPPING, FILE_PORTFOLIO, FILE_TRANSACTIONS, apply_parsed_files, parse_path, parsed_row_count,
+)
+
+from .rebuild_derived import _init_worker
+
+
+def _parse_path(path):
+    """Classify and parse one workbook in a worker process."""
+    start = time.perf_counter()
+    kind, parsed = parse_path(path)
+    return path, kind, parsed, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk-load a directory tree of Investec exports (transaction statements, portfolio holdings '
+        'reports and share name mappings). Files are classified by their headers and parsed in '
+        'parallel, then applied in date order (mappings first, then portfolios, then transactions). '
+        'Dividend TTM, performance, positions and cost basis are recomputed once at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to scan recursively for .xlsx/.xls files')
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='Worker processes for parsing (default: min(4, CPUs))')
+        parser.add_argument('--dry-run', action='store_true', help='Classify and parse only; write nothing')
+        parser.add_argument('--skip-derived', action='store_true', help='Do not run the final rebuild_derived pass')
+
+    def handle(self, *args, **options):
+        paths = self._find_files(options['directory'])
+        if not paths:
+            raise CommandError(f'No Excel files found under {options["directory"]}')
+        run_start = time.perf_counter()
+        workers = max(1, options['workers'])
+
+        # Parse: CPU bound and independent per file
+        self.stdout.write(f'Parsing {len(paths)} files with {workers} workers...')
+        parsed_files = {FILE_MAPPING: [], FILE_PORTFOLIO: [], FILE_TRANSACTIONS: []}
+        failures = []
+        parsed_rows = 0
+        parse_start = time.perf_counter()
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = [executor.submit(_parse_path, path) for path in paths]
+            for done, future in enumerate(as_completed(futures), start=1):
+                path, kind, parsed, elapsed = future.result()
+                name = os.path.relpath(path, options['directory'])
+                if not parsed['success']:
+                    failures.append((name, parsed['error']))
+                    self.stdout.write(self.style.ERROR(f'[{done}/{len(paths)}] {"failed":<12} {name}: {parsed["error"]}'))
+                    continue
+                rows = parsed_row_count(parsed)
+                parsed_rows += rows
+                parsed['filename'] = name
+                parsed_files[kind].append(parsed)
+                self.stdout.write(
+                    f'[{done}/{len(paths)}] {kind:<12} {name}: {rows} rows, '
+                    f'{len(parsed["errors"])} row errors, {elapsed:.2f}s'
+                )
+        parse_elapsed = time.perf_counter() - parse_start
+
+        if options['dry_run']:
+            self._summary(parsed_rows, parse_elapsed, failures, run_start, applied=False)
+            return
+
+        # Apply in dependency/date order, then recompute derived data once for everything loaded
+        apply_start = time.perf_counter()
+
+        def on_applied(kind, parsed, result):
+            if not result['success']:
+                failures.append((parsed['filename'], result['error']))
+                self.stdout.write(self.style.ERROR(f'  failed {parsed["filename"]}: {result["error"]}'))
+            else:
+                self.stdout.write(f'  applied {parsed["filename"]}: {result["message"]}')
+
+        rebuild = apply_parsed_files(parsed_files, on_applied=on_applied)
+        apply_elapsed = time.perf_counter() - apply_start
+
+        if rebuild['rebuild'] and not options['skip_derived']:
+            from_date = rebuild['rebuild_from']
+            self.stdout.write(f'Rebuilding derived data from {from_date or "the first transaction"}...')
+            call_command(
+                'rebuild_derived',
+                from_date=from_date.isoformat() if from_date else None,
+                workers=workers,
+                stdout=self.stdout,
+                stderr=self.stderr,
+            )
+
+        self.stdout.write(f'Applied in {apply_elapsed:.2f}s ({self._rate(parsed_rows, apply_elapsed)} rows/s)')
+        self._summary(parsed_rows, parse_elapsed, failures, run_start, applied=True)
+
+    def _find_files(self, directory):
+        if not os.path.isdir(directory):
+            raise CommandError(f'Not a directory: {directory}')
+        paths = []
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                # Skip Excel lock files (~$name.xlsx)
+                if filename.lower().endswith(EXCEL_EXTENSIONS) and not filename.startswith('~$'):
+                    paths.append(os.path.join(root, filename))
+        return sorted(paths)
+
+    def _rate(self, rows, elapsed):
+        return f'{rows / elapsed:,.0f}' if elapsed > 0 else '-'
+
+    def _summary(self, rows, parse_elapsed, failures, run_start, applied):
+        total_elapsed = time.perf_counter() - run_start
+        self.stdout.write(f'Parsed {rows} rows in {parse_elapsed:.2f}s ({self._rate(rows, parse_elapsed)} rows/s)')
+        if failures:
+            self.stdout.write(self.style.WARNING(f'{len(failures)} files skipped:'))
+            for name, error in failures:
+                self.stdout.write(f'  {name}: {error}')
+        message = f'Done in {total_elapsed:.2f}s: {rows} rows, {self._rate(rows, total_elapsed)} rows/s'
+        if not applied:
+            message += ' (dry run, nothing written)'
+        self.stdout.write(self.style.SUCCESS(message))
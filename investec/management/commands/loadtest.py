@@ -0,0 +1,310 @@
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from investec.synthetic import generate_dataset, share_catalog
+
+
+# Uploads of the generated dataset, in the order the app expects them
+SEED_UPLOADS = [
+    ('mapping', '/api/investec/mapping/upload/', 'file'),
+    ('portfolio', '/api/investec/portfolio/upload/', 'files'),
+    ('transactions', '/api/investec/upload/', 'file'),
+]
+UPLOAD_FIELDS = {kind: field for kind, url, field in SEED_UPLOADS}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _multipart(field, path):
+    """Encode one file as a multipart/form-data body; returns (body, content type)."""
+    boundary = uuid.uuid4().hex
+    with open(path, 'rb') as f:
+        content = f.read()
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="{field}"; filename="{os.path.basename(path)}"\r\n'.encode(),
+        b'Content-Type: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet\r\n\r\n',
+        content,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def _request(url, method='GET', body=None, content_type=None, timeout=120):
+    """Return (status code, seconds); status is None when the request failed without a response."""
+    request = urllib.request.Request(url, data=body, method=method)
+    if content_type:
+        request.add_header('Content-Type', content_type)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return status, time.perf_counter() - start
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the API: boot it under gunicorn (config/gunicorn.py), seed the configured '
+        'database with a synthetic statement, portfolio and mapping through the upload endpoints, '
+        'then drive the concurrent mix of requests described by a scenario file and report '
+        'p50/p95/p99 latency, throughput and error rate per scenario. --asgi serves the ASGI '
+        'application under uvicorn workers; --compare prints the change against an earlier report '
+        '(e.g. the same scenarios against the sync and async endpoints). WRITES TO THE CONFIGURED DATABASE.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', help='Scenario file (JSON), e.g. scripts/loadtest_scenario.json')
+        parser.add_argument('--url', help='Test an already running server instead of starting gunicorn')
+        parser.add_argument('--workers', type=int, help='Gunicorn workers (overrides the scenario file)')
+        parser.add_argument('--asgi', action='store_true', help='Serve config.asgi:application under uvicorn workers')
+        parser.add_argument('--duration', type=float, help='Seconds to run (overrides the scenario file)')
+        parser.add_argument('--seed-rows', type=int, help='Statement rows to seed (overrides the scenario file)')
+        parser.add_argument('--no-seed', action='store_true', help='Use the data already in the database')
+        parser.add_argument('--output', help='Also write the report to this JSON file')
+        parser.add_argument('--compare', help='Earlier report (--output) to compare against, by scenario name')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive', help='Do not ask for confirmation')
+
+    def handle(self, *args, **options):
+        plan = self._load_scenario(options['scenario'])
+        duration = options['duration'] or plan.get('duration', 30)
+        workers = options['workers'] or plan.get('workers', 2)
+        seed_rows = options['seed_rows'] or plan.get('seed_rows', 10000)
+        timeout = plan.get('timeout', 120)
+        baseline = self._load_report(options['compare']) if options['compare'] else None
+
+        if options['interactive'] and not options['no_seed']:
+            answer = input(
+                f'This uploads {seed_rows} synthetic transactions into database '
+                f'"{connection.settings_dict["NAME"]}" ({connection.vendor}), replacing data in their date range.\n'
+                "Type 'yes' to continue: "
+            )
+            if answer != 'yes':
+                raise CommandError('Load test cancelled.')
+
+        workdir = tempfile.mkdtemp(prefix='investec-loadtest-')
+        server = None
+        try:
+            if options['url']:
+                base_url = options['url'].rstrip('/')
+            else:
+                server, base_url = self._start_gunicorn(workers, workdir, options['asgi'])
+            self._wait_ready(base_url, server)
+
+            start = time.perf_counter()
+            files = generate_dataset(os.path.join(workdir, 'data'), seed_rows, seed=plan.get('seed', 0))
+            self.stdout.write(f'Generated {seed_rows} statement rows in {time.perf_counter() - start:.1f}s')
+            if not options['no_seed']:
+                self._seed(base_url, files, timeout)
+
+            report = self._run(base_url, plan['scenarios'], files, duration, seed_rows, timeout)
+        finally:
+            if server:
+                server.terminate()
+                try:
+                    server.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        report['meta'] = {
+            'scenario': options['scenario'],
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'url': options['url'],
+            'gunicorn_workers': None if options['url'] else workers,
+            'worker_class': None if options['url'] else ('uvicorn' if options['asgi'] else 'sync'),
+            'duration': duration,
+            'seed_rows': seed_rows,
+            'database': connection.vendor,
+        }
+        self._print_report(report, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Report written to {options["output"]}'))
+
+    def _load_scenario(self, path):
+        try:
+            with open(path) as f:
+                plan = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read scenario file {path}: {e}')
+        scenarios = plan.get('scenarios')
+        if not scenarios:
+            raise CommandError(f'{path} defines no scenarios')
+        for scenario in scenarios:
+            if 'name' not in scenario or 'path' not in scenario:
+                raise CommandError(f'Every scenario needs a name and a path: {scenario}')
+            if scenario.get('file') and scenario['file'] not in UPLOAD_FIELDS:
+                raise CommandError(f'Scenario {scenario["name"]}: file must be one of mapping, portfolio, transactions')
+        return plan
+
+    def _load_report(self, path):
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        meta = previous.get('meta', {})
+        self.stdout.write(f'Comparing against {path} ({meta.get("worker_class") or "sync"} workers, {meta.get("scenario")})')
+        return {result['scenario']: result for result in previous['results']}
+
+    def _start_gunicorn(self, workers, workdir, asgi=False):
+        port = _free_port()
+        env = dict(
+            os.environ,
+            GUNICORN_BIND=f'127.0.0.1:{port}',
+            GUNICORN_WORKERS=str(workers),
+            PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+        )
+        application = 'config.wsgi:application'
+        if asgi:
+            application = 'config.asgi:application'
+            env.update(GUNICORN_WORKER_CLASS='uvicorn_worker.UvicornWorker', DB_CONN_MAX_AGE='0')
+        command = [
+            sys.executable, '-m', 'gunicorn', '-c', os.path.join(settings.BASE_DIR, 'config', 'gunicorn.py'),
+            application,
+        ]
+        self.stdout.write(f'Starting gunicorn with {workers} {"uvicorn" if asgi else "sync"} workers on port {port}')
+        self.server_log = os.path.join(workdir, 'gunicorn.log')
+        with open(self.server_log, 'w') as log:
+            server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        return server, f'http://127.0.0.1:{port}'
+
+    def _wait_ready(self, base_url, server, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server and server.poll() is not None:
+                with open(self.server_log) as f:
+                    raise CommandError(f'gunicorn exited with code {server.returncode}:\n{f.read()[-2000:]}')
+            # Any answer will do: /metrics may be forbidden to this client (INVESTEC_METRICS_ALLOWED_IPS)
+            status, seconds = _request(f'{base_url}/metrics', timeout=5)
+            if status is not None and status < 500:
+                return
+            time.sleep(0.5)
+        raise CommandError(f'{base_url} did not become ready within {timeout}s')
+
+    def _seed(self, base_url, files, timeout):
+        for kind, url, field in SEED_UPLOADS:
+            body, content_type = _multipart(field, files[kind])
+            status, seconds = _request(base_url + url, 'POST', body, content_type, timeout=max(timeout, 600))
+            if status is None or status >= 300:
+                raise CommandError(f'Seeding {kind} failed (HTTP {status})')
+            self.stdout.write(f'Seeded {kind} in {seconds:.1f}s')
+
+    def _run(self, base_url, scenarios, files, duration, seed_rows, timeout):
+        """Run every scenario's threads concurrently for `duration` seconds."""
+        samples = {scenario['name']: [] for scenario in scenarios}
+        shares = [share[0] for share in share_catalog()]
+        bodies = {}
+        for scenario in scenarios:
+            if scenario.get('file'):
+                field = scenario.get('field') or UPLOAD_FIELDS[scenario['file']]
+                bodies[scenario['name']] = _multipart(field, files[scenario['file']])
+
+        deadline = time.monotonic() + duration
+        lock = threading.Lock()
+
+        def worker(scenario, number):
+            rng = random.Random(f'{scenario["name"]}-{number}')
+            method = scenario.get('method', 'POST' if scenario.get('file') else 'GET')
+            body, content_type = bodies.get(scenario['name'], (None, None))
+            think_time = scenario.get('think_time', 0)
+            while time.monotonic() < deadline:
+                path = scenario['path'].format(
+                    offset=rng.randrange(max(seed_rows, 1)),
+                    share_name=urllib.parse.quote(rng.choice(shares)),
+                )
+                status, seconds = _request(base_url + path, method, body, content_type, timeout=timeout)
+                with lock:
+                    samples[scenario['name']].append((status, seconds))
+                if think_time:
+                    time.sleep(rng.uniform(0.5, 1.5) * think_time)
+
+        threads = [
+            threading.Thread(target=worker, args=(scenario, number), daemon=True)
+            for scenario in scenarios
+            for number in range(scenario.get('concurrency', 1))
+        ]
+        self.stdout.write(f'Running {len(threads)} clients for {duration:g}s...')
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results = []
+        for scenario in scenarios:
+            runs = samples[scenario['name']]
+            latencies = sorted(seconds for status, seconds in runs)
+            errors = sum(1 for status, seconds in runs if status is None or status >= 400)
+            results.append({
+                'scenario': scenario['name'],
+                'concurrency': scenario.get('concurrency', 1),
+                'requests': len(runs),
+                'errors': errors,
+                'error_rate': round(errors / len(runs), 4) if runs else None,
+                'throughput': round(len(runs) / elapsed, 2),
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+                'status_codes': {
+                    str(code): sum(1 for status, seconds in runs if status == code)
+                    for code in sorted({status for status, seconds in runs}, key=str)
+                },
+            })
+        return {'elapsed': round(elapsed, 2), 'results': results}
+
+    def _print_report(self, report, baseline=None):
+        header = f'\n{"scenario":<24}{"conc":>5}{"reqs":>7}{"req/s":>8}{"err%":>7}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}'
+        if baseline:
+            header += f'{"req/s was":>11}{"p95 was":>9}'
+        self.stdout.write(header)
+        for result in report['results']:
+            def ms(value):
+                return f'{value * 1000:.0f}ms' if value is not None else '-'
+            error_rate = f'{result["error_rate"] * 100:.1f}' if result['error_rate'] is not None else '-'
+            line = (
+                f'{result["scenario"]:<24}{result["concurrency"]:>5}{result["requests"]:>7}{result["throughput"]:>8}'
+                f'{error_rate:>7}{ms(result["p50"]):>9}{ms(result["p95"]):>9}{ms(result["p99"]):>9}{ms(result["max"]):>9}'
+            )
+            previous = baseline.get(result['scenario']) if baseline else None
+            if previous:
+                line += f'{previous["throughput"]:>11}{ms(previous["p95"]):>9}'
+            self.stdout.write(self.style.ERROR(line) if result['errors'] else line)
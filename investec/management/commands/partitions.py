@@ -0,0 +1,50 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from investec.partitions import PARTITIONED_MODELS, detach_partition, ensure_partitions, is_partitioned, list_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        'List, create and detach the yearly partitions of the transaction and portfolio tables '
+        '(PostgreSQL, see migration 0024). --create adds the partitions for the given years ahead '
+        'of an import; --detach takes a year out of the table, keeping it as a plain table of the '
+        'same name unless --drop is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', choices=sorted(PARTITIONED_MODELS), action='append', help='Table to work on (repeatable, default: all)')
+        parser.add_argument('--create', type=int, action='append', default=[], metavar='YEAR', help='Create the partition for YEAR (repeatable)')
+        parser.add_argument('--detach', type=int, action='append', default=[], metavar='YEAR', help='Detach the partition for YEAR (repeatable)')
+        parser.add_argument('--drop', action='store_true', help='Drop detached partitions instead of keeping them')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(f'Partitions need PostgreSQL (the configured database is {connection.vendor}).')
+        if options['drop'] and not options['detach']:
+            raise CommandError('--drop only applies with --detach')
+        tables = options['table'] or sorted(PARTITIONED_MODELS)
+
+        for key in tables:
+            model = PARTITIONED_MODELS[key]
+            table = model._meta.db_table
+            if not is_partitioned(model):
+                raise CommandError(f'{table} is not partitioned: run migrate first.')
+            created = ensure_partitions(model, [date(year, 1, 1) for year in options['create']])
+            for year in created:
+                self.stdout.write(self.style.SUCCESS(f'Created partition {table}_y{year}'))
+            for year in sorted(options['detach']):
+                if year not in {partition['year'] for partition in list_partitions(model)}:
+                    raise CommandError(f'{table} has no partition for {year}')
+                name = detach_partition(model, year, drop=options['drop'])
+                self.stdout.write(self.style.SUCCESS(
+                    f'Dropped partition {name}' if options['drop'] else f'Detached partition {name} (kept as a plain table)'
+                ))
+
+            self.stdout.write(f'\n{table}')
+            for partition in list_partitions(model):
+                year = partition['year'] or 'default'
+                self.stdout.write(f'  {year!s:<9}{partition["rows"]:>12} rows{partition["bytes"] / 1024 / 1024:>10.1f} MB  {partition["name"]}')
+
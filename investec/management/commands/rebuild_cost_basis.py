@@ -0,0 +1,110 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from investec.cost_basis import METHODS, _fifo_sequential, match_streams, rebuild_cost_basis
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute realized gains and open lots from Buy/Sell transactions (FIFO or average cost). '
+        'With --benchmark-trades, time the matching engine on synthetic trades instead (no database writes).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--method', choices=list(METHODS) + ['all'], default='fifo', help='Lot matching method (default: fifo)')
+        parser.add_argument('--account', action='append', default=[], help='Account number to recompute (repeatable)')
+        parser.add_argument('--share', action='append', default=[], help='Share name to recompute (repeatable)')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes for matching (default: 1)')
+        parser.add_argument('--benchmark-trades', type=int, default=0, help='Benchmark on this many synthetic trades, e.g. 1000000')
+        parser.add_argument('--benchmark-shares', type=int, default=500, help='Number of synthetic share streams (default: 500)')
+
+    def handle(self, *args, **options):
+        methods = list(METHODS) if options['method'] == 'all' else [options['method']]
+
+        if options['benchmark_trades']:
+            self._benchmark(options['benchmark_trades'], options['benchmark_shares'], methods, options['workers'])
+            return
+
+        keys = None
+        if options['account'] or options['share']:
+            from investec.models import InvestecJseTransaction
+
+            queryset = InvestecJseTransaction.objects.filter(type__in=['Buy', 'Sell'])
+            if options['account']:
+                queryset = queryset.filter(account_number__in=options['account'])
+            if options['share']:
+                queryset = queryset.filter(share_name__in=options['share'])
+            keys = set(queryset.values_list('account_number', 'share_name').distinct())
+            if not keys:
+                raise CommandError('No Buy/Sell transactions match the given --account/--share filters.')
+
+        for method in methods:
+            start = time.perf_counter()
+            result = rebuild_cost_basis(keys=keys, method=method, workers=options['workers'])
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f"{method}: {result['streams']} streams, {result['realized_gains']} realized gains, "
+                f"{result['open_lots']} open lots in {elapsed:.2f}s"
+            ))
+            if result['skipped_without_price']:
+                self.stdout.write(self.style.WARNING(
+                    f"{method}: skipped {result['skipped_without_price']} Buy/Sell transactions without value_per_share"
+                ))
+
+    def _synthetic_streams(self, trades, shares, seed=42):
+        """Random Buy/Sell streams that never sell more than is held."""
+        rng = np.random.default_rng(seed)
+        sizes = rng.multinomial(trades, np.full(shares, 1.0 / shares))
+        streams = {}
+        next_id = 1
+        for share_index, size in enumerate(sizes):
+            if size == 0:
+                continue
+            is_buy = rng.random(size) < 0.6
+            qty = rng.integers(1, 1000, size).astype(float)
+            # Turn sells with nothing held into buys and cap the rest at the position held
+            position = 0.0
+            for i in range(size):
+                if not is_buy[i] and position < 1:
+                    is_buy[i] = True
+                if is_buy[i]:
+                    position += qty[i]
+                else:
+                    qty[i] = min(qty[i], position)
+                    position -= qty[i]
+            streams[('BENCH', f'SHARE{share_index}')] = {
+                'ids': np.arange(next_id, next_id + size, dtype=np.int64),
+                'dates': np.datetime64('2010-01-01') + np.sort(rng.integers(0, 5000, size)).astype('timedelta64[D]'),
+                'is_buy': is_buy,
+                'qty': qty,
+                'price': rng.uniform(1, 500, size).round(2),
+            }
+            next_id += size
+        return streams
+
+    def _benchmark(self, trades, shares, methods, workers):
+        self.stdout.write(f'Generating {trades:,} synthetic trades across {shares} shares...')
+        streams = self._synthetic_streams(trades, shares)
+
+        # Correctness check: vectorized FIFO against the sequential reference on one stream
+        key = next(iter(streams))
+        sample = match_streams({key: streams[key]}, method='fifo')[key]
+        stream = streams[key]
+        order = np.lexsort((stream['ids'], ~stream['is_buy'], stream['dates']))
+        reference_cost, _, _ = _fifo_sequential(stream['is_buy'][order], stream['qty'][order], stream['price'][order])
+        vectorized_cost = sample['sell_cost']
+        if not np.allclose(vectorized_cost, [reference_cost[i] for i in sorted(reference_cost)]):
+            raise CommandError('Vectorized FIFO disagrees with the sequential reference.')
+
+        for method in methods:
+            for worker_count in sorted({1, workers}):
+                start = time.perf_counter()
+                results = match_streams(streams, method=method, workers=worker_count)
+                elapsed = time.perf_counter() - start
+                sells = sum(len(result['sell_ids']) for result in results.values())
+                self.stdout.write(self.style.SUCCESS(
+                    f'{method} workers={worker_count}: {trades:,} trades ({sells:,} sells) in {elapsed:.2f}s '
+                    f'= {trades / elapsed:,.0f} trades/s'
+                ))
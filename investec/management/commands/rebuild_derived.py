@@ -0,0 +1,192 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.dateparse import parse_date
+
+
+def _init_worker():
+    """Give every worker process its own database connections."""
+    import django
+    django.setup()
+    connections.close_all()
+
+
+def _rebuild_share(share_name, date_from, date_to, account_numbers):
+    from investec.ttm import rebuild_share_ttm
+
+    start = time.perf_counter()
+    result = rebuild_share_ttm(share_name, date_from=date_from, date_to=date_to, account_numbers=account_numbers)
+    return share_name, result, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild derived data (monthly share performance, transaction dividend_ttm, position '
+        'checkpoints and cost basis) from the stored transactions and portfolios. Work is '
+        'partitioned by share across a process pool; each share is written in its own '
+        'transaction, so an interrupted run can be continued with --resume.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-date', help='Only rebuild months from this date (YYYY-MM-DD)')
+        parser.add_argument('--to-date', help='Only rebuild months up to this date (YYYY-MM-DD)')
+        parser.add_argument('--share', action='append', default=[], help='Share name to rebuild (repeatable, default: all)')
+        parser.add_argument('--account', action='append', default=[], help='Account number to rebuild the dividend TTM of (repeatable, default: all)')
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='Worker processes (default: min(4, CPUs))')
+        parser.add_argument('--resume', action='store_true', help='Skip shares completed by the previous, interrupted run with the same arguments')
+        parser.add_argument('--state-file', default=os.path.join(settings.BASE_DIR, '.rebuild_derived_state.json'), help='Progress file used by --resume')
+        parser.add_argument('--skip-positions', action='store_true', help='Do not rebuild position checkpoints')
+        parser.add_argument('--skip-cost-basis', action='store_true', help='Do not rebuild realized gains and open lots')
+
+    def handle(self, *args, **options):
+        from investec.models import InvestecJseTransaction
+        from investec.ttm import DIVIDEND_TYPES
+
+        date_from = self._parse_date(options['from_date'], '--from-date')
+        date_to = self._parse_date(options['to_date'], '--to-date')
+        run_start = time.perf_counter()
+
+        # Partitions: every share with dividend transactions (optionally restricted by --share)
+        shares = InvestecJseTransaction.objects.filter(type__in=DIVIDEND_TYPES).exclude(share_name='')
+        if options['share']:
+            shares = shares.filter(share_name__in=options['share'])
+        if options['account']:
+            shares = shares.filter(account_number__in=options['account'])
+        shares = sorted(set(shares.values_list('share_name', flat=True)))
+
+        signature = {
+            'from_date': options['from_date'],
+            'to_date': options['to_date'],
+            'shares': sorted(options['share']),
+            'accounts': sorted(options['account']),
+        }
+        account_numbers = options['account'] or None
+        completed = self._load_state(options['state_file'], signature) if options['resume'] else set()
+        pending = [share for share in shares if share not in completed]
+        if completed:
+            self.stdout.write(f'Resuming: {len(completed)} of {len(shares)} shares already rebuilt')
+
+        totals = {'performance': 0, 'transactions': 0}
+        failures = []
+        already_done = len(shares) - len(pending)
+        processed = 0
+        ttm_start = time.perf_counter()
+
+        # Child processes must open their own connections, not inherit the parent's socket
+        connections.close_all()
+        workers = max(1, options['workers'])
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = {executor.submit(_rebuild_share, share, date_from, date_to, account_numbers): share for share in pending}
+            for future in as_completed(futures):
+                try:
+                    share_name, result, elapsed = future.result()
+                except Exception as e:
+                    failures.append(f'{futures[future]}: {e}')
+                    continue
+                completed.add(share_name)
+                self._save_state(options['state_file'], signature, completed)
+                totals['performance'] += result['performance']
+                totals['transactions'] += result['transactions']
+                processed += 1
+                self._progress(already_done + processed, len(shares), processed, share_name, result, elapsed, ttm_start)
+        if pending:
+            self.stdout.write('')
+        ttm_elapsed = time.perf_counter() - ttm_start
+
+        if failures:
+            for failure in failures[:20]:
+                self.stderr.write(self.style.ERROR(failure))
+            raise CommandError(
+                f'{len(failures)} shares failed; progress saved to {options["state_file"]}. Re-run with --resume.'
+            )
+
+        report = [(
+            'dividend TTM / performance',
+            totals['performance'] + totals['transactions'],
+            ttm_elapsed,
+        )]
+
+        if not options['skip_positions']:
+            from investec.ledger import refresh_positions
+
+            start = time.perf_counter()
+            checkpoints = refresh_positions(from_date=date_from)
+            report.append(('position checkpoints', checkpoints, time.perf_counter() - start))
+
+        if not options['skip_cost_basis']:
+            from investec.cost_basis import rebuild_cost_basis
+
+            keys = None
+            if options['share']:
+                keys = set(InvestecJseTransaction.objects.filter(
+                    type__in=['Buy', 'Sell'], share_name__in=options['share']
+                ).values_list('account_number', 'share_name').distinct())
+            start = time.perf_counter()
+            rows = 0
+            for method in settings.INVESTEC_COST_BASIS_METHODS:
+                result = rebuild_cost_basis(keys=keys, method=method, workers=workers)
+                rows += result['realized_gains'] + result['open_lots']
+            report.append(('cost basis', rows, time.perf_counter() - start))
+
+        # The stored dividend TTM (and, after a bulk load, the rows) changed
+        from investec.exports import refresh_exports
+
+        refresh_exports()
+
+        if os.path.exists(options['state_file']):
+            os.remove(options['state_file'])
+
+        total_elapsed = time.perf_counter() - run_start
+        total_rows = sum(rows for _, rows, _ in report)
+        self.stdout.write(f'Rebuilt {len(shares)} shares '
+                          f'({totals["performance"]} performance records, {totals["transactions"]} transactions updated)')
+        for stage, rows, elapsed in report:
+            self.stdout.write(f'  {stage:<28} {rows:>10} rows {elapsed:>8.2f}s {self._rate(rows, elapsed):>12} rows/s')
+        self.stdout.write(self.style.SUCCESS(
+            f'Done in {total_elapsed:.2f}s: {total_rows} rows, {self._rate(total_rows, total_elapsed)} rows/s'
+        ))
+
+    def _parse_date(self, value, option):
+        if not value:
+            return None
+        parsed = parse_date(value)
+        if parsed is None:
+            raise CommandError(f'Invalid {option}: {value}. Expected YYYY-MM-DD.')
+        return parsed
+
+    def _rate(self, rows, elapsed):
+        return f'{rows / elapsed:,.0f}' if elapsed > 0 else '-'
+
+    def _progress(self, done, total, processed, share_name, result, elapsed, started):
+        percent = 100.0 * done / total if total else 100.0
+        rate = processed / (time.perf_counter() - started)
+        remaining = (total - done) / rate if rate > 0 else 0
+        self.stdout.write(
+            f'\r[{done:>{len(str(total))}}/{total}] {percent:5.1f}% {share_name[:20]:<20} '
+            f'{result["performance"] + result["transactions"]:>7} rows {elapsed:6.2f}s  ETA {remaining:6.0f}s',
+            ending='',
+        )
+        self.stdout.flush()
+
+    def _load_state(self, path, signature):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get('signature') != signature:
+            self.stdout.write(self.style.WARNING('Saved progress is for different arguments; starting over'))
+            return set()
+        return set(state.get('completed', []))
+
+    def _save_state(self, path, signature, completed):
+        # Write then rename so an interruption never leaves a truncated state file
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'signature': signature, 'completed': sorted(completed)}, f)
+        os.replace(temp_path, path)
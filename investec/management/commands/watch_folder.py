@@ -0,0 +1,236 @@
+import os
+import shutil
+import signal
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files import File
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from investec.importers import (
+    EXCEL_EXTENSIONS, KIND_ORDER, batch_rebuild, import_parsed_file, parse_path, parsed_row_count, peek_path,
+)
+from investec.memory import MemoryTracker, over_budget
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Optional: without watchdog the folder is polled
+    Observer = None
+
+
+# Never let a file that keeps changing hold back files that are ready for longer than this
+MAX_BATCH_WAIT_SECONDS = 60
+# Safety rescan interval while inotify is active and nothing is pending
+IDLE_RESCAN_SECONDS = 60
+
+
+class Command(BaseCommand):
+    help = (
+        'Watch a folder for dropped Investec statements, portfolio reports and share name mappings. '
+        'Files are picked up once they stop changing, imported with the same functions as the upload '
+        'endpoints and moved to the archive (or error) folder. Files that arrive together are imported '
+        'as one batch, one file at a time within INVESTEC_WATCH_MEMORY_BUDGET_MB, followed by a single '
+        'derived-data rebuild. Uses inotify via the optional '
+        'watchdog package when installed, otherwise polls.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.INVESTEC_WATCH_DIR, help='Folder to watch (default: INVESTEC_WATCH_DIR)')
+        parser.add_argument('--archive-dir', default=settings.INVESTEC_WATCH_ARCHIVE_DIR, help='Where imported files are moved (default: <dir>/archive)')
+        parser.add_argument('--error-dir', default=settings.INVESTEC_WATCH_ERROR_DIR, help='Where failed files are moved (default: <dir>/error)')
+        parser.add_argument('--poll', type=float, default=settings.INVESTEC_WATCH_POLL_SECONDS, help='Seconds between scans when polling')
+        parser.add_argument('--settle', type=float, default=settings.INVESTEC_WATCH_SETTLE_SECONDS, help='Seconds a file must be unchanged before it is imported')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes for the derived-data rebuild (default: 1)')
+        parser.add_argument('--no-inotify', action='store_true', help='Poll even if watchdog is installed')
+        parser.add_argument('--once', action='store_true', help='Import the files already in the folder and exit')
+
+    def handle(self, *args, **options):
+        watch_dir = os.path.abspath(options['dir'])
+        archive_dir = options['archive_dir'] or os.path.join(watch_dir, 'archive')
+        error_dir = options['error_dir'] or os.path.join(watch_dir, 'error')
+        for folder in (watch_dir, archive_dir, error_dir):
+            try:
+                os.makedirs(folder, exist_ok=True)
+            except OSError as e:
+                raise CommandError(f'Cannot create {folder}: {e}')
+
+        settle = max(0.0, options['settle'])
+        poll = max(0.1, options['poll'])
+        wake = threading.Event()
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            stop.set()
+            wake.set()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+
+        observer = None
+        if Observer is not None and not options['no_inotify'] and not options['once']:
+            observer = Observer()
+            observer.schedule(_WakeHandler(wake), watch_dir, recursive=False)
+            observer.start()
+        self._log(f'Watching {watch_dir} ({"inotify" if observer else f"polling every {poll:g}s"}, settle {settle:g}s)')
+
+        # path -> (size, mtime_ns, unchanged since)
+        seen = {}
+        try:
+            while not stop.is_set():
+                ready, pending = self._scan(watch_dir, seen, settle)
+                oldest_ready = min((seen[path][2] for path in ready), default=None)
+                # Wait for files still being written so files dropped together share one rebuild
+                if ready and (not pending or time.monotonic() - oldest_ready >= MAX_BATCH_WAIT_SECONDS):
+                    self._process_batch(ready, archive_dir, error_dir, options['workers'])
+                    for path in ready:
+                        seen.pop(path, None)
+                    continue
+
+                if options['once'] and not pending:
+                    break
+                if observer and not pending:
+                    timeout = IDLE_RESCAN_SECONDS
+                else:
+                    timeout = min(poll, settle) if pending else poll
+                wake.wait(timeout=timeout)
+                wake.clear()
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+        self._log('Stopped')
+
+    def _scan(self, watch_dir, seen, settle):
+        """
+        Return (ready, pending) Excel file paths. A file is ready once its size and
+        mtime have been unchanged for `settle` seconds; until then it is pending.
+        """
+        now = time.monotonic()
+        present = set()
+        ready, pending = [], []
+        with os.scandir(watch_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                # Skip folders, Excel lock files (~$name.xlsx), hidden and non-Excel files
+                if not entry.is_file() or name.startswith(('~$', '.')) or not name.lower().endswith(EXCEL_EXTENSIONS):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                present.add(entry.path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous = seen.get(entry.path)
+                if previous is None or previous[:2] != signature:
+                    seen[entry.path] = signature + (now,)
+                    previous = seen[entry.path]
+                if stat.st_size > 0 and now - previous[2] >= settle:
+                    ready.append(entry.path)
+                else:
+                    pending.append(entry.path)
+        for path in set(seen) - present:
+            del seen[path]
+        return sorted(ready), pending
+
+    def _process_batch(self, paths, archive_dir, error_dir, workers):
+        close_old_connections()
+        start = time.perf_counter()
+        self._log(f'Importing {len(paths)} file(s)')
+
+        # Classify from the header rows only, so the batch can be imported in dependency
+        # order (see apply_parsed_files) with one parsed file in memory at a time
+        queue = []
+        for path in paths:
+            try:
+                kind, order_key, error = peek_path(path)
+            except OSError as e:
+                # Removed or unreadable since the scan
+                self._log(self.style.WARNING(f'  {os.path.basename(path)}: {e}'))
+                continue
+            if error:
+                self._move(path, error_dir, error['error'])
+                continue
+            queue.append((KIND_ORDER.index(kind), order_key, path, kind))
+        queue.sort()
+
+        changes = []
+        rows = 0
+        budget_mb = settings.INVESTEC_WATCH_MEMORY_BUDGET_MB
+        for _, _, path, kind in queue:
+            name = os.path.basename(path)
+            try:
+                with open(path, 'rb') as f:
+                    details = over_budget(File(f, name=name), budget_mb)
+                if details:
+                    self._move(path, error_dir, (
+                        f'File needs an estimated {details["estimated_memory_mb"]:.0f} MB to import '
+                        f'({details["cells"]} cells), more than the {budget_mb:g} MB watch folder budget'
+                    ))
+                    continue
+                with MemoryTracker(kind) as memory:
+                    _, parsed = parse_path(path, kind)
+                    if not parsed['success']:
+                        self._move(path, error_dir, parsed['error'])
+                        continue
+                    rows += parsed_row_count(parsed)
+                    result, change = import_parsed_file(kind, parsed)
+                    # Drop the frame before the next file is parsed
+                    del parsed
+            except OSError as e:
+                self._log(self.style.WARNING(f'  {name}: {e}'))
+                continue
+            if result['success']:
+                changes.append(change)
+                self._log(f'  {name}: {result["message"]} (peak memory +{memory.report()["rss_peak_increase_mb"]:g} MB)')
+                self._move(path, archive_dir)
+            else:
+                self._move(path, error_dir, result['error'])
+
+        rebuild = batch_rebuild(changes)
+        if rebuild['rebuild']:
+            from_date = rebuild['rebuild_from']
+            try:
+                call_command(
+                    'rebuild_derived',
+                    from_date=from_date.isoformat() if from_date else None,
+                    workers=workers,
+                    stdout=self.stdout,
+                    stderr=self.stderr,
+                )
+            except CommandError as e:
+                # The files are imported; derived data can be finished with rebuild_derived --resume
+                self._log(self.style.ERROR(f'Derived data rebuild failed: {e}'))
+        elapsed = time.perf_counter() - start
+        self._log(f'Batch done in {elapsed:.2f}s ({rows} rows)')
+
+    def _move(self, path, folder, error=None):
+        name = os.path.basename(path)
+        destination = os.path.join(folder, name)
+        if os.path.exists(destination):
+            stem, extension = os.path.splitext(name)
+            destination = os.path.join(folder, f'{stem}-{datetime.now():%Y%m%d-%H%M%S}{extension}')
+        shutil.move(path, destination)
+        if error:
+            with open(f'{destination}.error.txt', 'w') as f:
+                f.write(f'{error}\n')
+            self._log(self.style.ERROR(f'  {name}: {error} -> {folder}'))
+
+    def _log(self, message):
+        self.stdout.write(f'[{datetime.now():%Y-%m-%d %H:%M:%S}] {message}')
+
+
+if Observer is not None:
+    class _WakeHandler(FileSystemEventHandler):
+        """Wake the scan loop on any change in the watched folder."""
+
+        def __init__(self, wake):
+            super().__init__()
+            self.wake = wake
+
+        def on_any_event(self, event):
+            self.wake.set()
@@ -0,0 +1,250 @@
+"""
+Memory accounting and admission control for uploads.
+
+pd.read_excel keeps every cell of a workbook as a Python object, so an import
+needs memory roughly proportional to the cells of its largest sheet (df_raw,
+the header-aware re-read and the model instances are alive at the same time).
+
+- estimate_upload_memory() reads the sheet dimensions from the .xlsx zip (no
+  parsing) and predicts the peak from BYTES_PER_CELL;
+- admit_upload() compares the estimate with INVESTEC_UPLOAD_MEMORY_BUDGET_MB
+  before parsing starts and, over budget, rejects the upload (413) or queues it
+  in INVESTEC_WATCH_DIR for the watch_folder process (202), per
+  INVESTEC_UPLOAD_OVER_BUDGET. The watcher imports one file at a time and checks
+  each against its own, larger INVESTEC_WATCH_MEMORY_BUDGET_MB (over_budget());
+- MemoryTracker samples resident memory (and optionally tracemalloc) while an
+  upload runs; its report() is returned in the upload response.
+"""
+import os
+import re
+import resource
+import threading
+import tracemalloc
+import uuid
+import zipfile
+from datetime import datetime
+
+from django.conf import settings
+
+from .metrics import UPLOAD_PEAK_MEMORY
+
+
+MB = 1024 * 1024
+
+# Peak resident memory per worksheet cell of a full import (parse, bulk insert, TTM):
+# 330-480 bytes measured on 10k-40k row synthetic statements (pandas 2, openpyxl 3.1)
+BYTES_PER_CELL = 500
+# Fixed overhead of an import (openpyxl workbook, parser state)
+BASE_BYTES = 16 * MB
+# Sheets without a <dimension> element: uncompressed sheet XML bytes per cell
+XML_BYTES_PER_CELL = 40
+# .xls (BIFF) files have no cheap dimension lookup: assume this many cells per file byte
+XLS_CELLS_PER_BYTE = 0.1
+
+_DIMENSION = re.compile(rb'<(?:\w+:)?dimension\s+ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"')
+_SHEET = re.compile(r'^xl/worksheets/[^/]+\.xml$')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _column_number(letters):
+    number = 0
+    for letter in letters.decode():
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+def _sheet_cells(workbook, info):
+    """Cells of one worksheet from its <dimension ref="A1:K1200"/>, else from its XML size."""
+    with workbook.open(info) as sheet:
+        head = sheet.read(4096)
+    match = _DIMENSION.search(head)
+    if match and match.group(3):
+        rows = int(match.group(4)) - int(match.group(2)) + 1
+        columns = _column_number(match.group(3)) - _column_number(match.group(1)) + 1
+        return max(rows, 1) * max(columns, 1)
+    # Missing or single-cell ("A1") dimension: writers that stream rows often leave it out
+    return info.file_size // XML_BYTES_PER_CELL
+
+
+def estimate_upload_memory(uploaded_file):
+    """
+    Estimate the peak memory of importing uploaded_file without parsing it.
+
+    Returns a dict with 'estimated_bytes', 'cells' (of the largest sheet) and
+    'method' ('dimension' for .xlsx, 'file_size' when the workbook is not a zip).
+    The file position is restored to the start.
+    """
+    try:
+        uploaded_file.seek(0)
+        with zipfile.ZipFile(uploaded_file) as workbook:
+            sheets = [info for info in workbook.infolist() if _SHEET.match(info.filename)]
+            cells = max((_sheet_cells(workbook, info) for info in sheets), default=0)
+        method = 'dimension'
+    except (zipfile.BadZipFile, OSError, ValueError):
+        size = getattr(uploaded_file, 'size', None) or 0
+        cells = int(size * XLS_CELLS_PER_BYTE)
+        method = 'file_size'
+    finally:
+        uploaded_file.seek(0)
+    return {
+        'estimated_bytes': BASE_BYTES + cells * BYTES_PER_CELL,
+        'cells': cells,
+        'method': method,
+    }
+
+
+def over_budget(uploaded_file, budget_mb):
+    """
+    None when importing uploaded_file fits in budget_mb (or budget_mb is 0), otherwise
+    a dict with 'estimated_memory_mb', 'memory_budget_mb' and 'cells'.
+    """
+    if not budget_mb or budget_mb <= 0:
+        return None
+    estimate = estimate_upload_memory(uploaded_file)
+    estimated_mb = estimate['estimated_bytes'] / MB
+    if estimated_mb <= budget_mb:
+        return None
+    return {
+        'estimated_memory_mb': round(estimated_mb, 1),
+        'memory_budget_mb': budget_mb,
+        'cells': estimate['cells'],
+    }
+
+
+def _queue_upload(uploaded_file):
+    """Copy the upload into the watch folder; returns the queued path."""
+    watch_dir = settings.INVESTEC_WATCH_DIR
+    os.makedirs(watch_dir, exist_ok=True)
+    name = os.path.basename(uploaded_file.name)
+    destination = os.path.join(watch_dir, name)
+    if os.path.exists(destination):
+        stem, extension = os.path.splitext(name)
+        destination = os.path.join(watch_dir, f'{stem}-{datetime.now():%Y%m%d-%H%M%S}{extension}')
+    # Write under a hidden name and rename, so the watcher never sees a partial file
+    partial = os.path.join(watch_dir, f'.{uuid.uuid4().hex}.partial')
+    uploaded_file.seek(0)
+    with open(partial, 'wb') as f:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    uploaded_file.seek(0)
+    os.replace(partial, destination)
+    return destination
+
+
+def admit_upload(uploaded_file):
+    """
+    Check uploaded_file against settings.INVESTEC_UPLOAD_MEMORY_BUDGET_MB before parsing.
+
+    Returns None when the upload may be imported now, otherwise a result dict in the
+    importer format: a 413 error (INVESTEC_UPLOAD_OVER_BUDGET = 'reject') or, for
+    'queue', a success with 'queued': True and status_code 202 once the file has been
+    copied to INVESTEC_WATCH_DIR for the watch_folder command.
+    """
+    budget_mb = settings.INVESTEC_UPLOAD_MEMORY_BUDGET_MB
+    details = over_budget(uploaded_file, budget_mb)
+    if details is None:
+        return None
+    estimated_mb = details['estimated_memory_mb']
+    if settings.INVESTEC_UPLOAD_OVER_BUDGET == 'queue':
+        try:
+            queued_path = _queue_upload(uploaded_file)
+        except OSError as e:
+            return {
+                'success': False,
+                'filename': uploaded_file.name,
+                'error': f'File is too large to import now and could not be queued: {e}',
+                'status_code': 503,
+                **details,
+            }
+        return {
+            'success': True,
+            'queued': True,
+            'filename': uploaded_file.name,
+            'message': (
+                f'File needs an estimated {estimated_mb:.0f} MB to import, more than the {budget_mb:g} MB '
+                f'upload budget; it has been queued for the watch folder import.'
+            ),
+            'queued_as': os.path.basename(queued_path),
+            'status_code': 202,
+            **details,
+        }
+    return {
+        'success': False,
+        'filename': uploaded_file.name,
+        'error': (
+            f'File is too large to import: it needs an estimated {estimated_mb:.0f} MB '
+            f'({details["cells"]} cells) and the upload budget is {budget_mb:g} MB. '
+            f'Split the statement into smaller date ranges or drop it into the watch folder.'
+        ),
+        'status_code': 413,
+        **details,
+    }
+
+
+def _resident_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # No /proc: fall back to the lifetime peak (kilobytes on Linux and the BSDs)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryTracker(threading.Thread):
+    """
+    Sample resident memory every INVESTEC_UPLOAD_MEMORY_SAMPLE_INTERVAL seconds while
+    the enclosed block runs; with INVESTEC_UPLOAD_TRACEMALLOC also trace Python
+    allocations (slower, but exact for the allocations themselves).
+
+        with MemoryTracker('transactions') as memory:
+            ...
+        result['memory'] = memory.report()
+
+    Both figures are per process: concurrent requests in threaded workers share them.
+    """
+
+    def __init__(self, pipeline, interval=None, trace=None):
+        super().__init__(daemon=True)
+        self.pipeline = pipeline
+        self.interval = interval or settings.INVESTEC_UPLOAD_MEMORY_SAMPLE_INTERVAL
+        self.trace = settings.INVESTEC_UPLOAD_TRACEMALLOC if trace is None else trace
+        self.finished = threading.Event()
+        self.started_tracing = False
+        self.traced_peak = None
+
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = _resident_bytes()
+        if self.trace:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self.started_tracing = True
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+        self.start()
+        return self
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, _resident_bytes())
+
+    def __exit__(self, *exc_info):
+        self.finished.set()
+        self.join()
+        self.end_bytes = _resident_bytes()
+        self.peak_bytes = max(self.peak_bytes, self.end_bytes)
+        if self.trace:
+            self.traced_peak = tracemalloc.get_traced_memory()[1] - self.traced_start
+            if self.started_tracing:
+                tracemalloc.stop()
+        UPLOAD_PEAK_MEMORY.labels(pipeline=self.pipeline).observe(self.peak_bytes - self.start_bytes)
+        return False
+
+    def report(self):
+        return {
+            'rss_start_mb': round(self.start_bytes / MB, 1),
+            'rss_peak_mb': round(self.peak_bytes / MB, 1),
+            'rss_end_mb': round(self.end_bytes / MB, 1),
+            'rss_peak_increase_mb': round((self.peak_bytes - self.start_bytes) / MB, 1),
+            'traced_peak_mb': round(self.traced_peak / MB, 1) if self.traced_peak is not None else None,
+        }
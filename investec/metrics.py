@@ -0,0 +1,94 @@
+"""
+Prometheus metrics for the ETL service, exposed at /metrics.
+
+Under gunicorn every worker is a separate process. When PROMETHEUS_MULTIPROC_DIR
+is set (config/gunicorn.py sets it before the workers start) each process writes
+its samples to files in that directory and /metrics aggregates all of them;
+otherwise the metrics of the current process are returned (runserver, tests).
+"""
+import os
+import resource
+
+from prometheus_client import (
+    REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+TTM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_LATENCY = Histogram(
+    'investec_http_request_duration_seconds', 'Request latency by URL name',
+    ['url_name', 'method'], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    'investec_http_requests_total', 'Requests by URL name and status code',
+    ['url_name', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'investec_http_request_db_queries', 'Database queries per request',
+    ['url_name'], buckets=QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    'investec_http_request_db_seconds', 'Database time per request',
+    ['url_name'], buckets=LATENCY_BUCKETS,
+)
+ROWS_INGESTED = Counter(
+    'investec_rows_ingested_total', 'Rows written by imports, per table',
+    ['table'],
+)
+TTM_RECOMPUTE_SECONDS = Histogram(
+    'investec_ttm_recompute_seconds', 'Dividend TTM / performance recompute duration',
+    ['scope'], buckets=TTM_BUCKETS,
+)
+UPLOAD_PEAK_MEMORY = Histogram(
+    'investec_upload_peak_memory_increase_bytes', 'Peak resident memory increase while importing an upload',
+    ['pipeline'], buckets=MEMORY_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    'investec_cache_lookups_total', 'Cache lookups by cache and result (hit/miss)',
+    ['cache', 'result'],
+)
+WORKER_MEMORY = Gauge(
+    'investec_worker_resident_memory_bytes', 'Resident memory of each live worker process',
+    multiprocess_mode='liveall',
+)
+WORKER_PEAK_MEMORY = Gauge(
+    'investec_worker_peak_resident_memory_bytes', 'Peak resident memory of each live worker process',
+    multiprocess_mode='liveall',
+)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def record_rows_ingested(table, rows):
+    if rows:
+        ROWS_INGESTED.labels(table=table).inc(rows)
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def update_worker_memory():
+    """Refresh the memory gauges of the current process (cheap: one /proc read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            WORKER_MEMORY.set(int(f.read().split()[1]) * _PAGE_SIZE)
+    except (OSError, IndexError, ValueError):
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    WORKER_PEAK_MEMORY.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def render_metrics():
+    """Prometheus text exposition of all workers (multiprocess) or this process."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    update_worker_memory()
+    return generate_latest(registry)
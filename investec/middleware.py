@@ -0,0 +1,217 @@
+import hmac
+import re
+import time
+import uuid
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.urls import Resolver404, get_resolver
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .instrumentation import QueryCounter, query_source, request_queries
+from .metrics import REQUEST_DB_SECONDS, REQUEST_LATENCY, REQUEST_QUERIES, REQUESTS, update_worker_memory
+from .profiling import RequestProfile
+from .querylog import flush as flush_slow_queries
+
+
+class HybridMiddleware:
+    """
+    Base for middleware that runs in both WSGI and ASGI (async) request chains, like
+    django.utils.deprecation.MiddlewareMixin: under ASGI a sync-only middleware would
+    push every async view back onto a thread. Subclasses implement __call__ for the sync
+    chain and __acall__ for the async one.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+    Record latency, status and SQL query count/time of every request, labelled by
+    URL name (e.g. 'investec:holdings_series') rather than path so the label set stays
+    bounded. Requests that do not resolve to a view are labelled 'unresolved'.
+    
+    Latency is measured until the response is returned: for streamed responses that is
+    the time to the first byte, and queries run while streaming are not counted.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        queries = QueryCounter()
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        return self._record(request, response, time.perf_counter() - start, queries)
+
+    async def __acall__(self, request):
+        queries = QueryCounter()
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        return self._record(request, response, time.perf_counter() - start, queries)
+
+    def _record(self, request, response, elapsed, queries):
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.view_name if match and match.view_name else 'unresolved'
+        if url_name == 'metrics':
+            return response
+
+        REQUEST_LATENCY.labels(url_name=url_name, method=request.method).observe(elapsed)
+        REQUESTS.labels(url_name=url_name, method=request.method, status=response.status_code).inc()
+        REQUEST_QUERIES.labels(url_name=url_name).observe(queries.count)
+        REQUEST_DB_SECONDS.labels(url_name=url_name).observe(queries.seconds)
+        update_worker_memory()
+        return response
+
+
+class QueryAttributionMiddleware(HybridMiddleware):
+    """
+    Attribute the request's SQL to its URL name for the slow-query log
+    (investec/querylog.py) and store the slow queries it recorded after the response.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = query_source.set('unresolved')
+        try:
+            return self.get_response(request)
+        finally:
+            query_source.reset(token)
+            flush_slow_queries()
+
+    async def __acall__(self, request):
+        token = query_source.set('unresolved')
+        try:
+            return await self.get_response(request)
+        finally:
+            query_source.reset(token)
+            # The async ORM runs the request's queries in its thread-sensitive thread,
+            # whose buffer this flushes
+            await sync_to_async(flush_slow_queries)()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        query_source.set(request.resolver_match.view_name)
+
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+    Profile a single request on demand: send the X-Profile header (or ?profile=) with
+    settings.INVESTEC_PROFILE_TOKEN. The profile is saved under the X-Request-ID of the
+    request (a new id if absent) and the id is returned in the X-Profile-Id header.
+    
+    Requests without the flag only pay for one header lookup; with no token
+    configured profiling is disabled.
+    
+    Under ASGI the profile follows the thread that runs the view. A sync view (every
+    DRF view, uploads included) runs on a thread outside the event loop, so the rest
+    of the chain is driven from a thread of its own with async_to_sync, which runs
+    the view on that same thread, and that thread is profiled. For an async view
+    the event loop thread is profiled, including any other requests it serves
+    meanwhile.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.token = settings.INVESTEC_PROFILE_TOKEN
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self._requested(request):
+            return self.get_response(request)
+        with RequestProfile() as profile:
+            response = self.get_response(request)
+        return self._save(profile, request, response)
+
+    async def __acall__(self, request):
+        if not self._requested(request):
+            return await self.get_response(request)
+        if self._sync_view(request):
+            profile, response = await sync_to_async(self._profile_thread)(request)
+        else:
+            with RequestProfile() as profile:
+                response = await self.get_response(request)
+        return await sync_to_async(self._save)(profile, request, response)
+
+    def _sync_view(self, request):
+        try:
+            match = get_resolver(getattr(request, 'urlconf', None)).resolve(request.path_info)
+        except Resolver404:
+            return False
+        return not iscoroutinefunction(match.func)
+
+    def _profile_thread(self, request):
+        # Thread-sensitive code under async_to_sync (the sync view) runs in the calling thread
+        with RequestProfile() as profile:
+            response = async_to_sync(self.get_response)(request)
+        return profile, response
+
+    def _requested(self, request):
+        if not self.token:
+            return False
+        supplied = request.headers.get('X-Profile') or request.GET.get('profile')
+        return bool(supplied) and hmac.compare_digest(supplied, self.token)
+
+    def _save(self, profile, request, response):
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        # Keep the token out of the saved metadata
+        params = request.GET.copy()
+        params.pop('profile', None)
+        profile.save(
+            request_id,
+            method=request.method,
+            path=f'{request.path}?{params.urlencode()}' if params else request.path,
+            status=response.status_code,
+            upload_size=request.META.get('CONTENT_LENGTH') or None,
+        )
+        response['X-Profile-Id'] = request_id
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware that can also run in an async (ASGI) chain, where the sync-only
+    original would run every async view on a thread. Static files are served from
+    WhiteNoise's file index as before; everything else is passed straight through.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0018_rename_investec_js_dividend_idx_investec_in_dividen_430afb_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investecjseportfolio',
+            index=models.Index(fields=['share_code', 'date'], include=('quantity', 'price', 'total_value'), name='investec_pf_code_date_cov'),
+        ),
+        migrations.AddIndex(
+            model_name='investecjseportfolio',
+            index=models.Index(fields=['date'], include=('total_cost', 'total_value', 'profit_loss', 'annual_income_zar'), name='investec_pf_date_totals_cov'),
+        ),
+    ]
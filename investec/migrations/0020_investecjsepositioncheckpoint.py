@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0019_portfolio_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestecJsePositionCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_number', models.CharField(max_length=50)),
+                ('share_name', models.CharField(max_length=100)),
+                ('date', models.DateField()),
+                ('year', models.IntegerField(blank=True, null=True)),
+                ('month', models.IntegerField(blank=True, null=True)),
+                ('quantity', models.DecimalField(decimal_places=4, max_digits=15)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Investec Jse Position Checkpoint',
+                'verbose_name_plural': 'Investec Jse Position Checkpoints',
+                'ordering': ['-date', 'account_number', 'share_name'],
+                'indexes': [models.Index(fields=['date'], name='investec_in_date_b0cb18_idx')],
+                'unique_together': {('account_number', 'share_name', 'date')},
+            },
+        ),
+    ]
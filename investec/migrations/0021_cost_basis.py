@@ -0,0 +1,62 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0020_investecjsepositioncheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestecJseRealizedGain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_number', models.CharField(max_length=50)),
+                ('share_name', models.CharField(max_length=100)),
+                ('method', models.CharField(default='fifo', max_length=10)),
+                ('date', models.DateField()),
+                ('year', models.IntegerField(blank=True, null=True)),
+                ('month', models.IntegerField(blank=True, null=True)),
+                ('sell_transaction_id', models.BigIntegerField(blank=True, null=True)),
+                ('quantity', models.DecimalField(decimal_places=4, max_digits=15)),
+                ('sell_price', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('proceeds', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('cost_basis', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('realized_gain', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('unmatched_quantity', models.DecimalField(decimal_places=4, default=0, max_digits=15)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Investec Jse Realized Gain',
+                'verbose_name_plural': 'Investec Jse Realized Gains',
+                'ordering': ['-date', 'account_number', 'share_name'],
+                'indexes': [models.Index(fields=['method', 'account_number', 'share_name', 'date'], name='investec_in_method_5b4759_idx'), models.Index(fields=['year', 'month'], name='investec_in_year_e30fda_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='InvestecJseOpenLot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_number', models.CharField(max_length=50)),
+                ('share_name', models.CharField(max_length=100)),
+                ('method', models.CharField(default='fifo', max_length=10)),
+                ('date', models.DateField()),
+                ('buy_transaction_id', models.BigIntegerField(blank=True, null=True)),
+                ('quantity', models.DecimalField(decimal_places=4, max_digits=15)),
+                ('unit_cost', models.DecimalField(decimal_places=4, max_digits=15)),
+                ('cost_basis', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Investec Jse Open Lot',
+                'verbose_name_plural': 'Investec Jse Open Lots',
+                'ordering': ['account_number', 'share_name', 'date'],
+                'indexes': [models.Index(fields=['method', 'account_number', 'share_name', 'date'], name='investec_in_method_112f3e_idx')],
+            },
+        ),
+    ]
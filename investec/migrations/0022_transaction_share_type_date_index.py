@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0021_cost_basis'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investecjsetransaction',
+            index=models.Index(fields=['share_name', 'type', 'date'], name='investec_txn_share_type_date'),
+        ),
+    ]
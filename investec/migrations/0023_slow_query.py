@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0022_transaction_share_type_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestecSlowQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('sql', models.TextField()),
+                ('source', models.CharField(max_length=200)),
+                ('stage', models.CharField(blank=True, max_length=100)),
+                ('calls', models.IntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('max_seconds', models.FloatField(default=0)),
+                ('last_seconds', models.FloatField(default=0)),
+                ('last_params', models.TextField(blank=True)),
+                ('explain_plan', models.TextField(blank=True)),
+                ('explained_at', models.DateTimeField(blank=True, null=True)),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+                ('last_seen', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Investec Slow Query',
+                'verbose_name_plural': 'Investec Slow Queries',
+                'ordering': ['-total_seconds'],
+                'unique_together': {('fingerprint', 'source', 'stage')},
+            },
+        ),
+    ]
@@ -0,0 +1,140 @@
+"""
+Partition the transaction and portfolio tables by year (PostgreSQL only).
+
+Each table is rebuilt as a table partitioned by RANGE (date), with one partition
+per calendar year holding data (<table>_y<year>, up to next year) and a DEFAULT
+partition (<table>_default), and its rows copied over in date order. The primary
+key becomes (id, date), since a partitioned table's unique constraints must
+contain the partition key. The model's indexes are recreated on the partitioned
+table, plus a BRIN index on date.
+
+After this migration id is no longer an IDENTITY column (what Django creates on
+PostgreSQL): it is a plain bigint with DEFAULT nextval('<table>_id_seq'), the
+sequence owned by the column and set past the highest copied id. Inserts that
+leave id out behave the same, and pg_get_serial_sequence() and sqlsequencereset
+still find the sequence, but ALTER TABLE ... ALTER COLUMN id ... IDENTITY
+statements do not apply; reset the sequence with setval() instead. Unapplying
+keeps the sequence default.
+
+Downtime: the migration runs in one transaction that holds an ACCESS EXCLUSIVE
+lock on both tables from the first rename to the commit, so every read and write
+of transactions and portfolios waits until it is done. Stop the web workers and
+watch_folder for the window. On PostgreSQL 16 with 2M transactions and 25k
+portfolio rows it took 13-20s and unapplying it 35-55s; with 10M transactions it
+took 59s (about 6s per million transaction rows, the copy and the index builds)
+and unapplying it 65s. If the tables cannot be locked
+within LOCK_TIMEOUT (a long-running query holds them) the migration fails
+instead of queueing every other query behind its lock; rerun it.
+
+Reversible: unapplying rebuilds both tables as plain tables with a single-column
+primary key, copying the rows back the same way (counts, ids and row contents
+were checked to match in both directions). A failure rolls the whole
+transaction back, so the tables are never left half-migrated.
+
+Requires PostgreSQL 11+ (DEFAULT partitions, primary keys and indexes on
+partitioned tables). partitions.py finds partitioned tables in
+pg_partitioned_table and their partitions in pg_inherits. On other databases
+(SQLite in development) this migration does nothing. See investec/partitions.py
+for creating and detaching partitions afterwards.
+"""
+from datetime import date
+
+from django.db import migrations
+
+
+TABLES = ['investecjsetransaction', 'investecjseportfolio']
+
+LOCK_TIMEOUT = '10s'
+
+
+def _columns(schema_editor, table):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum',
+            [table],
+        )
+        return ', '.join(schema_editor.quote_name(row[0]) for row in cursor.fetchall())
+
+
+def _rebuild(schema_editor, model, partitioned):
+    """Copy model's table into a new table, partitioned by year or plain, with the model's indexes."""
+    qn = schema_editor.quote_name
+    table = model._meta.db_table
+    old = f'{table}_old'
+    schema_editor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old)}')
+    # Columns and NOT NULL only: the old table's id sequence, constraints and indexes are
+    # dropped with it below
+    partition_by = ' PARTITION BY RANGE ("date")' if partitioned else ''
+    schema_editor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old)}){partition_by}')
+
+    if partitioned:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN("date"), MAX("date") FROM {qn(old)}')
+            first, last = cursor.fetchone()
+        next_year = date.today().year + 1
+        first_year = first.year if first else next_year - 1
+        last_year = max(last.year if last else next_year, next_year)
+        for year in range(first_year, last_year + 1):
+            schema_editor.execute(
+                f'CREATE TABLE {qn(f"{table}_y{year}")} PARTITION OF {qn(table)} '
+                f"FOR VALUES FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')"
+            )
+        schema_editor.execute(f'CREATE TABLE {qn(f"{table}_default")} PARTITION OF {qn(table)} DEFAULT')
+
+    # Insert in date order so the physical order follows date (what BRIN relies on)
+    columns = _columns(schema_editor, old)
+    schema_editor.execute(f'INSERT INTO {qn(table)} ({columns}) SELECT {columns} FROM {qn(old)} ORDER BY "date", "id"')
+    schema_editor.execute(f'DROP TABLE {qn(old)}')
+
+    sequence = f'{table}_id_seq'
+    schema_editor.execute(f'CREATE SEQUENCE {qn(sequence)} OWNED BY {qn(table)}."id"')
+    schema_editor.execute(f"ALTER TABLE {qn(table)} ALTER COLUMN \"id\" SET DEFAULT nextval('{sequence}')")
+    schema_editor.execute(
+        f"SELECT setval('{sequence}', COALESCE((SELECT MAX(\"id\") FROM {qn(table)}), 0) + 1, false)"
+    )
+    primary_key = '"id", "date"' if partitioned else '"id"'
+    schema_editor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(f"{table}_pkey")} PRIMARY KEY ({primary_key})')
+
+    for index in model._meta.indexes:
+        schema_editor.add_index(model, index)
+    if partitioned:
+        # A few pages per partition, cheap to maintain on appends; vacuum summarizes new page ranges
+        schema_editor.execute(f'CREATE INDEX {qn(f"{table}_date_brin")} ON {qn(table)} USING brin ("date")')
+    schema_editor.execute(f'ANALYZE {qn(table)}')
+
+
+def _lock(schema_editor, models):
+    """Lock both tables up front (in a fixed order) so the rebuild cannot deadlock with writers halfway."""
+    schema_editor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    tables = ', '.join(schema_editor.quote_name(model._meta.db_table) for model in models)
+    schema_editor.execute(f'LOCK TABLE {tables} IN ACCESS EXCLUSIVE MODE')
+    schema_editor.execute('SET LOCAL lock_timeout = 0')
+
+
+def partition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    models = [apps.get_model('investec', model_name) for model_name in TABLES]
+    _lock(schema_editor, models)
+    for model in models:
+        _rebuild(schema_editor, model, partitioned=True)
+
+
+def unpartition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    models = [apps.get_model('investec', model_name) for model_name in TABLES]
+    _lock(schema_editor, models)
+    for model in models:
+        _rebuild(schema_editor, model, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0023_slow_query'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:29
+
+from django.db import migrations, models
+
+
+def resolve_share_codes(apps, schema_editor):
+    """Fill share_code on the stored transactions from the share name mappings (UPDATE ... FROM)."""
+    qn = schema_editor.quote_name
+    transactions = qn(apps.get_model('investec', 'InvestecJseTransaction')._meta.db_table)
+    mappings = qn(apps.get_model('investec', 'InvestecJseShareNameMapping')._meta.db_table)
+    schema_editor.execute(
+        f"UPDATE {transactions} SET share_code = NULLIF(m.share_code, '') "
+        f'FROM {mappings} m '
+        f"WHERE {transactions}.share_name = m.share_name AND COALESCE(m.share_code, '') <> ''"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0024_partition_by_year'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investecjsetransaction',
+            name='share_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(resolve_share_codes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='investecjsetransaction',
+            index=models.Index(fields=['share_code', 'date'], name='investec_txn_code_date'),
+        ),
+    ]
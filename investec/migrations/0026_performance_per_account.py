@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:31
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0025_transaction_share_code'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='investecjsesharemonthlyperformance',
+            unique_together={('investec_account', 'share_name', 'date', 'dividend_type')},
+        ),
+    ]
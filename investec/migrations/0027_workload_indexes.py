@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0026_performance_per_account'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investecjseportfolio',
+            index=models.Index(fields=['date', 'share_code'], name='investec_pf_date_code'),
+        ),
+        migrations.AddIndex(
+            model_name='investecjsetransaction',
+            index=models.Index(condition=models.Q(('type__in', ['Dividend', 'Special Dividend', 'Foreign Dividend', 'Dividend Tax']), models.Q(('quantity', 0), ('value', 0), ('description__startswith', 'TTM Summary'), _negated=True)), fields=['share_name', 'type', 'date'], name='investec_txn_ttm_dividends'),
+        ),
+        migrations.AddIndex(
+            model_name='investecjsetransaction',
+            index=models.Index(condition=models.Q(('quantity', 0), ('value', 0), ('description__startswith', 'TTM Summary'), _negated=True), fields=['account_number', '-date', '-created_at'], name='investec_txn_account_recent'),
+        ),
+    ]
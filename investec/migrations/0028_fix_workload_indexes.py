@@ -0,0 +1,46 @@
+"""
+Fix the workload indexes of 0027.
+
+Django 4.2 escapes the % of a LIKE pattern in an index condition as %% (the
+PostgreSQL schema editor's quote_value) but runs CREATE INDEX without parameters,
+so the %% reached the server: the indexes were built WHERE ... LIKE 'TTM Summary%%'.
+That matches the same rows, but it is not the predicate the queries filter on
+(LIKE 'TTM Summary%'), so the planner could not prove the queries imply it and
+never used the indexes.
+
+Running the CREATE INDEX with an empty parameter list lets the driver turn %% back
+into %. Other databases never had the doubled %. The rebuild locks the transaction
+table against writes while the two indexes are built (no CONCURRENTLY on a
+partitioned table); reversing it keeps the rebuilt indexes.
+
+investec_pf_date_code (date, share_code) is dropped: a snapshot is a few hundred
+rows, which the planner reads through investec_pf_date_totals_cov (date) and sorts
+for less than the ordered scan costs, so the index was never used.
+"""
+
+from django.db import migrations
+
+
+def rebuild_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    model = apps.get_model('investec', 'InvestecJseTransaction')
+    for index in model._meta.indexes:
+        if index.condition is not None:
+            schema_editor.remove_index(model, index)
+            schema_editor.execute(index.create_sql(model, schema_editor), params=())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investec', '0027_workload_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_partial_indexes, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='investecjseportfolio',
+            name='investec_pf_date_code',
+        ),
+    ]
@@ -1,4 +1,14 @@
 from django.db import models
+from django.db.models import Q
+
+
+# Dividend transaction types (the TTM engine's input, see ttm.py)
+DIVIDEND_TYPES = ['Dividend', 'Special Dividend', 'Foreign Dividend', 'Dividend Tax']
+
+# Legacy TTM summary records stored among the transactions: quantity=0, value=0 and a
+# description starting with 'TTM Summary'. Reads and the TTM engine exclude them with
+# ~TTM_SUMMARY, the same predicate as the partial indexes below, so the planner can use them.
+TTM_SUMMARY = Q(quantity=0) & Q(value=0) & Q(description__startswith='TTM Summary')
 
 
 # ------------------------------------------------
@@ -49,6 +59,7 @@ class InvestecJseTransaction(models.Model):
     account_number = models.CharField(max_length=50)
     description = models.CharField(max_length=255)
     share_name = models.CharField(max_length=100, blank=True)  # Can be empty for account-related transactions
+    share_code = models.CharField(max_length=20, blank=True, null=True)  # From InvestecJseShareNameMapping, resolved at import (see share_codes.py)
     type = models.CharField(max_length=50)  # e.g., 'Buy', 'Sell', 'Dividend', 'Fee', 'Broker Fee', etc.
     quantity = models.DecimalField(max_digits=15, decimal_places=4)
     value = models.DecimalField(max_digits=15, decimal_places=2)
@@ -66,6 +77,19 @@ class InvestecJseTransaction(models.Model):
         indexes = [
             models.Index(fields=['year', 'month']),
             models.Index(fields=['date']),
+            models.Index(fields=['share_name', 'type', 'date'], name='investec_txn_share_type_date'),  # Read-time TTM window lookups
+            models.Index(fields=['share_code', 'date'], name='investec_txn_code_date'),  # Joins to portfolio holdings and prices
+            # Partial indexes without the TTM summary records
+            models.Index(
+                fields=['share_name', 'type', 'date'],
+                condition=Q(type__in=DIVIDEND_TYPES) & ~TTM_SUMMARY,
+                name='investec_txn_ttm_dividends',
+            ),  # TTM engine dividend loads (ttm.dividend_queryset)
+            models.Index(
+                fields=['account_number', '-date', '-created_at'],
+                condition=~TTM_SUMMARY,
+                name='investec_txn_account_recent',
+            ),  # Transaction list by account, newest first
         ]
     
     def save(self, *args, **kwargs):
@@ -117,6 +141,17 @@ class InvestecJsePortfolio(models.Model):
             models.Index(fields=['date', 'company']),
             models.Index(fields=['share_code']),
             models.Index(fields=['year', 'month']),
+            # Covering indexes for the holdings API (index-only scans on PostgreSQL)
+            models.Index(
+                fields=['share_code', 'date'],
+                include=['quantity', 'price', 'total_value'],
+                name='investec_pf_code_date_cov',
+            ),
+            models.Index(
+                fields=['date'],
+                include=['total_cost', 'total_value', 'profit_loss', 'annual_income_zar'],
+                name='investec_pf_date_totals_cov',
+            ),
         ]
     
     def save(self, *args, **kwargs):
@@ -163,7 +198,8 @@ class InvestecJseShareMonthlyPerformance(models.Model):
         ordering = ['-date', 'share_name']
         verbose_name = 'Investec Jse Share Monthly Performance'
         verbose_name_plural = 'Investec Jse Share Monthly Performances'
-        unique_together = ('share_name', 'date', 'dividend_type')
+        # One series per account: accounts holding the same share are not merged
+        unique_together = ('investec_account', 'share_name', 'date', 'dividend_type')
         indexes = [
             models.Index(fields=['share_name', 'date']),
             models.Index(fields=['date']),
@@ -180,4 +216,159 @@ class InvestecJseShareMonthlyPerformance(models.Model):
         super().save(*args, **kwargs)
     
     def __str__(self):
-        return f"{self.share_name} - {self.date} - TTM: {self.dividend_ttm}"
\ No newline at end of file
+        return f"{self.share_name} - {self.date} - TTM: {self.dividend_ttm}"
+
+
+# ------------------------------------------------
+# Position Ledger Models
+# ------------------------------------------------
+
+class InvestecJsePositionCheckpoint(models.Model):
+    """
+    Model to store month-end position checkpoints derived from Buy/Sell transactions.
+    
+    One row per (account_number, share_name) for every month with Buy/Sell activity.
+    The quantity is the running position at the end of that month, so holdings on any
+    date are the latest earlier checkpoint plus that month's transactions up to the date.
+    """
+    
+    account_number = models.CharField(max_length=50)
+    share_name = models.CharField(max_length=100)
+    date = models.DateField()  # Month End date
+    year = models.IntegerField(null=True, blank=True)
+    month = models.IntegerField(null=True, blank=True)
+    quantity = models.DecimalField(max_digits=15, decimal_places=4)  # Running quantity held at month end
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date', 'account_number', 'share_name']
+        verbose_name = 'Investec Jse Position Checkpoint'
+        verbose_name_plural = 'Investec Jse Position Checkpoints'
+        unique_together = ('account_number', 'share_name', 'date')
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def save(self, *args, **kwargs):
+        """Automatically populate year and month from date field."""
+        if self.date:
+            self.year = self.date.year
+            self.month = self.date.month
+        super().save(*args, **kwargs)
+    
+    def __str__(self):
+        return f"{self.date} - {self.account_number} - {self.share_name} - Qty: {self.quantity}"
+
+
+# ------------------------------------------------
+# Cost Basis Models
+# ------------------------------------------------
+
+class InvestecJseRealizedGain(models.Model):
+    """Model to store the realized gain of each Sell transaction after lot matching (FIFO or average cost)."""
+    
+    account_number = models.CharField(max_length=50)
+    share_name = models.CharField(max_length=100)
+    method = models.CharField(max_length=10, default='fifo')  # Lot matching method: 'fifo' or 'average'
+    date = models.DateField()  # Sell date
+    year = models.IntegerField(null=True, blank=True)
+    month = models.IntegerField(null=True, blank=True)
+    sell_transaction_id = models.BigIntegerField(null=True, blank=True)  # InvestecJseTransaction id of the Sell (not a FK: transactions are re-imported by date range)
+    quantity = models.DecimalField(max_digits=15, decimal_places=4)  # Quantity sold
+    sell_price = models.DecimalField(max_digits=15, decimal_places=2)  # value_per_share of the Sell (rands)
+    proceeds = models.DecimalField(max_digits=15, decimal_places=2)  # quantity × sell_price
+    cost_basis = models.DecimalField(max_digits=15, decimal_places=2)  # Cost of the matched lots
+    realized_gain = models.DecimalField(max_digits=15, decimal_places=2)  # proceeds - cost_basis for the matched quantity
+    unmatched_quantity = models.DecimalField(max_digits=15, decimal_places=4, default=0)  # Quantity sold with no earlier Buy to match (incomplete history)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date', 'account_number', 'share_name']
+        verbose_name = 'Investec Jse Realized Gain'
+        verbose_name_plural = 'Investec Jse Realized Gains'
+        indexes = [
+            models.Index(fields=['method', 'account_number', 'share_name', 'date']),
+            models.Index(fields=['year', 'month']),
+        ]
+    
+    def save(self, *args, **kwargs):
+        """Automatically populate year and month from date field."""
+        if self.date:
+            self.year = self.date.year
+            self.month = self.date.month
+        super().save(*args, **kwargs)
+    
+    def __str__(self):
+        return f"{self.date} - {self.share_name} - {self.method} - Gain: {self.realized_gain}"
+
+
+class InvestecJseOpenLot(models.Model):
+    """Model to store the open (unsold) lots per share after lot matching (FIFO or average cost)."""
+    
+    account_number = models.CharField(max_length=50)
+    share_name = models.CharField(max_length=100)
+    method = models.CharField(max_length=10, default='fifo')  # Lot matching method: 'fifo' or 'average'
+    date = models.DateField()  # Buy date of the lot (average cost: date of the last Buy)
+    buy_transaction_id = models.BigIntegerField(null=True, blank=True)  # InvestecJseTransaction id of the Buy (average cost: last Buy)
+    quantity = models.DecimalField(max_digits=15, decimal_places=4)  # Remaining quantity of the lot
+    unit_cost = models.DecimalField(max_digits=15, decimal_places=4)  # Cost per share (rands)
+    cost_basis = models.DecimalField(max_digits=15, decimal_places=2)  # quantity × unit_cost
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['account_number', 'share_name', 'date']
+        verbose_name = 'Investec Jse Open Lot'
+        verbose_name_plural = 'Investec Jse Open Lots'
+        indexes = [
+            models.Index(fields=['method', 'account_number', 'share_name', 'date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} - {self.share_name} - {self.method} - Qty: {self.quantity} @ {self.unit_cost}"
+
+
+# ------------------------------------------------
+# Diagnostics Models
+# ------------------------------------------------
+
+class InvestecSlowQuery(models.Model):
+    """
+    Aggregated slow queries (see investec/querylog.py).
+    
+    One row per query fingerprint (the SQL with literals and IN lists collapsed) and
+    the view or pipeline stage that issued it. The latest sampled EXPLAIN plan is kept.
+    """
+    
+    fingerprint = models.CharField(max_length=40)  # sha1 of the normalized SQL
+    sql = models.TextField()  # Normalized SQL
+    source = models.CharField(max_length=200)  # URL name of the view, or the management command
+    stage = models.CharField(max_length=100, blank=True)  # Import pipeline stage, e.g. 'transactions.delete_range'
+    calls = models.IntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    max_seconds = models.FloatField(default=0)
+    last_seconds = models.FloatField(default=0)
+    last_params = models.TextField(blank=True)  # Parameters of the latest occurrence (truncated)
+    explain_plan = models.TextField(blank=True)  # Latest sampled EXPLAIN plan (estimated, not ANALYZE)
+    explained_at = models.DateTimeField(null=True, blank=True)
+    
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-total_seconds']
+        verbose_name = 'Investec Slow Query'
+        verbose_name_plural = 'Investec Slow Queries'
+        unique_together = ('fingerprint', 'source', 'stage')
+    
+    @property
+    def mean_seconds(self):
+        return self.total_seconds / self.calls if self.calls else 0
+    
+    def __str__(self):
+        return f"{self.source} {self.stage} - {self.calls} calls - {self.sql[:80]}"
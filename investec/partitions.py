@@ -0,0 +1,160 @@
+"""
+Yearly range partitions of the transaction and portfolio tables (PostgreSQL).
+
+Migration 0024 rebuilds both tables as PARTITION BY RANGE (date) with one
+partition per calendar year (<table>_y<year>), a DEFAULT partition for years
+without one (<table>_default) and a BRIN index on date. A statement's date-range
+delete or a portfolio month delete then only touches that year's partition, and
+an old year can be detached (kept as a plain table) or dropped without a DELETE.
+
+ensure_partitions() is called by the importers before they write, so a new year
+gets its own partition instead of filling the default one. On other databases
+(SQLite in development) and on tables that are not partitioned, every function
+here is a no-op.
+"""
+import re
+from datetime import date
+
+from django.db import DatabaseError, connection, transaction
+
+from .models import InvestecJsePortfolio, InvestecJseTransaction
+
+
+PARTITIONED_MODELS = {
+    'transactions': InvestecJseTransaction,
+    'portfolio': InvestecJsePortfolio,
+}
+
+_BOUND = re.compile(r"FROM \('(\d{4})-01-01'\) TO \('(\d{4})-01-01'\)")
+
+# Years known to have a partition, per table (None: the table is not partitioned).
+# Only filled from the catalog, so a partition created in a rolled-back transaction
+# is looked up again
+_known_years = {}
+
+
+def partition_name(table, year):
+    return f'{table}_y{year}'
+
+
+def default_partition_name(table):
+    return f'{table}_default'
+
+
+def is_partitioned(model):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [model._meta.db_table]
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions(model):
+    """
+    The attached partitions of model's table, by name: dicts with 'name', 'year'
+    (None for the default partition), 'rows' (planner estimate) and 'bytes'.
+    """
+    if not is_partitioned(model):
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint, pg_total_relation_size(c.oid) '
+            'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname',
+            [model._meta.db_table],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound, estimate, size in rows:
+        match = _BOUND.search(bound)
+        partitions.append({
+            'name': name,
+            'year': int(match.group(1)) if match else None,
+            'rows': max(estimate, 0),
+            'bytes': size,
+        })
+    return partitions
+
+
+def _catalog_years(model):
+    if not is_partitioned(model):
+        return None
+    return {partition['year'] for partition in list_partitions(model) if partition['year'] is not None}
+
+
+def create_partition(model, year):
+    """
+    Create the partition for year. Rows of that year already in the default
+    partition are moved into it (PostgreSQL refuses to add a partition whose
+    range overlaps rows in the default partition).
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    name = partition_name(table, year)
+    bounds = f"FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')"
+    default = default_partition_name(table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [default])
+        has_default = cursor.fetchone()[0]
+        stranded = False
+        if has_default:
+            cursor.execute(
+                f'SELECT EXISTS (SELECT 1 FROM {qn(default)} WHERE "date" >= %s AND "date" < %s)',
+                [date(year, 1, 1), date(year + 1, 1, 1)],
+            )
+            stranded = cursor.fetchone()[0]
+        if not stranded:
+            cursor.execute(f'CREATE TABLE {qn(name)} PARTITION OF {qn(table)} FOR VALUES {bounds}')
+            return name
+        cursor.execute(f'CREATE TABLE {qn(name)} (LIKE {qn(table)})')
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {qn(default)} WHERE "date" >= %s AND "date" < %s RETURNING *) '
+            f'INSERT INTO {qn(name)} SELECT * FROM moved ORDER BY "date", "id"',
+            [date(year, 1, 1), date(year + 1, 1, 1)],
+        )
+        cursor.execute(f'ALTER TABLE {qn(table)} ATTACH PARTITION {qn(name)} FOR VALUES {bounds}')
+    return name
+
+
+def ensure_partitions(model, dates):
+    """Create the missing partitions for the years of dates; returns the years created."""
+    if connection.vendor != 'postgresql':
+        return []
+    table = model._meta.db_table
+    years = {value.year for value in dates if value}
+    known = _known_years.get(table, set())
+    if known is None or years <= known:
+        return []
+
+    known = _known_years[table] = _catalog_years(model)
+    if known is None:
+        return []
+    created = []
+    for year in sorted(years - known):
+        try:
+            create_partition(model, year)
+        except DatabaseError:
+            # Another worker created it first
+            if year not in _catalog_years(model):
+                raise
+            continue
+        created.append(year)
+    return created
+
+
+def detach_partition(model, year, drop=False):
+    """
+    Detach the partition for year: its rows leave the table but are kept in a plain
+    table of the same name, or are dropped with drop=True. Returns the partition name.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    name = partition_name(table, year)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {qn(table)} DETACH PARTITION {qn(name)}')
+        if drop:
+            cursor.execute(f'DROP TABLE {qn(name)}')
+    _known_years.pop(table, None)
+    return name
@@ -0,0 +1,328 @@
+"""
+Staged import pipelines: extract, normalize, validate, load and derive.
+
+A Pipeline is a list of Stages passing columnar batches (pandas DataFrames) along:
+extract reads the source into batches of INVESTEC_PIPELINE_BATCH_ROWS rows,
+normalize maps them onto the model's fields, validate drops (and reports) the rows
+that cannot be stored, load writes them and derive recomputes what depends on them
+once the last batch is in. Stages are generators over the batch stream, and every
+stage is timed as its own StageTimer stage.
+
+The load and derive stages of a run share one database transaction: a file that
+fails halfway (a batch that cannot be written, a derive stage that raises) leaves
+the rows it replaces in place instead of a partial load. The file is parsed in full
+before that transaction opens, so reading and validating the workbook never holds
+it (or the locks of the rows the load deletes) open.
+
+- extract, normalize and validate stages never touch the database. Pipeline.parse()
+  runs them (in a worker process for bulk loads) and returns a picklable parse
+  result that Pipeline.load() writes later; Pipeline.run() does both in one go.
+- Pipeline.replace(name, stage) swaps a stage, e.g. CopyLoad (PostgreSQL COPY) for
+  BulkCreateLoad; INVESTEC_PIPELINE_LOAD picks the default load stage.
+
+A stage fails the whole file by raising PipelineError (missing columns, no date);
+errors in individual rows are collected by the validate stages instead (see
+validation.py).
+"""
+import csv
+import io
+
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .metrics import record_rows_ingested
+from .partitions import ensure_partitions
+from .validation import empty_errors
+
+
+EXTRACT = 'extract'
+NORMALIZE = 'normalize'
+VALIDATE = 'validate'
+LOAD = 'load'
+DERIVE = 'derive'
+
+# Stages that never touch the database, run by Pipeline.parse()
+PARSE_KINDS = (EXTRACT, NORMALIZE, VALIDATE)
+
+
+class PipelineError(Exception):
+    """A file-level failure: the importers answer with message and extra as the error payload."""
+
+    def __init__(self, message, status_code=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.extra = extra
+
+
+class Context:
+    """
+    State of one pipeline run, shared by its stages: the file name, the StageTimer,
+    values stages record for later stages and the result (values), and the error
+    frames of rejected rows (errors).
+    """
+
+    def __init__(self, filename, timer):
+        self.filename = filename
+        self.timer = timer
+        self.values = {}
+        self.errors = []
+
+    def error_frame(self):
+        frames = [errors for errors in self.errors if len(errors)]
+        return pd.concat(frames, ignore_index=True) if frames else empty_errors()
+
+
+class Stage:
+    """
+    One step of a pipeline. Subclasses set kind and name and override process(), which
+    gets each batch and returns it (or a new batch, or None to drop it); start() runs
+    before the first batch (or at the end, if there is none) and finish() after the last.
+    """
+    kind = None
+    name = None
+
+    def start(self, context):
+        pass
+
+    def process(self, batch, context):
+        return batch
+
+    def finish(self, context):
+        pass
+
+    def run(self, batches, context):
+        timer = context.timer
+        started = False
+        for batch in batches:
+            with timer.stage(self.name, rows=len(batch)):
+                if not started:
+                    self.start(context)
+                    started = True
+                batch = self.process(batch, context)
+            if batch is not None:
+                yield batch
+        with timer.stage(self.name):
+            if not started:
+                self.start(context)
+            self.finish(context)
+
+
+class Pipeline:
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return f'Pipeline({self.name!r}, [{", ".join(stage.name for stage in self.stages)}])'
+
+    def replace(self, name, stage):
+        """A copy of this pipeline with the stage called name replaced by stage."""
+        if name not in {existing.name for existing in self.stages}:
+            raise ValueError(f'{self.name} pipeline has no {name} stage')
+        return Pipeline(self.name, [stage if existing.name == name else existing for existing in self.stages])
+
+    def _chain(self, stages, batches, context):
+        for stage in stages:
+            batches = stage.run(batches, context)
+        return batches
+
+    def _parse_stages(self):
+        return [stage for stage in self.stages if stage.kind in PARSE_KINDS]
+
+    def _load_stages(self, derive):
+        return [stage for stage in self.stages if stage.kind == LOAD or (derive and stage.kind == DERIVE)]
+
+    def _parsed(self, context, batches):
+        frame = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+        return {
+            'success': True,
+            'filename': context.filename,
+            'frame': frame,
+            'errors': context.error_frame(),
+            **context.values,
+        }
+
+    def parse(self, source, timer):
+        """
+        Run the extract, normalize and validate stages over source (an uploaded file).
+        Returns the parse result: 'frame' (the rows to load), 'errors' (error frame)
+        and the values the stages recorded. Raises PipelineError.
+        """
+        context = Context(source.name, timer)
+        batches = list(self._chain(self._parse_stages(), source, context))
+        return self._parsed(context, batches)
+
+    def _load(self, batches, context, derive):
+        # One transaction for the whole file, so the rows a load stage deletes come
+        # back if a later batch or derive stage fails
+        with transaction.atomic():
+            for _ in self._chain(self._load_stages(derive), batches, context):
+                pass
+        return context
+
+    def load(self, parsed, timer, derive=True):
+        """
+        Run the load (and, with derive, the derive) stages over a parse result, in one
+        transaction. Returns the run's context.
+        """
+        context = Context(parsed['filename'], timer)
+        context.values.update({key: value for key, value in parsed.items() if key not in ('success', 'filename', 'frame', 'errors')})
+        context.errors.append(parsed['errors'])
+        frame = parsed['frame']
+        batch_rows = settings.INVESTEC_PIPELINE_BATCH_ROWS
+        batches = (frame.iloc[start:start + batch_rows] for start in range(0, len(frame), batch_rows))
+        return self._load(batches, context, derive)
+
+    def run(self, source, timer, derive=True):
+        """
+        Parse source, then load the parsed batches; the load and derive stages run in one
+        transaction, opened once the last batch is parsed. Returns the run's context.
+        """
+        context = Context(source.name, timer)
+        batches = list(self._chain(self._parse_stages(), source, context))
+        return self._load(iter(batches), context, derive)
+
+
+# ------------------------------------------------
+# Extract
+# ------------------------------------------------
+
+def promote_header(df_raw, header_row):
+    """
+    The rows below header_row of a workbook read with header=None, with that row as
+    column names - what pd.read_excel(header=header_row) returns, without reading the
+    file a second time.
+    """
+    names = []
+    seen = {}
+    for position, value in enumerate(df_raw.iloc[header_row].tolist()):
+        name = f'Unnamed: {position}' if pd.isna(value) else value
+        if isinstance(name, float) and name.is_integer():
+            name = int(name)
+        # Repeated names get a .1, .2, ... suffix, like read_excel
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(f'{name}.{count}' if count else name)
+    frame = df_raw.iloc[header_row + 1:].reset_index(drop=True)
+    frame.columns = names
+    return frame.infer_objects()
+
+
+class ExcelExtract(Stage):
+    """
+    Read the first sheet of an Excel workbook once, find its header row with locate
+    and yield the rows below it in batches.
+
+    locate(df_raw, filename, context) returns the header row (None: the first row),
+    recording anything else it finds (e.g. the statement dates) in context.values, or
+    raises PipelineError. The Excel row number of each batch's first row follows from
+    its index and context.values['first_row'].
+    """
+    kind = EXTRACT
+    name = 'extract'
+
+    def __init__(self, locate=None, batch_rows=None):
+        self.locate = locate
+        self.batch_rows = batch_rows
+
+    def run(self, source, context):
+        batch_rows = self.batch_rows or settings.INVESTEC_PIPELINE_BATCH_ROWS
+        with context.timer.stage(self.name):
+            if not source.name.endswith(('.xlsx', '.xls')):
+                raise PipelineError('Invalid file format. Please upload an Excel file (.xlsx or .xls).')
+            try:
+                df_raw = pd.read_excel(source, header=None)
+            except pd.errors.EmptyDataError:
+                raise PipelineError('The Excel file is empty.')
+            header_row = self.locate(df_raw, source.name, context) if self.locate else None
+            frame = promote_header(df_raw, header_row or 0)
+            del df_raw
+            context.values['total_rows'] = len(frame)
+            context.values['first_row'] = (header_row or 0) + 2
+        # A file without rows still passes its (empty) columns along to be checked
+        for start in range(0, max(len(frame), 1), batch_rows):
+            yield frame.iloc[start:start + batch_rows]
+
+
+# ------------------------------------------------
+# Load
+# ------------------------------------------------
+
+class BulkCreateLoad(Stage):
+    """
+    Write each batch with bulk_create (inside the pipeline's transaction). Columns that
+    are not fields of model are ignored. Counts the rows written in context.values['created'].
+    """
+    kind = LOAD
+    name = 'bulk_create'
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = {field.name for field in model._meta.concrete_fields if not field.primary_key}
+
+    def start(self, context):
+        context.values.setdefault('created', 0)
+
+    def columns(self, batch):
+        return [column for column in batch.columns if column in self.fields]
+
+    def process(self, batch, context):
+        if not len(batch):
+            return batch
+        # New years get their own partition (PostgreSQL) before the rows arrive
+        ensure_partitions(self.model, set(batch['date']))
+        created = self.write(batch, self.columns(batch))
+        context.values['created'] += created
+        record_rows_ingested(self.model._meta.db_table, created)
+        return batch
+
+    def write(self, batch, columns):
+        records = batch[columns].to_dict('records')
+        return len(self.model.objects.bulk_create([self.model(**record) for record in records]))
+
+
+class CopyLoad(BulkCreateLoad):
+    """
+    Write each batch with PostgreSQL COPY ... FROM STDIN (CSV) instead of INSERTs: no
+    model instances and one round trip per batch. created_at/updated_at are set to the
+    load time. Falls back to bulk_create on other databases.
+    """
+    name = 'copy'
+
+    NULL = r'\N'
+
+    def write(self, batch, columns):
+        if connection.vendor != 'postgresql':
+            return super().write(batch, columns)
+        now = timezone.now()
+        auto = [
+            field.name for field in self.model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+        ]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch[columns].itertuples(index=False, name=None):
+            writer.writerow([self.NULL if value is None or value is pd.NaT or value != value else value for value in row] + [now] * len(auto))
+        buffer.seek(0)
+        qn = connection.ops.quote_name
+        db_columns = ', '.join(qn(self.model._meta.get_field(name).column) for name in columns + auto)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {qn(self.model._meta.db_table)} ({db_columns}) FROM STDIN WITH (FORMAT csv, NULL '{self.NULL}')",
+                buffer,
+            )
+        return len(batch)
+
+
+LOAD_STAGES = {
+    'bulk_create': BulkCreateLoad,
+    'copy': CopyLoad,
+}
+
+
+def load_stage(model):
+    """The load stage for model configured by INVESTEC_PIPELINE_LOAD."""
+    return LOAD_STAGES[settings.INVESTEC_PIPELINE_LOAD](model)
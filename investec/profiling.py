@@ -0,0 +1,120 @@
+"""
+On-demand request profiling (see ProfilingMiddleware).
+
+A profiled request is run under cProfile while a sampler thread records the
+request thread's stack every INVESTEC_PROFILE_INTERVAL seconds. Three files are
+written to INVESTEC_PROFILE_DIR, named by request id:
+
+- <id>.prof    pstats dump (python -m pstats, snakeviz)
+- <id>.folded  collapsed stacks, one "frame;frame;frame count" line per stack
+               (flamegraph.pl, speedscope, inferno)
+- <id>.json    request, duration and status
+
+Only the INVESTEC_PROFILE_KEEP slowest profiles are kept.
+"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+
+
+class StackSampler(threading.Thread):
+    """Sample the stack of one thread at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+class RequestProfile:
+    """Profile the enclosed block with cProfile and the stack sampler."""
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.INVESTEC_PROFILE_INTERVAL
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), self.interval)
+        self.seconds = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.sampler.stop()
+        self.seconds = time.perf_counter() - self.started
+        return False
+
+    def save(self, request_id, **details):
+        """Write the .prof, .folded and .json files, then evict all but the slowest profiles."""
+        directory = settings.INVESTEC_PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, request_id)
+        self.profiler.dump_stats(f'{base}.prof')
+        with open(f'{base}.folded', 'w') as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(f'{base}.json', 'w') as f:
+            json.dump({
+                'request_id': request_id,
+                'seconds': round(self.seconds, 4),
+                'samples': sum(self.sampler.stacks.values()),
+                'interval': self.interval,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                **details,
+            }, f, indent=2)
+        evict_profiles(directory, settings.INVESTEC_PROFILE_KEEP)
+        return base
+
+
+def list_profiles(directory=None):
+    """Metadata of the stored profiles, slowest first."""
+    directory = directory or settings.INVESTEC_PROFILE_DIR
+    profiles = []
+    if not os.path.isdir(directory):
+        return profiles
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # Being written or evicted by another worker
+            continue
+    return sorted(profiles, key=lambda profile: profile.get('seconds', 0), reverse=True)
+
+
+def evict_profiles(directory, keep):
+    for profile in list_profiles(directory)[keep:]:
+        for extension in ('.json', '.prof', '.folded'):
+            try:
+                os.remove(os.path.join(directory, f'{profile["request_id"]}{extension}'))
+            except FileNotFoundError:
+                pass
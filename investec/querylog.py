@@ -0,0 +1,236 @@
+"""
+Slow-query log.
+
+install() (called from InvestecConfig.ready when INVESTEC_SLOW_QUERY_MS > 0) adds a
+SlowQueryLog to the execute wrappers of every database connection. Queries slower
+than the threshold are:
+
+- written as one JSON line to the 'investec.slow_queries' logger (a rotating file,
+  settings.INVESTEC_SLOW_QUERY_LOG)
+- aggregated per fingerprint, source and stage into InvestecSlowQuery (admin)
+
+The source is the URL name of the view (set by QueryAttributionMiddleware) or the
+management command; the stage is the import pipeline stage running (StageTimer).
+A sample of slow SELECTs (INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE) is planned again
+under EXPLAIN (BUFFERS) on PostgreSQL, EXPLAIN QUERY PLAN on SQLite. The plan is
+estimated only, never ANALYZE: that would run the slow query a second time in the
+request that issued it. For actual row counts and times, run the stored SQL with
+its last_params under EXPLAIN (ANALYZE, BUFFERS) by hand.
+
+Aggregates are buffered per thread and written after the request (or, in commands,
+whenever no transaction is open and at exit), never inside the caller's transaction.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .instrumentation import query_source, query_stage
+
+
+logger = logging.getLogger('investec.slow_queries')
+
+# Flush the buffer early once this many slow queries are pending (long-running commands)
+MAX_PENDING = 50
+MAX_PARAMS_LENGTH = 2000
+
+_state = threading.local()
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'IN \((?:\?, )*\?\)')
+_VALUES_LIST = re.compile(r'VALUES (?:\((?:\?, )*\?\)(?:, )?)+')
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    Return (sha1, normalized SQL): literals and parameters become '?', IN lists and
+    multi-row VALUES collapse to '(...)', so bulk statements of any size share one entry.
+    """
+    normalized = _SPACE.sub(' ', sql).strip()
+    normalized = _STRING.sub('?', normalized)
+    normalized = _NUMBER.sub('?', normalized.replace('%s', '?'))
+    normalized = _IN_LIST.sub('IN (...)', normalized)
+    normalized = _VALUES_LIST.sub('VALUES (...)', normalized)
+    return hashlib.sha1(normalized.encode()).hexdigest(), normalized
+
+
+def _default_source():
+    if len(sys.argv) > 1 and os.path.basename(sys.argv[0]) == 'manage.py':
+        return f'manage.py {sys.argv[1]}'
+    return 'unattributed'
+
+
+def _explain(connection, sql, params):
+    """EXPLAIN (without running) a SELECT with its parameters; returns the plan text or '' if unsupported/failed."""
+    if connection.vendor == 'postgresql':
+        # BUFFERS without ANALYZE (the planner's buffer use) needs PostgreSQL 13+
+        prefix = 'EXPLAIN (BUFFERS) ' if connection.pg_version >= 130000 else 'EXPLAIN '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return ''
+    try:
+        # Savepoint: a failed EXPLAIN must not abort the caller's transaction
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+    except DatabaseError as e:
+        return f'EXPLAIN failed: {e}'
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+class SlowQueryLog:
+    """Execute wrapper recording queries slower than settings.INVESTEC_SLOW_QUERY_MS."""
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(_state, 'busy', False):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            result = execute(sql, params, many, context)
+            succeeded = True
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            if seconds * 1000 >= settings.INVESTEC_SLOW_QUERY_MS:
+                _state.busy = True
+                try:
+                    self._record(context['connection'], sql, params, many, seconds, succeeded)
+                finally:
+                    _state.busy = False
+
+    def _record(self, connection, sql, params, many, seconds, succeeded):
+        digest, normalized = fingerprint(sql)
+        entry = {
+            'fingerprint': digest,
+            'sql': normalized,
+            'source': query_source.get() or _default_source(),
+            'stage': query_stage.get(),
+            'seconds': seconds,
+            'params': '' if many else repr(params)[:MAX_PARAMS_LENGTH],
+            'plan': '',
+        }
+        sampled = random.random() < settings.INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE
+        if succeeded and sampled and not many and sql.lstrip()[:6].upper() == 'SELECT':
+            entry['plan'] = _explain(connection, sql, params)
+
+        logger.warning(json.dumps({
+            'seconds': round(seconds, 4),
+            'source': entry['source'],
+            'stage': entry['stage'],
+            'fingerprint': digest,
+            'sql': sql,
+            'params': entry['params'],
+            'failed': not succeeded,
+            'plan': entry['plan'] or None,
+        }, default=str))
+
+        pending = getattr(_state, 'pending', None)
+        if pending is None:
+            pending = _state.pending = []
+        pending.append(entry)
+        if len(pending) >= MAX_PENDING and not connection.in_atomic_block:
+            _flush()
+
+
+def flush():
+    """Write this thread's buffered slow queries to InvestecSlowQuery."""
+    if not getattr(_state, 'pending', None) or getattr(_state, 'busy', False):
+        return
+    _state.busy = True
+    try:
+        _flush()
+    finally:
+        _state.busy = False
+
+
+def _flush():
+    from .models import InvestecSlowQuery
+
+    pending, _state.pending = _state.pending, []
+    aggregated = {}
+    for entry in pending:
+        key = (entry['fingerprint'], entry['source'], entry['stage'])
+        total = aggregated.setdefault(key, {'sql': entry['sql'], 'calls': 0, 'total': 0.0, 'max': 0.0})
+        total['calls'] += 1
+        total['total'] += entry['seconds']
+        total['max'] = max(total['max'], entry['seconds'])
+        total['last'] = entry['seconds']
+        total['params'] = entry['params']
+        if entry['plan']:
+            total['plan'] = entry['plan']
+
+    now = timezone.now()
+    try:
+        for (digest, source, stage), total in aggregated.items():
+            updates = {
+                'calls': F('calls') + total['calls'],
+                'total_seconds': F('total_seconds') + total['total'],
+                'max_seconds': Greatest('max_seconds', Value(total['max'], output_field=FloatField())),
+                'last_seconds': total['last'],
+                'last_params': total['params'],
+                'last_seen': now,
+            }
+            if total.get('plan'):
+                updates.update(explain_plan=total['plan'], explained_at=now)
+            rows = InvestecSlowQuery.objects.filter(fingerprint=digest, source=source[:200], stage=stage[:100])
+            with transaction.atomic():
+                if rows.update(**updates):
+                    continue
+                try:
+                    with transaction.atomic():
+                        InvestecSlowQuery.objects.create(
+                            fingerprint=digest,
+                            sql=total['sql'],
+                            source=source[:200],
+                            stage=stage[:100],
+                            calls=total['calls'],
+                            total_seconds=total['total'],
+                            max_seconds=total['max'],
+                            last_seconds=total['last'],
+                            last_params=total['params'],
+                            explain_plan=total.get('plan', ''),
+                            explained_at=now if total.get('plan') else None,
+                        )
+                except IntegrityError:
+                    # Another worker created it first
+                    rows.update(**updates)
+    except DatabaseError as e:
+        # e.g. the table does not exist yet while migrations run
+        logger.debug(f'Could not store slow queries: {e}')
+
+
+def _add_wrapper(sender, connection, **kwargs):
+    if not any(isinstance(wrapper, SlowQueryLog) for wrapper in connection.execute_wrappers):
+        # Insert first: the connection may open inside a `with connection.execute_wrapper(...)`
+        # block, whose exit pops the last wrapper
+        connection.execute_wrappers.insert(0, SlowQueryLog())
+
+
+def install():
+    """Wrap every database connection opened from now on and flush the buffer at exit."""
+    log_dir = os.path.dirname(settings.INVESTEC_SLOW_QUERY_LOG)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    connection_created.connect(_add_wrapper, dispatch_uid='investec_slow_query_log')
+    for connection in connections.all():
+        if connection.connection is not None:
+            _add_wrapper(None, connection)
+    atexit.register(flush)
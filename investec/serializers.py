@@ -1,3 +1,7 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
 from rest_framework import serializers
 from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareNameMapping, InvestecJseShareMonthlyPerformance
 
@@ -13,15 +17,17 @@ class InvestecJseTransactionSerializer(serializers.ModelSerializer):
             'account_number',
             'description',
             'share_name',
+            'share_code',
             'type',
             'quantity',
             'value',
             'value_per_share',
             'value_calculated',
+            'dividend_ttm',
             'created_at',
             'updated_at',
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'share_code', 'dividend_ttm', 'created_at', 'updated_at']
 
 
 class InvestecJsePortfolioSerializer(serializers.ModelSerializer):
@@ -90,3 +96,100 @@ class InvestecJseShareMonthlyPerformanceSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+
+# ------------------------------------------------
+# Fast (values-based) serialization
+# ------------------------------------------------
+
+def _decimal_representation(decimal_places):
+    # Quantized like DRF's DecimalField: computed values (e.g. the live TTM annotation on
+    # SQLite) come back from the database with more or fewer places than the column
+    exponent = Decimal(1).scaleb(-decimal_places)
+    
+    def represent(value):
+        if value is None:
+            return None
+        return format(Decimal(value).quantize(exponent, rounding=ROUND_HALF_UP), 'f')
+    return represent
+
+
+def _date_representation(value):
+    return None if value is None else value.isoformat()
+
+
+def _datetime_representation(value):
+    if value is None:
+        return None
+    rendered = value.isoformat()
+    if rendered.endswith('+00:00'):
+        rendered = rendered[:-6] + 'Z'
+    return rendered
+
+
+def _field_converter(model, field_name):
+    """Return a converter rendering a raw DB value the way the DRF field would (None = as-is)."""
+    try:
+        field = model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return None
+    if isinstance(field, models.DecimalField):
+        return _decimal_representation(field.decimal_places)
+    if isinstance(field, models.DateTimeField):
+        return _datetime_representation
+    if isinstance(field, models.DateField):
+        return _date_representation
+    return None
+
+
+def _convert_columns(model, rows, fields):
+    """Transpose value rows into columns and render each column with a single converter."""
+    columns = []
+    for field_name, column in zip(fields, zip(*rows)):
+        converter = _field_converter(model, field_name)
+        columns.append(list(map(converter, column)) if converter else list(column))
+    return columns
+
+
+def serialize_values(model, rows, fields):
+    """
+    Serialize tuples from ``QuerySet.values_list(*fields)`` into dicts.
+    
+    Produces the same output as the ModelSerializers above but converts whole
+    columns at once instead of building a serializer field tree per row, which
+    dominates the cost for large result sets.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    columns = _convert_columns(model, rows, fields)
+    return [dict(zip(fields, row)) for row in zip(*columns)]
+
+
+def serialize_columns(model, rows, fields):
+    """
+    Serialize tuples from ``QuerySet.values_list(*fields)`` into a columnar dict.
+    
+    Returns ``{field: [value, ...]}``; field names appear once instead of once per row.
+    """
+    rows = list(rows)
+    if not rows:
+        return {field: [] for field in fields}
+    return dict(zip(fields, _convert_columns(model, rows, fields)))
+
+
+TRANSACTION_FIELDS = InvestecJseTransactionSerializer.Meta.fields
+PERFORMANCE_FIELDS = InvestecJseShareMonthlyPerformanceSerializer.Meta.fields
+HOLDINGS_SNAPSHOT_FIELDS = [
+    'share_code',
+    'company',
+    'quantity',
+    'currency',
+    'unit_cost',
+    'total_cost',
+    'price',
+    'total_value',
+    'profit_loss',
+    'portfolio_percent',
+    'annual_income_zar',
+]
+HOLDINGS_SERIES_FIELDS = ['date', 'quantity', 'price', 'total_value']
@@ -0,0 +1,61 @@
+"""
+share_code on InvestecJseTransaction, denormalized from InvestecJseShareNameMapping.
+
+A transaction's share_code is the share code mapped to its share_name, or NULL.
+The transaction import fills it with one mapping lookup per batch (share_codes_for);
+when mappings change (mapping upload, admin) the stored transactions are
+re-resolved with one set-based UPDATE ... FROM (resolve_share_codes). Transactions
+then join portfolio holdings and prices on (share_code, date) directly.
+"""
+from django.db import connection
+
+from .models import InvestecJseShareNameMapping, InvestecJseTransaction
+
+
+def share_codes_for(share_names):
+    """{share_name: share_code} for the mapped names among share_names, in one query."""
+    return dict(
+        InvestecJseShareNameMapping.objects.filter(
+            share_name__in=set(share_names),
+        ).exclude(
+            share_code__isnull=True
+        ).exclude(
+            share_code=''
+        ).values_list('share_name', 'share_code')
+    )
+
+
+def resolve_share_codes(share_names=None):
+    """
+    Set the share_code of stored transactions from their mapping, for the mappings of
+    share_names (default: all). Only rows whose code differs are written. Returns the
+    number of transactions updated.
+    """
+    qn = connection.ops.quote_name
+    transactions = qn(InvestecJseTransaction._meta.db_table)
+    mappings = qn(InvestecJseShareNameMapping._meta.db_table)
+    sql = (
+        f"UPDATE {transactions} SET share_code = NULLIF(m.share_code, '') "
+        f'FROM {mappings} m '
+        f'WHERE {transactions}.share_name = m.share_name '
+        f"AND COALESCE({transactions}.share_code, '') <> COALESCE(m.share_code, '')"
+    )
+    params = []
+    if share_names is not None:
+        share_names = list(set(share_names))
+        if not share_names:
+            return 0
+        sql += f' AND m.share_name IN ({", ".join(["%s"] * len(share_names))})'
+        params = share_names
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def clear_share_codes(share_names):
+    """Clear the share_code of transactions whose share names lost their mapping."""
+    return InvestecJseTransaction.objects.filter(
+        share_name__in=list(share_names),
+    ).exclude(
+        share_code__isnull=True
+    ).update(share_code=None)
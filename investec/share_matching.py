@@ -0,0 +1,177 @@
+"""
+Suggest share name mappings: match the share names of unmapped transactions ("NINETY",
+"TIGBRANDS", "A V I") to the companies and share codes of the portfolio holdings
+("NINETY ONE LIMITED" / NY1).
+
+ShareNameIndex is a trigram index over match keys: each candidate share code is
+indexed under its code, its company names with the spaces taken out, with and
+without their stop words ("STANDARDBANKGROUPLTD", "STANDARDBANK"), and each
+distinctive word of the names ("STANDARD", "BANK"; not LTD, GROUP, ...). A
+share name is scored against only the keys that share a trigram with it, found
+through the index's postings, so matching thousands of names costs a few dictionary
+lookups per trigram instead of a comparison with every company.
+
+A key scores the Dice coefficient of its trigrams and the name's, at least
+PREFIX_SCORE (up to 1) when one is a prefix of the other (statement names are often
+truncated: "SHOPRIT", "CORONAT"), at least ABBREVIATION_SCORE (up to 0.9) when the
+name is an abbreviation of the key - its letters in order, starting with the key's
+first ("TIGBRANDS", "INVLTD") - and 1 when they are equal. Word keys count
+WORD_WEIGHT of that. A candidate scores its best key.
+"""
+import re
+from collections import defaultdict
+
+from django.db.models import Count
+
+from .models import InvestecJsePortfolio, InvestecJseTransaction
+
+
+# Words that do not tell companies apart (legal forms, "group", "holdings")
+STOP_WORDS = {
+    'LIMITED', 'LTD', 'LD', 'L', 'PLC', 'INC', 'CORP', 'CORPORATION', 'CO', 'COMPANY', 'THE', 'AND', 'OF',
+    'GROUP', 'GRP', 'HOLDINGS', 'HLDGS', 'HLDG', 'N', 'NV', 'SA', 'SCA', 'S', 'C', 'A', 'V',
+}
+
+# Weight of a match on one word of a company or share name (the whole name counts fully)
+WORD_WEIGHT = 0.9
+
+# Least score of a key that the share name is a prefix of (or that is a prefix of it),
+# and of a key the share name abbreviates
+PREFIX_SCORE = 0.5
+ABBREVIATION_SCORE = 0.4
+
+# Default least score of a suggestion and number of suggestions per share name
+MIN_SCORE = 0.5
+SUGGESTIONS = 3
+
+
+def _words(text):
+    return re.findall(r'[A-Z0-9]+', str(text).upper())
+
+
+def _trigrams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _match_keys(text):
+    """(key, weight) pairs of a name: the whole name without spaces and punctuation, and its distinctive words."""
+    words = _words(text)
+    keys = {''.join(words): 1.0} if words else {}
+    if len(words) > 1:
+        distinctive = [word for word in words if len(word) > 1 and word not in STOP_WORDS]
+        if distinctive:
+            # "STANDARD BANK GROUP LTD" is also "STANDARDBANK"
+            keys.setdefault(''.join(distinctive), 1.0)
+        for word in distinctive:
+            keys.setdefault(word, WORD_WEIGHT)
+    return keys.items()
+
+
+def _abbreviates(name_key, key):
+    """name_key's letters appear in key in order, starting with key's first letter."""
+    if name_key[0] != key[0]:
+        return False
+    letters = iter(key)
+    return all(letter in letters for letter in name_key)
+
+
+def _key_score(name_key, key, shared, name_grams, key_grams):
+    if name_key == key:
+        return 1.0
+    score = 2 * shared / (name_grams + key_grams)
+    if len(name_key) >= 3 and len(key) >= 3:
+        shorter, longer = sorted((len(name_key), len(key)))
+        if key.startswith(name_key) or name_key.startswith(key):
+            score = max(score, PREFIX_SCORE + (1 - PREFIX_SCORE) * shorter / longer)
+        elif len(name_key) < len(key) and _abbreviates(name_key, key):
+            score = max(score, ABBREVIATION_SCORE + (0.9 - ABBREVIATION_SCORE) * shorter / longer)
+    return score
+
+
+class ShareNameIndex:
+    """Trigram index over the match keys of candidate (share_code, company) pairs."""
+
+    def __init__(self, candidates=()):
+        self.candidates = {}  # share_code -> company (the name of its longest match)
+        self.keys = []  # (key, share_code, company, weight, trigram count)
+        self.postings = defaultdict(list)  # trigram -> indexes into keys
+        for share_code, company in candidates:
+            self.add(share_code, company)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def add(self, share_code, company):
+        if not share_code:
+            return
+        self.candidates.setdefault(share_code, company)
+        keys = dict(_match_keys(company))
+        code = ''.join(_words(share_code))
+        if code:
+            keys[code] = 1.0
+        for key, weight in keys.items():
+            grams = _trigrams(key)
+            position = len(self.keys)
+            self.keys.append((key, share_code, company, weight, len(grams)))
+            for gram in grams:
+                self.postings[gram].append(position)
+
+    def match(self, share_name, limit=SUGGESTIONS, min_score=MIN_SCORE):
+        """The best candidates for share_name: dicts with share_code, company and score, best first."""
+        best = {}
+        for name_key, name_weight in _match_keys(share_name):
+            name_grams = _trigrams(name_key)
+            shared = defaultdict(int)
+            for gram in name_grams:
+                for position in self.postings.get(gram, ()):
+                    shared[position] += 1
+            for position, count in shared.items():
+                key, share_code, company, weight, key_grams = self.keys[position]
+                score = name_weight * weight * _key_score(name_key, key, count, len(name_grams), key_grams)
+                if score > best.get(share_code, (0, None))[0]:
+                    best[share_code] = (score, company)
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))
+        return [
+            {'share_code': share_code, 'company': company, 'score': round(score, 3)}
+            for share_code, (score, company) in ranked[:limit] if score >= min_score
+        ]
+
+
+def portfolio_index():
+    """ShareNameIndex over every (share_code, company) of the stored portfolio holdings."""
+    return ShareNameIndex(
+        InvestecJsePortfolio.objects.exclude(share_code='').values_list('share_code', 'company').distinct()
+    )
+
+
+def unmapped_share_names():
+    """{share_name: transaction count} of the transactions without a share code (no mapping, or one without a code)."""
+    return dict(
+        InvestecJseTransaction.objects.filter(
+            share_code__isnull=True,
+        ).exclude(
+            share_name=''
+        ).values_list('share_name').annotate(transactions=Count('id')).order_by('share_name')
+    )
+
+
+def suggest_mappings(share_names=None, limit=SUGGESTIONS, min_score=MIN_SCORE):
+    """
+    Suggested mappings for share_names (default: every unmapped share name), scored in
+    one pass over a portfolio index. Returns a list of dicts with share_name,
+    transactions (count, None for names given explicitly) and suggestions, by share name.
+    """
+    if share_names is None:
+        counts = unmapped_share_names()
+    else:
+        counts = dict.fromkeys(sorted(set(share_names)))
+    index = portfolio_index()
+    return [
+        {
+            'share_name': share_name,
+            'transactions': transactions,
+            'suggestions': index.match(share_name, limit=limit, min_score=min_score),
+        }
+        for share_name, transactions in counts.items()
+    ]
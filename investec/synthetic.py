@@ -0,0 +1,274 @@
+"""
+Synthetic Investec exports for benchmarks and load tests.
+
+Writes workbooks laid out like the real downloads so they go through the same
+parsers as uploaded files:
+
+- Transaction history: account / report / "From date" / "To date" header rows, then
+  Date, Account Number, Description, Share code, Share name, Quantity, Value with
+  "Buy 179 NEDBANK at 26,447 Cents", "DIV. 446 A V I", "DIV. TAX ON  94 NINETY 1L",
+  "FOREIGN DIV. 3061 BATS", "SPEC.DIV. 1229 OUTSURE", fees, VAT, interest and transfers
+- Portfolio holdings report: "Portfolio Holdings Report" block with
+  "ABSA GROUP LIMITED (ABG)" instrument descriptions
+- Share name mapping: Share_Name, Company, Share_Code
+
+Output is deterministic for a given seed. Workbooks are streamed with openpyxl's
+write-only mode, so 1M-row statements do not need the whole sheet in memory.
+"""
+import os
+import random
+from datetime import date, datetime, timedelta
+
+from openpyxl import Workbook
+
+
+# (statement share name, name used in dividend descriptions, company, share code, price in cents)
+SHARES = [
+    ('ABSAGROUP', 'ABSAGROUP', 'ABSA GROUP LIMITED', 'ABG', 16596),
+    ('A V I', 'A V I', 'AVI LTD', 'AVI', 8928),
+    ('ASPEN', 'ASPEN', 'ASPEN PHARMACARE HLDGS L', 'APN', 15210),
+    ('ASTRAL', 'ASTRAL', 'ASTRAL FOODS LTD', 'ARL', 17455),
+    ('BHP GROUP', 'BHP GROUP', 'BHP GROUP LIMITED', 'BHG', 49971),
+    ('BOXER', 'BOXER', 'BOXER RETAIL LIMITED', 'BOX', 4530),
+    ('CAPITEC', 'CAPITEC', 'CAPITEC BANK HLDGS LTD', 'CPI', 342627),
+    ('CORONAT', 'CORONAT', 'CORONATION FUND MNGRS LD', 'CML', 4105),
+    ('CURRO', 'CURRO', 'CURRO HOLDINGS LIMITED', 'COH', 1191),
+    ('NASPERS', 'NASPERS-N-', 'NASPERS LTD -N-', 'NPN', 512300),
+    ('NEDBANK', 'NEDBANK', 'NEDBANK GROUP LTD', 'NED', 26448),
+    ('NINETY', 'NINETY 1L', 'NINETY ONE LTD', 'N91', 4012),
+    ('OUTSURE', 'OUTSURE', 'OUTSURANCE GROUP LTD', 'OUT', 6540),
+    ('SYGNIA', 'SYGNIA', 'SYGNIA LIMITED', 'SYG', 2495),
+    ('TIGBRANDS', 'TIGBRANDS', 'TIGER BRANDS LTD', 'TBS', 22010),
+    ('WOOLIES', 'WOOLIES', 'WOOLWORTHS HOLDINGS LTD', 'WHL', 5980),
+]
+# Shares paying foreign dividends ("FOREIGN DIV. 3061 BATS")
+FOREIGN_SHARES = [
+    ('BATS', 'BATS', 'BRITISH AMERICAN TOB PLC', 'BTI', 70210),
+    ('RICHEMONT', 'RICHEMONT', 'COMPAGNIE FIN RICHEMONT', 'CFR', 301540),
+]
+ACCOUNTS = ['1812775', '1867563']
+
+# Relative frequency of each kind of statement line (roughly that of the real exports)
+LINE_WEIGHTS = {
+    'buy': 20,
+    'sell': 30,
+    'dividend': 14,
+    'foreign_dividend': 3,
+    'special_dividend': 1,
+    'fee': 4,
+    'interest': 4,
+    'transfer': 6,
+}
+
+
+def share_catalog(count=None):
+    """
+    The share universe: the real names first, then SYN0001-style shares when more
+    are requested (for large portfolio and mapping files).
+    """
+    catalog = SHARES + FOREIGN_SHARES
+    if count is None or count <= len(catalog):
+        return catalog[:count] if count else catalog
+    for n in range(len(catalog) + 1, count + 1):
+        name = f'SYN{n:04d}'
+        catalog.append((name, name, f'SYNTHETIC HOLDINGS {n} LTD', f'S{n:03d}', 1000 + (n * 7919) % 90000))
+    return catalog
+
+
+def _cents(amount):
+    return f'{amount:,}'
+
+
+def _statement_lines(rng, rows, start, end, shares, accounts):
+    """Yield (date, account, description, share_name, quantity, value) in random date order."""
+    foreign = {share[0] for share in FOREIGN_SHARES}
+    kinds = list(LINE_WEIGHTS)
+    weights = list(LINE_WEIGHTS.values())
+    span = max((end - start).days, 0)
+    
+    produced = 0
+    while produced < rows:
+        day = start + timedelta(days=rng.randint(0, span))
+        account = rng.choice(accounts)
+        kind = rng.choices(kinds, weights)[0]
+        share_name, dividend_name, company, code, price = rng.choice(shares)
+        quantity = rng.choice([1, 2, 13, 45, 70, 100, 160, 179, 219, 400, 447, 733, 1549, 3270])
+    
+        if kind in ('buy', 'sell'):
+            fill = max(1, int(price * rng.uniform(0.97, 1.03)))
+            amount = round(quantity * fill / 100, 2)
+            if kind == 'buy':
+                lines = [(f'Buy {quantity} {share_name} at {_cents(fill)} Cents', share_name, quantity, -amount)]
+            else:
+                lines = [(f'Sell {quantity} {share_name} at {_cents(fill)} Cents', share_name, -quantity, amount)]
+        elif kind == 'dividend' or (kind == 'foreign_dividend' and share_name not in foreign):
+            gross = round(quantity * price * rng.uniform(0.01, 0.03) / 100, 2)
+            lines = [(f'DIV. {quantity} {dividend_name}', None, 0, gross)]
+            if rng.random() < 0.3:
+                lines.append((f'DIV. TAX ON  {quantity} {dividend_name}', None, 0, -round(gross * 0.2, 2)))
+        elif kind == 'foreign_dividend':
+            gross = round(quantity * price * rng.uniform(0.01, 0.03) / 100, 2)
+            lines = [
+                (f'FOREIGN DIV. {quantity} {dividend_name}', None, 0, gross),
+                (f'FOREIGN TAX  {quantity} {dividend_name}', None, 0, -round(gross * 0.35, 2)),
+            ]
+        elif kind == 'special_dividend':
+            lines = [(f'SPEC.DIV. {quantity} {dividend_name}', None, 0, round(quantity * price * 0.005 / 100, 2))]
+        elif kind == 'fee':
+            fee = round(rng.uniform(50, 500), 2)
+            lines = [
+                ('BROKER TRUSTEES FEE', None, 0, -fee),
+                ('VAT @   15,00%', None, 0, -round(fee * 0.15, 2)),
+            ]
+        elif kind == 'interest':
+            period_start = day - timedelta(days=30)
+            lines = [(f'GROSS INTEREST {period_start:%y/%m/%d}-{day:%y/%m/%d}', None, 0, round(rng.uniform(10, 5000), 2))]
+        else:
+            amount = round(rng.uniform(100, 50000), 2)
+            lines = [
+                ('TRF INCOME TO TRADING', None, 0, amount),
+                ('TRF INCOME TO TRADING', None, 0, -amount),
+            ]
+    
+        for description, statement_share, line_quantity, value in lines[:rows - produced]:
+            yield day, account, description, statement_share, line_quantity, value
+            produced += 1
+
+
+def generate_transaction_statement(directory, rows, start=None, end=None, shares=None, accounts=None, seed=0):
+    """
+    Write a "Transaction History Report" with `rows` statement lines between start and
+    end (default: the last five years), newest first like the real export.
+    
+    Returns the path; the filename carries the date range
+    (TransactionHistory-All-YYYYMMDD-YYYYMMDD.xlsx) as the downloads do.
+    """
+    rng = random.Random(seed)
+    end = end or date.today()
+    start = start or end - timedelta(days=5 * 365)
+    shares = shares or share_catalog()
+    accounts = accounts or ACCOUNTS
+    
+    lines = sorted(_statement_lines(rng, rows, start, end, shares, accounts), key=lambda line: line[0], reverse=True)
+    
+    path = os.path.join(directory, f'TransactionHistory-All-{start:%Y%m%d}-{end:%Y%m%d}.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Transaction History')
+    for header in (
+        [f'{accounts[0]}_Synthetic Pty Ltd_JSE'],
+        [],
+        ['Transaction History Report'],
+        ['Report Date', f'{end:%Y/%m/%d}'],
+        [],
+        ['History Type', 'All'],
+        ['From date', f'{start:%Y/%m/%d}'],
+        ['To date', f'{end:%Y/%m/%d}'],
+        ['Share Code', ''],
+        [],
+        ['No of Results', len(lines)],
+        [],
+        ['Date', 'Account Number', 'Description', 'Share code', 'Share name', 'Quantity', 'Value'],
+    ):
+        sheet.append(header)
+    for day, account, description, share_name, quantity, value in lines:
+        sheet.append([datetime(day.year, day.month, day.day), account, description, '', share_name, quantity, value])
+    workbook.save(path)
+    return path
+
+
+def generate_portfolio_report(directory, holdings=None, as_of=None, account=None, seed=0):
+    """
+    Write a "Portfolio Holdings Report" for `holdings` instruments (default: every
+    share in SHARES and FOREIGN_SHARES) as at as_of (default: today).
+    """
+    rng = random.Random(seed)
+    as_of = as_of or date.today()
+    account = account or ACCOUNTS[0]
+    shares = share_catalog(holdings)
+    
+    positions = []
+    for share_name, dividend_name, company, code, price_cents in shares:
+        quantity = rng.randint(10, 20000)
+        price = round(price_cents / 100 * rng.uniform(0.9, 1.1), 2)
+        unit_cost = round(price * rng.uniform(0.4, 1.2), 6)
+        positions.append((f'{company} ({code})', quantity, unit_cost, round(quantity * unit_cost, 2), price, round(quantity * price, 2)))
+    total_cost = round(sum(position[3] for position in positions), 2)
+    total_value = round(sum(position[5] for position in positions), 2) or 1
+    
+    path = os.path.join(directory, f'Holdings-{as_of:%Y%m%d}{account}_SYNTHETIC_JSE.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Holdings')
+    for header in (
+        [f'{account}_SYNTHETIC PTY LTD_JSE'],
+        [],
+        ['Portfolio Holdings Report'],
+        [f'{as_of:%Y/%m/%d}'],
+        ['Reference Currency'],
+        ['ZAR'],
+        [None, None, 'Base', None, None, None, None, None, None, None, 'Reference'],
+        ['Instrument Description', 'Total Quantity', 'Currency', 'Unit', 'Total Cost', 'Price',
+         'Available To Withdraw', 'Open Position', 'Total Value', 'Currency', 'Exchange', 'Price',
+         'Total Value', 'Move (%)', 'Daily', f'{as_of:%Y/%m/%d}', 'Corporate', 'Asset', 'Portfolio',
+         'Yield (%)', 'Pending', 'Annual', 'Demat', 'Daily Profit/Loss', 'Profit/Loss',
+         'Initial Margin', 'ISL Margin'],
+        [None, None, None, 'Cost (net)', None, None, None, None, None, None, 'Rate', None, None, None,
+         'Move (%)', 'Move (%)', 'Action', 'Class (%)', '(%)', None, 'Quantity', 'Income (R)', 'Quantity',
+         None, None, '(derivatives)', '(derivatives)'],
+        ['Domestic Investments', None, None, None, total_cost, None, 0, 0, total_value, 'ZAR', 0, 0, total_value],
+        ['Equity', None, None, None, total_cost, None, 0, 0, total_value, 'ZAR', 0, 0, total_value],
+    ):
+        sheet.append(header)
+    for description, quantity, unit_cost, cost, price, value in positions:
+        move = round(rng.uniform(-3, 3), 6)
+        portfolio_percent = round(value / total_value * 100, 6)
+        dividend_yield = round(rng.uniform(0, 8), 2)
+        sheet.append([
+            description, f'{quantity:.2f}', 'ZAR', unit_cost, cost, price, 0, 0, value, 'ZAR', 1, price, value,
+            round((value - cost) / cost * 100, 6) if cost else 0, move, move, None, portfolio_percent,
+            portfolio_percent, dividend_yield, 0, round(value * dividend_yield / 100, 6), quantity,
+            round(value * move / 100, 2), round(value - cost, 2), 0, 0,
+        ])
+    sheet.append(['Total Investement', None, None, None, total_cost, None, 0, 0, total_value, 'ZAR', 0, 0, total_value])
+    workbook.save(path)
+    return path
+
+
+def generate_mapping_file(directory, rows=None, seed=0):
+    """
+    Write a share name mapping workbook. The first rows map the statement names of
+    the share catalog (including the "A V I" / "AVI" spellings); further rows, up to
+    `rows`, map synthetic shares, with some left unmapped as in the real file.
+    """
+    rng = random.Random(seed)
+    mappings = [(share_name, company, code) for share_name, dividend_name, company, code, price in share_catalog()]
+    mappings.insert(2, ('AVI', 'AVI LTD', 'AVI'))
+    if rows and rows > len(mappings):
+        real_count = len(SHARES) + len(FOREIGN_SHARES)
+        for share_name, dividend_name, company, code, price in share_catalog(real_count + rows - len(mappings))[real_count:]:
+            # Some names are left unmapped, as in the real file
+            mappings.append((share_name, None, None) if rng.random() < 0.1 else (share_name, company, code))
+    mappings = mappings[:rows] if rows else mappings
+    
+    path = os.path.join(directory, 'Share_Name_Mapping_Synthetic.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Mapping')
+    sheet.append(['Share_Name', 'Company', 'Share_Code'])
+    for mapping in mappings:
+        sheet.append(list(mapping))
+    workbook.save(path)
+    return path
+
+
+def generate_dataset(directory, rows, seed=0, end=None, years=5):
+    """
+    Write one statement of `rows` lines plus a matching portfolio report and mapping
+    file into directory. Returns {'transactions': path, 'portfolio': path, 'mapping': path}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    end = end or date.today()
+    start = end - timedelta(days=years * 365)
+    return {
+        'mapping': generate_mapping_file(directory, seed=seed),
+        'portfolio': generate_portfolio_report(directory, as_of=end, seed=seed),
+        'transactions': generate_transaction_statement(directory, rows, start=start, end=end, seed=seed),
+    }
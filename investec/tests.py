@@ -1,3 +1,1701 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import pstats
+import signal
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from prometheus_client import REGISTRY
+from django.conf import settings
+from django.core.files import File
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import exports, querylog
+from .cost_basis import _fifo_sequential, match_average, match_fifo, rebuild_cost_basis
+from .importers import (
+    FILE_MAPPING, FILE_PORTFOLIO, FILE_TRANSACTIONS, import_mapping_rows, peek_path, process_mapping_file,
+    process_portfolio_file, process_transaction_file,
+)
+from .instrumentation import query_source, query_stage
+from .ledger import POSITION_TYPES, holdings_as_of, refresh_positions
+from .models import (
+    DIVIDEND_TYPES, InvestecJseOpenLot, InvestecJsePortfolio, InvestecJsePositionCheckpoint, InvestecJseRealizedGain,
+    InvestecJseShareMonthlyPerformance, InvestecJseShareNameMapping, InvestecJseTransaction, InvestecSlowQuery,
+)
+from .ttm import calculate_dividend_ttm, dividend_queryset, live_dividend_ttm, rebuild_share_ttm
+from .share_codes import resolve_share_codes
+from .share_matching import ShareNameIndex
+from .synthetic import generate_dataset, share_catalog
+from .validation import ERROR_PREVIEW, error_records, is_blank, summarize_errors, validate_columns
+from .views import _transaction_queryset
+
+
+def _month_ends(first, count):
+    month_ends = []
+    year, month = first.year, first.month
+    for _ in range(count):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        month_ends.append(date(year, month, 1) - timedelta(days=1))
+    return month_ends
+
+
+def _transaction(day, account_number, share_name, type, quantity, value=0, description=None, value_per_share=None):
+    return InvestecJseTransaction(
+        date=day,
+        year=day.year,
+        month=day.month,
+        day=day.day,
+        account_number=account_number,
+        description=description or f'{type} {share_name}',
+        share_name=share_name,
+        type=type,
+        quantity=Decimal(quantity),
+        value=Decimal(value),
+        value_per_share=None if value_per_share is None else Decimal(value_per_share),
+    )
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'query plans are asserted on PostgreSQL')
+class QueryPlanTests(TestCase):
+    """
+    The hot queries use the indexes designed for them (see the model Meta.indexes).
+
+    The seeded tables are small enough that a sequential scan would win every plan, so
+    sequential scans are disabled: what is asserted is that the query uses its index
+    (the partial index predicates are implied by the query's filters, the column order
+    serves the filters) and, for ordered reads, that the index order spares a sort.
+    Partitions without rows may be scanned through any index, so the expected index is
+    only required to be among those used.
+    """
+
+    ACCOUNTS = [f'ACC-{n:02d}' for n in range(10)]
+    SHARES = [f'SHARE {n:02d}' for n in range(30)]
+
+    @classmethod
+    def setUpTestData(cls):
+        month_ends = _month_ends(date(2022, 1, 1), 36)
+        transactions = []
+        for n in range(12000):
+            day = date(2022, 1, 1) + timedelta(days=n % 1095)
+            dividend = n % 10 == 0
+            transactions.append(InvestecJseTransaction(
+                date=day,
+                year=day.year,
+                month=day.month,
+                day=day.day,
+                account_number=cls.ACCOUNTS[n % len(cls.ACCOUNTS)],
+                description=f'Transaction {n}',
+                share_name=cls.SHARES[n % len(cls.SHARES)],
+                type=DIVIDEND_TYPES[n % len(DIVIDEND_TYPES)] if dividend else ('Buy' if n % 2 else 'Sell'),
+                quantity=Decimal(0) if dividend else Decimal(n % 50 + 1),
+                value=Decimal(n % 997 + 1),
+            ))
+        # Legacy TTM summary records, one per account, share and month
+        for account_number in cls.ACCOUNTS[:3]:
+            for share_name in cls.SHARES:
+                for month_end in month_ends:
+                    transactions.append(InvestecJseTransaction(
+                        date=month_end,
+                        year=month_end.year,
+                        month=month_end.month,
+                        day=month_end.day,
+                        account_number=account_number,
+                        description=f'TTM Summary {share_name}',
+                        share_name=share_name,
+                        type='Dividend',
+                        quantity=Decimal(0),
+                        value=Decimal(0),
+                    ))
+        InvestecJseTransaction.objects.bulk_create(transactions, batch_size=2000)
+
+        InvestecJsePortfolio.objects.bulk_create([
+            InvestecJsePortfolio(
+                date=month_end,
+                year=month_end.year,
+                month=month_end.month,
+                day=month_end.day,
+                company=f'{share_name} LIMITED',
+                share_code=f'S{n:02d}',
+                quantity=Decimal(100),
+                unit_cost=Decimal(10),
+                total_cost=Decimal(1000),
+                price=Decimal(12),
+                total_value=Decimal(1200),
+            )
+            for month_end in month_ends
+            for n, share_name in enumerate(cls.SHARES)
+        ])
+
+        with connection.cursor() as cursor:
+            for model in (InvestecJseTransaction, InvestecJsePortfolio):
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def plan(self, queryset):
+        """(index names, node types) of the queryset's plan; partition indexes are named by their parent index."""
+        root = json.loads(queryset.explain(format='json'))[0]['Plan']
+        nodes = list(_plan_nodes(root))
+        names = {node['Index Name'] for node in nodes if 'Index Name' in node}
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT child.relname, COALESCE(parent.relname, child.relname) FROM pg_class child '
+                'LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid '
+                'LEFT JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE child.relname = ANY(%s)',
+                [list(names)],
+            )
+            parents = dict(cursor.fetchall())
+        return {parents.get(name, name) for name in names}, {node['Node Type'] for node in nodes}
+
+    def test_ttm_dividend_load_by_share(self):
+        indexes, _ = self.plan(dividend_queryset(share_names=[self.SHARES[3]]))
+        self.assertIn('investec_txn_ttm_dividends', indexes)
+
+    def test_transaction_list_by_account(self):
+        queryset = _transaction_queryset({'account_number': self.ACCOUNTS[2]})[:100]
+        indexes, node_types = self.plan(queryset)
+        self.assertIn('investec_txn_account_recent', indexes)
+        self.assertNotIn('Sort', node_types)
+
+    def test_transaction_list_with_summaries_skips_partial_index(self):
+        queryset = _transaction_queryset({'account_number': self.ACCOUNTS[2], 'include_ttm_summary': 'true'})[:100]
+        indexes, _ = self.plan(queryset)
+        self.assertNotIn('investec_txn_account_recent', indexes)
+
+    def test_portfolio_snapshot_by_date(self):
+        snapshot_date = InvestecJsePortfolio.objects.order_by('-date').values_list('date', flat=True)[0]
+        queryset = InvestecJsePortfolio.objects.filter(date=snapshot_date).order_by('share_code')
+        indexes, node_types = self.plan(queryset)
+        # A snapshot is a few rows: found through the date index and sorted
+        self.assertIn('investec_pf_date_totals_cov', indexes)
+        self.assertNotIn('Seq Scan', node_types)
+
+
+class WorkloadQueryTests(TestCase):
+    """
+    What the partial indexes rely on, on any database: the hot queries leave out exactly
+    the TTM summary records (quantity 0, value 0, description 'TTM Summary...') and
+    return the rows in the order the indexes are built in.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2024, 1, 15), 'ACC-1', 'NEDBANK', 'Dividend', 0, 120),
+            _transaction(date(2024, 1, 31), 'ACC-1', 'NEDBANK', 'Dividend', 0, 0, description='TTM Summary NEDBANK'),
+            # Zero-valued, or described like a summary, but not a summary record
+            _transaction(date(2024, 2, 15), 'ACC-1', 'NEDBANK', 'Dividend Tax', 0, 0),
+            _transaction(date(2024, 2, 29), 'ACC-1', 'NEDBANK', 'Dividend', 0, 5, description='TTM Summary NEDBANK'),
+            _transaction(date(2024, 3, 1), 'ACC-2', 'NEDBANK', 'Dividend', 0, 0, description='TTM Summary NEDBANK'),
+            _transaction(date(2024, 3, 5), 'ACC-1', '', 'Dividend', 0, 10, description='Interest'),
+            _transaction(date(2024, 3, 6), 'ACC-1', 'NEDBANK', 'Buy', 10, -2000),
+            _transaction(date(2024, 3, 6), 'ACC-2', 'SASOL', 'Foreign Dividend', 0, 30),
+            _transaction(date(2024, 3, 7), 'ACC-2', 'SASOL', 'Sell', -4, 900),
+        ])
+        InvestecJsePortfolio.objects.bulk_create([
+            InvestecJsePortfolio(
+                date=month_end,
+                year=month_end.year,
+                month=month_end.month,
+                day=month_end.day,
+                company=f'{share_code} LIMITED',
+                share_code=share_code,
+                quantity=Decimal(100),
+                unit_cost=Decimal(10),
+                total_cost=Decimal(1000),
+                price=Decimal(12),
+                total_value=Decimal(1200),
+            )
+            for month_end in _month_ends(date(2024, 1, 1), 2)
+            for share_code in ['SOL', 'ABG', 'NED', 'AGL']
+        ])
+
+    def expected(self, keep):
+        """Ids of the stored rows keep accepts that are not TTM summary records, newest first."""
+        rows = sorted(InvestecJseTransaction.objects.all(), key=lambda txn: (txn.date, txn.created_at, txn.id), reverse=True)
+        return [
+            txn.id for txn in rows
+            if keep(txn) and not (txn.quantity == 0 and txn.value == 0 and txn.description.startswith('TTM Summary'))
+        ]
+
+    def test_dividend_queryset(self):
+        def dividend(txn):
+            return txn.type in DIVIDEND_TYPES and txn.share_name != ''
+
+        self.assertEqual(sorted(dividend_queryset().values_list('id', flat=True)), sorted(self.expected(dividend)))
+        self.assertEqual(len(self.expected(dividend)), 4)
+        self.assertEqual(
+            sorted(dividend_queryset(share_names=['NEDBANK'], account_numbers=['ACC-2']).values_list('id', flat=True)),
+            [],
+        )
+        self.assertEqual(
+            sorted(dividend_queryset(share_names=['SASOL']).values_list('id', flat=True)),
+            sorted(self.expected(lambda txn: dividend(txn) and txn.share_name == 'SASOL')),
+        )
+
+    def test_transaction_list(self):
+        queryset = _transaction_queryset({'account_number': 'ACC-1'})
+        self.assertEqual(list(queryset.values_list('id', flat=True)), self.expected(lambda txn: txn.account_number == 'ACC-1'))
+        self.assertEqual(queryset.count(), 5)
+
+        with_summaries = _transaction_queryset({'account_number': 'ACC-1', 'include_ttm_summary': 'true'})
+        self.assertEqual(with_summaries.count(), 6)
+
+        response = self.client.get('/api/investec/transactions/', {'account_number': 'ACC-2'})
+        self.assertEqual([row['id'] for row in response.json()['results']], self.expected(lambda txn: txn.account_number == 'ACC-2'))
+
+    def test_portfolio_snapshot(self):
+        for url in ('/api/investec/holdings/', '/api/investec/async/holdings/'):
+            data = self.client.get(url, {'date': '2024-01-31'}).json()
+            self.assertEqual(data['date'], '2024-01-31')
+            self.assertEqual(data['data']['share_code'], ['ABG', 'AGL', 'NED', 'SOL'])
+
+
+class LiveTtmTests(TestCase):
+    """Read-time TTM (live_dividend_ttm) agrees with the dividend_ttm the TTM engine stores."""
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.default_rng(30)
+        transactions = []
+        for account_number in ('ACC-1', 'ACC-2'):
+            for share_name in ('NEDBANK', 'SASOL'):
+                for n in range(40):
+                    # Irregular dates over 2022-2024, so windows cross year (partition) boundaries
+                    day = date(2022, 1, 3) + timedelta(days=int(rng.integers(0, 1090)))
+                    dividend_type = ('Dividend', 'Dividend', 'Special Dividend', 'Dividend Tax')[n % 4]
+                    value = Decimal(int(rng.integers(1, 50000))) / 100
+                    transactions.append(_transaction(day, account_number, share_name, dividend_type, 0, value))
+                    if n % 9 == 0:
+                        # The same dividend imported twice counts once
+                        transactions.append(_transaction(day, account_number, share_name, dividend_type, 0, value))
+        # Month ends (window edges), a zero dividend, summary records and trades
+        transactions += [
+            _transaction(date(2023, 1, 31), 'ACC-1', 'NEDBANK', 'Dividend', 0, 100),
+            _transaction(date(2023, 12, 1), 'ACC-1', 'NEDBANK', 'Dividend', 0, 7),
+            _transaction(date(2023, 12, 31), 'ACC-1', 'NEDBANK', 'Dividend', 0, 0),
+            _transaction(date(2023, 6, 30), 'ACC-1', 'NEDBANK', 'Dividend', 0, 0, description='TTM Summary NEDBANK'),
+            _transaction(date(2023, 6, 30), 'ACC-2', 'SASOL', 'Dividend', 0, 0, description='TTM Summary SASOL'),
+            _transaction(date(2023, 6, 15), 'ACC-1', 'NEDBANK', 'Buy', 10, -2500),
+        ]
+        InvestecJseTransaction.objects.bulk_create(transactions)
+        for share_name in ('NEDBANK', 'SASOL'):
+            rebuild_share_ttm(share_name)
+
+    def test_live_matches_stored(self):
+        rows = dividend_queryset().annotate(live=live_dividend_ttm()).values_list('account_number', 'share_name', 'type', 'date', 'dividend_ttm', 'live')
+        rows = list(rows)
+        self.assertEqual(len(rows), 4 * 40 + 4 * 5 + 3)
+        mismatches = [row for row in rows if row[4] != row[5]]
+        self.assertEqual(mismatches, [])
+        # The two accounts hold the same share with different dividends
+        self.assertNotEqual(
+            {row[3:5] for row in rows if row[:3] == ('ACC-1', 'NEDBANK', 'Dividend')},
+            {row[3:5] for row in rows if row[:3] == ('ACC-2', 'NEDBANK', 'Dividend')},
+        )
+
+    def test_non_dividends_are_null(self):
+        live = InvestecJseTransaction.objects.exclude(type__in=DIVIDEND_TYPES).annotate(live=live_dividend_ttm())
+        self.assertEqual([txn.live for txn in live], [None])
+
+    def test_transaction_list_live_mode(self):
+        response = self.client.get('/api/investec/transactions/', {'account_number': 'ACC-2', 'type': 'Special', 'ttm': 'live', 'limit': 500})
+        results = response.json()['results']
+        self.assertEqual(len(results), 20 + 2)
+        stored = dict(InvestecJseTransaction.objects.filter(account_number='ACC-2').values_list('id', 'dividend_ttm'))
+        self.assertEqual({row['id']: Decimal(str(row['dividend_ttm'])) for row in results}, {row['id']: stored[row['id']] for row in results})
+
+
+class TtmEngineTests(TestCase):
+    """The stored TTM series are kept per account, and a recompute replaces only its own series."""
+
+    @classmethod
+    def setUpTestData(cls):
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2024, 1, 10), 'ACC-1', 'NEDBANK', 'Dividend', 0, 100),
+            _transaction(date(2024, 3, 10), 'ACC-1', 'NEDBANK', 'Dividend', 0, 50),
+            _transaction(date(2024, 2, 10), 'ACC-2', 'NEDBANK', 'Dividend', 0, 7),
+            _transaction(date(2024, 2, 12), 'ACC-2', 'SASOL', 'Dividend', 0, 30),
+        ])
+
+    def series(self, account_number, share_name, dividend_type='Dividend'):
+        return dict(InvestecJseShareMonthlyPerformance.objects.filter(
+            investec_account=account_number, share_name=share_name, dividend_type=dividend_type, date__lte=date(2024, 4, 30),
+        ).values_list('date', 'dividend_ttm'))
+
+    def test_accounts_have_their_own_series(self):
+        lookup = calculate_dividend_ttm([])
+        self.assertEqual(self.series('ACC-1', 'NEDBANK'), {
+            date(2024, 1, 31): Decimal(100),
+            date(2024, 2, 29): Decimal(100),
+            date(2024, 3, 31): Decimal(150),
+            date(2024, 4, 30): Decimal(150),
+        })
+        self.assertEqual(self.series('ACC-2', 'NEDBANK'), {
+            date(2024, 2, 29): Decimal(7),
+            date(2024, 3, 31): Decimal(7),
+            date(2024, 4, 30): Decimal(7),
+        })
+        self.assertEqual(lookup[('ACC-1', 'NEDBANK', 'Dividend', 2024, 3)], Decimal(150))
+        self.assertEqual(lookup[('ACC-2', 'NEDBANK', 'Dividend', 2024, 3)], Decimal(7))
+
+    def test_recompute_touches_only_its_accounts(self):
+        calculate_dividend_ttm([])
+        InvestecJseShareMonthlyPerformance.objects.filter(investec_account='ACC-2').update(dividend_ttm=Decimal(999))
+
+        lookup = calculate_dividend_ttm([], account_numbers={'ACC-1'})
+        self.assertEqual({key[0] for key in lookup}, {'ACC-1'})
+        self.assertEqual(set(self.series('ACC-2', 'NEDBANK').values()), {Decimal(999)})
+        self.assertEqual(set(self.series('ACC-2', 'SASOL').values()), {Decimal(999)})
+        self.assertEqual(self.series('ACC-1', 'NEDBANK')[date(2024, 3, 31)], Decimal(150))
+
+        # An upload recomputes the accounts of its dividends (and of the ones it deletes)
+        with override_settings(INVESTEC_EXPORT_REFRESH='off'):
+            result = process_transaction_file(_statement_workbook(
+                [[datetime(2024, 4, 10), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 25]], date(2024, 4, 1), date(2024, 4, 30),
+            ))
+        self.assertTrue(result['success'], result)
+        self.assertEqual(self.series('ACC-1', 'NEDBANK')[date(2024, 4, 30)], Decimal(175))
+        self.assertEqual(set(self.series('ACC-2', 'NEDBANK').values()), {Decimal(999)})
+
+    def test_replaces_only_its_series(self):
+        calculate_dividend_ttm([])
+        # ACC-2's SASOL dividend is deleted; a NEDBANK-only recompute leaves SASOL alone
+        InvestecJseTransaction.objects.filter(share_name='SASOL').delete()
+        calculate_dividend_ttm([], share_names=['NEDBANK'])
+        self.assertTrue(self.series('ACC-2', 'SASOL'))
+
+        # A recompute whose scope covers a series without dividends drops it
+        calculate_dividend_ttm([], account_numbers={'ACC-2'})
+        self.assertEqual(self.series('ACC-2', 'SASOL'), {})
+        self.assertEqual(self.series('ACC-2', 'NEDBANK')[date(2024, 4, 30)], Decimal(7))
+
+        # From date_from on only
+        InvestecJseShareMonthlyPerformance.objects.filter(investec_account='ACC-1').update(dividend_ttm=Decimal(999))
+        calculate_dividend_ttm([], account_numbers={'ACC-1'}, date_from=date(2024, 3, 1))
+        self.assertEqual(self.series('ACC-1', 'NEDBANK'), {
+            date(2024, 1, 31): Decimal(999),
+            date(2024, 2, 29): Decimal(999),
+            date(2024, 3, 31): Decimal(150),
+            date(2024, 4, 30): Decimal(150),
+        })
+
+    def test_worker_processes(self):
+        expected = calculate_dividend_ttm([])
+        with mock.patch('investec.ttm.PARALLEL_MIN_ROWS', 0):
+            self.assertEqual(calculate_dividend_ttm([], workers=2), expected)
+
+
+class PerformanceListTests(TestCase):
+    """The performance list endpoints (sync and async)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        # Two accounts holding the same share, with different latest months
+        records = []
+        for account, month_ends in [('ACC-1', _month_ends(date(2024, 1, 1), 3)), ('ACC-2', _month_ends(date(2023, 11, 1), 3))]:
+            for n, month_end in enumerate(month_ends):
+                for dividend_type in ('Dividend', 'Dividend Tax'):
+                    records.append(InvestecJseShareMonthlyPerformance(
+                        share_name='NEDBANK',
+                        date=month_end,
+                        year=month_end.year,
+                        month=month_end.month,
+                        dividend_type=dividend_type,
+                        investec_account=account,
+                        dividend_ttm=Decimal(10 * n + 1),
+                    ))
+        InvestecJseShareMonthlyPerformance.objects.bulk_create(records)
+
+    def latest(self, rows):
+        return sorted((row['investec_account'], row['dividend_type'], row['date'], row['dividend_ttm']) for row in rows)
+
+    EXPECTED_LATEST = [
+        ('ACC-1', 'Dividend', '2024-03-31', '21.00'),
+        ('ACC-1', 'Dividend Tax', '2024-03-31', '21.00'),
+        ('ACC-2', 'Dividend', '2024-01-31', '21.00'),
+        ('ACC-2', 'Dividend Tax', '2024-01-31', '21.00'),
+    ]
+
+    def test_latest_per_account(self):
+        response = self.client.get('/api/investec/performance/', {'latest': 'true', 'share_name': 'NEDBANK'})
+        self.assertEqual(response.json()['count'], 4)
+        self.assertEqual(self.latest(response.json()['results']), self.EXPECTED_LATEST)
+
+    def test_async_latest_matches_sync(self):
+        params = {'latest': 'true', 'share_name': 'NEDBANK'}
+        expected = self.client.get('/api/investec/performance/', params)
+        response = self.client.get('/api/investec/async/performance/', params)
+        self.assertTrue(response.content.startswith(b'{"count":4,"latest":true,'))
+        self.assertEqual(response.content, expected.content)
+
+    def test_limit_below_one_is_rejected(self):
+        for url in ('/api/investec/performance/', '/api/investec/async/performance/'):
+            for limit in ('0', '-5'):
+                response = self.client.get(url, {'limit': limit})
+                self.assertEqual(response.status_code, 400, (url, limit))
+                self.assertIn('limit', response.json()['error'])
+
+
+class PositionLedgerTests(TestCase):
+    """holdings_as_of (checkpoint plus month delta) equals a running sum of all Buy/Sell transactions."""
+
+    ACCOUNTS = ['ACC-1', 'ACC-2']
+    SHARES = ['SHARE A', 'SHARE B', 'SHARE C']
+
+    @classmethod
+    def setUpTestData(cls):
+        transactions = []
+        for n in range(240):
+            day = date(2023, 1, 1) + timedelta(days=n * 3 % 400)
+            account_number = cls.ACCOUNTS[n % 2]
+            share_name = cls.SHARES[n % 3]
+            if n % 4 == 3:
+                # Statements carry Sell quantities as negative numbers, but not always
+                transactions.append(_transaction(day, account_number, share_name, 'Sell', -(n % 7 + 1) if n % 8 == 3 else n % 7 + 1))
+            else:
+                transactions.append(_transaction(day, account_number, share_name, 'Buy', f'{n % 11 + 1}.25'))
+            if n % 10 == 0:
+                # Other types do not move positions
+                transactions.append(_transaction(day, account_number, share_name, 'Dividend', 0, 100))
+        InvestecJseTransaction.objects.bulk_create(transactions)
+
+    def naive_holdings(self, as_of_date, account_number=None):
+        positions = {}
+        for transaction in InvestecJseTransaction.objects.filter(type__in=POSITION_TYPES, date__lte=as_of_date):
+            if account_number and transaction.account_number != account_number:
+                continue
+            key = (transaction.account_number, transaction.share_name)
+            positions[key] = positions.get(key, Decimal('0')) + abs(transaction.quantity) * POSITION_TYPES[transaction.type]
+        return [
+            {'account_number': key[0], 'share_name': key[1], 'quantity': quantity}
+            for key, quantity in sorted(positions.items())
+            if quantity != 0
+        ]
+
+    def assertHoldings(self, as_of_date, account_number=None):
+        self.assertEqual(
+            holdings_as_of(as_of_date, account_number),
+            self.naive_holdings(as_of_date, account_number),
+            (as_of_date, account_number),
+        )
+
+    def test_holdings_match_running_sum(self):
+        refresh_positions()
+        self.assertTrue(InvestecJsePositionCheckpoint.objects.exists())
+        dates = [
+            date(2022, 12, 31),  # before the first transaction
+            date(2023, 1, 31),   # month end: the month's own checkpoint is not used
+            date(2023, 2, 1),    # month start
+            date(2023, 3, 15),   # mid month
+            date(2023, 6, 30),
+            date(2023, 12, 31),  # year end
+            date(2024, 1, 17),
+            date(2024, 6, 30),   # after the last transaction
+        ]
+        for as_of_date in dates:
+            self.assertHoldings(as_of_date)
+            self.assertHoldings(as_of_date, self.ACCOUNTS[1])
+
+    def test_partial_refresh_matches_full_rebuild(self):
+        refresh_positions()
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2023, 9, 12), self.ACCOUNTS[0], self.SHARES[0], 'Buy', 40),
+            _transaction(date(2023, 11, 2), self.ACCOUNTS[1], 'SHARE D', 'Buy', 5),
+            _transaction(date(2023, 11, 30), self.ACCOUNTS[1], 'SHARE D', 'Sell', -5),
+        ])
+        refresh_positions(date(2023, 9, 12))
+        partial = list(InvestecJsePositionCheckpoint.objects.order_by('account_number', 'share_name', 'date').values_list(
+            'account_number', 'share_name', 'date', 'quantity'))
+        refresh_positions()
+        full = list(InvestecJsePositionCheckpoint.objects.order_by('account_number', 'share_name', 'date').values_list(
+            'account_number', 'share_name', 'date', 'quantity'))
+        self.assertEqual(partial, full)
+        for as_of_date in (date(2023, 9, 11), date(2023, 9, 12), date(2023, 11, 15), date(2023, 11, 30)):
+            self.assertHoldings(as_of_date)
+
+
+def _stream(trades):
+    """(is_buy, qty, price) arrays of a chronological list of (type, quantity, price)."""
+    return (
+        np.array([type == 'Buy' for type, _, _ in trades]),
+        np.array([quantity for _, quantity, _ in trades], dtype=float),
+        np.array([price for _, _, price in trades], dtype=float),
+    )
+
+
+class CostBasisTests(TestCase):
+    """FIFO and average cost lot matching."""
+
+    def assertMatchResults(self, first, second):
+        for name, expected, actual in zip(('cost', 'matched', 'remaining'), first, second):
+            self.assertEqual(sorted(expected), sorted(actual), name)
+            for key in expected:
+                self.assertAlmostEqual(expected[key], actual[key], places=6, msg=(name, key))
+
+    def test_fifo_partial_fills_across_lots(self):
+        trades = [('Buy', 10, 100), ('Buy', 5, 120), ('Sell', 4, 0), ('Sell', 8, 0), ('Buy', 7, 90), ('Sell', 3, 0)]
+        result = match_fifo(*_stream(trades))
+        self.assertMatchResults(result, _fifo_sequential(*_stream(trades)))
+        cost, matched, remaining = result
+        # Sell 8 takes the last 6 of the first lot and 2 of the second
+        self.assertAlmostEqual(cost[3], 6 * 100 + 2 * 120)
+        self.assertAlmostEqual(matched[3], 8)
+        self.assertAlmostEqual(cost[5], 3 * 120)
+        self.assertEqual(remaining, {4: 7.0})
+
+    def test_fifo_sell_closing_position_exactly(self):
+        trades = [('Buy', 2.5, 10), ('Buy', 2.5, 20), ('Sell', 5, 0)]
+        cost, matched, remaining = match_fifo(*_stream(trades))
+        self.assertAlmostEqual(cost[2], 75)
+        self.assertAlmostEqual(matched[2], 5)
+        self.assertEqual(remaining, {})
+
+    def test_fifo_oversell_leaves_quantity_unmatched(self):
+        trades = [('Sell', 3, 0), ('Buy', 4, 50), ('Sell', 6, 0), ('Buy', 2, 60)]
+        cost, matched, remaining = match_fifo(*_stream(trades))
+        self.assertEqual((cost[0], matched[0]), (0.0, 0.0))
+        self.assertAlmostEqual(cost[2], 200)
+        self.assertAlmostEqual(matched[2], 4)
+        self.assertEqual(remaining, {3: 2.0})
+
+    def test_fifo_vectorized_matches_sequential(self):
+        rng = np.random.default_rng(29)
+        for _ in range(200):
+            size = int(rng.integers(1, 40))
+            is_buy = rng.random(size) < 0.6
+            qty = rng.integers(1, 400, size) / 4
+            price = rng.integers(100, 5000, size) / 10
+            if rng.random() < 0.5:
+                # Complete history: Sells never exceed the position, the vectorized path
+                position = 0.0
+                for i in range(size):
+                    if not is_buy[i]:
+                        qty[i] = min(qty[i], position) or 0.25
+                        is_buy[i] = position < 0.25
+                    position += qty[i] if is_buy[i] else -qty[i]
+            self.assertMatchResults(match_fifo(is_buy, qty, price), _fifo_sequential(is_buy, qty, price))
+
+    def test_average_cost(self):
+        trades = [('Buy', 10, 100), ('Buy', 10, 200), ('Sell', 5, 0), ('Buy', 5, 300), ('Sell', 8, 0)]
+        cost, matched, remaining, unit_cost = match_average(*_stream(trades))
+        self.assertAlmostEqual(cost[2], 5 * 150)
+        # 15 at 150 pooled with 5 at 300: 20 at 187.5
+        self.assertAlmostEqual(cost[4], 8 * 187.5)
+        self.assertEqual(matched, {2: 5.0, 4: 8.0})
+        self.assertEqual(remaining, {3: 12.0})
+        self.assertAlmostEqual(unit_cost, 187.5)
+
+    def test_average_cost_oversell(self):
+        cost, matched, remaining, unit_cost = match_average(*_stream([('Buy', 4, 10), ('Sell', 6, 0)]))
+        self.assertEqual((cost, matched, remaining, unit_cost), ({1: 40.0}, {1: 4.0}, {}, 0.0))
+
+    def test_rebuild_cost_basis(self):
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2023, 1, 5), 'ACC-1', 'SHARE A', 'Buy', 10, value_per_share='100'),
+            _transaction(date(2023, 2, 5), 'ACC-1', 'SHARE A', 'Buy', 10, value_per_share='120'),
+            # Sells on the day of a Buy are matched after it
+            _transaction(date(2023, 3, 5), 'ACC-1', 'SHARE A', 'Sell', -15, value_per_share='150'),
+            _transaction(date(2023, 3, 5), 'ACC-1', 'SHARE A', 'Buy', 5, value_per_share='130'),
+            _transaction(date(2023, 3, 6), 'ACC-2', 'SHARE A', 'Sell', -2, value_per_share='150'),
+            _transaction(date(2023, 3, 7), 'ACC-2', 'SHARE A', 'Buy', 1),
+        ])
+        fifo = rebuild_cost_basis(method='fifo')
+        self.assertEqual(fifo, {'method': 'fifo', 'streams': 2, 'realized_gains': 2, 'open_lots': 2, 'skipped_without_price': 1})
+        gains = {gain.account_number: gain for gain in InvestecJseRealizedGain.objects.filter(method='fifo')}
+        self.assertEqual(gains['ACC-1'].cost_basis, Decimal('1600.00'))
+        self.assertEqual(gains['ACC-1'].realized_gain, Decimal('650.00'))
+        self.assertEqual(gains['ACC-2'].unmatched_quantity, Decimal('2.0000'))
+        lots = InvestecJseOpenLot.objects.filter(method='fifo').order_by('date')
+        self.assertEqual([(lot.quantity, lot.unit_cost) for lot in lots], [
+            (Decimal('5.0000'), Decimal('120.0000')),
+            (Decimal('5.0000'), Decimal('130.0000')),
+        ])
+
+        rebuild_cost_basis(method='average')
+        gain = InvestecJseRealizedGain.objects.get(method='average', account_number='ACC-1')
+        # 10 at 100, 10 at 120 and 5 at 130 pooled at 114 before the Sell
+        self.assertEqual(gain.cost_basis, Decimal('1710.00'))
+        lot = InvestecJseOpenLot.objects.get(method='average')
+        self.assertEqual((lot.quantity, lot.unit_cost), (Decimal('10.0000'), Decimal('114.0000')))
+        # Rebuilding one method leaves the other's results alone
+        self.assertEqual(InvestecJseRealizedGain.objects.filter(method='fifo').count(), 2)
+
+
+@override_settings(INVESTEC_PROFILE_TOKEN='profile-token')
+class ProfilingMiddlewareTests(TestCase):
+    """A profiled request's profile covers the view, under WSGI and ASGI."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_PROFILE_DIR=directory.name))
+        self.directory = directory.name
+
+    def profiled_functions(self, response):
+        self.assertEqual(response.status_code, 200)
+        stats = pstats.Stats(f'{self.directory}/{response["X-Profile-Id"]}.prof')
+        return {(filename.rsplit('/', 1)[-1], name) for filename, _, name in stats.stats}
+
+    def test_wsgi_sync_view(self):
+        response = self.client.get('/api/investec/performance/', headers={'X-Profile': 'profile-token'})
+        self.assertIn(('views.py', 'share_performance_list_view'), self.profiled_functions(response))
+
+    async def test_asgi_sync_view(self):
+        # The sync view runs outside the event loop: its thread is the one profiled
+        response = await self.async_client.get('/api/investec/performance/', headers={'X-Profile': 'profile-token'})
+        self.assertIn(('views.py', 'share_performance_list_view'), self.profiled_functions(response))
+
+    async def test_asgi_async_view(self):
+        response = await self.async_client.get('/api/investec/async/holdings/totals/', headers={'X-Profile': 'profile-token'})
+        self.assertIn(('async_views.py', 'holdings_totals_view'), self.profiled_functions(response))
+
+    def test_not_requested(self):
+        response = self.client.get('/api/investec/performance/', headers={'X-Profile': 'wrong'})
+        self.assertNotIn('X-Profile-Id', response)
+
+
+class SlowQueryLogTests(TestCase):
+    """Queries over the threshold are aggregated per fingerprint, view and stage."""
+
+    def setUp(self):
+        # Installed at startup unless INVESTEC_SLOW_QUERY_MS is 0 in the test settings
+        querylog._add_wrapper(None, connection)
+        querylog._state.pending = []
+        self.enterContext(self.assertLogs('investec.slow_queries', 'WARNING'))
+        self.enterContext(override_settings(INVESTEC_SLOW_QUERY_MS=0, INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE=0))
+
+    def recorded(self, **filters):
+        querylog.flush()
+        return InvestecSlowQuery.objects.filter(sql__contains='investec_investecjsetransaction', **filters)
+
+    def test_threshold(self):
+        with override_settings(INVESTEC_SLOW_QUERY_MS=60_000):
+            InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+        self.assertFalse(self.recorded().exists())
+
+        InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+        self.assertEqual(self.recorded().get().calls, 1)
+
+    def test_fingerprint_groups_literals_and_in_lists(self):
+        InvestecJseTransaction.objects.filter(account_number__in=['1', '2'], quantity__gt=5).count()
+        InvestecJseTransaction.objects.filter(account_number__in=['3', '4', '5'], quantity__gt=7).count()
+        InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+
+        grouped = self.recorded().filter(sql__contains='IN (...)').get()
+        self.assertEqual(grouped.calls, 2)
+        self.assertGreaterEqual(grouped.total_seconds, grouped.max_seconds)
+        self.assertEqual(self.recorded().count(), 2)
+
+    def test_attribution(self):
+        source = query_source.set('investec:holdings_snapshot')
+        stage = query_stage.set('transactions.delete_range')
+        try:
+            InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+        finally:
+            query_stage.reset(stage)
+            query_source.reset(source)
+        InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+
+        rows = self.recorded().order_by('stage')
+        self.assertEqual([(row.source, row.stage, row.calls) for row in rows], [
+            (querylog._default_source(), '', 1),
+            ('investec:holdings_snapshot', 'transactions.delete_range', 1),
+        ])
+
+    def test_request_attributed_to_url_name(self):
+        response = self.client.get('/api/investec/transactions/')
+        self.assertEqual(response.status_code, 200)
+        # QueryAttributionMiddleware flushes after the response
+        self.assertTrue(InvestecSlowQuery.objects.filter(
+            source='investec:transaction_list', sql__contains='investec_investecjsetransaction',
+        ).exists())
+
+    def test_sampled_explain_does_not_run_the_query(self):
+        with override_settings(INVESTEC_SLOW_QUERY_EXPLAIN_SAMPLE=1), CaptureQueriesContext(connection) as queries:
+            InvestecJseTransaction.objects.filter(share_name='Alpha').count()
+        explains = [query['sql'] for query in queries if query['sql'].startswith('EXPLAIN')]
+        self.assertEqual(len(explains), 1)
+        self.assertNotIn('ANALYZE', explains[0])
+        self.assertTrue(self.recorded().get().explain_plan)
+
+
+class MetricsEndpointTests(TestCase):
+    """/metrics is served to allowed addresses and token holders only, and counts requests and imports."""
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_local_scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_other_addresses_forbidden(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 403)
+        with override_settings(INVESTEC_METRICS_ALLOWED_IPS=['10.0.0.0/8']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_token(self):
+        remote = {'REMOTE_ADDR': '203.0.113.5'}
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer scrape'}, **remote).status_code, 403)
+        with override_settings(INVESTEC_METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer scrape'}, **remote).status_code, 200)
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}, **remote).status_code, 403)
+            self.assertEqual(self.client.get('/metrics', **remote).status_code, 403)
+
+    def test_request_metrics(self):
+        requests = {'url_name': 'investec:holdings_totals', 'method': 'GET', 'status': '200'}
+        before = self.sample('investec_http_requests_total', **requests)
+        observed = self.sample('investec_http_request_db_queries_count', url_name='investec:holdings_totals')
+        unresolved = self.sample('investec_http_requests_total', url_name='unresolved', method='GET', status='404')
+        self.client.get('/api/investec/holdings/totals/')
+        self.client.get('/api/investec/no-such-endpoint/')
+
+        self.assertEqual(self.sample('investec_http_requests_total', **requests), before + 1)
+        self.assertEqual(self.sample('investec_http_request_db_queries_count', url_name='investec:holdings_totals'), observed + 1)
+        # Labelled by URL name, so unknown paths share one label
+        self.assertEqual(self.sample('investec_http_requests_total', url_name='unresolved', method='GET', status='404'), unresolved + 1)
+
+        # The scrape itself is not counted, and the exposition has the request counter
+        scrapes = self.sample('investec_http_requests_total', url_name='metrics', method='GET', status='200')
+        body = self.client.get('/metrics').content.decode()
+        self.assertEqual(self.sample('investec_http_requests_total', url_name='metrics', method='GET', status='200'), scrapes)
+        self.assertIn('investec_http_requests_total{method="GET",status="200",url_name="investec:holdings_totals"}', body)
+        self.assertIn('investec_worker_resident_memory_bytes', body)
+
+    def test_import_metrics(self):
+        table = InvestecJseTransaction._meta.db_table
+        rows = self.sample('investec_rows_ingested_total', table=table)
+        recomputes = self.sample('investec_ttm_recompute_seconds_count', scope='upload')
+        lines = [
+            [datetime(2024, 1, 5), 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],
+            [datetime(2024, 1, 12), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 150],
+        ]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(INVESTEC_EXPORT_DIR=directory.name, INVESTEC_EXPORT_REFRESH='off'):
+            self.assertTrue(process_transaction_file(_statement_workbook(lines))['success'])
+
+        self.assertEqual(self.sample('investec_rows_ingested_total', table=table), rows + 2)
+        self.assertEqual(self.sample('investec_ttm_recompute_seconds_count', scope='upload'), recomputes + 1)
+
+
+class HoldingsEndpointTests(TestCase):
+    """The holdings snapshot, series and totals endpoints."""
+
+    @classmethod
+    def setUpTestData(cls):
+        # ABG is sold out after February; NES is held throughout
+        holdings = []
+        for n, month_end in enumerate(_month_ends(date(2024, 1, 1), 3)):
+            for share_code, quantity, price in [('NES', 100, 20), ('ABG', 10 * (n + 1), 10)]:
+                if share_code == 'ABG' and n == 2:
+                    continue
+                holdings.append(InvestecJsePortfolio(
+                    date=month_end,
+                    year=month_end.year,
+                    month=month_end.month,
+                    day=month_end.day,
+                    company=f'{share_code} LIMITED',
+                    share_code=share_code,
+                    quantity=Decimal(quantity),
+                    unit_cost=Decimal(5),
+                    total_cost=Decimal(quantity * 5),
+                    price=Decimal(price),
+                    total_value=Decimal(quantity * price),
+                    profit_loss=Decimal(quantity * (price - 5)),
+                ))
+        InvestecJsePortfolio.objects.bulk_create(holdings)
+
+    def test_snapshot(self):
+        payload = self.client.get('/api/investec/holdings/').json()
+        self.assertEqual((payload['date'], payload['count'], payload['data']['share_code']), ('2024-03-31', 1, ['NES']))
+
+        # The latest snapshot on or before the requested date, in share code order
+        payload = self.client.get('/api/investec/holdings/', {'date': '2024-03-15'}).json()
+        self.assertEqual(payload['date'], '2024-02-29')
+        self.assertEqual(payload['data']['share_code'], ['ABG', 'NES'])
+        self.assertEqual(payload['data']['quantity'], ['20.0000', '100.0000'])
+        self.assertEqual(set(payload['data']), set(payload['fields']))
+
+        self.assertEqual(self.client.get('/api/investec/holdings/', {'date': '2023-12-31'}).status_code, 404)
+        self.assertEqual(self.client.get('/api/investec/holdings/', {'date': '31/01/2024'}).status_code, 400)
+
+    def test_series(self):
+        payload = self.client.get('/api/investec/holdings/series/', {'share_code': 'ABG, NES', 'from_date': '2024-02-01'}).json()
+        self.assertEqual((payload['from_date'], payload['to_date'], payload['count']), ('2024-02-01', None, 2))
+        self.assertEqual(payload['series']['ABG']['date'], ['2024-02-29'])
+        self.assertEqual(payload['series']['NES']['date'], ['2024-02-29', '2024-03-31'])
+        self.assertEqual(payload['series']['NES']['total_value'], ['2000.00', '2000.00'])
+
+        payload = self.client.get('/api/investec/holdings/series/', {'share_code': 'ABG'}).json()
+        self.assertEqual(list(payload['series']), ['ABG'])
+        self.assertEqual(payload['series']['ABG']['quantity'], ['10.0000', '20.0000'])
+
+    def test_totals(self):
+        payload = self.client.get('/api/investec/holdings/totals/', {'to_date': '2024-02-29'}).json()
+        self.assertEqual(payload['count'], 2)
+        self.assertEqual(payload['data']['date'], ['2024-01-31', '2024-02-29'])
+        self.assertEqual(payload['data']['holdings'], [2, 2])
+        self.assertEqual(payload['data']['total_value'], ['2100.00', '2200.00'])
+        self.assertEqual(payload['data']['profit_loss'], ['1550.00', '1600.00'])
+        self.assertEqual(self.client.get('/api/investec/holdings/totals/', {'from_date': 'soon'}).status_code, 400)
+
+
+class ThreadWorkers(ThreadPoolExecutor):
+    """ProcessPoolExecutor stand-in for commands under test: worker processes would not see the test database."""
+
+    def submit(self, fn, *args, **kwargs):
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                # The worker thread's connections, or the test database cannot be dropped
+                connections.close_all()
+        return super().submit(run)
+
+
+class RebuildDerivedTests(TransactionTestCase):
+    """rebuild_derived rewrites only the requested months and resumes after a failed share."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_EXPORT_DIR=directory.name, INVESTEC_EXPORT_REFRESH='off'))
+        self.state_file = os.path.join(directory.name, 'state.json')
+        self.enterContext(mock.patch('investec.management.commands.rebuild_derived.ProcessPoolExecutor', ThreadWorkers))
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(day, 'ACC-1', share_name, 'Dividend', 0, value)
+            for share_name, value in [('NEDBANK', 100), ('SASOL', 40)]
+            for day in (date(2023, 3, 10), date(2023, 9, 10), date(2024, 3, 10), date(2024, 9, 10))
+        ])
+
+    def rebuild(self, *args):
+        call_command(
+            'rebuild_derived', *args, '--workers', '1', '--state-file', self.state_file,
+            '--skip-positions', '--skip-cost-basis', stdout=io.StringIO(), stderr=io.StringIO(),
+        )
+
+    def performance(self):
+        return {
+            (row.share_name, row.date): row.dividend_ttm
+            for row in InvestecJseShareMonthlyPerformance.objects.filter(dividend_type='Dividend')
+        }
+
+    def test_date_range(self):
+        self.rebuild()
+        rebuilt = self.performance()
+        self.assertEqual(rebuilt[('NEDBANK', date(2024, 3, 31))], Decimal(200))
+
+        InvestecJseShareMonthlyPerformance.objects.update(dividend_ttm=Decimal(-1))
+        self.rebuild('--from-date', '2024-03-01', '--to-date', '2024-04-30')
+        # Months in the range are recomputed from the whole trailing year, the rest left as they were
+        for (share_name, month_end), dividend_ttm in self.performance().items():
+            in_range = date(2024, 3, 1) <= month_end <= date(2024, 4, 30)
+            self.assertEqual(dividend_ttm, rebuilt[(share_name, month_end)] if in_range else Decimal(-1), (share_name, month_end))
+
+    def test_resume(self):
+        from investec import ttm
+
+        rebuild_share_ttm = ttm.rebuild_share_ttm
+
+        def failing_sasol(share_name, **kwargs):
+            if share_name == 'SASOL':
+                raise RuntimeError('connection lost')
+            return rebuild_share_ttm(share_name, **kwargs)
+
+        with mock.patch.object(ttm, 'rebuild_share_ttm', side_effect=failing_sasol):
+            with self.assertRaisesMessage(CommandError, 'Re-run with --resume'):
+                self.rebuild()
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f)['completed'], ['NEDBANK'])
+        self.assertEqual({share_name for share_name, _ in self.performance()}, {'NEDBANK'})
+
+        with mock.patch.object(ttm, 'rebuild_share_ttm', side_effect=rebuild_share_ttm) as resumed:
+            self.rebuild('--resume')
+        self.assertEqual([call.args[0] for call in resumed.call_args_list], ['SASOL'])
+        self.assertEqual({share_name for share_name, _ in self.performance()}, {'NEDBANK', 'SASOL'})
+        self.assertFalse(os.path.exists(self.state_file))
+
+        # Progress saved for other arguments is not reused
+        with open(self.state_file, 'w') as f:
+            json.dump({'signature': {'from_date': '2024-01-01'}, 'completed': ['NEDBANK', 'SASOL']}, f)
+        with mock.patch.object(ttm, 'rebuild_share_ttm', side_effect=rebuild_share_ttm) as restarted:
+            self.rebuild('--resume')
+        self.assertEqual(sorted(call.args[0] for call in restarted.call_args_list), ['NEDBANK', 'SASOL'])
+
+
+class WatchFolderTests(TransactionTestCase):
+    """watch_folder imports settled workbooks, moves them to archive or error and rebuilds once."""
+
+    STATEMENT = [
+        [datetime(2024, 1, 5), 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],
+        [datetime(2024, 1, 12), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 150],
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_EXPORT_DIR=os.path.join(directory.name, 'exports'), INVESTEC_EXPORT_REFRESH='off'))
+        self.enterContext(mock.patch('investec.management.commands.rebuild_derived.ProcessPoolExecutor', ThreadWorkers))
+        # The command installs SIGINT/SIGTERM handlers
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        self.watch_dir = os.path.join(directory.name, 'incoming')
+        os.makedirs(self.watch_dir)
+
+    def drop(self, name, content):
+        with open(os.path.join(self.watch_dir, name), 'wb') as f:
+            f.write(content)
+
+    def test_once(self):
+        statement = _statement_workbook(self.STATEMENT)
+        self.drop(statement.name, statement.read())
+        self.drop('broken.xlsx', b'not a workbook')
+        self.drop('~$open-in-excel.xlsx', b'lock')
+        self.drop('notes.txt', b'not a statement')
+
+        call_command('watch_folder', '--dir', self.watch_dir, '--once', '--settle', '0', '--no-inotify', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertEqual(sorted(os.listdir(self.watch_dir)), ['archive', 'error', 'notes.txt', '~$open-in-excel.xlsx'])
+        self.assertEqual(os.listdir(os.path.join(self.watch_dir, 'archive')), [statement.name])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.watch_dir, 'error'))), ['broken.xlsx', 'broken.xlsx.error.txt'])
+        with open(os.path.join(self.watch_dir, 'error', 'broken.xlsx.error.txt')) as f:
+            self.assertIn('Error reading file', f.read())
+
+        self.assertEqual(InvestecJseTransaction.objects.count(), 2)
+        # The batch's derived-data rebuild ran
+        self.assertTrue(InvestecJseShareMonthlyPerformance.objects.filter(share_name='NEDBANK', date=date(2024, 1, 31)).exists())
+
+    def test_settle(self):
+        from investec.management.commands.watch_folder import Command
+
+        def scan():
+            ready, pending = Command()._scan(self.watch_dir, seen, settle=60)
+            return [os.path.basename(path) for path in ready], sorted(os.path.basename(path) for path in pending)
+
+        def age(seconds):
+            for path, (size, mtime, since) in seen.items():
+                seen[path] = (size, mtime, since - seconds)
+
+        seen = {}
+        self.drop('statement.xlsx', b'first part')
+        self.drop('empty.xlsx', b'')
+        self.assertEqual(scan(), ([], ['empty.xlsx', 'statement.xlsx']))
+
+        # Unchanged for the settle time: ready, unless still empty
+        age(60)
+        self.assertEqual(scan(), (['statement.xlsx'], ['empty.xlsx']))
+
+        # Still being written: the wait starts again
+        self.drop('statement.xlsx', b'first part, second part')
+        self.assertEqual(scan(), ([], ['empty.xlsx', 'statement.xlsx']))
+
+        os.remove(os.path.join(self.watch_dir, 'statement.xlsx'))
+        scan()
+        self.assertEqual([os.path.basename(path) for path in seen], ['empty.xlsx'])
+
+
+class SyntheticDataTests(TestCase):
+    """The synthetic workbooks are deterministic per seed and import like the real downloads."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_EXPORT_DIR=os.path.join(directory.name, 'exports'), INVESTEC_EXPORT_REFRESH='off'))
+        self.directory = directory.name
+
+    def dataset(self, name, rows, seed):
+        return generate_dataset(os.path.join(self.directory, name), rows, seed=seed, end=date(2024, 6, 30))
+
+    def test_deterministic(self):
+        def cells(paths):
+            return {kind: pd.read_excel(path, header=None) for kind, path in paths.items()}
+
+        first, again, other = cells(self.dataset('a', 200, 1)), cells(self.dataset('b', 200, 1)), cells(self.dataset('c', 200, 2))
+        for kind in first:
+            pd.testing.assert_frame_equal(first[kind], again[kind])
+        self.assertFalse(first['transactions'].equals(other['transactions']))
+
+    def test_dataset_imports(self):
+        paths = self.dataset('a', 300, 1)
+        self.assertEqual(
+            {kind: peek_path(path)[0] for kind, path in paths.items()},
+            {'mapping': FILE_MAPPING, 'portfolio': FILE_PORTFOLIO, 'transactions': FILE_TRANSACTIONS},
+        )
+        for kind, process in [('mapping', process_mapping_file), ('portfolio', process_portfolio_file), ('transactions', process_transaction_file)]:
+            with open(paths[kind], 'rb') as f:
+                result = process(File(f, name=os.path.basename(paths[kind])))
+            self.assertTrue(result['success'], result)
+
+        self.assertEqual(InvestecJseTransaction.objects.count(), 300)
+        self.assertEqual(InvestecJsePortfolio.objects.count(), len(share_catalog()))
+        self.assertEqual(set(InvestecJseTransaction.objects.filter(share_name='NEDBANK').values_list('share_code', flat=True)), {'NED'})
+        self.assertTrue(InvestecJseTransaction.objects.filter(type__in=DIVIDEND_TYPES).exists())
+
+    def test_benchmark_comparison(self):
+        from investec.management.commands.benchmark import Command
+
+        baseline_path = os.path.join(self.directory, 'baseline.json')
+        with open(baseline_path, 'w') as f:
+            json.dump({'meta': {'commit': 'abc1234'}, 'results': [{'rows': 1000, 'case': 'list_performance', 'median': 0.2}]}, f)
+        output = io.StringIO()
+        command = Command(stdout=output)
+        baseline = command._load(baseline_path)
+        command._print_result({
+            'rows': 1000, 'case': 'list_performance', 'median': 0.3, 'queries': 1, 'rows_per_second': None, 'error': None,
+        }, baseline)
+        self.assertIn('commit abc1234', output.getvalue())
+        self.assertIn('was 0.2000s (+50.0%)', output.getvalue())
+        with self.assertRaises(CommandError):
+            command._load(os.path.join(self.directory, 'missing.json'))
+
+
+class LoadTestCommandTests(LiveServerTestCase):
+    """loadtest drives the scenario mix against a running server and reports per-scenario latency and errors."""
+
+    def test_against_running_server(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        scenario_path = os.path.join(directory.name, 'scenario.json')
+        with open(scenario_path, 'w') as f:
+            json.dump({'scenarios': [
+                {'name': 'transactions', 'path': '/api/investec/transactions/?limit=10&offset={offset}', 'concurrency': 2},
+                # No portfolio snapshot stored: every request is a 404
+                {'name': 'snapshot', 'path': '/api/investec/holdings/?share={share_name}'},
+            ]}, f)
+        report_path = os.path.join(directory.name, 'report.json')
+
+        call_command(
+            'loadtest', scenario_path, '--url', self.live_server_url, '--no-seed', '--noinput',
+            '--duration', '0.5', '--seed-rows', '20', '--output', report_path, stdout=io.StringIO(),
+        )
+
+        with open(report_path) as f:
+            report = json.load(f)
+        results = {result['scenario']: result for result in report['results']}
+        transactions, snapshot = results['transactions'], results['snapshot']
+        self.assertEqual(transactions['concurrency'], 2)
+        self.assertGreater(transactions['requests'], 0)
+        self.assertEqual((transactions['errors'], transactions['status_codes']), (0, {'200': transactions['requests']}))
+        self.assertLessEqual(transactions['p50'], transactions['p95'])
+        self.assertLessEqual(transactions['p99'], transactions['max'])
+        self.assertEqual((snapshot['error_rate'], list(snapshot['status_codes'])), (1.0, ['404']))
+        self.assertEqual(report['meta']['url'], self.live_server_url)
+
+    def test_percentile(self):
+        from investec.management.commands.loadtest import _percentile
+
+        values = list(range(1, 101))
+        self.assertEqual([_percentile(values, percent) for percent in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(_percentile([7], 99), 7)
+        self.assertIsNone(_percentile([], 50))
+
+    def test_invalid_scenario(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'scenario.json')
+        with open(path, 'w') as f:
+            json.dump({'scenarios': [{'name': 'upload', 'path': '/api/investec/upload/', 'file': 'statement'}]}, f)
+        with self.assertRaisesMessage(CommandError, 'file must be one of'):
+            call_command('loadtest', path, '--url', self.live_server_url, '--noinput')
+
+
+class StartupImportTests(TestCase):
+    """Loading the URLconf and the read views does not import the import pipeline's heavy modules."""
+
+    def imported(self, code):
+        from investec.management.commands.benchmark_startup import HEAVY_MODULES
+
+        script = (
+            'import json, sys, django; django.setup(); from django.urls import get_resolver; '
+            f'get_resolver().url_patterns; {code}; '
+            f'print(json.dumps(sorted(module for module in {HEAVY_MODULES!r} if module in sys.modules)))'
+        )
+        # A fresh interpreter: this one has imported everything already
+        completed = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+        return json.loads(completed.stdout.splitlines()[-1])
+
+    def test_urlconf_and_read_views(self):
+        self.assertEqual(self.imported('from investec import async_views, views, ttm, ledger, exports'), [])
+
+    def test_import_pipeline(self):
+        # The check sees the modules once the upload path is imported
+        self.assertIn('pandas', self.imported('from investec import importers'))
+
+
+class AsyncViewPayloadTests(TestCase):
+    """The async read endpoints return the same bytes as their DRF counterparts."""
+
+    @classmethod
+    def setUpTestData(cls):
+        InvestecJsePortfolio.objects.bulk_create([
+            InvestecJsePortfolio(
+                date=month_end,
+                year=month_end.year,
+                month=month_end.month,
+                day=month_end.day,
+                company=company,
+                share_code=share_code,
+                quantity=Decimal(100),
+                unit_cost=Decimal('10.5'),
+                total_cost=Decimal(1050),
+                price=Decimal('12.25'),
+                total_value=Decimal(1225),
+            )
+            for month_end in _month_ends(date(2024, 1, 1), 3)
+            for company, share_code in [('NESTLÉ SA', 'NES'), ('ABSA GROUP LIMITED', 'ABG')]
+        ])
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2024, 1, 10), 'ACC-1', 'NESTLÉ', 'Buy', 10),
+            _transaction(date(2024, 2, 10), 'ACC-1', 'ABSA', 'Buy', 5),
+        ])
+        refresh_positions()
+
+    def test_payloads_match(self):
+        paths = [
+            'export/companies/',
+            'export/share-names/',
+            'holdings/?date=2024-02-29',
+            'holdings/series/',
+            'holdings/totals/',
+            'positions/?date=2024-03-31',
+        ]
+        for path in paths:
+            expected = self.client.get(f'/api/investec/{path}')
+            actual = self.client.get(f'/api/investec/async/{path}')
+            self.assertEqual(actual.status_code, expected.status_code, path)
+            self.assertEqual(actual.content, expected.content, path)
+        self.assertIn('NESTLÉ'.encode(), self.client.get('/api/investec/async/export/companies/').content)
+
+    def test_negative_page_is_rejected(self):
+        for url in ('/api/investec/transactions/', '/api/investec/async/transactions/'):
+            for params in ({'limit': '-1'}, {'offset': '-5'}, {'limit': 'ten'}):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400, (url, params))
+                self.assertIn('limit and offset', response.json()['error'])
+
+
+def _statement_workbook(lines, start=date(2024, 1, 1), end=date(2024, 1, 31)):
+    """An uploadable transaction statement with the given (date, account, description, share name, quantity, value) lines."""
+    from io import BytesIO
+
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    for row in (
+        ['Transaction History Report'],
+        ['From date', f'{start:%Y/%m/%d}'],
+        ['To date', f'{end:%Y/%m/%d}'],
+        ['Date', 'Account Number', 'Description', 'Share name', 'Quantity', 'Value'],
+        *lines,
+    ):
+        sheet.append(row)
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return SimpleUploadedFile(f'TransactionHistory-All-{start:%Y%m%d}-{end:%Y%m%d}.xlsx', buffer.getvalue())
+
+
+class ValidationTests(TestCase):
+    """Column validation, the error frame and the upload error reports."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_UPLOAD_ERROR_DIR=directory.name, INVESTEC_EXPORT_DIR=directory.name))
+
+    def test_validate_columns(self):
+        # A batch from the middle of a sheet: its index continues from the previous batches
+        df = pd.DataFrame({
+            'date': ['2024-01-05', 'not a date', '2024-01-07', None, '2024-01-09', '2024-01-10'],
+            'quantity': ['10', '5', 'abc', '1', ' 1 959.00', 1e12],
+            'value': [100, None, 3, 4, 5, 6],
+            'account': ['A', 'B', ' ', None, 'E', 'F'],
+        }, index=range(10, 16))
+        parsed, valid, errors = validate_columns(df, [
+            {'column': 'date', 'kind': 'date'},
+            {'column': 'quantity', 'label': 'Quantity', 'kind': 'number', 'clean': True, 'limit': 10 ** 11},
+            {'column': 'value', 'kind': 'number', 'required': False},
+            {'column': 'account', 'label': 'Account Number', 'kind': 'text'},
+        ], skip=is_blank(df['date']), first_row=4)
+
+        # Excel rows are first_row + index: the row without a date (index 13) is skipped, not reported
+        self.assertEqual(error_records(errors), [
+            {'row': 15, 'column': 'date', 'reason': 'not a date', 'value': 'not a date'},
+            {'row': 16, 'column': 'Quantity', 'reason': 'not a number', 'value': 'abc'},
+            {'row': 16, 'column': 'Account Number', 'reason': 'missing', 'value': ' '},
+            {'row': 19, 'column': 'Quantity', 'reason': 'out of range (must be below 1e+11 in absolute value)', 'value': '1000000000000.0'},
+        ])
+        self.assertEqual(valid.tolist(), [True, False, False, False, True, False])
+        self.assertEqual(parsed['quantity'][14], 1959.0)
+        self.assertTrue(pd.isna(parsed['value'][11]))
+
+    def test_clean_file_has_no_errors(self):
+        df = pd.DataFrame({'date': ['2024-01-05'], 'quantity': [1]})
+        _, valid, errors = validate_columns(df, [{'column': 'date', 'kind': 'date'}, {'column': 'quantity', 'kind': 'number'}])
+        self.assertEqual(valid.tolist(), [True])
+        self.assertEqual(list(errors.columns), ['row', 'column', 'reason', 'value'])
+        self.assertEqual(summarize_errors(errors, 'clean.xlsx'), {'errors': 0, 'error_details': []})
+
+    @override_settings(INVESTEC_PIPELINE_BATCH_ROWS=2, INVESTEC_UPLOAD_MEMORY_BUDGET_MB=0)
+    def test_upload_reports_excel_rows(self):
+        # The data starts on Excel row 5, below the header row 4; batches of 2 rows
+        upload = _statement_workbook([
+            [datetime(2024, 1, 5), 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],     # row 5
+            ['5 Janury 2024', 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],         # row 6
+            [datetime(2024, 1, 8), 'ACC-1', 'Sell 5 NEDBANK at 27,000 Cents', 'NEDBANK', 'five', 1350],  # row 7
+            [None, None, 'Total', None, None, -1294.7],                                                  # row 8
+            [datetime(2024, 1, 9), None, 'Sell 5 NEDBANK at 27,000 Cents', 'NEDBANK', -5, 1e14],         # row 9
+        ])
+        response = self.client.post('/api/investec/upload/', {'file': upload})
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual(result['created'], 1)
+        self.assertEqual(result['errors'], 4)
+        self.assertEqual([(error['row'], error['column'], error['reason']) for error in result['error_details']], [
+            (6, 'date', 'not a date'),
+            (7, 'quantity', 'not a number'),
+            (9, 'value', 'out of range (must be below 1e+13 in absolute value)'),
+            (9, 'account_number', 'missing'),
+        ])
+
+        report = self.client.get(f'/api/investec/upload-errors/{result["error_report"]}/', {'limit': 2, 'offset': 1}).json()
+        self.assertEqual((report['file'], report['count']), (upload.name, 4))
+        self.assertEqual([error['row'] for error in report['results']], [7, 9])
+
+        download = self.client.get(f'/api/investec/upload-errors/{result["error_report"]}/', {'download': 'true'})
+        lines = download.content.decode().splitlines()
+        self.assertEqual(lines[0], 'file,row,column,reason,value')
+        self.assertEqual(len(lines), 5)
+
+    @override_settings(INVESTEC_UPLOAD_ERROR_KEEP=2)
+    def test_report_paging_and_eviction(self):
+        errors = pd.DataFrame({
+            'row': range(2, 122),
+            'column': 'Value',
+            'reason': 'not a number',
+            'value': [f'x{n}' for n in range(120)],
+        })
+        summary = summarize_errors(errors, 'big.xlsx')
+        self.assertEqual(summary['errors'], 120)
+        self.assertEqual(len(summary['error_details']), ERROR_PREVIEW)
+        url = f'/api/investec/upload-errors/{summary["error_report"]}/'
+
+        page = self.client.get(url, {'limit': 30, 'offset': 100}).json()
+        self.assertEqual((page['count'], page['limit'], page['offset']), (120, 30, 100))
+        self.assertEqual([error['row'] for error in page['results']], list(range(102, 122)))
+        self.assertEqual(page['results'][0]['value'], 'x100')
+        for params in ({'offset': -1}, {'limit': 0}, {'limit': 'all'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+
+        # Only the newest INVESTEC_UPLOAD_ERROR_KEEP reports are kept
+        newer = [summarize_errors(errors.head(1), f'file{n}.xlsx')['error_report'] for n in range(2)]
+        self.assertEqual(self.client.get(url).status_code, 404)
+        for report_id in newer:
+            self.assertEqual(self.client.get(f'/api/investec/upload-errors/{report_id}/').status_code, 200)
+        self.assertEqual(self.client.get('/api/investec/upload-errors/not-a-report/').status_code, 404)
+
+
+@override_settings(INVESTEC_PIPELINE_BATCH_ROWS=2, INVESTEC_EXPORT_REFRESH='off')
+class PipelineTransactionTests(TestCase):
+    """A statement replaces the stored rows of its date range all at once or not at all."""
+
+    LINES = [
+        [datetime(2024, 1, day), 'ACC-1', f'Buy {day} NEDBANK at 26,447 Cents', 'NEDBANK', day, -264.47 * day]
+        for day in range(2, 7)
+    ]
+
+    def setUp(self):
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2024, 1, 10), 'ACC-1', 'NEDBANK', 'Buy', 3, -793.41),
+            _transaction(date(2024, 1, 20), 'ACC-1', 'NEDBANK', 'Sell', -1, 270),
+            _transaction(date(2024, 2, 1), 'ACC-1', 'NEDBANK', 'Buy', 1, -264.47),
+        ])
+        self.stored = sorted(InvestecJseTransaction.objects.values_list('id', 'date', 'quantity'))
+
+    def test_statement_replaces_its_range(self):
+        result = process_transaction_file(_statement_workbook(self.LINES))
+        self.assertEqual((result['deleted_previous'], result['created']), (2, 5))
+        self.assertEqual(
+            sorted(InvestecJseTransaction.objects.values_list('date', flat=True)),
+            [date(2024, 1, day) for day in range(2, 7)] + [date(2024, 2, 1)],
+        )
+
+    def test_failed_batch_keeps_stored_rows(self):
+        from .importers import ShareCodes
+
+        process = ShareCodes.process
+        calls = []
+
+        def fail_second_batch(stage, batch, context):
+            # The first batch has been written by the load stage when the second one fails
+            calls.append(len(batch))
+            if len(calls) == 2:
+                raise RuntimeError('disk full')
+            return process(stage, batch, context)
+
+        with mock.patch.object(ShareCodes, 'process', fail_second_batch):
+            result = process_transaction_file(_statement_workbook(self.LINES))
+        self.assertEqual((result['success'], result['error']), (False, 'Error processing file: disk full'))
+        self.assertEqual(calls, [2, 2])
+        # Neither the range delete nor the first batch is kept
+        self.assertEqual(sorted(InvestecJseTransaction.objects.values_list('id', 'date', 'quantity')), self.stored)
+
+    def test_parse_before_transaction(self):
+        from .importers import DeleteRange, TransactionValidate
+
+        validate, delete = TransactionValidate.process, DeleteRange.start
+        depth = {}
+
+        def record(name, method):
+            def wrapper(stage, *args):
+                depth.setdefault(name, []).append(len(connection.atomic_blocks))
+                return method(stage, *args)
+            return wrapper
+
+        outer = len(connection.atomic_blocks)
+        with mock.patch.object(TransactionValidate, 'process', record('validate', validate)), \
+                mock.patch.object(DeleteRange, 'start', record('delete', delete)):
+            process_transaction_file(_statement_workbook(self.LINES))
+        # Every batch is validated before the load's transaction opens
+        self.assertEqual(depth, {'validate': [outer] * 3, 'delete': [outer + 1]})
+
+    def test_failed_derive_keeps_stored_rows(self):
+        with mock.patch('investec.importers.rebuild_cost_basis', side_effect=RuntimeError('lost connection')):
+            result = process_transaction_file(_statement_workbook(self.LINES))
+        self.assertEqual(result['error'], 'Error processing file: lost connection')
+        self.assertEqual(sorted(InvestecJseTransaction.objects.values_list('id', 'date', 'quantity')), self.stored)
+
+
+class ShareCodeTests(TestCase):
+    """share_code is resolved from the mappings at import and re-resolved when the mappings change."""
+
+    LINES = [
+        [datetime(2024, 1, 5), 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],
+        [datetime(2024, 1, 12), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 150],
+        [datetime(2024, 1, 19), 'ACC-2', 'Buy 5 SASOL at 30,000 Cents', 'SASOL', 5, -1500],
+    ]
+
+    def codes(self):
+        return sorted(InvestecJseTransaction.objects.values_list('share_name', 'share_code'), key=lambda row: row[0])
+
+    def test_resolved_at_import(self):
+        import_mapping_rows([('NEDBANK', 'NEDBANK GROUP LIMITED', 'NED')], 'mappings.csv')
+        result = process_transaction_file(_statement_workbook(self.LINES))
+        self.assertTrue(result['success'], result)
+        self.assertEqual(self.codes(), [('NEDBANK', 'NED'), ('NEDBANK', 'NED'), ('SASOL', None)])
+
+    def test_mapping_upload_re_resolves(self):
+        process_transaction_file(_statement_workbook(self.LINES))
+        self.assertEqual(self.codes(), [('NEDBANK', None), ('NEDBANK', None), ('SASOL', None)])
+
+        result = import_mapping_rows([('NEDBANK', 'NEDBANK GROUP LIMITED', 'NED')], 'mappings.csv')
+        self.assertEqual(result['transactions_resolved'], 2)
+        self.assertEqual(self.codes(), [('NEDBANK', 'NED'), ('NEDBANK', 'NED'), ('SASOL', None)])
+
+        result = import_mapping_rows(
+            [('NEDBANK', 'NEDBANK GROUP LIMITED', 'NBK'), ('SASOL', 'SASOL LIMITED', 'SOL')], 'mappings.csv',
+        )
+        self.assertEqual(result['transactions_resolved'], 3)
+        self.assertEqual(self.codes(), [('NEDBANK', 'NBK'), ('NEDBANK', 'NBK'), ('SASOL', 'SOL')])
+
+        # Rows that already carry their mapped code are not written again
+        self.assertEqual(resolve_share_codes(), 0)
+
+    def test_resolve_limited_to_share_names(self):
+        process_transaction_file(_statement_workbook(self.LINES))
+        InvestecJseShareNameMapping.objects.bulk_create([
+            InvestecJseShareNameMapping(share_name='NEDBANK', share_code='NED'),
+            InvestecJseShareNameMapping(share_name='SASOL', share_code='SOL'),
+        ])
+        self.assertEqual(resolve_share_codes([]), 0)
+        self.assertEqual(resolve_share_codes(['SASOL']), 1)
+        self.assertEqual(self.codes(), [('NEDBANK', None), ('NEDBANK', None), ('SASOL', 'SOL')])
+
+        # A blank share code resolves to NULL
+        InvestecJseShareNameMapping.objects.filter(share_name='SASOL').update(share_code='')
+        self.assertEqual(resolve_share_codes(), 3)
+        self.assertEqual(self.codes(), [('NEDBANK', 'NED'), ('NEDBANK', 'NED'), ('SASOL', None)])
+
+
+@override_settings(INVESTEC_EXPORT_REFRESH='off')
+class ShareMatchingTests(TestCase):
+    """Suggested share name mappings and accepting them in bulk."""
+
+    COMPANIES = [
+        ('NY1', 'NINETY ONE LIMITED'),
+        ('AVI', 'AVI LIMITED'),
+        ('ABG', 'ABSA GROUP LIMITED (ABG)'),
+        ('SHP', 'SHOPRITE HOLDINGS LTD'),
+        ('TBS', 'TIGER BRANDS LIMITED'),
+        ('SBK', 'STANDARD BANK GROUP LTD'),
+        ('NED', 'NEDBANK GROUP LIMITED'),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        InvestecJsePortfolio.objects.bulk_create([
+            InvestecJsePortfolio(
+                date=date(2024, 1, 31),
+                year=2024,
+                month=1,
+                day=31,
+                company=company,
+                share_code=share_code,
+                quantity=Decimal(100),
+                unit_cost=Decimal(10),
+                total_cost=Decimal(1000),
+                price=Decimal(12),
+                total_value=Decimal(1200),
+            )
+            for share_code, company in cls.COMPANIES
+        ])
+        InvestecJseTransaction.objects.bulk_create([
+            _transaction(date(2024, 1, 5), 'ACC-1', 'NINETY', 'Buy', 10, -500),
+            _transaction(date(2024, 1, 6), 'ACC-2', 'NINETY', 'Buy', 5, -250),
+            _transaction(date(2024, 1, 7), 'ACC-1', 'AVI', 'Buy', 20, -1800),
+            _transaction(date(2024, 1, 8), 'ACC-1', 'XYZZY', 'Buy', 1, -10),
+        ])
+
+    def test_match(self):
+        index = ShareNameIndex(self.COMPANIES)
+        best = {name: [(match['share_code'], match['score']) for match in index.match(name)] for name in (
+            'NINETY', 'AVI', 'A V I', 'ABSA', 'SHOPRIT', 'TIGBRANDS', 'STANDARD BANK', 'XYZZY',
+        )}
+        self.assertEqual(best, {
+            'NINETY': [('NY1', 0.9)],  # one distinctive word of the company
+            'AVI': [('AVI', 1.0)],  # the share code itself
+            'A V I': [('AVI', 1.0)],
+            'ABSA': [('ABG', 0.9)],
+            'SHOPRIT': [('SHP', 0.938)],  # truncated: a prefix of "SHOPRITE"
+            'TIGBRANDS': [('TBS', 0.809)],  # abbreviates "TIGERBRANDS"
+            'STANDARD BANK': [('SBK', 1.0)],  # the company without its stop words
+            'XYZZY': [],
+        })
+
+        # Ranked best first; limit and min_score cut the list
+        bank = index.match('BANK', limit=5, min_score=0)
+        self.assertEqual([match['share_code'] for match in bank], ['SBK', 'NED'])
+        self.assertGreater(bank[0]['score'], bank[1]['score'])
+        self.assertEqual(len(index.match('BANK', limit=1, min_score=0)), 1)
+        self.assertEqual(index.match('BANK', min_score=0.95), [])
+
+    def test_suggestions(self):
+        response = self.client.get('/api/investec/mapping/suggestions/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['count'], data['matched']), (3, 2))
+        results = {result['share_name']: result for result in data['results']}
+        self.assertEqual(results['NINETY']['transactions'], 2)
+        self.assertEqual(results['NINETY']['suggestions'][0]['share_code'], 'NY1')
+        self.assertEqual(results['XYZZY']['suggestions'], [])
+
+        self.assertEqual(self.client.get('/api/investec/mapping/suggestions/', {'min_score': 2}).status_code, 400)
+
+    def test_accept_best_suggestions(self):
+        response = self.client.post('/api/investec/mapping/suggestions/accept/', {'min_score': 0.8}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual((data['created'], data['updated'], data['transactions_resolved']), (2, 0, 3))
+        self.assertEqual(
+            {mapping['share_name']: mapping['share_code'] for mapping in data['accepted']},
+            {'NINETY': 'NY1', 'AVI': 'AVI'},
+        )
+        # The stored transactions now carry the share codes, and only XYZZY is left unmapped
+        self.assertEqual(
+            sorted(InvestecJseTransaction.objects.values_list('share_name', 'share_code')),
+            [('AVI', 'AVI'), ('NINETY', 'NY1'), ('NINETY', 'NY1'), ('XYZZY', None)],
+        )
+        self.assertEqual(
+            [result['share_name'] for result in self.client.get('/api/investec/mapping/suggestions/').json()['results']],
+            ['XYZZY'],
+        )
+
+    def test_accept_given_mappings(self):
+        url = '/api/investec/mapping/suggestions/accept/'
+        response = self.client.post(url, {'mappings': [{'share_name': 'XYZZY', 'share_code': 'XYZ', 'company': 'XYZZY LIMITED'}]}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['transactions_resolved'], 1)
+        self.assertEqual(InvestecJseTransaction.objects.get(share_name='XYZZY').share_code, 'XYZ')
+
+        # Accepting the same mapping again changes nothing
+        response = self.client.post(url, {'mappings': [{'share_name': 'XYZZY', 'share_code': 'XYZ'}]}, content_type='application/json')
+        self.assertEqual(response.json()['created'], 0)
+
+        for body in ({}, {'mappings': {'share_name': 'AVI'}}, {'mappings': [{'share_name': 'AVI'}]}, {'min_score': 'high'}):
+            self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 400, body)
+
+
+@override_settings(INVESTEC_EXPORT_REFRESH='sync', INVESTEC_EXPORT_KEEP=3, INVESTEC_STORE_DIVIDEND_TTM=True, INVESTEC_TTM_READ_MODE='stored')
+class ExportArtifactTests(TestCase):
+    """Export artifacts are written once per data version, appended to only when that gives the same file."""
+
+    JANUARY = [
+        [datetime(2024, 1, 5), 'ACC-1', 'Buy 10 NEDBANK at 26,447 Cents', 'NEDBANK', 10, -2644.7],
+        [datetime(2024, 1, 12), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 150],
+        [datetime(2024, 1, 19), 'ACC-2', 'Buy 5 SASOL at 30,000 Cents', 'SASOL', 5, -1500],
+    ]
+    FEBRUARY = [
+        [datetime(2024, 2, 2), 'ACC-1', 'Sell 4 NEDBANK at 27,000 Cents', 'NEDBANK', -4, 1080],
+        [datetime(2024, 2, 16), 'ACC-1', 'Dividend NEDBANK', 'NEDBANK', 0, 90],
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(INVESTEC_EXPORT_DIR=directory.name))
+
+    def upload(self, lines, start, end):
+        # The refresh runs when the import commits
+        with self.captureOnCommitCallbacks(execute=True):
+            result = process_transaction_file(_statement_workbook(lines, start, end))
+        self.assertTrue(result['success'], result)
+        return result
+
+    def content(self, meta):
+        with open(exports.meta_path(meta), 'rb') as f:
+            return f.read()
+
+    def rewritten(self):
+        """A CSV artifact written whole from the current transactions."""
+        return self.content(exports.write_artifact('csv', 'stored'))
+
+    def test_append_matches_rewrite(self):
+        self.upload(self.JANUARY, date(2024, 1, 1), date(2024, 1, 31))
+        base, current = exports.export_artifact('csv', 'stored')
+        self.assertTrue(current)
+        self.assertEqual(base['count'], 3)
+
+        # February adds rows dated after the artifact's last row and deletes none
+        self.upload(self.FEBRUARY, date(2024, 2, 1), date(2024, 2, 29))
+        appended = exports.latest_artifact('csv', 'stored')
+        self.assertEqual(appended['appended_to'], base['id'])
+        self.assertTrue(exports.is_current(appended))
+        self.assertEqual((appended['count'], appended['last_date']), (5, '2024-02-16'))
+        self.assertEqual(self.content(appended), self.rewritten())
+
+    def test_delete_or_mapping_change_rewrites(self):
+        self.upload(self.JANUARY + self.FEBRUARY, date(2024, 1, 1), date(2024, 2, 29))
+        base, _ = exports.export_artifact('csv', 'stored')
+
+        # Uploading February again deletes its stored rows first
+        self.upload(self.FEBRUARY[:1], date(2024, 2, 1), date(2024, 2, 29))
+        replaced = exports.latest_artifact('csv', 'stored')
+        self.assertNotEqual(replaced['id'], base['id'])
+        self.assertNotIn('appended_to', replaced)
+        self.assertEqual(replaced['count'], 4)
+        self.assertEqual(self.content(replaced), self.rewritten())
+
+        # A mapping changes the share code of stored rows
+        with self.captureOnCommitCallbacks(execute=True):
+            import_mapping_rows([('NEDBANK', 'NEDBANK GROUP LIMITED', 'NED')], 'suggestions')
+        remapped = exports.latest_artifact('csv', 'stored')
+        self.assertNotIn('appended_to', remapped)
+        self.assertTrue(exports.is_current(remapped))
+        rows = list(csv.DictReader(io.StringIO(self.content(remapped).decode())))
+        self.assertEqual(
+            sorted({(row['Share Name'], row['Share Code']) for row in rows}),
+            [('NEDBANK', 'NED'), ('SASOL', '')],
+        )
+
+    def test_appendable(self):
+        self.upload(self.JANUARY, date(2024, 1, 1), date(2024, 1, 31))
+        base = exports.write_artifact('csv', 'stored')
+        self.assertTrue(exports.appendable(base))
+
+        # A row dated on or before the artifact's last row belongs in the middle of the file
+        InvestecJseTransaction.objects.bulk_create([_transaction(date(2024, 1, 19), 'ACC-3', 'SASOL', 'Buy', 1, -300)])
+        self.assertFalse(exports.appendable(base))
+        InvestecJseTransaction.objects.filter(account_number='ACC-3').delete()
+
+        # So does an edit of a stored row (updated_at moves)
+        stored = InvestecJseTransaction.objects.get(account_number='ACC-2')
+        stored.description = 'Buy 5 SASOL at 30,000 Cents (corrected)'
+        stored.save()
+        self.assertFalse(exports.appendable(base))
+
+    def test_stale_artifact(self):
+        self.upload(self.JANUARY, date(2024, 1, 1), date(2024, 1, 31))
+        base, current = exports.export_artifact('csv', 'stored')
+        self.assertEqual(exports.export_artifact('csv', 'stored'), (base, True))
+
+        # A change the importers record only by bumping the generation (e.g. a TTM rebuild)
+        with override_settings(INVESTEC_EXPORT_REFRESH='off'), self.captureOnCommitCallbacks(execute=True):
+            exports.refresh_exports()
+        self.assertFalse(exports.is_current(base))
+
+        # Served stale with a refresh scheduled, unless a fresh one is asked for
+        with mock.patch.object(exports, '_schedule') as schedule:
+            self.assertEqual(exports.export_artifact('csv', 'stored'), (base, False))
+        schedule.assert_called_once()
+        fresh, current = exports.export_artifact('csv', 'stored', fresh=True)
+        self.assertTrue(current)
+        self.assertNotEqual(fresh['id'], base['id'])
+        self.assertEqual(fresh['version']['generation'], base['version']['generation'] + 1)
+
+        response = self.client.get('/api/investec/export/transactions/', {'file_format': 'csv', 'ttm': 'stored', 'download': 'true'})
+        self.assertEqual(response['X-Export-Current'], 'true')
+        self.assertEqual(b''.join(response.streaming_content), self.content(fresh))
+
+    @override_settings(INVESTEC_EXPORT_KEEP=1)
+    def test_download_evicted_after_lookup(self):
+        self.upload(self.JANUARY, date(2024, 1, 1), date(2024, 1, 31))
+        base, _ = exports.export_artifact('csv', 'stored')
+        export_artifact = exports.export_artifact
+        replaced = []
+
+        def lookup_then_refresh(*args, **kwargs):
+            found = export_artifact(*args, **kwargs)
+            if not replaced:
+                # A background refresh saves a newer artifact and evicts the one just found
+                replaced.append(exports.write_artifact('csv', 'stored'))
+            return found
+
+        params = {'file_format': 'csv', 'ttm': 'stored', 'download': 'true'}
+        with mock.patch.object(exports, 'export_artifact', side_effect=lookup_then_refresh):
+            response = self.client.get('/api/investec/export/transactions/', params)
+        self.assertFalse(os.path.exists(exports.meta_path(base)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content(replaced[0]))
+
+        response = self.client.get('/api/investec/export/transactions/', {'file_format': 'csv', 'ttm': 'stored'})
+        self.assertEqual(response.data['filename'], replaced[0]['filename'])
+        self.assertNotIn('filepath', response.data)
+
+    @override_settings(INVESTEC_EXPORT_KEEP=2)
+    def test_eviction(self):
+        self.upload(self.JANUARY, date(2024, 1, 1), date(2024, 1, 31))
+        xlsx = exports.list_artifacts('xlsx', 'stored')  # The default export, written by the upload
+        written = [exports.write_artifact('csv', 'stored') for _ in range(3)]
+
+        # Only the newest INVESTEC_EXPORT_KEEP of a variant are kept, files and sidecars
+        self.assertEqual([meta['id'] for meta in exports.list_artifacts('csv', 'stored')], [meta['id'] for meta in written[1:]])
+        self.assertFalse(os.path.exists(exports.meta_path(written[0])))
+        self.assertFalse(os.path.exists(f'{os.path.splitext(exports.meta_path(written[0]))[0]}.json'))
+        self.assertEqual(exports.list_artifacts('xlsx', 'stored'), xlsx)
+        self.assertEqual(len(xlsx), 1)
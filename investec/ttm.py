@@ -0,0 +1,498 @@
+"""
+Dividend TTM engine: trailing 12-month dividend sums per account, share and dividend type.
+
+calculate_dividend_ttm stores the monthly series in InvestecJseShareMonthlyPerformance
+and returns the lookup used to stamp dividend_ttm onto transactions at import;
+live_dividend_ttm computes the same window at read time. Accounts never share a
+series, so each account is computed on its own and an upload only recomputes the
+accounts it touched. Uploads compute in-process (they run in threaded web workers,
+inside the import's transaction); only code running outside the web workers (e.g. a
+management command) should pass workers to spread a large recompute over spawned
+worker processes.
+
+pandas is imported by the calculation functions only, so the read endpoints that use
+live_dividend_ttm do not load it.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Case, DateField, DecimalField, Exists, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, When
+
+from .metrics import TTM_RECOMPUTE_SECONDS
+from .models import DIVIDEND_TYPES, TTM_SUMMARY, InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareMonthlyPerformance
+
+
+# Below this many dividend rows the account series are computed in-process even when
+# workers are requested; starting worker processes costs more than the series.
+PARALLEL_MIN_ROWS = 20000
+
+
+def _account_series(job):
+    """
+    Monthly TTM series of one account's dividends (run in a worker process when
+    calculate_dividend_ttm is given workers).
+    
+    job is (account_number, dividends DataFrame, date_from, date_to). Returns
+    (account_number, {(share_name, dividend_type, year, month): (ttm, share_code)}).
+    """
+    import pandas as pd
+    
+    account_number, df, date_from, date_to = job
+    series = {}
+    
+    for (share_name, dividend_type), group_df in df.groupby(['share_name', 'dividend_type']):
+        # share_code resolved onto the transactions at import (links the share to portfolio prices)
+        share_codes = group_df['share_code'].dropna()
+        share_code = share_codes.iloc[-1] if len(share_codes) > 0 else None
+        
+        # Sort by date
+        group_df = group_df.sort_values('date')
+        
+        # Set date as index for resampling
+        group_df_indexed = group_df.set_index('date')
+        
+        # Resample to monthly (month-end) and sum dividends per month
+        monthly_df = group_df_indexed.resample('ME').agg({
+            'value': 'sum'
+        })
+        
+        # Fill missing months with 0
+        # Create complete date range from earliest to latest date
+        if len(monthly_df) > 0:
+            min_date = monthly_df.index.min()
+            max_date = monthly_df.index.max()
+            
+            # CRITICAL: Extend max_date to at least the current month-end.
+            # This ensures the rolling TTM calculation runs all the way to the present day.
+            # Without this extension, reports for the current month might show empty/incorrect TTM values
+            # if there hasn't been a recent dividend transaction in the current month.
+            # The rolling window needs complete monthly data up to today to calculate accurate TTM values.
+            current_month_end = pd.Timestamp.now().to_period('M').to_timestamp('M')
+            if max_date < current_month_end:
+                max_date = current_month_end
+            
+            date_range = pd.date_range(start=min_date, end=max_date, freq='ME')
+            
+            # Reindex to fill missing months with 0
+            monthly_df = monthly_df.reindex(date_range, fill_value=0)
+            
+            # Ensure value column exists and is numeric
+            if 'value' not in monthly_df.columns:
+                monthly_df['value'] = 0
+            monthly_df['value'] = pd.to_numeric(monthly_df['value'], errors='coerce').fillna(0)
+            
+            # Calculate rolling 12-month sum (window includes current month)
+            monthly_df['dividend_ttm'] = monthly_df['value'].rolling(window=12, min_periods=1).sum()
+            
+            # Only store the requested months (the rolling sum above still used the earlier ones)
+            if date_from:
+                monthly_df = monthly_df[monthly_df.index >= pd.Timestamp(date_from)]
+            if date_to:
+                monthly_df = monthly_df[monthly_df.index <= pd.Timestamp(date_to).to_period('M').to_timestamp('M')]
+            
+            for idx, row in monthly_df.iterrows():
+                # Get TTM value and round to 2 decimal places for clean database storage
+                # Rounding prevents floating-point precision issues and ensures consistent values
+                ttm_value = Decimal(str(round(row['dividend_ttm'], 2)))
+                series[(share_name, dividend_type, idx.year, idx.month)] = (ttm_value, share_code)
+    
+    return account_number, series
+
+
+def _account_series_all(jobs, workers=None):
+    """
+    Run _account_series for every account, in parallel worker processes when workers > 1.
+    The workers are spawned, not forked: a fork of a threaded process holding database
+    connections copies their sockets and any lock another thread holds.
+    """
+    total_rows = sum(len(job[1]) for job in jobs)
+    if not workers or workers <= 1 or total_rows < PARALLEL_MIN_ROWS or len(jobs) < 2:
+        return dict(map(_account_series, jobs))
+    
+    # Largest accounts first so one long series does not end up last on a busy worker
+    jobs.sort(key=lambda job: len(job[1]), reverse=True)
+    import django
+    
+    # Spawned workers import this module (models) to run _account_series: set Django up first
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context, initializer=django.setup) as executor:
+        return dict(executor.map(_account_series, jobs))
+
+
+def dividend_queryset(share_names=None, account_numbers=None):
+    """
+    The stored dividend transactions the TTM series are computed from, optionally only
+    those of share_names / account_numbers. TTM summary records are not transactions and
+    are left out, which is what lets the planner use the investec_txn_ttm_dividends index.
+    """
+    queryset = InvestecJseTransaction.objects.filter(
+        type__in=DIVIDEND_TYPES,
+        share_name__isnull=False
+    ).exclude(share_name='').exclude(TTM_SUMMARY)
+    if share_names is not None:
+        queryset = queryset.filter(share_name__in=share_names)
+    if account_numbers is not None:
+        queryset = queryset.filter(account_number__in=account_numbers)
+    return queryset
+
+
+def calculate_dividend_ttm(transactions_to_create, share_names=None, date_from=None, date_to=None,
+                           account_numbers=None, workers=None):
+    """
+    Calculate trailing 12-month (TTM) dividend sum for each transaction.
+    Calculates TTM separately for each account and dividend type (Dividend, Special Dividend, Foreign Dividend).
+    
+    Optional scoping (used by rebuild_derived to process one share at a time, and by the
+    upload to recompute only the accounts it touched):
+    - share_names: only load and store these shares
+    - account_numbers: only load and store these accounts
+    - date_from / date_to: only store months whose month-end falls in this range
+      (earlier months are still read so the first stored TTM values are complete)
+    
+    Each account's series is independent of the others; with workers > 1 (and enough
+    dividends to be worth it, see PARALLEL_MIN_ROWS) the accounts are computed in
+    parallel spawned worker processes. Uploads never pass workers.
+    
+    Only the stored performance records of the (account, share, dividend type) series
+    written here are replaced, plus those of series in the requested scope that no
+    longer have any dividends; other series are left alone.
+    
+    Steps:
+    1. Get all existing dividend transactions from database
+    2. Combine with new transactions being uploaded
+    3. Filter to dividend types
+    4. Per account, group by share_name AND dividend_type, then resample to monthly (month-end)
+    5. Fill missing months with 0
+    6. Calculate rolling 12-month sum
+    7. Store TTM summary records in database for all months (even months without dividends)
+    8. Return lookup dictionary: (account_number, share_name, dividend_type, year, month) -> dividend_ttm
+    """
+    import pandas as pd
+    
+    if account_numbers is not None:
+        account_numbers = set(account_numbers)
+    
+    # Get all existing dividend transactions from database (without the TTM summary records)
+    existing_dividends = dividend_queryset(share_names, account_numbers).values(
+        'date', 'share_name', 'share_code', 'type', 'value', 'account_number', 'year', 'month'
+    )
+    
+    # Convert to list of dicts for pandas
+    existing_data = [
+        {
+            'date': item['date'],
+            'share_name': item['share_name'],
+            'share_code': item['share_code'],
+            'dividend_type': item['type'],  # Include dividend type
+            'value': float(item['value']),
+            'account_number': item['account_number'],
+            'year': item['year'],
+            'month': item['month']
+        }
+        for item in existing_dividends
+    ]
+    
+    # Add new transactions being uploaded (only dividend types with share_name)
+    # Exclude TTM summary records: they have quantity=0, value=0, and description starts with 'TTM Summary'
+    new_dividends = []
+    for txn in transactions_to_create:
+        if (txn.type in DIVIDEND_TYPES and 
+            txn.share_name and txn.share_name.strip() and
+            (share_names is None or txn.share_name in share_names) and
+            (account_numbers is None or txn.account_number in account_numbers) and
+            not (txn.quantity == 0 and txn.value == 0 and txn.description.startswith('TTM Summary'))):
+            new_dividends.append({
+                'date': txn.date,
+                'share_name': txn.share_name,
+                'share_code': txn.share_code,
+                'dividend_type': txn.type,  # Include dividend type
+                'value': float(txn.value),
+                'account_number': txn.account_number,
+                'year': txn.year,
+                'month': txn.month
+            })
+    
+    # Combine existing and new
+    all_dividends = existing_data + new_dividends
+    
+    if not all_dividends:
+        return {}  # No dividends to process
+    
+    # Create DataFrame immediately after combining existing and new records
+    # This is critical: we must convert to DataFrame before any aggregation to enable deduplication
+    df = pd.DataFrame(all_dividends)
+    
+    # CRITICAL: Ensure we exclude any TTM summary records that might have slipped through
+    # TTM summary records have value=0, but we also check account_number if available
+    # Filter out any records where value is 0 (TTM summary records have value=0)
+    # However, we need to be careful: actual dividend transactions should never have value=0
+    # So filtering by value != 0 should be safe
+    if 'value' in df.columns:
+        df = df[df['value'] != 0]
+    
+    # CRITICAL: Remove duplicates immediately after DataFrame creation, BEFORE any aggregation/summing operations.
+    # This prevents double-counting when uploading files that overlap with existing database records.
+    # If a transaction exists in both the database and the upload file, we keep only the first occurrence.
+    # Deduplication is based on: account_number, share_name, dividend_type, date, and value (to identify unique transactions).
+    df = df.drop_duplicates(subset=['account_number', 'share_name', 'dividend_type', 'date', 'value'], keep='first')
+    
+    # Convert date to datetime if needed
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+    
+    # One independent series per account
+    jobs = [
+        (account_number, account_df[['date', 'share_name', 'share_code', 'dividend_type', 'value']], date_from, date_to)
+        for account_number, account_df in df.groupby('account_number')
+    ]
+    series_by_account = _account_series_all(jobs, workers=workers)
+    
+    # Lookup: (account_number, share_name, dividend_type, year, month) -> dividend_ttm, and the
+    # TTM values per account, share_name AND dividend_type (separate records per dividend type)
+    ttm_lookup = {}
+    share_ttm_data = {}  # {(account_number, share_name, dividend_type, year, month): {'ttm': ttm_value, 'share_code': share_code}}
+    for account_number, series in series_by_account.items():
+        for (share_name, dividend_type, year, month), (ttm_value, share_code) in series.items():
+            key = (account_number, share_name, dividend_type, year, month)
+            ttm_lookup[key] = ttm_value
+            share_ttm_data[key] = {
+                'ttm': ttm_value,
+                'share_code': share_code,
+            }
+    
+    # Now create InvestecJseShareMonthlyPerformance records
+    # Get all unique share_names and date ranges
+    if share_ttm_data:
+        # Get portfolio data (quantity, price, total_value) for all relevant dates
+        # Keys are (account_number, share_name, dividend_type, year, month), so we need key[3] and key[4] for year and month
+        all_dates = set((key[3], key[4]) for key in share_ttm_data.keys())  # (year, month) tuples
+        portfolio_data = {}  # {(share_code, year, month): {'quantity': qty, 'price': price, 'total_value': total_value}}
+        
+        # Get current year and month for comparison
+        current_date = datetime.now()
+        current_year = current_date.year
+        current_month = current_date.month
+        
+        for (year, month) in all_dates:
+            # Check if this is the current month
+            is_current_month = (year == current_year and month == current_month)
+            
+            if is_current_month:
+                # For current month: Get the latest portfolio data within that month
+                # Get all portfolio records for this month, then get the latest one per share_code
+                all_portfolios = InvestecJsePortfolio.objects.filter(
+                    year=year,
+                    month=month
+                ).values('share_code', 'quantity', 'price', 'total_value', 'date').order_by('share_code', '-date')
+                
+                # Group by share_code and take the first (latest) record for each
+                latest_by_share = {}
+                for portfolio in all_portfolios:
+                    share_code = portfolio['share_code']
+                    if share_code not in latest_by_share:
+                        latest_by_share[share_code] = portfolio
+                
+                # Store the latest data for each share_code
+                for share_code, portfolio in latest_by_share.items():
+                    portfolio_data[(share_code, year, month)] = {
+                        'quantity': Decimal(str(portfolio['quantity'])),
+                        'price': Decimal(str(portfolio['price'])),
+                        'total_value': Decimal(str(portfolio['total_value']))
+                    }
+            else:
+                # For historical months: Get portfolio data for month-end date
+                # NOTE: pandas Timestamp is picky: if `year` is a string it treats it as a date string input
+                # and then passing additional date parts triggers:
+                # "Cannot pass a date attribute keyword argument when passing a date string; 'tz' is keyword-only"
+                # So we coerce year/month to int and use keyword args.
+                month_end = pd.Timestamp(year=int(year), month=int(month), day=1).to_period('M').to_timestamp('M').date()
+                
+                portfolios = InvestecJsePortfolio.objects.filter(
+                    date=month_end
+                ).values('share_code', 'quantity', 'price', 'total_value')
+                
+                for portfolio in portfolios:
+                    portfolio_data[(portfolio['share_code'], year, month)] = {
+                        'quantity': Decimal(str(portfolio['quantity'])),
+                        'price': Decimal(str(portfolio['price'])),
+                        'total_value': Decimal(str(portfolio['total_value']))
+                    }
+        
+        # Create InvestecJseShareMonthlyPerformance records
+        performance_records = []
+        
+        for (account_number, share_name, dividend_type, year, month), data in share_ttm_data.items():
+            ttm_value = data['ttm']
+            # Coerce year/month to int for the same reason as above (pandas Timestamp parsing).
+            month_end_date = pd.Timestamp(year=int(year), month=int(month), day=1).to_period('M').to_timestamp('M').date()
+            
+            # Get portfolio data (quantity, price, total_value) from portfolio if available
+            closing_price = None
+            quantity = None
+            total_market_value = None
+            share_code = data['share_code']
+            if share_code:
+                portfolio_info = portfolio_data.get((share_code, year, month))
+                if portfolio_info:
+                    closing_price = portfolio_info['price']
+                    quantity = portfolio_info['quantity']
+                    total_market_value = portfolio_info['total_value']
+            
+            # Calculate dividend yield: Dividend Yield = Total Dividend Cash Received TTM / Total Market Value
+            # Total Market Value = Quantity × Price (from portfolio)
+            # If no portfolio data exists for a month, set dividend_yield = 0
+            dividend_yield = Decimal('0')  # Default to 0 if no portfolio data
+            if total_market_value and total_market_value > 0 and ttm_value > 0:
+                dividend_yield = (ttm_value / total_market_value)
+            
+            performance_records.append(
+                InvestecJseShareMonthlyPerformance(
+                    share_name=share_name,
+                    date=month_end_date,
+                    year=year,
+                    month=month,
+                    dividend_type=dividend_type,
+                    investec_account=account_number,
+                    dividend_ttm=ttm_value,
+                    closing_price=closing_price,
+                    quantity=quantity,
+                    total_market_value=total_market_value,
+                    dividend_yield=dividend_yield,
+                )
+            )
+        
+        # Store InvestecJseShareMonthlyPerformance records: replace the months of each series
+        # written here, and drop the series in scope whose dividends are gone
+        if performance_records:
+            _replace_performance(performance_records, share_names, account_numbers, date_from, date_to)
+    
+    return ttm_lookup
+
+
+
+# Series per DELETE statement (each adds a handful of parameters to it)
+DELETE_BATCH_KEYS = 100
+
+
+def _replace_performance(performance_records, share_names, account_numbers, date_from, date_to):
+    import pandas as pd
+    
+    last_month = {}  # (account, share_name, dividend_type) -> last month-end written
+    for record in performance_records:
+        key = (record.investec_account, record.share_name, record.dividend_type)
+        last_month[key] = max(last_month.get(key, record.date), record.date)
+    
+    scope = InvestecJseShareMonthlyPerformance.objects.all()
+    if account_numbers is not None:
+        scope = scope.filter(investec_account__in=account_numbers)
+    if share_names is not None:
+        scope = scope.filter(share_name__in=share_names)
+    if date_from:
+        scope = scope.filter(date__gte=date_from)
+    if date_to:
+        scope = scope.filter(date__lte=pd.Timestamp(date_to).to_period('M').to_timestamp('M').date())
+    # Series in scope that were not written: their dividends were deleted
+    gone = set(scope.values_list('investec_account', 'share_name', 'dividend_type').distinct()) - set(last_month)
+    
+    conditions = [
+        Q(investec_account=account, share_name=share_name, dividend_type=dividend_type, date__lte=last)
+        for (account, share_name, dividend_type), last in last_month.items()
+    ] + [
+        Q(investec_account=account, share_name=share_name, dividend_type=dividend_type)
+        for account, share_name, dividend_type in gone
+    ]
+    for start in range(0, len(conditions), DELETE_BATCH_KEYS):
+        condition = Q()
+        for key_condition in conditions[start:start + DELETE_BATCH_KEYS]:
+            condition |= key_condition
+        scope.filter(condition).delete()
+    
+    InvestecJseShareMonthlyPerformance.objects.bulk_create(performance_records)
+
+
+def rebuild_share_ttm(share_name, date_from=None, date_to=None, account_numbers=None):
+    """
+    Recompute one share's InvestecJseShareMonthlyPerformance records and the stored
+    dividend_ttm of its dividend transactions, in a single database transaction.
+    account_numbers optionally restricts the rebuild to those accounts.
+    
+    Returns a dict with the number of performance records and transactions written.
+    """
+    with transaction.atomic():
+        with TTM_RECOMPUTE_SECONDS.labels(scope='share').time():
+            ttm_lookup = calculate_dividend_ttm(
+                [], share_names=[share_name], date_from=date_from, date_to=date_to, account_numbers=account_numbers
+            )
+        
+        transactions = InvestecJseTransaction.objects.filter(
+            share_name=share_name,
+            type__in=DIVIDEND_TYPES,
+        ).exclude(
+            TTM_SUMMARY
+        ).only('id', 'account_number', 'type', 'year', 'month', 'dividend_ttm')
+        if account_numbers is not None:
+            transactions = transactions.filter(account_number__in=account_numbers)
+        if date_from:
+            transactions = transactions.filter(date__gte=date_from)
+        if date_to:
+            transactions = transactions.filter(date__lte=date_to)
+        
+        changed = []
+        for txn in transactions:
+            dividend_ttm = ttm_lookup.get((txn.account_number, share_name, txn.type, txn.year, txn.month))
+            if txn.dividend_ttm != dividend_ttm:
+                txn.dividend_ttm = dividend_ttm
+                changed.append(txn)
+        InvestecJseTransaction.objects.bulk_update(changed, ['dividend_ttm'], batch_size=1000)
+    
+    return {'performance': len(ttm_lookup), 'transactions': len(changed)}
+
+def live_dividend_ttm():
+    """
+    Expression computing a transaction's trailing 12-month dividend sum at read time.
+    
+    Sums the values of dividend transactions with the same account_number, share_name and
+    type from the 11 months before the transaction's month through the end of its month -
+    the same window calculate_dividend_ttm stores - so the result is never stale. Like the
+    stored engine it leaves out TTM summary records and counts a repeated (date, value)
+    dividend once. The window is bounded on date (the 366 days before the transaction
+    through the 31 after cover any calendar-month window), so each row is one range scan
+    of the investec_txn_ttm_dividends index within one or two year partitions; the exact
+    months are then picked by year and month. Non-dividend rows evaluate to NULL.
+    """
+    month_index = F('year') * 12 + F('month')
+    outer_month_index = OuterRef('year') * 12 + OuterRef('month')
+    # An earlier copy of the same dividend (calculate_dividend_ttm's drop_duplicates)
+    repeated = InvestecJseTransaction.objects.filter(
+        account_number=OuterRef('account_number'),
+        share_name=OuterRef('share_name'),
+        type=OuterRef('type'),
+        date=OuterRef('date'),
+        value=OuterRef('value'),
+        id__lt=OuterRef('id'),
+    ).exclude(TTM_SUMMARY)
+    window = InvestecJseTransaction.objects.filter(
+        account_number=OuterRef('account_number'),
+        share_name=OuterRef('share_name'),
+        type=OuterRef('type'),
+        type__in=DIVIDEND_TYPES,
+        date__gt=ExpressionWrapper(OuterRef('date') - timedelta(days=366), output_field=DateField()),
+        date__lt=ExpressionWrapper(OuterRef('date') + timedelta(days=31), output_field=DateField()),
+    ).exclude(
+        TTM_SUMMARY
+    ).exclude(
+        Exists(repeated)
+    ).alias(
+        month_index=month_index
+    ).filter(
+        month_index__gt=outer_month_index - 12,
+        month_index__lte=outer_month_index,
+    ).order_by().values('share_name').annotate(ttm=Sum('value')).values('ttm')
+    
+    return Case(
+        When(Q(type__in=DIVIDEND_TYPES) & ~Q(share_name=''), then=Subquery(window)),
+        default=None,
+        output_field=DecimalField(max_digits=15, decimal_places=2),
+    )
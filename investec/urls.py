@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 app_name = 'investec'
 
@@ -8,8 +8,25 @@ urlpatterns = [
     path('transactions/', views.transaction_list_view, name='transaction_list'),
     path('portfolio/upload/', views.portfolio_upload_view, name='portfolio_upload'),
     path('mapping/upload/', views.mapping_upload_view, name='mapping_upload'),
+    path('mapping/suggestions/', views.mapping_suggestions_view, name='mapping_suggestions'),
+    path('mapping/suggestions/accept/', views.mapping_suggestions_accept_view, name='mapping_suggestions_accept'),
+    path('upload-errors/<str:report_id>/', views.upload_errors_view, name='upload_errors'),
     path('export/companies/', views.export_companies_view, name='export_companies'),
     path('export/share-names/', views.export_share_names_view, name='export_share_names'),
     path('export/transactions/', views.export_transactions_view, name='export_transactions'),
+    path('performance/', views.share_performance_list_view, name='share_performance_list'),
+    path('holdings/', views.holdings_snapshot_view, name='holdings_snapshot'),
+    path('holdings/series/', views.holdings_series_view, name='holdings_series'),
+    path('holdings/totals/', views.holdings_totals_view, name='holdings_totals'),
+    path('positions/', views.positions_view, name='positions'),
+    # Async (ASGI) read endpoints: same parameters and payloads, see async_views.py
+    path('async/transactions/', async_views.transaction_list_view, name='async_transaction_list'),
+    path('async/export/companies/', async_views.export_companies_view, name='async_export_companies'),
+    path('async/export/share-names/', async_views.export_share_names_view, name='async_export_share_names'),
+    path('async/performance/', async_views.share_performance_list_view, name='async_share_performance_list'),
+    path('async/holdings/', async_views.holdings_snapshot_view, name='async_holdings_snapshot'),
+    path('async/holdings/series/', async_views.holdings_series_view, name='async_holdings_series'),
+    path('async/holdings/totals/', async_views.holdings_totals_view, name='async_holdings_totals'),
+    path('async/positions/', async_views.positions_view, name='async_positions'),
 ]
 
@@ -0,0 +1,207 @@
+"""
+Column-wise validation of uploaded statement rows, and the error reports it produces.
+
+validate_columns() checks whole columns at once - required fields, number and date
+parseability, numeric range (what the model's DecimalField can store) - and returns
+the parsed columns, the mask of rows to load and an error frame with one row per
+problem: row (the Excel row number), column, reason and value. The parsers' row
+loops only see the valid rows, so a file with thousands of bad rows costs about
+the same to parse as a clean one.
+
+An import with errors keeps its error frame as a report (a CSV file in
+INVESTEC_UPLOAD_ERROR_DIR, see save_error_report); the upload response carries the
+first ERROR_PREVIEW errors and the report id, and the upload-errors endpoint pages
+through or downloads the rest. Only the newest INVESTEC_UPLOAD_ERROR_KEEP reports
+are kept.
+
+Every parser that imports this module already has pandas loaded.
+"""
+import os
+import re
+import uuid
+from datetime import datetime
+
+import pandas as pd
+from django.conf import settings
+
+
+ERROR_COLUMNS = ['row', 'column', 'reason', 'value']
+
+# Errors included in an import result; the rest are read from the report
+ERROR_PREVIEW = 50
+
+# Creation time (to the microsecond; older reports have seconds only) and a random suffix
+_REPORT_ID = re.compile(r'^[0-9]{8}T[0-9]{6}(?:[0-9]{6})?-[0-9a-f]{8}$')
+
+
+def empty_errors():
+    return pd.DataFrame({column: pd.Series(dtype='int64' if column == 'row' else 'object') for column in ERROR_COLUMNS})
+
+
+def decimal_limit(model, field_name):
+    """Smallest absolute value that does not fit the model's DecimalField (its integer digits)."""
+    field = model._meta.get_field(field_name)
+    return 10 ** (field.max_digits - field.decimal_places)
+
+
+def parse_numbers(values, clean=False):
+    """
+    The column as floats, NaN where a value is missing or not a number. clean=True
+    first drops spaces and thousands separators from text cells (" 1 959.00").
+    """
+    if clean and values.dtype == object:
+        # .str gives NaN for the cells that are not text, which keep their value
+        cleaned = values.str.replace(r'[\s,]', '', regex=True)
+        values = cleaned.where(cleaned.notna(), values)
+    return pd.to_numeric(values, errors='coerce')
+
+
+def parse_dates(values):
+    """The column as Timestamps, NaT where a value is missing or not a date (each text cell's format is inferred)."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, errors='coerce', format='mixed')
+
+
+def is_blank(values):
+    """Missing cells and text cells holding only whitespace."""
+    blank = values.isna()
+    if values.dtype == object:
+        blank |= values.astype(str).str.strip().eq('')
+    return blank
+
+
+def validate_columns(df, rules, skip=None, first_row=2):
+    """
+    Validate the columns of df named by rules.
+
+    rules: list of dicts with
+    - 'column': the column in df
+    - 'label': the column name reported in errors (default: column)
+    - 'kind': 'date', 'number' or 'text'
+    - 'required': a missing value is an error (default True); otherwise it is None
+    - 'limit' (numbers): values with an absolute value >= limit are out of range
+    - 'clean' (numbers): see parse_numbers
+    skip: mask of rows that are not data (headers, totals) - neither loaded nor errors.
+    first_row: Excel row number of df's first row.
+
+    Returns (parsed, valid, errors): parsed maps each rule's column to its parsed
+    Series (Timestamps, floats, or the text cells), valid is the mask of rows to load,
+    errors the error frame (ERROR_COLUMNS), ordered by row.
+    """
+    if skip is None:
+        skip = pd.Series(False, index=df.index)
+    parsed = {}
+    problems = []
+    failed = pd.Series(False, index=df.index)
+
+    for rule in rules:
+        column = rule['column']
+        label = rule.get('label', column)
+        values = df[column]
+        missing = is_blank(values)
+        if rule['kind'] == 'date':
+            parsed[column] = parse_dates(values)
+            invalid = parsed[column].isna() & ~missing
+            reason = 'not a date'
+        elif rule['kind'] == 'number':
+            parsed[column] = parse_numbers(values, clean=rule.get('clean', False))
+            invalid = parsed[column].isna() & ~missing
+            reason = 'not a number'
+            limit = rule.get('limit')
+            if limit is not None:
+                out_of_range = parsed[column].abs() >= limit
+                problems.append((out_of_range & ~skip, column, label, f'out of range (must be below {limit:g} in absolute value)'))
+                failed |= out_of_range
+        else:
+            parsed[column] = values
+            invalid = pd.Series(False, index=df.index)
+            reason = None
+
+        if rule.get('required', True):
+            problems.append((missing & ~skip, column, label, 'missing'))
+            failed |= missing
+        if reason:
+            problems.append((invalid & ~skip, column, label, reason))
+            failed |= invalid
+
+    frames = [
+        pd.DataFrame({
+            'row': df.index[mask] + first_row,
+            'column': label,
+            'reason': reason,
+            'value': df.loc[mask, column].astype(str).where(df.loc[mask, column].notna(), '').to_numpy(),
+        })
+        for mask, column, label, reason in problems if mask.any()
+    ]
+    errors = pd.concat(frames, ignore_index=True).sort_values('row', kind='stable', ignore_index=True) if frames else empty_errors()
+    return parsed, ~skip & ~failed, errors
+
+
+def error_records(errors, offset=0, limit=ERROR_PREVIEW):
+    """A page of an error frame as JSON-ready dicts."""
+    page = errors.iloc[offset:offset + limit]
+    return [
+        {'row': int(row), 'column': column, 'reason': reason, 'value': value}
+        for row, column, reason, value in page[ERROR_COLUMNS].itertuples(index=False, name=None)
+    ]
+
+
+# ------------------------------------------------
+# Error reports
+# ------------------------------------------------
+
+def _report_path(report_id):
+    return os.path.join(settings.INVESTEC_UPLOAD_ERROR_DIR, f'{report_id}.csv')
+
+
+def save_error_report(errors, filename):
+    """Write an error frame as a report, evict the oldest reports and return the report id."""
+    directory = settings.INVESTEC_UPLOAD_ERROR_DIR
+    os.makedirs(directory, exist_ok=True)
+    report_id = f'{datetime.now():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+    report = errors[ERROR_COLUMNS].copy()
+    report.insert(0, 'file', filename)
+    # Write then rename so a reader never sees a partial report
+    path = _report_path(report_id)
+    report.to_csv(f'{path}.tmp', index=False)
+    os.replace(f'{path}.tmp', path)
+    evict_error_reports(directory, settings.INVESTEC_UPLOAD_ERROR_KEEP)
+    return report_id
+
+
+def error_report_path(report_id):
+    """Path of a stored report, or None for an unknown (or malformed) report id."""
+    if not _REPORT_ID.match(report_id):
+        return None
+    path = _report_path(report_id)
+    return path if os.path.exists(path) else None
+
+
+def load_error_report(report_id):
+    path = error_report_path(report_id)
+    if path is None:
+        return None
+    return pd.read_csv(path, dtype={'file': str, 'column': str, 'reason': str, 'value': str}, keep_default_na=False)
+
+
+def evict_error_reports(directory, keep):
+    # Report ids start with their creation time, so they sort oldest first
+    reports = sorted(name for name in os.listdir(directory) if name.endswith('.csv'))
+    for name in reports[:max(len(reports) - keep, 0)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def summarize_errors(errors, filename):
+    """
+    The 'errors', 'error_details' and 'error_report' entries of an import result: the
+    error count, the first ERROR_PREVIEW errors and, when there are errors, the id of
+    the report holding all of them.
+    """
+    summary = {'errors': len(errors), 'error_details': error_records(errors)}
+    if len(errors):
+        summary['error_report'] = save_error_report(errors, filename)
+    return summary
@@ -1,20 +1,31 @@
-import pandas as pd
-import re
-import os
+import base64
+import binascii
+import hmac
+import ipaddress
 from datetime import datetime
-import traceback
+from itertools import groupby
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework import status
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q
+from django.http import FileResponse, HttpResponse, HttpResponseForbidden
+from django.db import connection
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
 from django.utils.dateparse import parse_date
-from decimal import Decimal, InvalidOperation
 
-from .models import InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareNameMapping, InvestecJseShareMonthlyPerformance
-from .serializers import InvestecJseTransactionSerializer, InvestecJsePortfolioSerializer, InvestecJseShareNameMappingSerializer
+from .instrumentation import StageTimer
+from .memory import MemoryTracker, admit_upload
+from .metrics import render_metrics
+from .ttm import live_dividend_ttm
+from .ledger import holdings_as_of
+from .models import TTM_SUMMARY, InvestecJseTransaction, InvestecJsePortfolio, InvestecJseShareMonthlyPerformance
+from .serializers import InvestecJseTransactionSerializer, PERFORMANCE_FIELDS, HOLDINGS_SNAPSHOT_FIELDS, HOLDINGS_SERIES_FIELDS, serialize_values, serialize_columns
+
+# The import pipeline (importers: pandas, numpy, openpyxl) is imported by the upload
+# and export views when they run, so loading the URLconf (every manage.py command,
+# worker boot and test run) and the read endpoints stay free of it
 
 
 
@@ -22,295 +33,41 @@ from .serializers import InvestecJseTransactionSerializer, InvestecJsePortfolioS
 # Import Transaction Data
 # ------------------------------------------------
 
-def calculate_dividend_ttm(transactions_to_create):
-    """
-    Calculate trailing 12-month (TTM) dividend sum for each transaction.
-    Calculates TTM separately for each dividend type (Dividend, Special Dividend, Foreign Dividend).
-    
-    Steps:
-    1. Get all existing dividend transactions from database
-    2. Combine with new transactions being uploaded
-    3. Filter to dividend types
-    4. Group by share_name AND dividend_type, then resample to monthly (month-end)
-    5. Fill missing months with 0
-    6. Calculate rolling 12-month sum
-    7. Store TTM summary records in database for all months (even months without dividends)
-    8. Return lookup dictionary: (share_name, dividend_type, year, month) -> dividend_ttm
+TTM_READ_MODES = ['stored', 'live']
+
+
+def _ttm_read_mode(params):
+    """Return the requested TTM read mode (?ttm=stored|live), defaulting to settings.INVESTEC_TTM_READ_MODE."""
+    mode = params.get('ttm', settings.INVESTEC_TTM_READ_MODE).lower()
+    if mode not in TTM_READ_MODES:
+        raise ValueError(f'Invalid ttm mode: {mode}. Expected one of: {", ".join(TTM_READ_MODES)}.')
+    return mode
+
+
+def _wants_timings(request):
+    """?timings=true adds the per-stage timing breakdown to upload responses."""
+    return request.query_params.get('timings', 'false').lower() == 'true'
+
+
+def _run_upload(kind, process, uploaded_file, request):
     """
-    # Dividend types to include
-    dividend_types = ['Dividend', 'Special Dividend', 'Foreign Dividend', 'Dividend Tax']
-    
-    # Get all existing dividend transactions from database
-    # Exclude TTM summary records (they have quantity=0, value=0, description starts with 'TTM Summary') as we only want actual transactions
-    # Use Q object to ensure proper exclusion: exclude records where ALL three conditions are true
-    existing_dividends = InvestecJseTransaction.objects.filter(
-        type__in=dividend_types,
-        share_name__isnull=False
-    ).exclude(share_name='').exclude(
-        Q(quantity=0) & Q(value=0) & Q(description__startswith='TTM Summary')
-    ).values('date', 'share_name', 'type', 'value', 'account_number', 'year', 'month')
-    
-    # Convert to list of dicts for pandas
-    existing_data = [
-        {
-            'date': item['date'],
-            'share_name': item['share_name'],
-            'dividend_type': item['type'],  # Include dividend type
-            'value': float(item['value']),
-            'account_number': item['account_number'],
-            'year': item['year'],
-            'month': item['month']
-        }
-        for item in existing_dividends
-    ]
+    Admission-check, import and measure one uploaded file.
     
-    # Add new transactions being uploaded (only dividend types with share_name)
-    # Exclude TTM summary records: they have quantity=0, value=0, and description starts with 'TTM Summary'
-    new_dividends = []
-    for txn in transactions_to_create:
-        if (txn.type in dividend_types and 
-            txn.share_name and txn.share_name.strip() and
-            not (txn.quantity == 0 and txn.value == 0 and txn.description.startswith('TTM Summary'))):
-            new_dividends.append({
-                'date': txn.date,
-                'share_name': txn.share_name,
-                'dividend_type': txn.type,  # Include dividend type
-                'value': float(txn.value),
-                'account_number': txn.account_number,
-                'year': txn.year,
-                'month': txn.month
-            })
-    
-    # Combine existing and new
-    all_dividends = existing_data + new_dividends
-    
-    if not all_dividends:
-        return {}  # No dividends to process
-    
-    # Create DataFrame immediately after combining existing and new records
-    # This is critical: we must convert to DataFrame before any aggregation to enable deduplication
-    df = pd.DataFrame(all_dividends)
-    
-    # CRITICAL: Ensure we exclude any TTM summary records that might have slipped through
-    # TTM summary records have value=0, but we also check account_number if available
-    # Filter out any records where value is 0 (TTM summary records have value=0)
-    # However, we need to be careful: actual dividend transactions should never have value=0
-    # So filtering by value != 0 should be safe
-    if 'value' in df.columns:
-        df = df[df['value'] != 0]
-    
-    # CRITICAL: Remove duplicates immediately after DataFrame creation, BEFORE any aggregation/summing operations.
-    # This prevents double-counting when uploading files that overlap with existing database records.
-    # If a transaction exists in both the database and the upload file, we keep only the first occurrence.
-    # Deduplication is based on: share_name, dividend_type, date, and value (to identify unique transactions).
-    df = df.drop_duplicates(subset=['share_name', 'dividend_type', 'date', 'value'], keep='first')
-    
-    # Convert date to datetime if needed
-    if 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
-    
-    # Group by share_name AND dividend_type, then process each group
-    ttm_lookup = {}
-    # Store TTM values per share_name AND dividend_type (separate records per dividend type)
-    share_ttm_data = {}  # {(share_name, dividend_type, year, month): {'ttm': ttm_value, 'account_number': account_number}}
-    
-    for (share_name, dividend_type), group_df in df.groupby(['share_name', 'dividend_type']):
-        # Get the account_number from the first transaction in this group
-        # All transactions for the same share/dividend_type should have the same account_number
-        account_number = group_df['account_number'].iloc[0] if 'account_number' in group_df.columns and len(group_df) > 0 else ''
-        
-        # Sort by date
-        group_df = group_df.sort_values('date')
-        
-        # Set date as index for resampling
-        group_df_indexed = group_df.set_index('date')
-        
-        # Resample to monthly (month-end) and sum dividends per month
-        monthly_df = group_df_indexed.resample('ME').agg({
-            'value': 'sum'
-        })
-        
-        # Fill missing months with 0
-        # Create complete date range from earliest to latest date
-        if len(monthly_df) > 0:
-            min_date = monthly_df.index.min()
-            max_date = monthly_df.index.max()
-            
-            # CRITICAL: Extend max_date to at least the current month-end.
-            # This ensures the rolling TTM calculation runs all the way to the present day.
-            # Without this extension, reports for the current month might show empty/incorrect TTM values
-            # if there hasn't been a recent dividend transaction in the current month.
-            # The rolling window needs complete monthly data up to today to calculate accurate TTM values.
-            current_month_end = pd.Timestamp.now().to_period('M').to_timestamp('M')
-            if max_date < current_month_end:
-                max_date = current_month_end
-            
-            date_range = pd.date_range(start=min_date, end=max_date, freq='ME')
-            
-            # Reindex to fill missing months with 0
-            monthly_df = monthly_df.reindex(date_range, fill_value=0)
-            
-            # Ensure value column exists and is numeric
-            if 'value' not in monthly_df.columns:
-                monthly_df['value'] = 0
-            monthly_df['value'] = pd.to_numeric(monthly_df['value'], errors='coerce').fillna(0)
-            
-            # Calculate rolling 12-month sum (window includes current month)
-            monthly_df['dividend_ttm'] = monthly_df['value'].rolling(window=12, min_periods=1).sum()
-            
-            # Create lookup dictionary: (share_name, dividend_type, year, month) -> dividend_ttm
-            for idx, row in monthly_df.iterrows():
-                # Get year and month from the index (month-end date)
-                year = idx.year
-                month = idx.month
-                
-                # Get TTM value and round to 2 decimal places for clean database storage
-                # Rounding prevents floating-point precision issues and ensures consistent values
-                ttm_value = Decimal(str(round(row['dividend_ttm'], 2)))
-                
-                # Store in lookup with dividend_type included (for transaction-level TTM)
-                ttm_lookup[(share_name, dividend_type, year, month)] = ttm_value
-                
-                # Store TTM per dividend_type (separate records per dividend type)
-                key = (share_name, dividend_type, year, month)
-                share_ttm_data[key] = {
-                    'ttm': ttm_value,
-                    'account_number': account_number
-                }
-    
-    # Now create InvestecJseShareMonthlyPerformance records
-    # Get all unique share_names and date ranges
-    if share_ttm_data:
-        # Get portfolio data to find closing prices
-        # Map share_name to share_code using InvestecJseShareNameMapping
-        share_name_to_code = {}
-        mappings = InvestecJseShareNameMapping.objects.filter(
-            share_name__in=[key[0] for key in share_ttm_data.keys()]
-        ).values('share_name', 'share_code')
-        for mapping in mappings:
-            if mapping['share_code']:
-                share_name_to_code[mapping['share_name']] = mapping['share_code']
-        
-        # Get portfolio data (quantity, price, total_value) for all relevant dates
-        # Keys are (share_name, dividend_type, year, month), so we need key[2] and key[3] for year and month
-        all_dates = set((key[2], key[3]) for key in share_ttm_data.keys())  # (year, month) tuples from (share_name, dividend_type, year, month)
-        portfolio_data = {}  # {(share_code, year, month): {'quantity': qty, 'price': price, 'total_value': total_value}}
-        
-        # Get current year and month for comparison
-        current_date = datetime.now()
-        current_year = current_date.year
-        current_month = current_date.month
-        
-        for (year, month) in all_dates:
-            # Check if this is the current month
-            is_current_month = (year == current_year and month == current_month)
-            
-            if is_current_month:
-                # For current month: Get the latest portfolio data within that month
-                # Get all portfolio records for this month, then get the latest one per share_code
-                all_portfolios = InvestecJsePortfolio.objects.filter(
-                    year=year,
-                    month=month
-                ).values('share_code', 'quantity', 'price', 'total_value', 'date').order_by('share_code', '-date')
-                
-                # Group by share_code and take the first (latest) record for each
-                latest_by_share = {}
-                for portfolio in all_portfolios:
-                    share_code = portfolio['share_code']
-                    if share_code not in latest_by_share:
-                        latest_by_share[share_code] = portfolio
-                
-                # Store the latest data for each share_code
-                for share_code, portfolio in latest_by_share.items():
-                    portfolio_data[(share_code, year, month)] = {
-                        'quantity': Decimal(str(portfolio['quantity'])),
-                        'price': Decimal(str(portfolio['price'])),
-                        'total_value': Decimal(str(portfolio['total_value']))
-                    }
-            else:
-                # For historical months: Get portfolio data for month-end date
-                # NOTE: pandas Timestamp is picky: if `year` is a string it treats it as a date string input
-                # and then passing additional date parts triggers:
-                # "Cannot pass a date attribute keyword argument when passing a date string; 'tz' is keyword-only"
-                # So we coerce year/month to int and use keyword args.
-                month_end = pd.Timestamp(year=int(year), month=int(month), day=1).to_period('M').to_timestamp('M').date()
-                
-                portfolios = InvestecJsePortfolio.objects.filter(
-                    date=month_end
-                ).values('share_code', 'quantity', 'price', 'total_value')
-                
-                for portfolio in portfolios:
-                    portfolio_data[(portfolio['share_code'], year, month)] = {
-                        'quantity': Decimal(str(portfolio['quantity'])),
-                        'price': Decimal(str(portfolio['price'])),
-                        'total_value': Decimal(str(portfolio['total_value']))
-                    }
-        
-        # Create InvestecJseShareMonthlyPerformance records
-        performance_records = []
-        
-        for (share_name, dividend_type, year, month), data in share_ttm_data.items():
-            ttm_value = data['ttm']
-            account_number = data['account_number']
-            # Coerce year/month to int for the same reason as above (pandas Timestamp parsing).
-            month_end_date = pd.Timestamp(year=int(year), month=int(month), day=1).to_period('M').to_timestamp('M').date()
-            
-            # Get portfolio data (quantity, price, total_value) from portfolio if available
-            closing_price = None
-            quantity = None
-            total_market_value = None
-            share_code = share_name_to_code.get(share_name)
-            if share_code:
-                portfolio_info = portfolio_data.get((share_code, year, month))
-                if portfolio_info:
-                    closing_price = portfolio_info['price']
-                    quantity = portfolio_info['quantity']
-                    total_market_value = portfolio_info['total_value']
-            
-            # Calculate dividend yield: Dividend Yield = Total Dividend Cash Received TTM / Total Market Value
-            # Total Market Value = Quantity × Price (from portfolio)
-            # If no portfolio data exists for a month, set dividend_yield = 0
-            dividend_yield = Decimal('0')  # Default to 0 if no portfolio data
-            if total_market_value and total_market_value > 0 and ttm_value > 0:
-                dividend_yield = (ttm_value / total_market_value)
-            
-            performance_records.append(
-                InvestecJseShareMonthlyPerformance(
-                    share_name=share_name,
-                    date=month_end_date,
-                    year=year,
-                    month=month,
-                    dividend_type=dividend_type,
-                    investec_account=account_number,
-                    dividend_ttm=ttm_value,
-                    closing_price=closing_price,
-                    quantity=quantity,
-                    total_market_value=total_market_value,
-                    dividend_yield=dividend_yield,
-                )
-            )
-        
-        # Store InvestecJseShareMonthlyPerformance records using bulk operations
-        # Delete existing records for these shares/dates/dividend_types, then bulk create new ones
-        if performance_records:
-            # Get unique share_names, dividend_types, and date range
-            share_names = list(set(rec.share_name for rec in performance_records))
-            dividend_types = list(set(rec.dividend_type for rec in performance_records))
-            min_date = min(rec.date for rec in performance_records)
-            max_date = max(rec.date for rec in performance_records)
-            
-            # Delete existing records for this date range and dividend types
-            InvestecJseShareMonthlyPerformance.objects.filter(
-                share_name__in=share_names,
-                dividend_type__in=dividend_types,
-                date__gte=min_date,
-                date__lte=max_date
-            ).delete()
-            
-            # Bulk create new records
-            InvestecJseShareMonthlyPerformance.objects.bulk_create(performance_records, ignore_conflicts=False)
-    
-    return ttm_lookup
+    Files over the memory budget are rejected or queued before parsing (see
+    investec/memory.py). Otherwise returns the importer result with the peak memory
+    of the import ('memory') and, with ?timings=true, the stage timings.
+    """
+    result = admit_upload(uploaded_file)
+    if result is not None:
+        return result
+    timer = StageTimer(kind)
+    with MemoryTracker(kind) as memory:
+        result = process(uploaded_file, timer=timer)
+    timings = timer.log(file=uploaded_file.name, success=result['success'])
+    if _wants_timings(request):
+        result['timings'] = timings
+    result['memory'] = memory.report()
+    return result
 
 
 @api_view(['POST'])
@@ -320,7 +77,9 @@ def excel_upload_view(request):
     API endpoint to upload Excel file and import transactions.
     
     Accepts POST request with 'file' field containing Excel file.
-    Returns import statistics and any errors encountered.
+    Returns import statistics, the peak memory of the import and any errors encountered.
+    With ?timings=true the response includes a per-stage timing breakdown.
+    Files over the upload memory budget are rejected (413) or queued (202) before parsing.
     """
     if 'file' not in request.FILES:
         return Response(
@@ -328,637 +87,98 @@ def excel_upload_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    from .importers import FILE_TRANSACTIONS, process_transaction_file
+    
     uploaded_file = request.FILES['file']
     
-    # Validate file extension
-    if not uploaded_file.name.endswith(('.xlsx', '.xls')):
-        return Response(
-            {'error': 'Invalid file format. Please upload an Excel file (.xlsx or .xls).'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+    result = _run_upload(FILE_TRANSACTIONS, process_transaction_file, uploaded_file, request)
+    status_code = result.pop('status_code', None)
+    if not result['success']:
+        result.pop('success')
+        result.pop('filename')
+        return Response(result, status=status_code)
+    if result.get('queued'):
+        return Response(result, status=status_code)
     
-    try:
-        # Read Excel file - try to find header row
-        # First, read without header to inspect structure
-        df_raw = pd.read_excel(uploaded_file, header=None)
-        
-        # Find header row (look for row containing 'Date' and 'Account Number')
-        header_row = None
-        for idx, row in df_raw.iterrows():
-            row_str = ' '.join([str(val).lower() for val in row.values if pd.notna(val)])
-            if 'date' in row_str and 'account' in row_str:
-                header_row = idx
-                break
-        
-        # If header row found, read with that row as header
-        if header_row is not None:
-            # Read with header_row as column names - pandas automatically starts data from next row
-            df = pd.read_excel(uploaded_file, header=header_row)
-        else:
-            # Fallback: read normally and try to detect columns
-            df = pd.read_excel(uploaded_file)
-        
-        # Normalize column names (remove spaces, convert to lowercase)
-        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_')
-        
-        # Map common column name variations to model fields
-        column_mapping = {
-            'date': ['date', 'transaction_date', 'trade_date'],
-            'account_number': ['account_number', 'account', 'account_no', 'accountnum'],
-            'description': ['description', 'desc', 'details'],
-            'share_name': ['share_name', 'sharename', 'stock_name', 'stock', 'instrument', 'security', 'share_name'],
-            'type': ['type', 'action', 'transaction_type', 'transaction', 'side'],
-            'quantity': ['quantity', 'qty', 'shares', 'units'],
-            'value': ['value', 'amount', 'price', 'total', 'transaction_value'],
-        }
-        
-        # Find actual column names in the dataframe
-        actual_columns = {}
-        for model_field, possible_names in column_mapping.items():
-            for possible_name in possible_names:
-                if possible_name in df.columns:
-                    actual_columns[model_field] = possible_name
-                    break
-        
-        # Check if all required columns are found (type can be extracted from description)
-        required_fields = ['date', 'account_number', 'description', 'share_name', 'quantity', 'value']
-        missing_fields = [field for field in required_fields if field not in actual_columns]
-        
-        if missing_fields:
-            return Response(
-                {
-                    'error': f'Missing required columns: {", ".join(missing_fields)}',
-                    'available_columns': list(df.columns),
-                    'suggestion': 'Please ensure your Excel file contains columns matching: date, account_number, description, share_name, quantity, value'
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Extract date range from filename (format: TransactionHistory-All-YYYYMMDD-YYYYMMDD.xlsx)
-        from_date = None
-        to_date = None
-        
-        filename = uploaded_file.name
-        # Try to extract dates from filename pattern: ...-YYYYMMDD-YYYYMMDD...
-        date_pattern = re.search(r'(\d{8})-(\d{8})', filename)
-        if date_pattern:
-            try:
-                from_date_str = date_pattern.group(1)
-                to_date_str = date_pattern.group(2)
-                from_date = pd.to_datetime(from_date_str, format='%Y%m%d').date()
-                to_date = pd.to_datetime(to_date_str, format='%Y%m%d').date()
-            except:
-                pass
-        
-        # If not found in filename, try to find dates in the Excel file itself
-        if from_date is None or to_date is None:
-            # Look for "From" and "To" date patterns in the raw data
-            for idx, row in df_raw.iterrows():
-                row_str = ' '.join([str(val) for val in row.values if pd.notna(val)])
-                row_lower = row_str.lower()
-                
-                # Look for "from date" or "to date" patterns
-                if 'from' in row_lower and 'date' in row_lower:
-                    # Try to extract date from this row
-                    for cell_val in row.values:
-                        if pd.notna(cell_val):
-                            cell_str = str(cell_val).strip()
-                            # Try various date formats
-                            for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
-                                try:
-                                    parsed_date = pd.to_datetime(cell_str, format=date_format).date()
-                                    if from_date is None:
-                                        from_date = parsed_date
-                                    elif to_date is None and parsed_date > from_date:
-                                        to_date = parsed_date
-                                    break
-                                except:
-                                    try:
-                                        parsed_date = pd.to_datetime(cell_str).date()
-                                        if from_date is None:
-                                            from_date = parsed_date
-                                        elif to_date is None and parsed_date > from_date:
-                                            to_date = parsed_date
-                                        break
-                                    except:
-                                        continue
-                
-                if 'to' in row_lower and 'date' in row_lower:
-                    # Try to extract date from this row
-                    for cell_val in row.values:
-                        if pd.notna(cell_val):
-                            cell_str = str(cell_val).strip()
-                            # Try various date formats
-                            for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
-                                try:
-                                    parsed_date = pd.to_datetime(cell_str, format=date_format).date()
-                                    if to_date is None or parsed_date > to_date:
-                                        to_date = parsed_date
-                                    break
-                                except:
-                                    try:
-                                        parsed_date = pd.to_datetime(cell_str).date()
-                                        if to_date is None or parsed_date > to_date:
-                                            to_date = parsed_date
-                                        break
-                                    except:
-                                        continue
-                
-                # Stop searching after finding both dates or after checking first 20 rows
-                if from_date and to_date or idx > 20:
-                    break
-        
-        # Clear existing transactions only for the date range being uploaded
-        if from_date and to_date:
-            deleted_count = InvestecJseTransaction.objects.filter(
-                date__gte=from_date,
-                date__lte=to_date
-            ).delete()[0]
-        else:
-            # If we can't determine the date range, don't delete anything
-            # This is safer than deleting all transactions
-            deleted_count = 0
-        
-        # Prepare data for bulk creation
-        transactions_to_create = []
-        errors = []
-        
-        for index, row in df.iterrows():
-            try:
-                # Parse date
-                date_value = row[actual_columns['date']]
-                
-                # Skip rows with empty date (header rows that might have been included)
-                if pd.isna(date_value) or (isinstance(date_value, str) and str(date_value).strip() == ''):
-                    continue
-                
-                # Handle different date formats
-                if isinstance(date_value, str):
-                    parsed_date = parse_date(date_value)
-                    if not parsed_date:
-                        # Try pandas to_datetime
-                        try:
-                            parsed_date = pd.to_datetime(date_value).date()
-                        except:
-                            errors.append(f'Row {index + 2}: Invalid date format: {date_value}')
-                            continue
-                elif isinstance(date_value, pd.Timestamp):
-                    parsed_date = date_value.date()
-                elif hasattr(date_value, 'date'):  # datetime object
-                    parsed_date = date_value.date()
-                else:
-                    # Try to convert to date
-                    try:
-                        parsed_date = pd.to_datetime(date_value).date()
-                    except:
-                        errors.append(f'Row {index + 2}: Invalid date format: {date_value}')
-                        continue
-                
-                # Parse quantity
-                quantity_value = row[actual_columns['quantity']]
-                if pd.isna(quantity_value):
-                    errors.append(f'Row {index + 2}: Quantity is missing')
-                    continue
-                try:
-                    quantity = Decimal(str(quantity_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + 2}: Invalid quantity value: {quantity_value}')
-                    continue
-                
-                # Get description early to check for dividend patterns
-                description_val = row[actual_columns['description']]
-                description = str(description_val)[:255] if not pd.isna(description_val) else ''
-                
-                # For dividends, quantity might be in description
-                # Patterns: "DIV. 327 NINETY 1L" -> quantity is 327
-                #          "FOREIGN DIV. 3061 BATS" -> quantity is 3061
-                #          "DIV. TAX ON 74 NINETY 1L" -> quantity is 74
-                #          "SPEC.DIV. 1229 OUTSURE" -> quantity is 1229
-                if quantity == 0 and description:
-                    description_upper = description.upper()
-                    if 'FOREIGN DIV' in description_upper:
-                        # Extract quantity from pattern like "FOREIGN DIV. 3061 BATS"
-                        foreign_div_match = re.search(r'FOREIGN\s+DIV\.?\s*(\d+)', description, re.IGNORECASE)
-                        if foreign_div_match:
-                            try:
-                                quantity = Decimal(foreign_div_match.group(1))
-                            except (InvalidOperation, ValueError):
-                                pass  # Keep original quantity if extraction fails
-                    elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
-                        # Extract quantity from pattern like "SPEC.DIV. 1229 OUTSURE"
-                        spec_div_match = re.search(r'SPEC(?:IAL)?\.?\s*DIV(?:IDEND)?\.?\s*(\d+)', description, re.IGNORECASE)
-                        if spec_div_match:
-                            try:
-                                quantity = Decimal(spec_div_match.group(1))
-                            except (InvalidOperation, ValueError):
-                                pass  # Keep original quantity if extraction fails
-                    elif 'DIV. TAX' in description_upper or 'DIVIDEND TAX' in description_upper:
-                        # Extract quantity from pattern like "DIV. TAX ON 74 NINETY 1L"
-                        div_tax_match = re.search(r'DIV\.?\s*TAX\s+ON\s+(\d+)', description, re.IGNORECASE)
-                        if div_tax_match:
-                            try:
-                                quantity = Decimal(div_tax_match.group(1))
-                            except (InvalidOperation, ValueError):
-                                pass  # Keep original quantity if extraction fails
-                    elif description_upper.startswith('DIV'):
-                        # Extract quantity from pattern like "DIV. 327 NINETY 1L"
-                        div_match = re.search(r'DIV\.?\s*(\d+)', description, re.IGNORECASE)
-                        if div_match:
-                            try:
-                                quantity = Decimal(div_match.group(1))
-                            except (InvalidOperation, ValueError):
-                                pass  # Keep original quantity if extraction fails
-                
-                # Parse value
-                value_value = row[actual_columns['value']]
-                if pd.isna(value_value):
-                    errors.append(f'Row {index + 2}: Value is missing')
-                    continue
-                try:
-                    value = Decimal(str(value_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + 2}: Invalid value: {value_value}')
-                    continue
-                
-                # Get other fields
-                # Account number - handle both string and numeric values
-                account_number_val = row[actual_columns['account_number']]
-                if pd.isna(account_number_val):
-                    account_number = ''
-                else:
-                    # Convert to string, handling numeric values
-                    account_number = str(int(account_number_val)) if isinstance(account_number_val, (int, float)) else str(account_number_val)
-                    account_number = account_number[:50]
-                
-                # Share name - try to extract from description if missing
-                share_name_val = row[actual_columns['share_name']]
-                if pd.isna(share_name_val) or str(share_name_val).strip() == '':
-                    # Try to extract share name from description
-                    if description:
-                        description_upper = description.upper()
-                        # For foreign dividends: "FOREIGN DIV. 3061 BATS" -> extract "BATS"
-                        #                      "FOREIGN DIV. 123 A V I" -> extract "A V I" and convert to "AVI"
-                        if 'FOREIGN DIV' in description_upper:
-                            # Try to match spaced letters first (e.g., "A V I" -> "AVI")
-                            foreign_spaced_match = re.search(r'FOREIGN\s+DIV\.?\s*\d+\s+((?:[A-Z]\s+)+[A-Z])', description, re.IGNORECASE)
-                            if foreign_spaced_match:
-                                # Remove spaces from spaced letters (e.g., "A V I" -> "AVI")
-                                spaced_name = foreign_spaced_match.group(1)
-                                share_name = spaced_name.replace(' ', '').upper()[:100]
-                            else:
-                                # Try regular word pattern
-                                foreign_div_share_match = re.search(r'FOREIGN\s+DIV\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
-                                if foreign_div_share_match:
-                                    share_name = foreign_div_share_match.group(1).upper()[:100]
-                                else:
-                                    # Fallback: look for uppercase words after the number
-                                    words = description.split()
-                                    found_number = False
-                                    for word in words:
-                                        if word.isdigit():
-                                            found_number = True
-                                        elif found_number and word.isupper() and len(word) > 2:
-                                            share_name = word[:100]
-                                            break
-                                    else:
-                                        share_name = ''
-                        # For special dividends: "SPEC.DIV. 1229 OUTSURE" -> extract "OUTSURE"
-                        elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
-                            # Extract share name from pattern like "SPEC.DIV. 1229 OUTSURE"
-                            spec_div_share_match = re.search(r'SPEC(?:IAL)?\.?\s*DIV(?:IDEND)?\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
-                            if spec_div_share_match:
-                                share_name = spec_div_share_match.group(1).upper()[:100]
-                            else:
-                                # Fallback: look for uppercase words after the number
-                                words = description.split()
-                                found_number = False
-                                for word in words:
-                                    if word.isdigit():
-                                        found_number = True
-                                    elif found_number and word.isupper() and len(word) > 2:
-                                        share_name = word[:100]
-                                        break
-                                else:
-                                    share_name = ''
-                        # For regular dividends: "DIV. 327 NINETY 1L" -> extract "NINETY"
-                        #                    "DIV. 446 A V I" -> extract "A V I" and convert to "AVI"
-                        #                    "DIV. TAX ON 74 NINETY 1L" -> extract "NINETY"
-                        elif description_upper.startswith('DIV'):
-                            # Handle "DIV. TAX ON" pattern: "DIV. TAX ON 74 NINETY 1L" -> "NINETY"
-                            div_tax_match = re.search(r'DIV\.?\s*TAX\s+ON\s+\d+\s+(\w+)', description, re.IGNORECASE)
-                            if div_tax_match:
-                                share_name = div_tax_match.group(1).upper()[:100]
-                            else:
-                                # Try to match spaced letters first (e.g., "A V I" -> "AVI")
-                                spaced_letters_match = re.search(r'DIV\.?\s*\d+\s+((?:[A-Z]\s+)+[A-Z])', description, re.IGNORECASE)
-                                if spaced_letters_match:
-                                    # Remove spaces from spaced letters (e.g., "A V I" -> "AVI")
-                                    spaced_name = spaced_letters_match.group(1)
-                                    share_name = spaced_name.replace(' ', '').upper()[:100]
-                                else:
-                                    # Try regular word pattern (e.g., "DIV. 327 NINETY 1L" -> "NINETY")
-                                    div_share_match = re.search(r'DIV\.?\s*\d+\s+(\w+)', description, re.IGNORECASE)
-                                    if div_share_match:
-                                        share_name = div_share_match.group(1).upper()[:100]
-                                    else:
-                                        # Fallback: look for uppercase words
-                                        words = description.split()
-                                        for word in words:
-                                            if word.isupper() and len(word) > 2 and word not in ['DIV', 'DIVIDEND', 'FOREIGN', 'TAX', 'ON']:
-                                                share_name = word[:100]
-                                                break
-                                        else:
-                                            share_name = ''
-                        else:
-                            # For other transactions: "Buy 179 NEDBANK" -> "NEDBANK"
-                            words = description.split()
-                            for word in reversed(words):  # Check from end, as share name is usually at the end
-                                if word.isupper() and len(word) > 2:
-                                    share_name = word[:100]
-                                    break
-                            else:
-                                share_name = ''  # Couldn't extract, use empty
-                    else:
-                        share_name = ''
-                else:
-                    share_name = str(share_name_val)[:100]
-                
-                # Extract type from description if not a separate column
-                if 'type' in actual_columns:
-                    transaction_type = str(row[actual_columns['type']])[:50] if not pd.isna(row[actual_columns['type']]) else ''
-                else:
-                    # Try to extract type from description (e.g., "Buy 179 NEDBANK" -> "Buy")
-                    transaction_type = ''
-                    if description:
-                        description_upper = description.upper()
-                        # Account-related transactions (no share code)
-                        if 'FEE' in description_upper or 'QUARTERLY ADMIN FEE' in description_upper:
-                            transaction_type = 'Fee'
-                        elif 'BROKER' in description_upper:
-                            transaction_type = 'Broker Fee'
-                        elif 'VAT' in description_upper:
-                            transaction_type = 'VAT'
-                        elif 'CAP.REDUC' in description_upper or 'CAPITAL REDUCTION' in description_upper:
-                            transaction_type = 'Capital Reduction'
-                        elif 'INTER A/C TRF' in description_upper or 'INTER ACCOUNT TRANSFER' in description_upper:
-                            transaction_type = 'Inter Account Transfer'
-                        elif 'TRF' in description_upper and ('TO' in description_upper or 'FROM' in description_upper):
-                            # Handle "TRF FROM TRADING TO INCOME", "TRF INCOME TO TRADING", and similar transfer patterns
-                            transaction_type = 'Transfer'
-                        elif 'TRANSFER FROM' in description_upper or 'TRANSFER TO' in description_upper:
-                            # Handle "TRANSFER FROM" and "TRANSFER TO" patterns
-                            transaction_type = 'Transfer'
-                        elif 'INVESTEC BANK' in description_upper or 'BANK TRANSFER' in description_upper:
-                            transaction_type = 'Bank Transfer'
-                        elif 'INTEREST' in description_upper:
-                            transaction_type = 'Interest'
-                        # Check for account number pattern: "10011910139 - MC DIPPENAAR" -> Transfer
-                        elif re.match(r'^\d+\s*-\s*[A-Z\s]+$', description, re.IGNORECASE):
-                            transaction_type = 'Transfer'
-                        # Share-related transactions
-                        elif 'FOREIGN DIV' in description_upper:
-                            transaction_type = 'Foreign Dividend'
-                        elif 'DIV. TAX' in description_upper or 'DIVIDEND TAX' in description_upper:
-                            transaction_type = 'Dividend Tax'
-                        elif 'SPEC.DIV' in description_upper or 'SPECIAL DIV' in description_upper or 'SPECIAL DIVIDEND' in description_upper:
-                            transaction_type = 'Special Dividend'
-                        elif description_upper.startswith('BUY'):
-                            transaction_type = 'Buy'
-                        elif description_upper.startswith('SELL'):
-                            transaction_type = 'Sell'
-                        elif 'DIV' in description_upper or 'DIVIDEND' in description_upper:
-                            transaction_type = 'Dividend'
-                        else:
-                            # Default: take first word as type
-                            transaction_type = description.split()[0][:50] if description.split() else ''
-                
-                # Validate required fields - account_number is always required
-                if not account_number:
-                    errors.append(f'Row {index + 2}: Missing required field (account_number)')
-                    continue
-                
-                # Check if this is an account-related transaction (no share code)
-                # These include: FEE, BROKER, VAT, CAP.REDUC, INTEREST, Bank Transfer, QUARTERLY ADMIN FEE, Transfers
-                is_account_transaction = False
-                if description:
-                    desc_upper = description.upper()
-                    account_keywords = ['FEE', 'BROKER', 'VAT', 'CAP.REDUC', 'CAPITAL REDUCTION', 
-                                       'BANK TRANSFER', 'TRANSFER', 'QUARTERLY ADMIN FEE', 
-                                       'INTER A/C TRF', 'INTER ACCOUNT TRANSFER', 'INVESTEC BANK',
-                                       'TRF FROM', 'TRF TO', 'TRANSFER FROM', 'TRANSFER TO']
-                    is_account_transaction = any(keyword in desc_upper for keyword in account_keywords)
-                    
-                    # Check for "TRF [something] TO [something]" pattern (e.g., "TRF INCOME TO TRADING")
-                    if 'TRF' in desc_upper and 'TO' in desc_upper:
-                        is_account_transaction = True
-                    # Check for "TRF [something] FROM [something]" pattern
-                    if 'TRF' in desc_upper and 'FROM' in desc_upper:
-                        is_account_transaction = True
-                    
-                    # Check for account number pattern: "10011910139 - MC DIPPENAAR"
-                    if re.match(r'^\d+\s*-\s*[A-Z\s]+$', description, re.IGNORECASE):
-                        is_account_transaction = True
-                
-                # Ensure account-related types always have blank share_name
-                account_types = ['VAT', 'Fee', 'Interest', 'Broker Fee', 'Capital Reduction', 
-                                   'Bank Transfer', 'Inter Account Transfer', 'Transfer']
-                if transaction_type in account_types:
-                    share_name = ''  # Force blank share_name for account-related types
-                    is_account_transaction = True
-                
-                # Special case: Transfer patterns should have no share name
-                # Patterns: "TRF FROM TRADING TO INCOME", "TRF INCOME TO TRADING", "TRF TRADING TO INCOME", etc.
-                if description:
-                    desc_upper_transfer = description.upper()
-                    if ('TRF' in desc_upper_transfer and ('TO' in desc_upper_transfer or 'FROM' in desc_upper_transfer)):
-                        share_name = ''
-                        is_account_transaction = True
-                
-                # For account-related transactions, allow empty share_name
-                # For share transactions, use empty string if share_name is missing (model allows blank)
-                if not share_name and not is_account_transaction:
-                    share_name = ''  # Empty string for share transactions without share name (model allows blank)
-                # If it's an account transaction, share_name remains empty
-                
-                # Extract value per share from description for Buy/Sell transactions
-                value_per_share = None
-                value_calculated = None
-                if transaction_type in ['Buy', 'Sell'] and description:
-                    # Pattern: "at 1,192 Cents" or "at 5000 Cents"
-                    price_match = re.search(r'at\s+([\d,]+)\s+Cents', description, re.IGNORECASE)
-                    if price_match:
-                        price_str = price_match.group(1).replace(',', '')
-                        try:
-                            # Convert from cents to rands (divide by 100)
-                            price_cents = Decimal(price_str)
-                            value_per_share = price_cents / Decimal('100')
-                            
-                            # Calculate value_calculated = value_per_share * quantity
-                            value_calculated = value_per_share * quantity
-                            
-                            # Make negative for Buy transactions
-                            if transaction_type == 'Buy':
-                                value_calculated = value_calculated * Decimal('-1')
-                        except (InvalidOperation, ValueError):
-                            pass
-                
-                transactions_to_create.append(
-                    InvestecJseTransaction(
-                        date=parsed_date,
-                        year=parsed_date.year,
-                        month=parsed_date.month,
-                        day=parsed_date.day,
-                        account_number=account_number,
-                        description=description,
-                        share_name=share_name,
-                        type=transaction_type,
-                        quantity=quantity,
-                        value=value,
-                        value_per_share=value_per_share,
-                        value_calculated=value_calculated,
-                    )
-                )
-            except Exception as e:
-                errors.append(f'Row {index + 2}: {str(e)}')
-                continue
-        
-        # Calculate Dividend TTM for all transactions
-        try:
-            ttm_lookup = calculate_dividend_ttm(transactions_to_create)
-        except Exception as e:
-            payload = {
-                'error': f'Error processing file: {str(e)}',
-                'exception_type': type(e).__name__,
-                'context': 'calculate_dividend_ttm(transactions_to_create)',
-                'pandas_version': getattr(pd, '__version__', None),
-            }
-            if getattr(settings, 'DEBUG', False):
-                payload['traceback'] = traceback.format_exc()
-            return Response(payload, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
-        # Dividend types that should have TTM calculated
-        dividend_types = ['Dividend', 'Special Dividend', 'Foreign Dividend', 'Dividend Tax']
-        
-        # Map TTM values to transactions
-        for txn in transactions_to_create:
-            # Only calculate TTM for dividend types with share_name
-            if (txn.type in dividend_types and 
-                txn.share_name and txn.share_name.strip() and 
-                txn.year and txn.month):
-                # Lookup key now includes dividend_type: (share_name, dividend_type, year, month)
-                lookup_key = (txn.share_name, txn.type, txn.year, txn.month)
-                if lookup_key in ttm_lookup:
-                    txn.dividend_ttm = ttm_lookup[lookup_key]
-                else:
-                    txn.dividend_ttm = None
-            else:
-                txn.dividend_ttm = None
-        
-        # Bulk create transactions
-        created_count = 0
-        if transactions_to_create:
-            with transaction.atomic():
-                created_instances = InvestecJseTransaction.objects.bulk_create(
-                    transactions_to_create,
-                    ignore_conflicts=False
-                )
-                created_count = len(created_instances)
-        
-        # Prepare response
-        response_data = {
-            'success': True,
-            'message': f'Successfully imported {created_count} transactions',
-            'deleted_previous': deleted_count,
-            'total_rows': len(df),
-            'created': created_count,
-            'errors': len(errors),
-        }
-        
-        # Add date range information if available
-        if from_date and to_date:
-            response_data['date_range'] = {
-                'from_date': str(from_date),
-                'to_date': str(to_date),
-            }
-            response_data['message'] += f' for date range {from_date} to {to_date}'
-        elif from_date:
-            response_data['date_range'] = {
-                'from_date': str(from_date),
-                'to_date': None,
-            }
-        elif to_date:
-            response_data['date_range'] = {
-                'from_date': None,
-                'to_date': str(to_date),
-            }
-        
-        if errors:
-            response_data['error_details'] = errors[:50]  # Limit to first 50 errors
-            if len(errors) > 50:
-                response_data['error_details'].append(f'... and {len(errors) - 50} more errors')
-        
-        return Response(response_data, status=status.HTTP_201_CREATED if created_count > 0 else status.HTTP_200_OK)
-        
-    except pd.errors.EmptyDataError:
-        return Response(
-            {'error': 'The Excel file is empty.'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
-    except Exception as e:
-        payload = {
-            'error': f'Error processing file: {str(e)}',
-            'exception_type': type(e).__name__,
-            'pandas_version': getattr(pd, '__version__', None),
-        }
-        if getattr(settings, 'DEBUG', False):
-            payload['traceback'] = traceback.format_exc()
-        return Response(payload, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(result, status=status.HTTP_201_CREATED if result['created'] > 0 else status.HTTP_200_OK)
 
 
-@api_view(['GET'])
-def transaction_list_view(request):
-    """
-    API endpoint to list all Investec transactions.
-    
-    Supports query parameters:
-    - limit: Number of records to return (default: 100)
-    - offset: Number of records to skip (default: 0)
-    - account_number: Filter by account number
-    - share_name: Filter by share name
-    - type: Filter by type (Buy, Sell, Dividend, etc.)
-    - include_ttm_summary: Include TTM summary records (default: True). Set to 'false' to exclude TTM summary records.
-    """
+def _transaction_queryset(params):
+    """Transactions filtered by the transaction list query parameters (shared with async_views)."""
     queryset = InvestecJseTransaction.objects.all()
     
     # Filter out TTM summary records by default, unless explicitly requested
     # TTM summary records are identified by quantity=0, value=0, and description starting with 'TTM Summary'
-    include_ttm_summary = request.query_params.get('include_ttm_summary', 'false').lower() == 'true'
+    include_ttm_summary = params.get('include_ttm_summary', 'false').lower() == 'true'
     if not include_ttm_summary:
-        queryset = queryset.exclude(
-            quantity=0,
-            value=0,
-            description__startswith='TTM Summary'
-        )
+        queryset = queryset.exclude(TTM_SUMMARY)
     
     # Apply filters
-    account_number = request.query_params.get('account_number', None)
+    account_number = params.get('account_number', None)
     if account_number:
         queryset = queryset.filter(account_number=account_number)
     
-    share_name = request.query_params.get('share_name', None)
+    share_name = params.get('share_name', None)
     if share_name:
         queryset = queryset.filter(share_name__icontains=share_name)
     
-    transaction_type = request.query_params.get('type', None)
+    share_code = params.get('share_code', None)
+    if share_code:
+        queryset = queryset.filter(share_code=share_code)
+    
+    transaction_type = params.get('type', None)
     if transaction_type:
         queryset = queryset.filter(type__icontains=transaction_type)
     
-    # Apply pagination
-    limit = int(request.query_params.get('limit', 100))
-    offset = int(request.query_params.get('offset', 0))
+    return queryset
+
+
+def _transaction_page(params):
+    """
+    The transaction list's limit and offset (shared with async_views). Raises ValueError
+    with a client-facing message.
+    """
+    try:
+        limit = int(params.get('limit', 100))
+        offset = int(params.get('offset', 0))
+    except ValueError:
+        raise ValueError('limit and offset must be integers.')
+    if limit < 0 or offset < 0:
+        raise ValueError('limit and offset must not be negative.')
+    return limit, offset
+
+
+@api_view(['GET'])
+def transaction_list_view(request):
+    """
+    API endpoint to list all Investec transactions.
+    
+    Supports query parameters:
+    - limit: Number of records to return (default: 100)
+    - offset: Number of records to skip (default: 0)
+    - account_number: Filter by account number
+    - share_name: Filter by share name
+    - share_code: Filter by share code (exact, from the share name mapping)
+    - type: Filter by type (Buy, Sell, Dividend, etc.)
+    - include_ttm_summary: Include TTM summary records (default: True). Set to 'false' to exclude TTM summary records.
+    - ttm: 'stored' returns the dividend_ttm written at import, 'live' computes it from the
+           current transactions (default: settings.INVESTEC_TTM_READ_MODE)
+    """
+    try:
+        ttm_mode = _ttm_read_mode(request.query_params)
+        limit, offset = _transaction_page(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    queryset = _transaction_queryset(request.query_params)
     
     total_count = queryset.count()
-    transactions = queryset[offset:offset + limit]
+    if ttm_mode == 'live':
+        queryset = queryset.annotate(live_dividend_ttm=live_dividend_ttm())
+    transactions = list(queryset[offset:offset + limit])
+    if ttm_mode == 'live':
+        for txn in transactions:
+            txn.dividend_ttm = txn.live_dividend_ttm
     
     serializer = InvestecJseTransactionSerializer(transactions, many=True)
     
@@ -966,6 +186,7 @@ def transaction_list_view(request):
         'count': total_count,
         'limit': limit,
         'offset': offset,
+        'ttm': ttm_mode,
         'results': serializer.data
     })
 
@@ -973,344 +194,6 @@ def transaction_list_view(request):
 # Import Portfolio Data
 # ------------------------------------------------
 
-def process_portfolio_file(uploaded_file):
-    """
-    Helper function to process a single portfolio Excel file.
-    Returns a dict with results or error information.
-    """
-    # Validate file extension
-    if not uploaded_file.name.endswith(('.xlsx', '.xls')):
-        return {
-            'success': False,
-            'filename': uploaded_file.name,
-            'error': 'Invalid file format. Please upload an Excel file (.xlsx or .xls).'
-        }
-    
-    try:
-        # Read Excel file without header to inspect structure
-        df_raw = pd.read_excel(uploaded_file, header=None)
-        
-        # First, find the row containing "Portfolio Holdings Report"
-        report_row = None
-        for idx, row in df_raw.iterrows():
-            row_str = ' '.join([str(val) for val in row.values if pd.notna(val)])
-            if 'portfolio holdings report' in row_str.lower():
-                report_row = idx
-                break
-        
-        if report_row is None:
-            return {
-                'success': False,
-                'filename': uploaded_file.name,
-                'error': 'Could not find "Portfolio Holdings Report" header in Excel file.'
-            }
-        
-        # Extract date from Excel file - look for date patterns in rows around the report header
-        portfolio_date = None
-        
-        # Try to extract date from filename first (format: Holdings-YYYYMMDD...)
-        filename = uploaded_file.name
-        date_match = re.search(r'(\d{8})', filename)
-        if date_match:
-            try:
-                date_str = date_match.group(1)
-                portfolio_date = pd.to_datetime(date_str, format='%Y%m%d').date()
-            except:
-                pass
-        
-        # If not found in filename, look for date in Excel rows around the report header
-        if portfolio_date is None:
-            # Check rows before and after the report header for date patterns
-            search_rows = list(range(max(0, report_row - 5), min(len(df_raw), report_row + 5)))
-            for idx in search_rows:
-                row = df_raw.iloc[idx]
-                for cell_val in row.values:
-                    if pd.notna(cell_val):
-                        cell_str = str(cell_val).strip()
-                        # Try various date formats
-                        for date_format in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y%m%d', '%d %B %Y', '%d %b %Y']:
-                            try:
-                                portfolio_date = pd.to_datetime(cell_str, format=date_format).date()
-                                break
-                            except:
-                                try:
-                                    # Try pandas flexible parsing
-                                    portfolio_date = pd.to_datetime(cell_str).date()
-                                    break
-                                except:
-                                    continue
-                    if portfolio_date:
-                        break
-                if portfolio_date:
-                    break
-        
-        if portfolio_date is None:
-            return {
-                'success': False,
-                'filename': uploaded_file.name,
-                'error': 'Could not extract date from Excel file. Please ensure the file contains a date near the "Portfolio Holdings Report" header or in the filename (format: YYYYMMDD).'
-            }
-        
-        # Find header row starting from the row after "Portfolio Holdings Report"
-        header_row = None
-        for idx in range(report_row + 1, len(df_raw)):
-            row = df_raw.iloc[idx]
-            row_str = ' '.join([str(val).lower() for val in row.values if pd.notna(val)])
-            if 'instrument description' in row_str and 'total quantity' in row_str:
-                header_row = idx
-                break
-        
-        if header_row is None:
-            return {
-                'success': False,
-                'filename': uploaded_file.name,
-                'error': 'Could not find header row (with "Instrument Description" and "Total Quantity") after "Portfolio Holdings Report".'
-            }
-        
-        # Read with header row
-        df = pd.read_excel(uploaded_file, header=header_row)
-        
-        # Map columns by name (from Excel structure)
-        instrument_col = 'Instrument Description'
-        quantity_col = 'Total Quantity'
-        currency_col = 'Currency'
-        unit_cost_col = 'Unit'  # Unit Cost (net)
-        total_cost_col = 'Total Cost'
-        price_col = 'Price'
-        total_value_col = 'Total Value'
-        exchange_rate_col = 'Exchange'  # Exchange Rate
-        move_percent_col = 'Move (%)'
-        portfolio_percent_col = 'Portfolio'  # Portfolio (%)
-        profit_loss_col = 'Profit/Loss'
-        annual_income_col = 'Annual'  # Annual Income (R)
-        
-        # Check if columns exist
-        col_names = list(df.columns)
-        missing_cols = []
-        for col_name, col_var in [
-            (instrument_col, 'Instrument Description'),
-            (quantity_col, 'Total Quantity'),
-            (currency_col, 'Currency'),
-            (unit_cost_col, 'Unit'),
-            (total_cost_col, 'Total Cost'),
-            (price_col, 'Price'),
-            (total_value_col, 'Total Value'),
-        ]:
-            if col_name not in col_names:
-                missing_cols.append(col_var)
-        
-        if missing_cols:
-            return {
-                'success': False,
-                'filename': uploaded_file.name,
-                'error': f'Missing required columns: {", ".join(missing_cols)}',
-                'available_columns': col_names[:30]
-            }
-        
-        # Clear existing portfolio data for this month/year (not just the specific date)
-        deleted_count = InvestecJsePortfolio.objects.filter(
-            year=portfolio_date.year,
-            month=portfolio_date.month
-        ).delete()[0]
-        
-        # Prepare data for bulk creation
-        portfolios_to_create = []
-        errors = []
-        
-        for index, row in df.iterrows():
-            try:
-                # Get instrument description
-                instrument_desc = row[instrument_col]
-                if pd.isna(instrument_desc) or str(instrument_desc).strip() == '':
-                    continue
-                
-                # Extract company and share_code from "ABSA GROUP LIMITED (ABG)"
-                instrument_str = str(instrument_desc).strip()
-                company = ''
-                share_code = ''
-                
-                # Pattern: "COMPANY NAME (CODE)"
-                match = re.match(r'^(.+?)\s*\(([^)]+)\)\s*$', instrument_str)
-                if match:
-                    company = match.group(1).strip()
-                    share_code = match.group(2).strip()
-                else:
-                    # If no parentheses, use full string as company
-                    company = instrument_str
-                    share_code = ''
-                
-                # Get quantity - only process rows with quantity
-                quantity_value = row[quantity_col]
-                if pd.isna(quantity_value):
-                    continue  # Skip rows without quantity (totals/headers)
-                
-                # Convert quantity - handle string values like " 910.00" or "1 959.00"
-                if isinstance(quantity_value, str):
-                    quantity_value = quantity_value.replace(' ', '').replace(',', '').strip()
-                
-                try:
-                    quantity = Decimal(str(quantity_value))
-                    if quantity == 0:
-                        continue  # Skip rows with zero quantity
-                except (InvalidOperation, ValueError):
-                    continue  # Skip invalid quantity rows (totals/headers)
-                
-                # Get other required fields
-                currency = str(row[currency_col])[:10] if not pd.isna(row[currency_col]) else 'ZAR'
-                
-                # Unit cost
-                unit_cost_value = row[unit_cost_col]
-                if pd.isna(unit_cost_value):
-                    errors.append(f'Row {index + header_row + 2}: Unit cost is missing')
-                    continue
-                try:
-                    unit_cost = Decimal(str(unit_cost_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + header_row + 2}: Invalid unit cost: {unit_cost_value}')
-                    continue
-                
-                # Total cost
-                total_cost_value = row[total_cost_col]
-                if pd.isna(total_cost_value):
-                    errors.append(f'Row {index + header_row + 2}: Total cost is missing')
-                    continue
-                try:
-                    total_cost = Decimal(str(total_cost_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + header_row + 2}: Invalid total cost: {total_cost_value}')
-                    continue
-                
-                # Price
-                price_value = row[price_col]
-                if pd.isna(price_value):
-                    errors.append(f'Row {index + header_row + 2}: Price is missing')
-                    continue
-                try:
-                    price = Decimal(str(price_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + header_row + 2}: Invalid price: {price_value}')
-                    continue
-                
-                # Total value
-                total_value_value = row[total_value_col]
-                if pd.isna(total_value_value):
-                    errors.append(f'Row {index + header_row + 2}: Total value is missing')
-                    continue
-                try:
-                    total_value = Decimal(str(total_value_value))
-                except (InvalidOperation, ValueError):
-                    errors.append(f'Row {index + header_row + 2}: Invalid total value: {total_value_value}')
-                    continue
-                
-                # Optional fields
-                exchange_rate = None
-                if exchange_rate_col in col_names and not pd.isna(row[exchange_rate_col]):
-                    try:
-                        exchange_rate = Decimal(str(row[exchange_rate_col]))
-                    except (InvalidOperation, ValueError):
-                        pass
-                
-                move_percent = None
-                if move_percent_col in col_names and not pd.isna(row[move_percent_col]):
-                    try:
-                        move_percent = Decimal(str(row[move_percent_col]))
-                    except (InvalidOperation, ValueError):
-                        pass
-                
-                portfolio_percent = None
-                if portfolio_percent_col in col_names and not pd.isna(row[portfolio_percent_col]):
-                    try:
-                        portfolio_percent = Decimal(str(row[portfolio_percent_col]))
-                    except (InvalidOperation, ValueError):
-                        pass
-                
-                profit_loss = None
-                if profit_loss_col in col_names and not pd.isna(row[profit_loss_col]):
-                    try:
-                        profit_loss = Decimal(str(row[profit_loss_col]))
-                    except (InvalidOperation, ValueError):
-                        pass
-                
-                # Annual Income (R)
-                annual_income_zar = None
-                if annual_income_col in col_names and not pd.isna(row[annual_income_col]):
-                    try:
-                        annual_income_zar = Decimal(str(row[annual_income_col]))
-                    except (InvalidOperation, ValueError):
-                        pass
-                
-                portfolios_to_create.append(
-                    InvestecJsePortfolio(
-                        date=portfolio_date,
-                        year=portfolio_date.year,
-                        month=portfolio_date.month,
-                        day=portfolio_date.day,
-                        company=company[:100],
-                        share_code=share_code[:20],
-                        quantity=quantity,
-                        currency=currency,
-                        unit_cost=unit_cost,
-                        total_cost=total_cost,
-                        price=price,
-                        total_value=total_value,
-                        exchange_rate=exchange_rate,
-                        move_percent=move_percent,
-                        portfolio_percent=portfolio_percent,
-                        profit_loss=profit_loss,
-                        annual_income_zar=annual_income_zar,
-                    )
-                )
-            except Exception as e:
-                errors.append(f'Row {index + header_row + 2}: {str(e)}')
-                continue
-        
-        # Bulk create portfolios
-        created_count = 0
-        if portfolios_to_create:
-            with transaction.atomic():
-                created_instances = InvestecJsePortfolio.objects.bulk_create(
-                    portfolios_to_create,
-                    ignore_conflicts=False
-                )
-                created_count = len(created_instances)
-        
-        # Retrieve and serialize the created data
-        portfolio_data = []
-        if created_count > 0:
-            # Query the created portfolios by date and company/share_code to get full data with IDs
-            portfolios = InvestecJsePortfolio.objects.filter(date=portfolio_date).order_by('company', 'share_code')
-            portfolio_data = InvestecJsePortfolioSerializer(portfolios, many=True).data
-        
-        # Prepare response
-        return {
-            'success': True,
-            'filename': uploaded_file.name,
-            'message': f'Successfully imported {created_count} portfolio holdings',
-            'date': str(portfolio_date),
-            'year': portfolio_date.year,
-            'month': portfolio_date.month,
-            'deleted_previous': deleted_count,
-            'total_rows': len(df),
-            'created': created_count,
-            'errors': len(errors),
-            'data': portfolio_data,
-            'error_details': errors[:50] if errors else []  # Limit to first 50 errors
-        }
-        
-    except pd.errors.EmptyDataError:
-        return {
-            'success': False,
-            'filename': uploaded_file.name,
-            'error': 'The Excel file is empty.'
-        }
-    except Exception as e:
-        return {
-            'success': False,
-            'filename': uploaded_file.name,
-            'error': f'Error processing file: {str(e)}'
-        }
-
-
 @api_view(['POST'])
 @parser_classes([MultiPartParser, FormParser])
 def portfolio_upload_view(request):
@@ -1323,7 +206,9 @@ def portfolio_upload_view(request):
     For each file, all portfolio data for that month/year will be deleted before importing.
     This ensures only one version per month is kept.
     
-    Returns import statistics, imported data, and any errors encountered for each file.
+    Returns import statistics, imported data, peak memory and any errors encountered for each file.
+    With ?timings=true each file result includes a per-stage timing breakdown.
+    Files over the upload memory budget are rejected or queued (see _run_upload).
     """
     # Get files - support both 'file' (single) and 'files' (multiple)
     uploaded_files = []
@@ -1343,6 +228,8 @@ def portfolio_upload_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    from .importers import FILE_PORTFOLIO, process_portfolio_file
+    
     # Process each file
     results = []
     total_created = 0
@@ -1350,7 +237,8 @@ def portfolio_upload_view(request):
     total_errors = 0
     
     for uploaded_file in uploaded_files:
-        result = process_portfolio_file(uploaded_file)
+        result = _run_upload(FILE_PORTFOLIO, process_portfolio_file, uploaded_file, request)
+        result.pop('status_code', None)
         results.append(result)
         
         if result.get('success'):
@@ -1361,12 +249,14 @@ def portfolio_upload_view(request):
     # Prepare aggregated response
     successful_files = [r for r in results if r.get('success')]
     failed_files = [r for r in results if not r.get('success')]
+    queued_files = [r for r in results if r.get('queued')]
     
     response_data = {
         'success': len(failed_files) == 0,
         'total_files': len(uploaded_files),
         'successful_files': len(successful_files),
         'failed_files': len(failed_files),
+        'queued_files': len(queued_files),
         'total_created': total_created,
         'total_deleted': total_deleted,
         'total_errors': total_errors,
@@ -1374,12 +264,64 @@ def portfolio_upload_view(request):
     }
     
     status_code = status.HTTP_201_CREATED if total_created > 0 else status.HTTP_200_OK
+    if queued_files and not total_created:
+        status_code = status.HTTP_202_ACCEPTED
     if failed_files:
         status_code = status.HTTP_207_MULTI_STATUS  # Multi-Status if some files failed
     
     return Response(response_data, status=status_code)
 
 
+# ------------------------------------------------
+# Upload Errors
+# ------------------------------------------------
+
+@api_view(['GET'])
+def upload_errors_view(request, report_id):
+    """
+    API endpoint to read the rows an upload rejected (the 'error_report' id of an
+    import result).
+    
+    Supports query parameters:
+    - limit: Number of errors to return (default: 100)
+    - offset: Number of errors to skip (default: 0)
+    - download: 'true' returns the whole report as a CSV file (file, row, column, reason, value)
+    """
+    from .validation import error_records, error_report_path, load_error_report
+    
+    path = error_report_path(report_id)
+    if path is None:
+        return Response({'error': f'Unknown error report: {report_id}'}, status=status.HTTP_404_NOT_FOUND)
+    
+    if request.query_params.get('download', 'false').lower() == 'true':
+        with open(path, 'rb') as f:
+            response = HttpResponse(f.read(), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="upload-errors-{report_id}.csv"'
+        return response
+    
+    try:
+        limit = int(request.query_params.get('limit', 100))
+        offset = int(request.query_params.get('offset', 0))
+    except ValueError:
+        return Response({'error': 'limit and offset must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if limit < 1 or offset < 0:
+        return Response({'error': 'limit must be at least 1 and offset at least 0'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    report = load_error_report(report_id)
+    if report is None:
+        # Evicted since the path lookup
+        return Response({'error': f'Unknown error report: {report_id}'}, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response({
+        'report': report_id,
+        'file': report['file'].iloc[0] if len(report) else None,
+        'count': len(report),
+        'limit': limit,
+        'offset': offset,
+        'results': error_records(report, offset=offset, limit=limit),
+    })
+
+
 # ------------------------------------------------
 # Share Name Mapping
 # ------------------------------------------------
@@ -1394,7 +336,9 @@ def mapping_upload_view(request):
     Expected columns: Share_Name, Company, Share_Code
     Company and Share_Code are optional.
     
-    Returns import statistics and any errors encountered.
+    Returns import statistics, the peak memory of the import and any errors encountered.
+    With ?timings=true the response includes a per-stage timing breakdown.
+    Files over the upload memory budget are rejected (413) or queued (202) before parsing.
     """
     if 'file' not in request.FILES:
         return Response(
@@ -1402,126 +346,127 @@ def mapping_upload_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    from .importers import FILE_MAPPING, process_mapping_file
+    
     uploaded_file = request.FILES['file']
     
-    # Validate file extension
-    if not uploaded_file.name.endswith(('.xlsx', '.xls')):
-        return Response(
-            {'error': 'Invalid file format. Please upload an Excel file (.xlsx or .xls).'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+    result = _run_upload(FILE_MAPPING, process_mapping_file, uploaded_file, request)
+    status_code = result.pop('status_code', None)
+    if not result['success']:
+        result.pop('success')
+        result.pop('filename')
+        return Response(result, status=status_code)
+    if result.get('queued'):
+        return Response(result, status=status_code)
     
+    return Response(result, status=status.HTTP_201_CREATED if result['created'] > 0 or result['updated'] > 0 else status.HTTP_200_OK)
+
+
+def _suggestion_params(params):
+    """(limit, min_score) of a suggestions request, defaulting to share_matching's. Raises ValueError."""
+    from .share_matching import MIN_SCORE, SUGGESTIONS
+
     try:
-        # Read Excel file
-        df = pd.read_excel(uploaded_file)
-        
-        # Normalize column names
-        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_')
-        
-        # Map column names
-        share_name_col = None
-        company_col = None
-        share_code_col = None
-        
-        for col in df.columns:
-            col_lower = col.lower()
-            if 'share_name' in col_lower or 'sharename' in col_lower:
-                share_name_col = col
-            elif 'company' in col_lower:
-                company_col = col
-            elif 'share_code' in col_lower or 'sharecode' in col_lower or 'code' in col_lower:
-                share_code_col = col
-        
-        if not share_name_col:
-            return Response(
-                {
-                    'error': 'Missing required column: Share_Name',
-                    'available_columns': list(df.columns)
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Prepare data for bulk create/update
-        mappings_to_create = []
-        mappings_to_update = []
-        errors = []
-        
-        for index, row in df.iterrows():
-            try:
-                share_name = str(row[share_name_col]).strip() if not pd.isna(row[share_name_col]) else ''
-                if not share_name:
-                    continue
-                
-                company = str(row[company_col]).strip()[:100] if company_col and not pd.isna(row[company_col]) else ''
-                share_code = str(row[share_code_col]).strip()[:20] if share_code_col and not pd.isna(row[share_code_col]) else ''
-                
-                # Check if mapping exists
-                try:
-                    existing = InvestecJseShareNameMapping.objects.get(share_name=share_name)
-                    # Update existing
-                    if company:
-                        existing.company = company
-                    if share_code:
-                        existing.share_code = share_code
-                    mappings_to_update.append(existing)
-                except InvestecJseShareNameMapping.DoesNotExist:
-                    # Create new
-                    mappings_to_create.append(
-                        InvestecJseShareNameMapping(
-                            share_name=share_name,
-                            company=company if company else None,
-                            share_code=share_code if share_code else None,
-                        )
-                    )
-            except Exception as e:
-                errors.append(f'Row {index + 2}: {str(e)}')
-                continue
-        
-        # Bulk create and update
-        created_count = 0
-        updated_count = 0
-        
-        if mappings_to_create:
-            with transaction.atomic():
-                created_instances = InvestecJseShareNameMapping.objects.bulk_create(
-                    mappings_to_create,
-                    ignore_conflicts=False
-                )
-                created_count = len(created_instances)
-        
-        if mappings_to_update:
-            with transaction.atomic():
-                InvestecJseShareNameMapping.objects.bulk_update(
-                    mappings_to_update,
-                    ['company', 'share_code']
-                )
-                updated_count = len(mappings_to_update)
-        
-        response_data = {
-            'success': True,
-            'message': f'Successfully imported {created_count} new mappings and updated {updated_count} existing mappings',
-            'created': created_count,
-            'updated': updated_count,
-            'errors': len(errors),
-        }
-        
-        if errors:
-            response_data['error_details'] = errors[:50]
-            if len(errors) > 50:
-                response_data['error_details'].append(f'... and {len(errors) - 50} more errors')
-        
-        return Response(response_data, status=status.HTTP_201_CREATED if created_count > 0 or updated_count > 0 else status.HTTP_200_OK)
-        
-    except pd.errors.EmptyDataError:
-        return Response(
-            {'error': 'The Excel file is empty.'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
-    except Exception as e:
-        return Response(
-            {'error': f'Error processing file: {str(e)}'},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        limit = int(params.get('limit', SUGGESTIONS))
+        min_score = float(params.get('min_score', MIN_SCORE))
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer and min_score a number')
+    if limit < 1 or not 0 <= min_score <= 1:
+        raise ValueError('limit must be at least 1 and min_score between 0 and 1')
+    return limit, min_score
+
+
+@api_view(['GET'])
+def mapping_suggestions_view(request):
+    """
+    API endpoint to suggest share name mappings from the portfolio companies.
+
+    Scores every unmapped transaction share name (no mapping, or a mapping without a
+    share code) against the companies and share codes of the stored portfolios in one
+    batch (see share_matching.py).
+
+    Supports query parameters:
+    - share_name: Score these share names instead (repeatable)
+    - limit: Suggestions per share name (default: 3)
+    - min_score: Least score of a suggestion, 0 to 1 (default: 0.5)
+    """
+    from .share_matching import suggest_mappings
+
+    try:
+        limit, min_score = _suggestion_params(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    share_names = request.query_params.getlist('share_name') or None
+    results = suggest_mappings(share_names, limit=limit, min_score=min_score)
+
+    return Response({
+        'count': len(results),
+        'matched': sum(1 for result in results if result['suggestions']),
+        'results': results,
+    })
+
+
+@api_view(['POST'])
+def mapping_suggestions_accept_view(request):
+    """
+    API endpoint to accept share name mapping suggestions in bulk.
+
+    Accepts a JSON body with either:
+    - mappings: list of {share_name, share_code, company (optional)} to store, e.g. the
+      suggestions picked from the suggestions endpoint
+    - min_score: accept the best suggestion of every unmapped share name scoring at
+      least this much
+
+    The mappings are imported like the rows of a mapping file: existing mappings are
+    updated and the share_code of the stored transactions is re-resolved. Returns the
+    import statistics and the accepted mappings.
+    """
+    from .share_matching import suggest_mappings
+
+    data = request.data
+    if 'mappings' in data:
+        mappings = data['mappings']
+        if not isinstance(mappings, list) or not all(isinstance(mapping, dict) for mapping in mappings):
+            return Response({'error': 'mappings must be a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+        rows = []
+        for position, mapping in enumerate(mappings):
+            share_name = str(mapping.get('share_name') or '').strip()
+            share_code = str(mapping.get('share_code') or '').strip()
+            company = str(mapping.get('company') or '').strip()
+            if not share_name or not share_code:
+                return Response({'error': f'mappings[{position}]: share_name and share_code are required'}, status=status.HTTP_400_BAD_REQUEST)
+            if len(share_name) > 100 or len(company) > 100 or len(share_code) > 20:
+                return Response({'error': f'mappings[{position}]: share_name and company are at most 100 characters, share_code 20'}, status=status.HTTP_400_BAD_REQUEST)
+            rows.append((share_name, company, share_code))
+    elif 'min_score' in data:
+        try:
+            _, min_score = _suggestion_params({'min_score': data['min_score']})
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        rows = [
+            (result['share_name'], suggestion['company'][:100], suggestion['share_code'])
+            for result in suggest_mappings(limit=1, min_score=min_score)
+            for suggestion in result['suggestions']
+        ]
+    else:
+        return Response({'error': 'Provide mappings or min_score'}, status=status.HTTP_400_BAD_REQUEST)
+
+    accepted = [{'share_name': share_name, 'company': company, 'share_code': share_code} for share_name, company, share_code in rows]
+    if not rows:
+        return Response({'created': 0, 'updated': 0, 'transactions_resolved': 0, 'accepted': accepted})
+
+    from .importers import FILE_MAPPING, import_mapping_rows
+
+    timer = StageTimer(FILE_MAPPING)
+    result = import_mapping_rows(rows, 'suggestions', timer=timer)
+    timings = timer.log(file='suggestions', success=result['success'])
+    if _wants_timings(request):
+        result['timings'] = timings
+    result.pop('success')
+    result['accepted'] = accepted
+
+    return Response(result, status=status.HTTP_201_CREATED if result['created'] > 0 or result['updated'] > 0 else status.HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -1572,67 +517,435 @@ def export_share_names_view(request):
 @api_view(['GET'])
 def export_transactions_view(request):
     """
-    API endpoint to export all InvestecJseTransaction data to Excel file.
+    API endpoint to export all InvestecJseTransaction data to an Excel (or CSV) file.
+    
+    Serves the latest export artifact (see investec/exports.py): artifacts are written
+    once per data version, in the background after imports, so a request normally
+    returns a file that already exists. A stale artifact (the data changed since) is
+    returned with 'current': false while a refresh runs in the background.
     
-    Exports all transactions to an Excel file in the source files directory.
+    Supports query parameters:
+    - ttm: 'stored' or 'live' Dividend TTM column (default: settings.INVESTEC_TTM_READ_MODE)
+    - file_format: 'xlsx' (default) or 'csv' (oldest first, appended to by imports)
+    - fresh: 'true' writes a current artifact first when the latest one is stale
+    - download: 'true' returns the file itself instead of its description
     """
+    from . import exports
+    
     try:
-        # Get all transactions
-        transactions = InvestecJseTransaction.objects.all().order_by('-date', '-created_at')
-        
-        # Convert to list of dictionaries
-        transactions_data = []
-        for txn in transactions:
-            # Convert timezone-aware datetimes to timezone-naive for Excel compatibility
-            created_at = txn.created_at.replace(tzinfo=None) if txn.created_at else None
-            updated_at = txn.updated_at.replace(tzinfo=None) if txn.updated_at else None
-            
-            transactions_data.append({
-                'Date': txn.date,
-                'Year': txn.year,
-                'Month': txn.month,
-                'Day': txn.day,
-                'Account Number': txn.account_number,
-                'Description': txn.description,
-                'Share Name': txn.share_name,
-                'Type': txn.type,
-                'Quantity': float(txn.quantity) if txn.quantity else None,
-                'Value': float(txn.value) if txn.value else None,
-                'Value Per Share': float(txn.value_per_share) if txn.value_per_share else None,
-                'Value Calculated': float(txn.value_calculated) if txn.value_calculated else None,
-                'Dividend TTM': float(txn.dividend_ttm) if txn.dividend_ttm else None,
-                'Created At': created_at,
-                'Updated At': updated_at,
-            })
-        
-        # Create DataFrame
-        df = pd.DataFrame(transactions_data)
-        
-        # Get the source files directory path
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        source_files_dir = os.path.join(current_dir, 'source files')
-        
-        # Ensure directory exists
-        os.makedirs(source_files_dir, exist_ok=True)
-        
-        # Generate filename with timestamp
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'InvestecJseTransaction_Export_{timestamp}.xlsx'
-        filepath = os.path.join(source_files_dir, filename)
-        
-        # Export to Excel
-        df.to_excel(filepath, index=False, engine='openpyxl')
-        
-        return Response({
-            'success': True,
-            'message': f'Successfully exported {len(transactions_data)} transactions to Excel',
-            'filename': filename,
-            'filepath': filepath,
-            'count': len(transactions_data)
-        })
-        
+        ttm_mode = _ttm_read_mode(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    file_format = request.query_params.get('file_format', exports.DEFAULT_FORMAT).lower()
+    if file_format not in exports.FORMATS:
+        return Response(
+            {'error': f'Invalid file_format: {file_format}. Expected one of: {", ".join(exports.FORMATS)}.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    fresh = request.query_params.get('fresh', 'false').lower() == 'true'
+    download = request.query_params.get('download', 'false').lower() == 'true'
+    
+    try:
+        artifact, current = exports.export_artifact(file_format, ttm_mode, fresh=fresh)
+        if download:
+            try:
+                export_file = open(exports.meta_path(artifact), 'rb')
+            except FileNotFoundError:
+                # A refresh replaced and evicted the artifact after it was looked up:
+                # serve the newer one (written now if it is stale too)
+                artifact, current = exports.export_artifact(file_format, ttm_mode, fresh=True)
+                export_file = open(exports.meta_path(artifact), 'rb')
     except Exception as e:
         return Response(
             {'error': f'Error exporting transactions: {str(e)}'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    
+    if download:
+        response = FileResponse(export_file, as_attachment=True, filename=f'InvestecJseTransaction_Export_{artifact["id"]}.{file_format}')
+        response['X-Export-Current'] = 'true' if current else 'false'
+        return response
+    
+    return Response({
+        'success': True,
+        'message': f'Exported {artifact["count"]} transactions to {file_format.upper()}',
+        'filename': artifact['filename'],
+        'count': artifact['count'],
+        'format': file_format,
+        'ttm': ttm_mode,
+        'generated_at': artifact['generated_at'],
+        'current': current,
+    })
+
+
+# ------------------------------------------------
+# Share Performance
+# ------------------------------------------------
+
+def _parse_date_range(params):
+    """
+    Parse optional from_date / to_date query parameters (YYYY-MM-DD).
+    Returns (from_date, to_date) or raises ValueError with a client-facing message.
+    """
+    parsed = []
+    for param in ['from_date', 'to_date']:
+        value = params.get(param, None)
+        if value:
+            parsed_value = parse_date(value)
+            if parsed_value is None:
+                raise ValueError(f'Invalid {param}: {value}. Expected YYYY-MM-DD.')
+            parsed.append(parsed_value)
+        else:
+            parsed.append(None)
+    return tuple(parsed)
+
+
+def _filter_date_range(queryset, from_date, to_date):
+    if from_date:
+        queryset = queryset.filter(date__gte=from_date)
+    if to_date:
+        queryset = queryset.filter(date__lte=to_date)
+    return queryset
+
+
+PERFORMANCE_DEFAULT_LIMIT = 1000
+PERFORMANCE_MAX_LIMIT = 100000
+
+
+def _encode_cursor(row_date, row_id):
+    """Encode a keyset position (date, id) as an opaque URL-safe cursor."""
+    raw = f'{row_date.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor produced by _encode_cursor. Returns (date, id) or raises ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date_str, id_str = raw.split('|')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    cursor_date = parse_date(date_str)
+    if cursor_date is None:
+        raise ValueError('Invalid cursor.')
+    return cursor_date, int(id_str)
+
+
+def _performance_queryset(params):
+    """
+    Performance records filtered by the performance list query parameters, and the page
+    limit (shared with async_views). Raises ValueError with a client-facing message.
+    """
+    queryset = InvestecJseShareMonthlyPerformance.objects.all()
+    
+    # Apply filters
+    share_name = params.get('share_name', None)
+    if share_name:
+        queryset = queryset.filter(share_name=share_name)
+    
+    dividend_type = params.get('dividend_type', None)
+    if dividend_type:
+        queryset = queryset.filter(dividend_type=dividend_type)
+    
+    investec_account = params.get('investec_account', None)
+    if investec_account:
+        queryset = queryset.filter(investec_account=investec_account)
+    
+    from_date, to_date = _parse_date_range(params)
+    queryset = _filter_date_range(queryset, from_date, to_date)
+    for param in ['year', 'month']:
+        value = params.get(param, None)
+        if value:
+            queryset = queryset.filter(**{param: int(value)})
+    limit = int(params.get('limit', PERFORMANCE_DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be at least 1.')
+    return queryset, min(limit, PERFORMANCE_MAX_LIMIT)
+
+
+def _latest_performance(queryset):
+    """Latest mode: one row per (investec_account, share_name, dividend_type) - the most recent month."""
+    if connection.features.can_distinct_on_fields:
+        # PostgreSQL: SELECT DISTINCT ON (investec_account, share_name, dividend_type) ...
+        # ORDER BY investec_account, share_name, dividend_type, date DESC
+        return queryset.order_by('investec_account', 'share_name', 'dividend_type', '-date').distinct(
+            'investec_account', 'share_name', 'dividend_type'
+        )
+    latest_date = queryset.filter(
+        investec_account=OuterRef('investec_account'),
+        share_name=OuterRef('share_name'),
+        dividend_type=OuterRef('dividend_type'),
+    ).values('investec_account', 'share_name', 'dividend_type').annotate(latest=Max('date')).values('latest')
+    return queryset.filter(date=Subquery(latest_date)).order_by('investec_account', 'share_name', 'dividend_type')
+
+
+def _after_cursor(queryset, cursor):
+    """Keyset pagination: rows strictly after the cursor position in (-date, -id) order."""
+    cursor_date, cursor_id = _decode_cursor(cursor)
+    return queryset.filter(Q(date__lt=cursor_date) | Q(date=cursor_date, id__lt=cursor_id))
+
+
+@api_view(['GET'])
+def share_performance_list_view(request):
+    """
+    API endpoint to query InvestecJseShareMonthlyPerformance records.
+    
+    Supports query parameters:
+    - share_name: Filter by share name (exact match, uses the (share_name, date) index)
+    - dividend_type: Filter by dividend type (Dividend, Special Dividend, Foreign Dividend, Dividend Tax)
+    - investec_account: Filter by account number
+    - from_date / to_date: Month-end date range (YYYY-MM-DD, inclusive)
+    - year / month: Filter by year and/or month (uses the (year, month) index)
+    - latest: Set to 'true' to return only each share's most recent month per account and dividend type
+    - limit: Number of records per page (default: 1000, max: 100000)
+    - cursor: Opaque cursor from a previous response's 'next_cursor'
+    
+    Results are ordered newest first and paginated by cursor (keyset on date, id),
+    so deep pages cost the same as the first one.
+    """
+    try:
+        queryset, limit = _performance_queryset(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if request.query_params.get('latest', 'false').lower() == 'true':
+        results = serialize_values(
+            InvestecJseShareMonthlyPerformance,
+            _latest_performance(queryset).values_list(*PERFORMANCE_FIELDS),
+            PERFORMANCE_FIELDS,
+        )
+        return Response({
+            'count': len(results),
+            'latest': True,
+            'results': results,
+        })
+    
+    cursor = request.query_params.get('cursor', None)
+    if cursor:
+        try:
+            queryset = _after_cursor(queryset, cursor)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Fetch one extra row to know whether another page exists
+    rows = list(queryset.order_by('-date', '-id').values_list(*PERFORMANCE_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    next_cursor = None
+    if has_more and rows:
+        date_idx = PERFORMANCE_FIELDS.index('date')
+        id_idx = PERFORMANCE_FIELDS.index('id')
+        next_cursor = _encode_cursor(rows[-1][date_idx], rows[-1][id_idx])
+    
+    return Response({
+        'limit': limit,
+        'next_cursor': next_cursor,
+        'results': serialize_values(InvestecJseShareMonthlyPerformance, rows, PERFORMANCE_FIELDS),
+    })
+
+
+# ------------------------------------------------
+# Portfolio Holdings
+# ------------------------------------------------
+
+@api_view(['GET'])
+def holdings_snapshot_view(request):
+    """
+    API endpoint to return one portfolio holdings snapshot.
+    
+    Supports query parameters:
+    - date: Snapshot date (YYYY-MM-DD). The latest snapshot on or before this date is returned.
+            Defaults to the most recent snapshot.
+    
+    Returns a columnar payload: {'date', 'count', 'fields', 'data': {field: [values...]}}.
+    """
+    requested = request.query_params.get('date', None)
+    dates = InvestecJsePortfolio.objects.all()
+    if requested:
+        requested_date = parse_date(requested)
+        if requested_date is None:
+            return Response({'error': f'Invalid date: {requested}. Expected YYYY-MM-DD.'}, status=status.HTTP_400_BAD_REQUEST)
+        dates = dates.filter(date__lte=requested_date)
+    snapshot_date = dates.aggregate(latest=Max('date'))['latest']
+    
+    if snapshot_date is None:
+        return Response({'error': 'No portfolio snapshot found.'}, status=status.HTTP_404_NOT_FOUND)
+    
+    rows = InvestecJsePortfolio.objects.filter(date=snapshot_date).order_by('share_code').values_list(*HOLDINGS_SNAPSHOT_FIELDS)
+    data = serialize_columns(InvestecJsePortfolio, rows, HOLDINGS_SNAPSHOT_FIELDS)
+    
+    return Response({
+        'date': str(snapshot_date),
+        'count': len(data['share_code']),
+        'fields': HOLDINGS_SNAPSHOT_FIELDS,
+        'data': data,
+    })
+
+
+def _holdings_series_rows(params, from_date, to_date):
+    """(share_code, *HOLDINGS_SERIES_FIELDS) rows in (share_code, date) order (shared with async_views)."""
+    queryset = _filter_date_range(InvestecJsePortfolio.objects.all(), from_date, to_date)
+    
+    share_codes = params.get('share_code', None)
+    if share_codes:
+        queryset = queryset.filter(share_code__in=[code.strip() for code in share_codes.split(',') if code.strip()])
+    
+    return queryset.order_by('share_code', 'date').values_list('share_code', *HOLDINGS_SERIES_FIELDS)
+
+
+def _series_by_share(rows):
+    series = {}
+    for share_code, share_rows in groupby(rows, key=lambda row: row[0]):
+        series[share_code] = serialize_columns(
+            InvestecJsePortfolio,
+            [row[1:] for row in share_rows],
+            HOLDINGS_SERIES_FIELDS,
+        )
+    return series
+
+
+@api_view(['GET'])
+def holdings_series_view(request):
+    """
+    API endpoint to return per-share holdings time series.
+    
+    Supports query parameters:
+    - share_code: One or more share codes, comma-separated (default: all shares)
+    - from_date / to_date: Snapshot date range (YYYY-MM-DD, inclusive)
+    
+    Reads only (share_code, date, quantity, price, total_value), which the covering
+    (share_code, date) INCLUDE (quantity, price, total_value) index answers on its own.
+    Returns {'fields', 'series': {share_code: {field: [values...]}}}.
+    """
+    try:
+        from_date, to_date = _parse_date_range(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    rows = _holdings_series_rows(request.query_params, from_date, to_date)
+    series = _series_by_share(rows)
+    
+    return Response({
+        'from_date': str(from_date) if from_date else None,
+        'to_date': str(to_date) if to_date else None,
+        'count': len(series),
+        'fields': HOLDINGS_SERIES_FIELDS,
+        'series': series,
+    })
+
+
+HOLDINGS_TOTALS_FIELDS = ['date', 'holdings', 'total_cost', 'total_value', 'profit_loss', 'annual_income_zar']
+
+
+def _holdings_totals_rows(from_date, to_date):
+    """HOLDINGS_TOTALS_FIELDS rows per snapshot date (shared with async_views)."""
+    queryset = _filter_date_range(InvestecJsePortfolio.objects.all(), from_date, to_date)
+    totals = queryset.values('date').annotate(
+        holdings=Count('*'),
+        total_cost=Sum('total_cost'),
+        total_value=Sum('total_value'),
+        profit_loss=Sum('profit_loss'),
+        annual_income_zar=Sum('annual_income_zar'),
+    ).order_by('date')
+    return totals.values_list(*HOLDINGS_TOTALS_FIELDS)
+
+
+@api_view(['GET'])
+def holdings_totals_view(request):
+    """
+    API endpoint to return portfolio totals per snapshot date.
+    
+    Supports query parameters:
+    - from_date / to_date: Snapshot date range (YYYY-MM-DD, inclusive)
+    
+    Totals are computed in the database (GROUP BY date) from the covering
+    (date) INCLUDE (total_cost, total_value, profit_loss, annual_income_zar) index.
+    Returns a columnar payload: {'count', 'fields', 'data': {field: [values...]}}.
+    """
+    try:
+        from_date, to_date = _parse_date_range(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    data = serialize_columns(InvestecJsePortfolio, _holdings_totals_rows(from_date, to_date), HOLDINGS_TOTALS_FIELDS)
+    
+    return Response({
+        'count': len(data['date']),
+        'fields': HOLDINGS_TOTALS_FIELDS,
+        'data': data,
+    })
+
+
+# ------------------------------------------------
+# Position Ledger
+# ------------------------------------------------
+
+@api_view(['GET'])
+def positions_view(request):
+    """
+    API endpoint to return holdings reconstructed from Buy/Sell transactions.
+    
+    Supports query parameters:
+    - date: Point-in-time date (YYYY-MM-DD, inclusive). Defaults to today.
+    - account_number: Filter by account number
+    
+    Holdings are read from the nearest month-end position checkpoint plus the
+    transactions since, so any date can be queried - not only portfolio upload dates.
+    """
+    requested = request.query_params.get('date', None)
+    if requested:
+        as_of_date = parse_date(requested)
+        if as_of_date is None:
+            return Response({'error': f'Invalid date: {requested}. Expected YYYY-MM-DD.'}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        as_of_date = datetime.now().date()
+    
+    account_number = request.query_params.get('account_number', None)
+    positions = holdings_as_of(as_of_date, account_number=account_number)
+    
+    return Response({
+        'date': str(as_of_date),
+        'count': len(positions),
+        'results': [
+            {
+                'account_number': position['account_number'],
+                'share_name': position['share_name'],
+                'quantity': format(position['quantity'], 'f'),
+            }
+            for position in positions
+        ],
+    })
+
+
+# ------------------------------------------------
+# Metrics
+# ------------------------------------------------
+
+def _metrics_allowed(request):
+    """True for a client address in settings.INVESTEC_METRICS_ALLOWED_IPS or a request with the scrape token."""
+    token = settings.INVESTEC_METRICS_TOKEN
+    if token:
+        scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(supplied.strip().encode(), token.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.INVESTEC_METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of the service metrics (see investec/metrics.py).
+    
+    Only served to the addresses in INVESTEC_METRICS_ALLOWED_IPS, or to scrapers sending
+    Authorization: Bearer <INVESTEC_METRICS_TOKEN>; everyone else gets a 403.
+    Under gunicorn the samples of all live workers are aggregated through
+    PROMETHEUS_MULTIPROC_DIR, so any worker can answer the scrape.
+    """
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)